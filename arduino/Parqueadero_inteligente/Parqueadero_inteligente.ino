@@ -43,6 +43,12 @@ bool lastSensorState1 = false;
 bool lastSensorState2 = false;
 bool lastSensorState3 = false;
 
+// 🆕 CANAL DE COMANDOS (LONG-POLL EN EL SEGUNDO NÚCLEO)
+const char* PUERTA = "entrada";
+const unsigned long esperaComandos_s = 25;
+volatile bool aperturaPendiente = false;
+unsigned long ultimoComando = 0;   // Última secuencia ejecutada
+
 // ---------- FUNCIONES DE BARRERA ----------
 void abrirBarrera() {
   Serial.println("🔓 Abriendo barrera...");
@@ -68,32 +74,98 @@ void abrirBarreraTemporizada(int msDelay) {
   Serial.println("✅ Barrera cerrada");
 }
 
-// ---------- UTILIDADES HTTP ----------
-bool httpPostJson(String endpoint, String jsonPayload, String &responseOut) {
+// 🆕 CONEXIÓN PERSISTENTE CON EL SERVIDOR (PROTOCOLO COMPACTO v2)
+// Un solo HTTPClient con keep-alive para loop(): las lecturas de tarjetas y
+// sensores reutilizan la misma conexión TCP en vez de abrir una por evento.
+// El servidor responde texto corto: una letra y a lo sumo un dato ("A 12", "F 5000").
+WiFiClient clienteBarrera;
+HTTPClient httpBarrera;
+String urlBarrera;
+const uint16_t conexion_ms = 1000;
+// Más que PLAZO_ESCRITURA del servidor (2 s): si el escritor tarda en dar turno la
+// respuesta llega igual, en vez de vencer aquí una lectura que el servidor sí guardó
+const uint16_t respuesta_ms = 3000;
+
+// Solo se reintenta si la petición no llegó al servidor (no conectó o no se pudo
+// enviar). Un timeout de lectura o una conexión perdida después de enviar puede
+// haber sido procesado: repetir el toque tomaría otro espacio o cobraría dos veces.
+bool peticionNoEnviada(int code) {
+  return code == HTTPC_ERROR_CONNECTION_REFUSED ||
+         code == HTTPC_ERROR_SEND_HEADER_FAILED ||
+         code == HTTPC_ERROR_SEND_PAYLOAD_FAILED ||
+         code == HTTPC_ERROR_NOT_CONNECTED;
+}
+
+bool httpPostCompacto(const char* cuerpo, String &respuestaOut) {
   if (WiFi.status() != WL_CONNECTED) {
     Serial.println("❌ WiFi no conectado");
     return false;
   }
-  
+
+  // Un reintento: si el servidor cerró la conexión inactiva, el primer POST no se envía y el segundo reconecta
+  for (int intento = 0; intento < 2; intento++) {
+    httpBarrera.begin(clienteBarrera, urlBarrera);
+    httpBarrera.addHeader("Content-Type", "application/json");
+    int code = httpBarrera.POST((uint8_t*)cuerpo, strlen(cuerpo));
+    if (code > 0) {
+      respuestaOut = httpBarrera.getString();
+      httpBarrera.end();   // Con setReuse(true) la conexión queda abierta
+      respuestaOut.trim();
+      return true;
+    }
+    httpBarrera.end();
+    clienteBarrera.stop();
+    Serial.println("❌ HTTP POST error: " + String(code));
+    if (!peticionNoEnviada(code)) break;
+  }
+  return false;
+}
+
+// 🆕 TAREA QUE ESPERA COMANDOS DEL SERVIDOR SIN BLOQUEAR loop()
+// Mantiene una petición abierta a /api/barrera/<puerta>/comandos; el servidor
+// responde en cuanto una recarga o registro ordena abrir la barrera.
+void tareaComandos(void *parametro) {
   HTTPClient http;
-  String url = serverURL + endpoint;
-  http.begin(url);
-  http.addHeader("Content-Type", "application/json");
-  http.setTimeout(5000);
-  
-  Serial.println("📤 Enviando POST a: " + url);
-  Serial.println("📦 Payload: " + jsonPayload);
-  
-  int code = http.POST(jsonPayload);
-  if (code > 0) {
-    responseOut = http.getString();
-    Serial.println("✅ HTTP POST exitoso - Código: " + String(code));
+  http.setReuse(true);
+  http.setTimeout((esperaComandos_s + 5) * 1000);
+
+  for (;;) {
+    if (WiFi.status() != WL_CONNECTED) {
+      vTaskDelay(pdMS_TO_TICKS(1000));
+      continue;
+    }
+
+    String url = serverURL + "/api/barrera/" + PUERTA + "/comandos?desde=" +
+                 String(ultimoComando) + "&espera=" + String(esperaComandos_s);
+    http.begin(url);
+    int code = http.GET();
+    if (code != 200) {
+      http.end();
+      vTaskDelay(pdMS_TO_TICKS(2000));
+      continue;
+    }
+    String respuesta = http.getString();
     http.end();
-    return true;
-  } else {
-    Serial.println("❌ HTTP POST error: " + String(code));
+
+    // Secuencia del último comando entregado
+    unsigned long ultimo = ultimoComando;
+    int idx = respuesta.indexOf("\"ultimo\"");
+    if (idx >= 0) {
+      ultimo = respuesta.substring(respuesta.indexOf(":", idx) + 1).toInt();
+    }
+    if (ultimo <= ultimoComando) continue;
+
+    if (respuesta.indexOf("ABRIR_BARRERA") >= 0) {
+      Serial.println("📩 Comando ABRIR_BARRERA recibido (seq " + String(ultimo) + ")");
+      aperturaPendiente = true;
+    }
+
+    // Confirmar al servidor
+    http.begin(serverURL + "/api/barrera/" + PUERTA + "/ack");
+    http.addHeader("Content-Type", "application/json");
+    http.POST("{\"seq\":" + String(ultimo) + "}");
     http.end();
-    return false;
+    ultimoComando = ultimo;
   }
 }
 
@@ -108,224 +180,96 @@ String leerUID(MFRC522 &mfrc522) {
   return uid;
 }
 
-// 🆕 FUNCIÓN PARA LEER SENSORES (SILENCIOSA)
+// 🆕 FUNCIÓN PARA LEER SENSORES (SILENCIOSA): UN ENTERO CON UN BIT POR SENSOR
 void leerSensores() {
   bool sensor1 = digitalRead(SENSOR_1) == LOW;
   bool sensor2 = digitalRead(SENSOR_2) == LOW;
   bool sensor3 = digitalRead(SENSOR_3) == LOW;
   
   if (sensor1 != lastSensorState1 || sensor2 != lastSensorState2 || sensor3 != lastSensorState3) {
-    String jsonSensores = "{";
-    jsonSensores += "\"sensor_1\":" + String(sensor1 ? "true" : "false");
-    jsonSensores += ",\"sensor_2\":" + String(sensor2 ? "true" : "false");
-    jsonSensores += ",\"sensor_3\":" + String(sensor3 ? "true" : "false");
-    jsonSensores += "}";
+    int bits = (sensor1 ? 1 : 0) | (sensor2 ? 2 : 0) | (sensor3 ? 4 : 0);
+    char cuerpo[24];
+    snprintf(cuerpo, sizeof(cuerpo), "{\"t\":\"P\",\"m\":%d,\"n\":3}", bits);
     
     String respuesta;
-    httpPostJson("/api/sensores/actualizar", jsonSensores, respuesta);
-    
-    lastSensorState1 = sensor1;
-    lastSensorState2 = sensor2;
-    lastSensorState3 = sensor3;
+    if (httpPostCompacto(cuerpo, respuesta) && respuesta == "K") {
+      lastSensorState1 = sensor1;
+      lastSensorState2 = sensor2;
+      lastSensorState3 = sensor3;
+    }
   }
 }
 
+// 🆕 DATO QUE ACOMPAÑA A LA LETRA DE LA RESPUESTA ("A 12" -> "12")
+String datoRespuesta(const String &respuesta) {
+  return respuesta.length() > 2 ? respuesta.substring(2) : "";
+}
+
 // 🆕 FUNCIÓN CORREGIDA PARA ENTRADA - SOLO ABRE BARRERA CUANDO HAY ESPACIO
 void procesarEntrada(String tarjeta_rfid) {
-  Serial.println("🎫 PROCESANDO ENTRADA - Tarjeta: " + tarjeta_rfid);
+  char cuerpo[48];
+  snprintf(cuerpo, sizeof(cuerpo), "{\"t\":\"E\",\"c\":\"%s\"}", tarjeta_rfid.c_str());
   
   String respuesta;
-  String json = "{\"tarjeta_rfid\":\"" + tarjeta_rfid + "\"}";
+  if (!httpPostCompacto(cuerpo, respuesta)) {
+    Serial.println("❌ 🌐 Error de comunicación con el servidor");
+    Serial.println("🚫 Barrera NO se abre por seguridad");
+    return;
+  }
   
-  if (httpPostJson("/api/entrada/detectar", json, respuesta)) {
-    respuesta.trim();
-    
-    Serial.println("=== PROCESANDO ENTRADA ===");
-    
-    // 🆕 VERIFICAR SI SE PERMITE LA ENTRADA ANTES DE ABRIR BARRERA
-    bool entrada_permitida = respuesta.indexOf("ENTRADA_PERMITIDA") >= 0;
-    bool usuario_nuevo = respuesta.indexOf("USUARIO_NUEVO") >= 0;
-    bool no_espacios = respuesta.indexOf("NO_HAY_ESPACIOS") >= 0;
-    bool saldo_insuficiente = respuesta.indexOf("SALDO_INSUFICIENTE") >= 0;
-    bool entrada_duplicada = respuesta.indexOf("ENTRADA_DUPLICADA") >= 0;
-    
-    String accion = "";
-    int idx_accion = respuesta.indexOf("\"accion\"");
-    if (idx_accion >= 0) {
-      int start = respuesta.indexOf(":", idx_accion) + 1;
-      int end = respuesta.indexOf(",", start);
-      if (end == -1) end = respuesta.indexOf("}", start);
-      if (end > start) {
-        accion = respuesta.substring(start, end);
-        accion.replace("\"", "");
-        accion.trim();
-      }
-    }
-    
-    Serial.println("Accion detectada: '" + accion + "'");
-    Serial.println("======================");
-    
-    // 🎯 SOLO ABRIR BARRERA EN CASOS ESPECÍFICOS
-    if (entrada_permitida || accion == "ENTRADA_PERMITIDA") {
-      Serial.println("✅ ENTRADA PERMITIDA - Abriendo barrera");
-      
-      String espacio = "";
-      int idx_espacio = respuesta.indexOf("\"espacio\"");
-      if (idx_espacio >= 0) {
-        int start = respuesta.indexOf(":", idx_espacio) + 1;
-        int end = respuesta.indexOf(",", start);
-        if (end == -1) end = respuesta.indexOf("}", start);
-        if (end > start) {
-          espacio = respuesta.substring(start, end);
-          espacio.replace("\"", "");
-          espacio.trim();
-          Serial.println("📍 Espacio asignado: " + espacio);
-        }
-      }
-      
+  // 🎯 SOLO ABRIR BARRERA EN CASOS ESPECÍFICOS
+  switch (respuesta.length() ? respuesta[0] : '?') {
+    case 'A':
+      Serial.println("✅ ENTRADA PERMITIDA - Espacio " + datoRespuesta(respuesta));
       abrirBarreraTemporizada(5000);
-    }
-    else if (usuario_nuevo || accion == "USUARIO_NUEVO") {
+      break;
+    case 'R':
       Serial.println("👤 USUARIO NUEVO - Abriendo barrera para registro");
-      
-      String url_registro = "";
-      int idx_url = respuesta.indexOf("url_registro");
-      if (idx_url >= 0) {
-        int start = respuesta.indexOf(":", idx_url) + 1;
-        int end = respuesta.indexOf(",", start);
-        if (end == -1) end = respuesta.indexOf("}", start);
-        if (end > start) {
-          url_registro = respuesta.substring(start, end);
-          url_registro.replace("\"", "");
-          url_registro.trim();
-          Serial.println("📱 URL Registro: " + url_registro);
-        }
-      }
-      
       abrirBarreraTemporizada(5000);
-    }
-    else if (no_espacios || accion == "NO_HAY_ESPACIOS") {
-      Serial.println("🅿️ ❌ NO HAY ESPACIOS DISPONIBLES");
-      Serial.println("🚫 Barrera NO se abre - Espere a que se libere un espacio");
-      // 🆕 NO ABRIR BARRERA
-    }
-    else if (saldo_insuficiente || accion == "SALDO_INSUFICIENTE") {
-      Serial.println("💰 ❌ SALDO INSUFICIENTE");
-      Serial.println("🚫 Barrera NO se abre - Recargue su saldo");
-      // 🆕 NO ABRIR BARRERA
-      
-      String url_recarga = "";
-      int idx_url = respuesta.indexOf("url_recarga");
-      if (idx_url >= 0) {
-        int start = respuesta.indexOf(":", idx_url) + 1;
-        int end = respuesta.indexOf(",", start);
-        if (end == -1) end = respuesta.indexOf("}", start);
-        if (end > start) {
-          url_recarga = respuesta.substring(start, end);
-          url_recarga.replace("\"", "");
-          url_recarga.trim();
-          Serial.println("📱 URL Recarga: " + url_recarga);
-        }
-      }
-    }
-    else if (entrada_duplicada || accion == "ENTRADA_DUPLICADA") {
-      Serial.println("⚠️ 🚫 YA TIENE ENTRADA ACTIVA");
-      Serial.println("🚫 Barrera NO se abre - Ya está dentro del parqueadero");
-      // 🆕 NO ABRIR BARRERA
-    }
-    else {
-      Serial.println("❌ 🤔 Respuesta no reconocida del servidor");
-      Serial.println("🚫 Barrera NO se abre por seguridad");
-      // 🆕 NO ABRIR BARRERA
-    }
-    
-  } else {
-    Serial.println("❌ 🌐 Error de comunicación con el servidor");
-    Serial.println("🚫 Barrera NO se abre por seguridad");
+      break;
+    case 'L':
+      Serial.println("🅿️ ❌ NO HAY ESPACIOS DISPONIBLES - Barrera NO se abre");
+      break;
+    case 'F':
+      Serial.println("💰 ❌ SALDO INSUFICIENTE (mínimo $" + datoRespuesta(respuesta) + ") - Barrera NO se abre");
+      break;
+    case 'D':
+      Serial.println("⚠️ 🚫 YA TIENE ENTRADA ACTIVA - Barrera NO se abre");
+      break;
+    case 'O':
+      Serial.println("⏳ Servidor ocupado - Pase la tarjeta de nuevo");
+      lastUIDEntrada = "";
+      break;
+    default:
+      Serial.println("❌ 🤔 Respuesta '" + respuesta + "' - Barrera NO se abre por seguridad");
   }
 }
 
 // 🆕 FUNCIÓN MEJORADA PARA SALIDA
 void procesarSalida(String tarjeta_rfid) {
-  Serial.println("🎫 PROCESANDO SALIDA - Tarjeta: " + tarjeta_rfid);
+  char cuerpo[48];
+  snprintf(cuerpo, sizeof(cuerpo), "{\"t\":\"S\",\"c\":\"%s\"}", tarjeta_rfid.c_str());
   
   String respuesta;
-  String json = "{\"tarjeta_rfid\":\"" + tarjeta_rfid + "\"}";
+  if (!httpPostCompacto(cuerpo, respuesta)) {
+    Serial.println("❌ Error de comunicación con el servidor");
+    return;
+  }
   
-  if (httpPostJson("/api/salida/detectar", json, respuesta)) {
-    if (respuesta.indexOf("SALIDA_PERMITIDA") >= 0 || respuesta.indexOf("ABRIR_BARRERA") >= 0) {
-      Serial.println("✅ SALIDA PERMITIDA - Abriendo barrera");
-      
-      // Extraer monto cobrado
-      String monto_cobrado = "";
-      int idx_monto = respuesta.indexOf("\"monto_cobrado\"");
-      if (idx_monto >= 0) {
-        int start = respuesta.indexOf(":", idx_monto) + 1;
-        int end = respuesta.indexOf(",", start);
-        if (end == -1) end = respuesta.indexOf("}", start);
-        if (end > start) {
-          monto_cobrado = respuesta.substring(start, end);
-          monto_cobrado.replace("\"", "");
-          monto_cobrado.trim();
-          Serial.println("💰 Monto cobrado: $" + monto_cobrado);
-        }
-      }
-      
-      // Extraer nuevo saldo
-      String nuevo_saldo = "";
-      int idx_saldo = respuesta.indexOf("\"nuevo_saldo\"");
-      if (idx_saldo >= 0) {
-        int start = respuesta.indexOf(":", idx_saldo) + 1;
-        int end = respuesta.indexOf(",", start);
-        if (end == -1) end = respuesta.indexOf("}", start);
-        if (end > start) {
-          nuevo_saldo = respuesta.substring(start, end);
-          nuevo_saldo.replace("\"", "");
-          nuevo_saldo.trim();
-          Serial.println("💳 Nuevo saldo: $" + nuevo_saldo);
-        }
-      }
-
-      // Extraer factura URL
-      String factura_url = "";
-      int idx_factura = respuesta.indexOf("\"factura_url\"");
-      if (idx_factura >= 0) {
-        int start = respuesta.indexOf(":", idx_factura) + 1;
-        int end = respuesta.indexOf(",", start);
-        if (end == -1) end = respuesta.indexOf("}", start);
-        if (end > start) {
-          factura_url = respuesta.substring(start, end);
-          factura_url.replace("\"", "");
-          factura_url.trim();
-          Serial.println("🧾 Factura: " + factura_url);
-        }
-      }
-      
+  switch (respuesta.length() ? respuesta[0] : '?') {
+    case 'A':
+      Serial.println("✅ SALIDA PERMITIDA - Cobrado $" + datoRespuesta(respuesta));
       abrirBarreraTemporizada(5000);
-    }
-    else if (respuesta.indexOf("SALDO_INSUFICIENTE_SALIDA") >= 0) {
-      Serial.println("❌ SALDO INSUFICIENTE PARA SALIR");
-      
-      // Extraer información adicional
-      String monto_requerido = "";
-      int idx_monto_req = respuesta.indexOf("\"monto_requerido\"");
-      if (idx_monto_req >= 0) {
-        int start = respuesta.indexOf(":", idx_monto_req) + 1;
-        int end = respuesta.indexOf(",", start);
-        if (end == -1) end = respuesta.indexOf("}", start);
-        if (end > start) {
-          monto_requerido = respuesta.substring(start, end);
-          monto_requerido.replace("\"", "");
-          monto_requerido.trim();
-          Serial.println("💰 Monto requerido: $" + monto_requerido);
-        }
-      }
-    }
-    else {
-      Serial.println("❌ No se pudo procesar la salida");
-    }
-  } else {
-    Serial.println("❌ Error de comunicación con el servidor");
+      break;
+    case 'F':
+      Serial.println("❌ SALDO INSUFICIENTE PARA SALIR - Requiere $" + datoRespuesta(respuesta));
+      break;
+    case 'O':
+      Serial.println("⏳ Servidor ocupado - Pase la tarjeta de nuevo");
+      lastUIDSalida = "";
+      break;
+    default:
+      Serial.println("❌ No se pudo procesar la salida ('" + respuesta + "')");
   }
 }
 
@@ -334,7 +278,7 @@ void setup() {
   Serial.begin(115200);
   delay(1000);
   Serial.println("\n🚗 ESP32 - Sistema de Parqueadero Inteligente");
-  Serial.println("📍 Versión 7.0 - Control de espacios mejorado");
+  Serial.println("📍 Versión 8.0 - Protocolo compacto v2 con keep-alive");
 
   pinMode(SENSOR_1, INPUT_PULLUP);
   pinMode(SENSOR_2, INPUT_PULLUP);
@@ -361,6 +305,15 @@ void setup() {
     Serial.println("\n❌ WiFi NO conectado");
   }
   
+  // 🆕 Conexión keep-alive para tarjetas y sensores
+  urlBarrera = serverURL + "/api/v2/barrera";
+  httpBarrera.setReuse(true);
+  httpBarrera.setConnectTimeout(conexion_ms);
+  httpBarrera.setTimeout(respuesta_ms);
+
+  // 🆕 Canal de comandos en el núcleo 0 (loop() corre en el núcleo 1)
+  xTaskCreatePinnedToCore(tareaComandos, "comandos", 8192, NULL, 1, NULL, 0);
+
   Serial.println("\n✅ Sistema listo - Esperando tarjetas RFID...");
   Serial.println("🎫 Entrada: RFID superior");
   Serial.println("🎫 Salida: RFID inferior");
@@ -395,6 +348,13 @@ void loop() {
     rfid_salida.PCD_StopCrypto1();
   }
 
+  // 🆕 APERTURA ORDENADA POR EL SERVIDOR (RECARGA O REGISTRO CONFIRMADO)
+  if (aperturaPendiente) {
+    aperturaPendiente = false;
+    Serial.println("🚦 Apertura automática ordenada por el servidor");
+    abrirBarreraTemporizada(5000);
+  }
+
   // LEER SENSORES CADA 2 SEGUNDOS (SILENCIOSO)
   if (millis() - lastSensorUpdate > sensorInterval) {
     lastSensorUpdate = millis();
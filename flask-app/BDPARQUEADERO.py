@@ -1,18 +1,48 @@
 import os  
-from flask import Flask, jsonify, request, send_file, render_template_string
+from flask import Flask, jsonify, request, send_file, render_template_string, Response
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import text
-from datetime import datetime
+from sqlalchemy import text, event, bindparam
+from sqlalchemy.orm import Session
+from sqlalchemy.engine import Engine
+from datetime import datetime, timedelta
+import atexit
+import bisect
+import gzip
 import hashlib
+import heapq
+import itertools
+import json
+import logging
+import logging.handlers
+import math
+import queue
+import re
+import secrets
+import sys
+import threading
+import time
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
 import qrcode
+try:
+    import brotli  # Opcional: si no está instalado solo se sirve gzip
+except ImportError:
+    brotli = None
+try:
+    import numpy as np  # Opcional: solo lo usa la simulación de tarifas
+except ImportError:
+    np = None
 from io import BytesIO
 import socket
+import sqlite3
 from flask import Flask, jsonify, request, send_file, render_template_string, redirect
 app = Flask(__name__)
 
 # ✅ CONFIGURACIÓN SQLite
 basedir = os.path.abspath(os.path.dirname(__file__))
-db_path = os.path.join(basedir, 'parqueadero.db')
+db_path = os.environ.get("PARQUEADERO_DB") or os.path.join(basedir, 'parqueadero.db')  # 🆕 Otra base (pruebas de carga)
 
 if os.path.exists(db_path):
     try:
@@ -25,6 +55,341 @@ else:
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# 🆕 SERVIDOR DE PRODUCCIÓN: UN PROCESO CON VARIOS HILOS
+# Los índices en memoria (tarjetas, espacios, tokens, eventos) son del proceso,
+# así que se escala con hilos, no con procesos. Cada hilo toma su conexión del pool.
+HILOS_SERVIDOR = int(os.environ.get("PARQUEADERO_HILOS", 16))
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    "pool_size": HILOS_SERVIDOR,
+    "max_overflow": 4,            # Hilos de fondo: barredor, QR, cierre de días
+    "pool_timeout": 10,
+    "connect_args": {"timeout": 5, "check_same_thread": False}
+}
+
+# 🆕 PRESUPUESTO DE HILOS PARA CONEXIONES LARGAS
+# Un long-poll de barrera ocupa un hilo hasta ESPERA_MAXIMA_COMANDOS segundos y un
+# dashboard SSE lo ocupa hasta EDAD_MAXIMA_STREAM, y ambos comparten el pool con los
+# toques de tarjeta. Cada uno tiene un cupo fijo de hilos (por defecto un cuarto);
+# pasado el cupo se responde 503 con Retry-After en vez de dejar a las barreras sin hilos.
+MAXIMO_ESPERAS_COMANDOS = int(os.environ.get("PARQUEADERO_MAX_ESPERAS", max(HILOS_SERVIDOR // 4, 1)))
+MAXIMO_DASHBOARDS = int(os.environ.get("PARQUEADERO_MAX_DASHBOARDS", max(HILOS_SERVIDOR // 4, 1)))
+if HILOS_SERVIDOR - MAXIMO_ESPERAS_COMANDOS - MAXIMO_DASHBOARDS < HILOS_SERVIDOR // 2:
+    raise RuntimeError(
+        f"PARQUEADERO_MAX_ESPERAS ({MAXIMO_ESPERAS_COMANDOS}) + PARQUEADERO_MAX_DASHBOARDS ({MAXIMO_DASHBOARDS}) "
+        f"dejan menos de la mitad de PARQUEADERO_HILOS ({HILOS_SERVIDOR}) para los toques de tarjeta")
+
+# 🆕 PRAGMAS DE SQLite PARA CADA CONEXIÓN NUEVA
+# WAL deja leer mientras un hilo escribe; NORMAL solo sincroniza al hacer checkpoint
+# (en WAL no se pierde integridad, como mucho la última transacción si se va la luz).
+PRAGMAS_SQLITE = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 10000,        # ms esperando el bloqueo de escritura antes de "database is locked"
+    "cache_size": -20000,         # Negativo = KiB: 20 MB de caché de páginas por conexión
+    "temp_store": "MEMORY"
+}
+
+@event.listens_for(Engine, "connect")
+def configurar_sqlite(conexion_dbapi, registro_conexion):
+    if not isinstance(conexion_dbapi, sqlite3.Connection):
+        return
+    cursor = conexion_dbapi.cursor()
+    for pragma, valor in PRAGMAS_SQLITE.items():
+        cursor.execute(f"PRAGMA {pragma} = {valor}")
+    cursor.close()
+
+# 🆕 BITÁCORA ESTRUCTURADA: UNA LÍNEA JSON POR EVENTO, ESCRITA DESDE OTRO HILO
+# Las rutas de barreras, sensores y registro no escriben en stdout: dejan el
+# registro en una cola acotada (si está llena se descarta y se cuenta) y un
+# QueueListener lo formatea y lo escribe. Un nivel apagado cuesta una consulta a
+# la caché de niveles del logger. Las categorías muy frecuentes se muestrean
+# (1 de cada N eventos INFO/DEBUG; advertencias y errores siempre pasan).
+# Sin datos personales: se registran ids, nunca nombres, cédulas ni formularios.
+#   PARQUEADERO_LOG_NIVEL=DEBUG   PARQUEADERO_LOG_MUESTREO="sensores=100,barrera=1"
+NIVEL_BITACORA = os.environ.get("PARQUEADERO_LOG_NIVEL", "INFO").upper()
+MUESTREO_BITACORA = {"sensores": 20}
+CAPACIDAD_COLA_BITACORA = 10000
+
+def leer_muestreo_bitacora(valor):
+    """{categoría: N} a partir de "categoria=N,otra=M" sobre los valores por defecto"""
+    muestreo = dict(MUESTREO_BITACORA)
+    for parte in filter(None, (valor or "").split(",")):
+        categoria, _, cada = parte.partition("=")
+        muestreo[categoria.strip()] = max(1, int(cada))
+    return muestreo
+
+muestreo_bitacora = leer_muestreo_bitacora(os.environ.get("PARQUEADERO_LOG_MUESTREO"))
+
+class FormatoJSON(logging.Formatter):
+    def format(self, registro):
+        datos = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(registro.created)) + f".{int(registro.msecs):03d}Z",
+            "nivel": registro.levelname,
+            "categoria": registro.name.rpartition(".")[2],
+            "evento": registro.msg,
+        }
+        datos.update(getattr(registro, "campos", {}))
+        if registro.exc_info:
+            datos["traza"] = self.formatException(registro.exc_info)
+        return json.dumps(datos, ensure_ascii=False, default=str)
+
+class ColaBitacora(logging.handlers.QueueHandler):
+    """QueueHandler que no formatea en el hilo de la petición ni espera si la cola está llena"""
+
+    def __init__(self, cola):
+        super().__init__(cola)
+        self.descartados = 0
+
+    def prepare(self, registro):
+        return registro  # El JSON lo arma el hilo del QueueListener
+
+    def enqueue(self, registro):
+        try:
+            self.queue.put_nowait(registro)
+        except queue.Full:
+            self.descartados += 1
+
+class Bitacora:
+    """Eventos con campos estructurados de una categoría (barrera, sensores, registro...)"""
+
+    def __init__(self, categoria):
+        self.logger = logging.getLogger(f"parqueadero.{categoria}")
+        self.cada = muestreo_bitacora.get(categoria, 1)
+        self.contador = itertools.count()
+
+    def registrar(self, nivel, evento, campos, exc_info=None):
+        if self.cada > 1 and nivel < logging.WARNING:
+            if next(self.contador) % self.cada:
+                return
+            campos["muestra"] = self.cada  # Cada línea representa N eventos
+        # makeRecord directo: sin buscar el archivo y la línea del llamador en la pila
+        self.logger.handle(self.logger.makeRecord(self.logger.name, nivel, "", 0, evento, None, exc_info,
+                                                  extra={"campos": campos}))
+
+    # El nivel se revisa antes de llamar a registrar: apagado no cuesta más que esta consulta
+    def debug(self, evento, **campos):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.registrar(logging.DEBUG, evento, campos)
+
+    def info(self, evento, **campos):
+        if self.logger.isEnabledFor(logging.INFO):
+            self.registrar(logging.INFO, evento, campos)
+
+    def advertencia(self, evento, **campos):
+        if self.logger.isEnabledFor(logging.WARNING):
+            self.registrar(logging.WARNING, evento, campos)
+
+    def error(self, evento, traza=True, **campos):
+        """Con traza=False no se adjunta la excepción en curso (su texto puede traer datos personales)"""
+        if self.logger.isEnabledFor(logging.ERROR):
+            exc_info = sys.exc_info() if traza and sys.exc_info()[0] else None
+            self.registrar(logging.ERROR, evento, campos, exc_info=exc_info)
+
+bitacora_raiz = logging.getLogger("parqueadero")
+if not bitacora_raiz.handlers:  # Una sola cola aunque el módulo se importe dos veces (__main__ y flask CLI)
+    bitacora_raiz.setLevel(NIVEL_BITACORA)
+    bitacora_raiz.propagate = False
+    manejador_cola = ColaBitacora(queue.Queue(CAPACIDAD_COLA_BITACORA))
+    salida_bitacora = logging.StreamHandler(sys.stdout)
+    salida_bitacora.setFormatter(FormatoJSON())
+    oyente_bitacora = logging.handlers.QueueListener(manejador_cola.queue, salida_bitacora)
+    oyente_bitacora.start()
+    atexit.register(oyente_bitacora.stop)  # Vacía la cola al salir
+    bitacora_raiz.addHandler(manejador_cola)
+cola_bitacora = bitacora_raiz.handlers[0]
+
+bitacora_barrera = Bitacora("barrera")
+bitacora_sensores = Bitacora("sensores")
+bitacora_registro = Bitacora("registro")
+bitacora_recargas = Bitacora("recargas")
+bitacora_reportes = Bitacora("reportes")
+bitacora_tarifas = Bitacora("tarifas")
+bitacora_fondo = Bitacora("fondo")  # Barredor y escritor único
+
+# 🆕 MÉTRICAS POR ENDPOINT (HISTOGRAMA DE LATENCIA, CÓDIGOS Y SQL) EN FORMATO PROMETHEUS
+# Cada petición mide su duración (hasta terminar de enviar la respuesta si es en
+# streaming), su código y las sentencias SQL que ejecutó con su tiempo. Las
+# escrituras que la petición encola en el escritor único se le cargan a ella.
+# Las series se agrupan por la regla de la ruta (no por la URL con parámetros)
+# y /metrics las expone en el formato de texto de Prometheus.
+CUBETAS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # Segundos
+GRUPOS_METRICAS = {
+    "/api/entrada/detectar": "barrera",
+    "/api/salida/detectar": "barrera",
+    "/api/v2/barrera": "barrera",
+    "/api/sensores/actualizar": "sensores",
+    "/api/sensores/lote": "sensores",
+}
+
+class MedicionPeticion:
+    """Tiempo y SQL acumulados por una petición en curso"""
+
+    def __init__(self):
+        self.inicio = time.perf_counter()
+        self.codigo = 500  # Si la vista lanza una excepción no pasa por after_request
+        self.sentencias = 0
+        self.segundos_sql = 0.0
+        self.en_streaming = False
+        self.grupo = None  # La vista puede fijarlo (el protocolo v2 atiende barreras y sensores)
+        self.perfil = PerfilSQL() if perfilador_sql.activo else None  # Sentencias una por una (N+1)
+
+class SerieEndpoint:
+    def __init__(self):
+        self.cubetas = [0] * (len(CUBETAS_LATENCIA) + 1)  # La última es +Inf
+        self.suma = 0.0
+        self.cuenta = 0
+        self.codigos = {}
+        self.sentencias = 0
+        self.segundos_sql = 0.0
+
+class MetricasEndpoints:
+    """Series por (endpoint, método, grupo), protegidas con un lock"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def registrar(self, endpoint, metodo, grupo, medicion, segundos):
+        with self.lock:
+            serie = self.series.get((endpoint, metodo, grupo))
+            if serie is None:
+                serie = self.series[(endpoint, metodo, grupo)] = SerieEndpoint()
+            serie.cubetas[bisect.bisect_left(CUBETAS_LATENCIA, segundos)] += 1
+            serie.suma += segundos
+            serie.cuenta += 1
+            serie.codigos[medicion.codigo] = serie.codigos.get(medicion.codigo, 0) + 1
+            serie.sentencias += medicion.sentencias
+            serie.segundos_sql += medicion.segundos_sql
+
+    def exponer(self):
+        """Texto en formato de exposición de Prometheus (versión 0.0.4)"""
+        with self.lock:
+            series = [(clave, serie.cubetas[:], serie.suma, serie.cuenta, dict(serie.codigos),
+                       serie.sentencias, serie.segundos_sql) for clave, serie in sorted(self.series.items())]
+        lineas = [
+            "# HELP parqueadero_peticion_segundos Duración de las peticiones HTTP",
+            "# TYPE parqueadero_peticion_segundos histogram",
+        ]
+        for clave, cubetas, suma, cuenta, _, _, _ in series:
+            etiquetas = etiquetas_metricas(clave)
+            acumulado = 0
+            for limite, cantidad in zip(CUBETAS_LATENCIA + ("+Inf",), cubetas):
+                acumulado += cantidad
+                lineas.append(f'parqueadero_peticion_segundos_bucket{{{etiquetas},le="{limite}"}} {acumulado}')
+            lineas.append(f"parqueadero_peticion_segundos_sum{{{etiquetas}}} {suma:.6f}")
+            lineas.append(f"parqueadero_peticion_segundos_count{{{etiquetas}}} {cuenta}")
+        lineas += [
+            "# HELP parqueadero_respuestas_total Respuestas HTTP por código",
+            "# TYPE parqueadero_respuestas_total counter",
+        ]
+        for clave, _, _, _, codigos, _, _ in series:
+            etiquetas = etiquetas_metricas(clave)
+            for codigo, cantidad in sorted(codigos.items()):
+                lineas.append(f'parqueadero_respuestas_total{{{etiquetas},codigo="{codigo}"}} {cantidad}')
+        lineas += [
+            "# HELP parqueadero_sql_sentencias_total Sentencias SQL ejecutadas por las peticiones",
+            "# TYPE parqueadero_sql_sentencias_total counter",
+        ]
+        for clave, _, _, _, _, sentencias, _ in series:
+            lineas.append(f"parqueadero_sql_sentencias_total{{{etiquetas_metricas(clave)}}} {sentencias}")
+        lineas += [
+            "# HELP parqueadero_sql_segundos_total Tiempo en SQL de las peticiones",
+            "# TYPE parqueadero_sql_segundos_total counter",
+        ]
+        for clave, _, _, _, _, _, segundos_sql in series:
+            lineas.append(f"parqueadero_sql_segundos_total{{{etiquetas_metricas(clave)}}} {segundos_sql:.6f}")
+        return lineas
+
+def etiquetas_metricas(clave):
+    endpoint, metodo, grupo = clave
+    endpoint = endpoint.replace("\\", "\\\\").replace('"', '\\"')
+    return f'endpoint="{endpoint}",metodo="{metodo}",grupo="{grupo}"'
+
+metricas_endpoints = MetricasEndpoints()
+metricas_hilo = threading.local()
+
+@contextmanager
+def medir_sql_para(medicion):
+    """Carga a la medición dada las sentencias que ejecute este hilo dentro del bloque"""
+    anterior = getattr(metricas_hilo, "medicion", None)
+    metricas_hilo.medicion = medicion
+    try:
+        yield
+    finally:
+        metricas_hilo.medicion = anterior
+
+@event.listens_for(Engine, "before_cursor_execute")
+def iniciar_medicion_sql(conexion, cursor, sql, parametros, contexto, executemany):
+    metricas_hilo.inicio_sql = time.perf_counter()
+
+@event.listens_for(Engine, "after_cursor_execute")
+def terminar_medicion_sql(conexion, cursor, sql, parametros, contexto, executemany):
+    medicion = getattr(metricas_hilo, "medicion", None)
+    perfiles = getattr(metricas_hilo, "perfiles", None)  # Bloques de perfilar_sql() abiertos en este hilo
+    if medicion is None and not perfiles:
+        return
+    segundos = time.perf_counter() - metricas_hilo.inicio_sql
+    if medicion is not None:
+        medicion.sentencias += 1
+        medicion.segundos_sql += segundos
+        if medicion.perfil is not None:
+            perfiles = [medicion.perfil] + (perfiles or [])
+    if perfiles:
+        sitio = sitio_llamada()
+        for perfil in perfiles:
+            perfil.anotar(sql, segundos, sitio)
+
+@app.before_request
+def iniciar_medicion_peticion():
+    metricas_hilo.medicion = MedicionPeticion()
+
+@app.after_request
+def anotar_codigo_peticion(respuesta):
+    medicion = getattr(metricas_hilo, "medicion", None)
+    if medicion is not None:
+        medicion.codigo = respuesta.status_code
+        if respuesta.is_streamed:
+            # El cuerpo (y su SQL) se genera después del teardown: se registra al cerrar la respuesta
+            medicion.en_streaming = True
+            regla, metodo = regla_peticion(), request.method
+            respuesta.call_on_close(lambda: registrar_medicion(medicion, regla, metodo))
+    return respuesta
+
+@app.teardown_request
+def cerrar_medicion_peticion(error=None):
+    medicion = getattr(metricas_hilo, "medicion", None)
+    if medicion is not None and not medicion.en_streaming:
+        registrar_medicion(medicion, regla_peticion(), request.method)
+
+def regla_peticion():
+    return request.url_rule.rule if request.url_rule is not None else "sin_ruta"
+
+def registrar_medicion(medicion, regla, metodo):
+    if getattr(metricas_hilo, "medicion", None) is medicion:
+        metricas_hilo.medicion = None
+    grupo = medicion.grupo or GRUPOS_METRICAS.get(regla, "api" if regla.startswith("/api/") else "web")
+    metricas_endpoints.registrar(regla, metodo, grupo, medicion, time.perf_counter() - medicion.inicio)
+    if medicion.perfil is not None:
+        perfilador_sql.registrar(regla, metodo, medicion.perfil)
+
+@app.route("/metrics")
+def metricas_prometheus():
+    """Latencias, códigos y SQL por endpoint, más la cola del escritor único"""
+    lineas = metricas_endpoints.exponer()
+    escritor = escritor_unico.estadisticas()
+    lineas += [
+        "# HELP parqueadero_escritor_en_cola Escrituras esperando turno en el escritor único",
+        "# TYPE parqueadero_escritor_en_cola gauge",
+        f"parqueadero_escritor_en_cola {escritor['en_cola']}",
+        "# HELP parqueadero_escritor_vencidos_total Escrituras que vencieron antes de empezar",
+        "# TYPE parqueadero_escritor_vencidos_total counter",
+        f"parqueadero_escritor_vencidos_total {escritor['vencidos']}",
+        "# HELP parqueadero_bitacora_descartados_total Eventos de bitácora descartados con la cola llena",
+        "# TYPE parqueadero_bitacora_descartados_total counter",
+        f"parqueadero_bitacora_descartados_total {cola_bitacora.descartados}",
+    ]
+    return Response("\n".join(lineas) + "\n", content_type="text/plain; version=0.0.4; charset=utf-8")
+
 db = SQLAlchemy(app)
 
 # MODELOS
@@ -74,6 +439,17 @@ class Tarifa(db.Model):
     TARIFA_HORA = db.Column(db.Numeric(10,2), nullable=False)
     TARIFA_MINIMA = db.Column(db.Numeric(10,2), default=0.0)
     ACTIVA = db.Column(db.Boolean, default=True)
+    FRACCION_MINUTOS = db.Column(db.Integer, nullable=False, default=0, server_default="0")  # 🆕 0 = proporcional al minuto
+    REDONDEO = db.Column(db.String(10), nullable=False, default="ARRIBA", server_default="ARRIBA")  # 🆕 ARRIBA, CERCANO o ABAJO
+
+# 🆕 FRANJAS HORARIAS: LAS HORAS DENTRO DE [HORA_INICIO, HORA_FIN) SE COBRAN A SU PROPIA TARIFA
+class FranjaTarifa(db.Model):
+    __tablename__ = "FRANJA_TARIFA"
+    ID = db.Column(db.Integer, primary_key=True)
+    ID_TARIFA = db.Column(db.Integer, db.ForeignKey('TARIFA.ID'), nullable=False)
+    HORA_INICIO = db.Column(db.Integer, nullable=False)  # 0-23, hora local
+    HORA_FIN = db.Column(db.Integer, nullable=False)     # 1-24; menor que HORA_INICIO cruza la medianoche
+    TARIFA_HORA = db.Column(db.Numeric(10,2), nullable=False)
 
 # 🆕 AGREGAR ESTOS CAMPOS AL MODELO ESPACIO
 class Espacio(db.Model):
@@ -84,6 +460,7 @@ class Espacio(db.Model):
     ESTADO = db.Column(db.String(20), default="DISPONIBLE")  # DISPONIBLE, OCUPADO, MANTENIMIENTO
     ID_ENTRADA_ACTUAL = db.Column(db.Integer, db.ForeignKey('ENTRADA.ID'), nullable=True)
     SENSOR_PIN = db.Column(db.Integer, nullable=False)  # 🆕 PIN del sensor (1, 2, 3)
+    CONTROLADOR = db.Column(db.String(30), nullable=False, default="PRINCIPAL", server_default="PRINCIPAL")  # 🆕 ESP32 dueño del sensor
     ULTIMA_DETECCION = db.Column(db.DateTime, nullable=True)  # 🆕 Última vez que el sensor detectó algo
 
 # 🆕 AGREGAR MÁS CAMPOS A ENTRADA PARA FACTURACIÓN
@@ -103,21 +480,1458 @@ class Entrada(db.Model):
     espacio = db.relationship("Espacio", foreign_keys=[ID_ESPACIO], backref="entradas_activas", lazy=True)
     usuario = db.relationship("Usuario", foreign_keys=[ID_USUARIO], back_populates="entradas", lazy=True)
     vehiculo = db.relationship("Vehiculo", foreign_keys=[ID_VEHICULO], backref="entradas", lazy=True)
+
+# 🆕 COMANDOS PARA LAS BARRERAS (CANAL PUSH HACIA EL ESP32)
+class ComandoBarrera(db.Model):
+    __tablename__ = "COMANDO_BARRERA"
+    ID = db.Column(db.Integer, primary_key=True)  # Número de secuencia del comando
+    PUERTA = db.Column(db.String(20), nullable=False)  # entrada, salida
+    COMANDO = db.Column(db.String(30), nullable=False)  # ABRIR_BARRERA
+    DATOS = db.Column(db.Text, nullable=True)  # JSON con detalles (espacio, placa...)
+    ESTADO = db.Column(db.String(20), default="PENDIENTE")  # PENDIENTE, CONFIRMADO
+    FECHA = db.Column(db.DateTime, default=datetime.utcnow)
+    FECHA_CONFIRMACION = db.Column(db.DateTime, nullable=True)
+# 🆕 ROLLUP DIARIO: UNA FILA POR DÍA CERRADO PARA LOS REPORTES POR RANGO
+class ResumenDiario(db.Model):
+    __tablename__ = "RESUMEN_DIARIO"
+    FECHA = db.Column(db.Date, primary_key=True)
+    ENTRADAS = db.Column(db.Integer, nullable=False, default=0)
+    SALIDAS = db.Column(db.Integer, nullable=False, default=0)
+    RECAUDO = db.Column(db.Numeric(12,2), nullable=False, default=0.0)
+    RECARGAS = db.Column(db.Integer, nullable=False, default=0)
+    MONTO_RECARGAS = db.Column(db.Numeric(12,2), nullable=False, default=0.0)
+    USUARIOS_NUEVOS = db.Column(db.Integer, nullable=False, default=0)
+    PICO_OCUPACION = db.Column(db.Integer, nullable=False, default=0)  # Máximo de vehículos a la vez
+    FECHA_CIERRE = db.Column(db.DateTime, default=datetime.utcnow)
+
+# 🆕 CONTADORES DEL DÍA POR TIPO DE VEHÍCULO (SE ACTUALIZAN EN LA MISMA TRANSACCIÓN QUE CADA EVENTO)
+class ContadorDiario(db.Model):
+    __tablename__ = "CONTADOR_DIARIO"
+    FECHA = db.Column(db.Date, primary_key=True)
+    TIPO_VEHICULO = db.Column(db.String(20), primary_key=True)  # GENERAL para recargas y registros
+    ENTRADAS = db.Column(db.Integer, nullable=False, default=0)
+    SALIDAS = db.Column(db.Integer, nullable=False, default=0)
+    RECAUDO = db.Column(db.Numeric(12,2), nullable=False, default=0.0)
+    RECARGAS = db.Column(db.Integer, nullable=False, default=0)
+    MONTO_RECARGAS = db.Column(db.Numeric(12,2), nullable=False, default=0.0)
+    USUARIOS_NUEVOS = db.Column(db.Integer, nullable=False, default=0)
+
+# 🆕 FACTURA CONGELADA AL MOMENTO DE LA SALIDA (NO SE RECALCULA AL CONSULTARLA)
+class Factura(db.Model):
+    __tablename__ = "FACTURA"
+    ID_ENTRADA = db.Column(db.Integer, db.ForeignKey('ENTRADA.ID'), primary_key=True)
+    NOMBRE = db.Column(db.String, nullable=False)
+    CEDULA = db.Column(db.String(20), nullable=False)
+    TELEFONO = db.Column(db.String(15))
+    EMAIL = db.Column(db.String(100))
+    PLACA = db.Column(db.String(10), nullable=False)
+    TIPO_VEHICULO = db.Column(db.String(20))
+    MARCA = db.Column(db.String(30))
+    COLOR = db.Column(db.String(20))
+    ESPACIO = db.Column(db.String(10))
+    FECHA_ENTRADA = db.Column(db.DateTime, nullable=False)
+    FECHA_SALIDA = db.Column(db.DateTime, nullable=False)
+    TIEMPO_ESTACIONADO = db.Column(db.String(20))
+    TARIFA_HORA = db.Column(db.Numeric(10,2))
+    MONTO_COBRADO = db.Column(db.Numeric(10,2), nullable=False)
+    SALDO_RESTANTE = db.Column(db.Numeric(10,2))
+    FECHA_EMISION = db.Column(db.DateTime, default=datetime.utcnow)
+
+# 🆕 LIBRO DE SALDOS: CADA CAMBIO DE USUARIO.SALDO DEJA UN MOVIMIENTO (SOLO SE AGREGAN FILAS)
+class MovimientoSaldo(db.Model):
+    __tablename__ = "MOVIMIENTO_SALDO"
+    ID = db.Column(db.Integer, primary_key=True)
+    ID_USUARIO = db.Column(db.Integer, db.ForeignKey('USUARIO.ID'), nullable=False)
+    FECHA = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    TIPO = db.Column(db.String(20), nullable=False)  # APERTURA, RECARGA, COBRO
+    MONTO = db.Column(db.Numeric(10,2), nullable=False)  # Positivo = abono, negativo = débito
+    SALDO_RESULTANTE = db.Column(db.Numeric(10,2), nullable=False)
+    REFERENCIA = db.Column(db.String(50))  # ENTRADA:<id> o RECARGA:<token>
+
+# 🆕 CORTE PERIÓDICO DEL SALDO: LA AUDITORÍA REPRODUCE DESDE EL ÚLTIMO CORTE
+class CorteSaldo(db.Model):
+    __tablename__ = "CORTE_SALDO"
+    ID_USUARIO = db.Column(db.Integer, db.ForeignKey('USUARIO.ID'), primary_key=True)
+    ID_MOVIMIENTO = db.Column(db.Integer, primary_key=True)  # Último movimiento incluido
+    SALDO = db.Column(db.Numeric(12,2), nullable=False)
+    FECHA = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
 # HELPER FUNCTIONS
-def generar_token():
-    return hashlib.md5(datetime.utcnow().isoformat().encode()).hexdigest()[:20]
+# 🆕 La IP se resuelve a lo sumo una vez por minuto: la salida y el usuario nuevo
+# la piden en cada tarjeta y gethostbyname puede tardar si el DNS responde lento
+VIGENCIA_IP_SERVIDOR = 60
+ip_servidor_cache = {"ip": None, "vence": 0.0}
 
 def obtener_ip_servidor():
+    ahora = time.monotonic()
+    if ip_servidor_cache["ip"] is not None and ahora < ip_servidor_cache["vence"]:
+        return ip_servidor_cache["ip"]
     try:
         hostname = socket.gethostname()
         local_ip = socket.gethostbyname(hostname)
-        return local_ip
     except:
-        return "192.168.1.3"
+        local_ip = "192.168.1.3"
+    ip_servidor_cache.update(ip=local_ip, vence=ahora + VIGENCIA_IP_SERVIDOR)
+    return local_ip
 
 def obtener_tarifa_minima():
-    tarifa = Tarifa.query.filter_by(TIPO_VEHICULO="CARRO", ACTIVA=True).first()
-    return float(tarifa.TARIFA_MINIMA) if tarifa else 2000.0
+    """Retorna la tarifa mínima de los carros (desde el motor de tarifas en memoria)"""
+    return motor_tarifas.tarifa_minima("CARRO")
+
+def hoy_utc():
+    """Día actual con el mismo corte que las fechas guardadas (utcnow) y los contadores diarios"""
+    return datetime.utcnow().date()
+
+def rango_dia(fecha):
+    """Retorna (inicio, fin) del día para filtrar por rango y poder usar los índices"""
+    inicio = datetime(fecha.year, fecha.month, fecha.day)
+    return inicio, inicio + timedelta(days=1)
+
+# 🆕 ÍNDICE EN MEMORIA DE TARJETAS RFID (RUTA CALIENTE DE LAS BARRERAS)
+class IndiceRFID:
+    """Índice local al proceso: tarjeta RFID -> usuario, vehículo y entrada activa.
+
+    Se carga al iniciar y los endpoints que escriben lo actualizan después de cada
+    commit (write-through), de modo que un toque de tarjeta se responde desde memoria.
+    Los registros se tratan como inmutables: cada cambio reemplaza el diccionario.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tarjetas = {}
+        self.version = 0
+        self.aciertos = 0
+        self.fallos = 0
+
+    def leer_tarjetas(self, tarjeta_rfid=None):
+        """Consulta usuario, vehículo y entrada activa (de todas las tarjetas o de una)"""
+        consulta = db.session.query(
+            Usuario.ID, Usuario.NOMBRE, Usuario.SALDO, Usuario.TARJETA_RFID,
+            Vehiculo.ID, Vehiculo.PLACA, Vehiculo.TIPO
+        ).outerjoin(Vehiculo, Vehiculo.ID_USUARIO == Usuario.ID).filter(
+            Usuario.TARJETA_RFID.isnot(None)
+        )
+        if tarjeta_rfid:
+            consulta = consulta.filter(Usuario.TARJETA_RFID == tarjeta_rfid)
+
+        registros = {}
+        por_usuario = {}
+        for usuario_id, nombre, saldo, tarjeta, vehiculo_id, placa, tipo in consulta.order_by(Vehiculo.ID):
+            if tarjeta in registros:
+                continue  # Igual que usuario.vehiculos[0]: se usa el primer vehículo
+            registros[tarjeta] = {
+                "usuario_id": usuario_id,
+                "nombre": nombre,
+                "saldo": float(saldo) if saldo else 0.0,
+                "vehiculo": {"id": vehiculo_id, "placa": placa, "tipo": tipo} if vehiculo_id else None,
+                "entrada": None
+            }
+            por_usuario[usuario_id] = tarjeta
+
+        if not registros:
+            return registros
+
+        consulta_entradas = db.session.query(
+            Entrada.ID, Entrada.ID_USUARIO, Entrada.FECHA_ENTRADA, Entrada.ID_ESPACIO,
+            Espacio.NUMERO, Vehiculo.PLACA, Vehiculo.TIPO
+        ).join(Vehiculo, Vehiculo.ID == Entrada.ID_VEHICULO).outerjoin(
+            Espacio, Espacio.ID == Entrada.ID_ESPACIO
+        ).filter(Entrada.ESTADO == "ACTIVA")
+        if tarjeta_rfid:
+            consulta_entradas = consulta_entradas.filter(Entrada.ID_USUARIO.in_(list(por_usuario)))
+
+        for entrada_id, usuario_id, fecha_entrada, espacio_id, numero, placa, tipo in consulta_entradas:
+            tarjeta = por_usuario.get(usuario_id)
+            if tarjeta and registros[tarjeta]["entrada"] is None:
+                registros[tarjeta]["entrada"] = {
+                    "id": entrada_id,
+                    "fecha_entrada": fecha_entrada,
+                    "espacio_id": espacio_id,
+                    "espacio": numero,
+                    "placa": placa,
+                    "tipo": tipo
+                }
+
+        return registros
+
+    def cargar(self):
+        """Carga todas las tarjetas (se llama al iniciar)"""
+        registros = self.leer_tarjetas()
+        with self.lock:
+            self.tarjetas = registros
+            self.version += 1
+        print(f"🗂️ Índice RFID cargado: {len(registros)} tarjetas")
+
+    def obtener(self, tarjeta_rfid):
+        """Retorna el registro de la tarjeta; en un fallo lo carga desde la base de datos"""
+        with self.lock:
+            registro = self.tarjetas.get(tarjeta_rfid)
+            if registro is not None:
+                self.aciertos += 1
+                return registro
+            self.fallos += 1
+            version = self.version
+
+        registro = self.leer_tarjetas(tarjeta_rfid).get(tarjeta_rfid)
+        if registro is not None:
+            with self.lock:
+                # Si hubo una escritura mientras consultábamos, no guardar datos viejos
+                if self.version == version:
+                    self.tarjetas[tarjeta_rfid] = registro
+        return registro
+
+    def guardar(self, tarjeta_rfid, registro):
+        """Reemplaza el registro completo de una tarjeta (usuario recién creado)"""
+        with self.lock:
+            self.tarjetas[tarjeta_rfid] = registro
+            self.version += 1
+
+    def actualizar(self, tarjeta_rfid, **cambios):
+        """Aplica cambios a una tarjeta ya indexada; si no está, la próxima consulta la carga"""
+        with self.lock:
+            registro = self.tarjetas.get(tarjeta_rfid)
+            if registro is not None:
+                self.tarjetas[tarjeta_rfid] = dict(registro, **cambios)
+            self.version += 1
+
+    def invalidar(self, tarjeta_rfid):
+        """Elimina una tarjeta del índice"""
+        with self.lock:
+            self.tarjetas.pop(tarjeta_rfid, None)
+            self.version += 1
+
+    def estadisticas(self):
+        """Tamaño del índice y contadores de aciertos/fallos"""
+        with self.lock:
+            total = self.aciertos + self.fallos
+            return {
+                "tarjetas_indexadas": len(self.tarjetas),
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+                "tasa_aciertos": round(self.aciertos / total * 100, 2) if total else 0
+            }
+
+indice_rfid = IndiceRFID()
+
+# 🆕 MOTOR DE TARIFAS: PLANES EN MEMORIA VERSIONADOS, FRANJAS HORARIAS Y REDONDEO POR FRACCIONES
+REGLAS_REDONDEO = ("ARRIBA", "CERCANO", "ABAJO")
+HORAS_MINIMAS_COBRO = 1            # Toda estadía se cobra como mínimo una hora
+MONTO_SIN_TARIFA = 2000.0          # Cobro si el tipo de vehículo no tiene tarifa activa
+TARIFA_HORA_SIN_TARIFA = 5000.0
+TARIFA_MINIMA_POR_DEFECTO = 5000.0
+# Las franjas están en hora local y las fechas se guardan en UTC (Colombia: UTC-5)
+DESFASE_UTC_TARIFAS = float(os.environ.get("PARQUEADERO_DESFASE_UTC", "-5"))
+EPOCA = datetime(1970, 1, 1)
+# Horas locales desde la época, calculadas en SQLite para no convertir cada fila a datetime
+SQL_ESTADIAS_FINALIZADAS = """
+    SELECT V.TIPO,
+           (julianday(E.FECHA_ENTRADA) - 2440587.5) * 24.0 + :desfase,
+           (julianday(E.FECHA_SALIDA) - 2440587.5) * 24.0 + :desfase,
+           COALESCE(E.MONTO_COBRADO, 0)
+    FROM ENTRADA E JOIN VEHICULO V ON V.ID = E.ID_VEHICULO
+    WHERE E.ESTADO = 'FINALIZADA' AND E.FECHA_SALIDA >= :desde AND E.FECHA_SALIDA < :hasta
+"""
+
+def tramos_franjas(franjas):
+    """Parte las franjas que cruzan la medianoche: (inicio, fin, tarifa) con inicio < fin"""
+    tramos = []
+    for inicio, fin, tarifa in franjas:
+        if inicio < fin:
+            tramos.append((inicio, fin, tarifa))
+        else:
+            tramos.append((inicio, 24, tarifa))
+            if fin > 0:
+                tramos.append((0, fin, tarifa))
+    return tuple(tramos)
+
+def normalizar_plan(tipo, datos, base=None):
+    """Valida un plan ({"hora", "minima", "fraccion_minutos", "redondeo", "franjas"}) sobre el plan base.
+
+    Lanza ValueError con un mensaje para el cliente si algún valor no es válido.
+    """
+    base = base or {}
+    try:
+        hora = float(datos.get("hora", base.get("hora", 0)))
+        minima = float(datos.get("minima", base.get("minima", 0)))
+        fraccion = int(datos.get("fraccion_minutos", base.get("fraccion_minutos", 0)))
+    except (TypeError, ValueError):
+        raise ValueError("hora, minima y fraccion_minutos deben ser numéricos")
+    redondeo = str(datos.get("redondeo", base.get("redondeo", "ARRIBA"))).upper()
+    if hora <= 0:
+        raise ValueError("La tarifa por hora debe ser mayor que cero")
+    if minima < 0:
+        raise ValueError("La tarifa mínima no puede ser negativa")
+    if not 0 <= fraccion <= 1440:
+        raise ValueError("fraccion_minutos debe estar entre 0 y 1440")
+    if redondeo not in REGLAS_REDONDEO:
+        raise ValueError(f"redondeo debe ser uno de {', '.join(REGLAS_REDONDEO)}")
+
+    if "franjas" in datos:
+        franjas = []
+        for franja in datos["franjas"] or []:
+            try:
+                franjas.append((int(franja["inicio"]), int(franja["fin"]), float(franja["hora"])))
+            except (KeyError, TypeError, ValueError):
+                raise ValueError("Cada franja necesita inicio, fin y hora numéricos")
+    else:
+        franjas = list(base.get("franjas", ()))
+
+    ocupadas = [False] * 24
+    for inicio, fin, tarifa in franjas:
+        if not (0 <= inicio <= 23 and 1 <= fin <= 24 and inicio != fin) or tarifa < 0:
+            raise ValueError("Franja inválida: inicio 0-23, fin 1-24, distintos y tarifa no negativa")
+        horas = range(inicio, fin) if inicio < fin else list(range(inicio, 24)) + list(range(0, fin))
+        for h in horas:
+            if ocupadas[h]:
+                raise ValueError(f"Las franjas se traslapan a las {h}:00")
+            ocupadas[h] = True
+
+    return {
+        "tipo": tipo,
+        "hora": hora,
+        "minima": minima,
+        "fraccion_minutos": fraccion,
+        "redondeo": redondeo,
+        "franjas": tuple(sorted(franjas)),
+        "tramos": tramos_franjas(franjas)
+    }
+
+def horas_facturables(horas, fraccion_minutos, redondeo):
+    """Redondea la estadía a fracciones de fraccion_minutos (0 = sin redondeo), mínimo una hora"""
+    if fraccion_minutos:
+        fraccion = fraccion_minutos / 60
+        unidades = horas / fraccion
+        if redondeo == "ARRIBA":
+            unidades = math.ceil(unidades - 1e-9)
+        elif redondeo == "CERCANO":
+            unidades = math.floor(unidades + 0.5)
+        else:
+            unidades = math.floor(unidades + 1e-9)
+        horas = unidades * fraccion
+    return max(HORAS_MINIMAS_COBRO, horas)
+
+def horas_en_tramo(desde, hasta, inicio, fin):
+    """Horas de [desde, hasta) (horas locales desde la época) que caen en [inicio, fin) de cada día"""
+    def acumulado(t):
+        dia, hora = divmod(t, 24)
+        return dia * (fin - inicio) + min(max(hora - inicio, 0), fin - inicio)
+    return acumulado(hasta) - acumulado(desde)
+
+def precio_instante(plan, hora_local):
+    """Tarifa por hora vigente en un instante (la de su franja o la base)"""
+    hora_dia = hora_local % 24
+    for inicio, fin, tarifa in plan["tramos"]:
+        if inicio <= hora_dia < fin:
+            return tarifa
+    return plan["hora"]
+
+class MotorTarifas:
+    """Planes de tarifa activos por tipo de vehículo, en memoria y con número de versión.
+
+    Cada cobro se calcula desde el plan en memoria (sin consultar TARIFA); al cambiar
+    una tarifa el plan completo se vuelve a leer y la versión aumenta. Las horas que
+    caen en una franja se cobran a la tarifa de la franja y el resto a la tarifa base;
+    el total se escala a las horas facturables (redondeadas) y nunca baja de la mínima.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.planes = {}
+        self.version = 0
+        self.cargado_en = None
+        self.cobros = 0
+        self.simulaciones = 0
+        self.historico = None  # Estadías de días cerrados ya leídas (no cambian)
+
+    def leer_planes(self):
+        """Tarifas activas y sus franjas en dos consultas"""
+        tarifas = Tarifa.query.filter_by(ACTIVA=True).order_by(Tarifa.ID).all()
+        franjas = {}
+        for id_tarifa, inicio, fin, tarifa_hora in db.session.query(
+            FranjaTarifa.ID_TARIFA, FranjaTarifa.HORA_INICIO, FranjaTarifa.HORA_FIN, FranjaTarifa.TARIFA_HORA
+        ).join(Tarifa, Tarifa.ID == FranjaTarifa.ID_TARIFA).filter(Tarifa.ACTIVA == True):
+            franjas.setdefault(id_tarifa, []).append({"inicio": inicio, "fin": fin, "hora": float(tarifa_hora)})
+
+        planes = {}
+        for tarifa in tarifas:
+            if tarifa.TIPO_VEHICULO in planes:
+                continue  # Igual que .first(): si hay dos activas manda la más antigua
+            planes[tarifa.TIPO_VEHICULO] = normalizar_plan(tarifa.TIPO_VEHICULO, {
+                "hora": float(tarifa.TARIFA_HORA),
+                "minima": float(tarifa.TARIFA_MINIMA or 0),
+                "fraccion_minutos": tarifa.FRACCION_MINUTOS or 0,
+                "redondeo": tarifa.REDONDEO or "ARRIBA",
+                "franjas": franjas.get(tarifa.ID, [])
+            })
+        return planes
+
+    def cargar(self):
+        """Lee los planes activos y publica una nueva versión"""
+        planes = self.leer_planes()
+        with self.lock:
+            self.planes = planes
+            self.version += 1
+            self.cargado_en = datetime.utcnow()
+            version = self.version
+        print(f"💲 Tarifas cargadas: {len(planes)} planes (versión {version})")
+        return version
+
+    def plan(self, tipo_vehiculo):
+        """Plan activo de un tipo de vehículo o None"""
+        if not self.version:
+            self.cargar()
+        return self.planes.get(tipo_vehiculo)
+
+    def tarifa_minima(self, tipo_vehiculo):
+        plan = self.plan(tipo_vehiculo)
+        return plan["minima"] if plan else TARIFA_MINIMA_POR_DEFECTO
+
+    def tarifa_hora(self, tipo_vehiculo):
+        plan = self.plan(tipo_vehiculo)
+        return plan["hora"] if plan else TARIFA_HORA_SIN_TARIFA
+
+    def cotizar(self, tipo_vehiculo, fecha_entrada, fecha_salida):
+        """Monto de una estadía: {"monto", "horas_facturables", "tarifa_hora", "version"}"""
+        with self.lock:
+            plan = self.planes.get(tipo_vehiculo) if self.version else None
+            version = self.version
+            self.cobros += 1
+        if not version:
+            plan = self.plan(tipo_vehiculo)
+            version = self.version
+        if not plan:
+            return {"monto": MONTO_SIN_TARIFA, "horas_facturables": None,
+                    "tarifa_hora": TARIFA_HORA_SIN_TARIFA, "version": version}
+
+        desde = (fecha_entrada - EPOCA).total_seconds() / 3600 + DESFASE_UTC_TARIFAS
+        hasta = (fecha_salida - EPOCA).total_seconds() / 3600 + DESFASE_UTC_TARIFAS
+        horas = max(0.0, hasta - desde)
+        tarifa_media = precio_instante(plan, desde)
+        if horas > 0 and plan["tramos"]:
+            en_franjas = 0.0
+            importe = 0.0
+            for inicio, fin, tarifa in plan["tramos"]:
+                dentro = horas_en_tramo(desde, hasta, inicio, fin)
+                en_franjas += dentro
+                importe += dentro * tarifa
+            tarifa_media = (importe + (horas - en_franjas) * plan["hora"]) / horas
+
+        facturables = horas_facturables(horas, plan["fraccion_minutos"], plan["redondeo"])
+        monto = round(max(facturables * tarifa_media, plan["minima"]), 2)
+        return {"monto": monto, "horas_facturables": round(facturables, 4),
+                "tarifa_hora": round(tarifa_media, 2), "version": version}
+
+    def leer_estadias(self, desde, hasta):
+        """Estadías finalizadas del periodo como arreglos: tipos, entrada, salida (horas locales) y monto cobrado"""
+        filas = db.session.execute(
+            text(SQL_ESTADIAS_FINALIZADAS).bindparams(
+                bindparam("desde", type_=db.DateTime), bindparam("hasta", type_=db.DateTime)),
+            {"desfase": DESFASE_UTC_TARIFAS, "desde": desde, "hasta": hasta}
+        ).fetchall()
+        if not filas:
+            vacio = np.empty(0)
+            return np.empty(0, dtype=object), vacio, vacio, vacio
+        tipos, entradas, salidas, montos = zip(*filas)
+        return (np.array(tipos, dtype=object), np.array(entradas, dtype=np.float64),
+                np.array(salidas, dtype=np.float64), np.array(montos, dtype=np.float64))
+
+    def estadias(self, desde, hasta):
+        """Estadías del periodo: los días cerrados salen del histórico en memoria, hoy de la base de datos"""
+        hoy = rango_dia(datetime.utcnow())[0]
+        partes = []
+        cerrado_hasta = min(hasta, hoy)
+        if desde < cerrado_hasta:
+            with self.lock:
+                historico = self.historico
+            if historico is None or desde < historico["desde"]:
+                historico = {"desde": desde, "hasta": hoy, "arreglos": self.leer_estadias(desde, hoy)}
+            elif historico["hasta"] < hoy:
+                nuevos = self.leer_estadias(historico["hasta"], hoy)
+                historico = {"desde": historico["desde"], "hasta": hoy, "arreglos": tuple(
+                    np.concatenate([viejo, nuevo]) for viejo, nuevo in zip(historico["arreglos"], nuevos))}
+            with self.lock:
+                self.historico = historico
+            tipos, entradas, salidas, montos = historico["arreglos"]
+            mascara = ((salidas >= (desde - EPOCA).total_seconds() / 3600 + DESFASE_UTC_TARIFAS) &
+                       (salidas < (cerrado_hasta - EPOCA).total_seconds() / 3600 + DESFASE_UTC_TARIFAS))
+            partes.append((tipos[mascara], entradas[mascara], salidas[mascara], montos[mascara]))
+        if hasta > hoy:
+            partes.append(self.leer_estadias(max(desde, hoy), hasta))
+        if not partes:
+            return self.leer_estadias(desde, hasta)
+        if len(partes) == 1:
+            return partes[0]
+        return tuple(np.concatenate(columna) for columna in zip(*partes))
+
+    def simular(self, propuestas, desde, hasta):
+        """Re-liquida las estadías finalizadas entre desde y hasta con el plan vigente y con el propuesto.
+
+        propuestas: {tipo: cambios sobre el plan vigente}. Todo el cálculo es vectorizado con NumPy.
+        """
+        if np is None:
+            raise RuntimeError("La simulación de tarifas requiere numpy")
+        inicio_lectura = time.perf_counter()
+        tipos, entradas, salidas, cobrados = self.estadias(desde, hasta)
+        inicio_calculo = time.perf_counter()
+
+        por_tipo = {}
+        total_vigente = total_propuesto = 0.0
+        for tipo in sorted(set(tipos.tolist())):
+            mascara = tipos == tipo
+            vigente = self.plan(tipo)
+            propuesto = normalizar_plan(tipo, propuestas.get(tipo, {}), vigente) if (
+                tipo in propuestas or vigente) else None
+            montos_vigentes = liquidar_vectorizado(vigente, entradas[mascara], salidas[mascara])
+            montos_propuestos = liquidar_vectorizado(propuesto, entradas[mascara], salidas[mascara])
+            diferencia = montos_propuestos - montos_vigentes
+            por_tipo[tipo] = {
+                "estadias": int(mascara.sum()),
+                "cobrado": round(float(cobrados[mascara].sum()), 2),
+                "vigente": round(float(montos_vigentes.sum()), 2),
+                "propuesto": round(float(montos_propuestos.sum()), 2),
+                "diferencia_media": round(float(diferencia.mean()), 2),
+                "suben": int((diferencia > 0.005).sum()),
+                "bajan": int((diferencia < -0.005).sum())
+            }
+            total_vigente += por_tipo[tipo]["vigente"]
+            total_propuesto += por_tipo[tipo]["propuesto"]
+
+        fin = time.perf_counter()
+        with self.lock:
+            self.simulaciones += 1
+        return {
+            "desde": desde.strftime('%Y-%m-%d'),
+            "hasta": hasta.strftime('%Y-%m-%d'),
+            "version_tarifas": self.version,
+            "estadias": int(len(tipos)),
+            "cobrado": round(float(cobrados.sum()), 2),
+            "vigente": round(total_vigente, 2),
+            "propuesto": round(total_propuesto, 2),
+            "diferencia": round(total_propuesto - total_vigente, 2),
+            "por_tipo": por_tipo,
+            "segundos_lectura": round(inicio_calculo - inicio_lectura, 4),
+            "segundos_calculo": round(fin - inicio_calculo, 4)
+        }
+
+    def estadisticas(self):
+        with self.lock:
+            return {
+                "version": self.version,
+                "planes": len(self.planes),
+                "cargado_en": self.cargado_en.strftime('%Y-%m-%d %H:%M:%S') if self.cargado_en else None,
+                "cobros": self.cobros,
+                "simulaciones": self.simulaciones,
+                "historico_en_memoria": len(self.historico["arreglos"][0]) if self.historico else 0
+            }
+
+def liquidar_vectorizado(plan, desde, hasta):
+    """Misma liquidación que MotorTarifas.cotizar sobre arreglos de horas locales de entrada y salida"""
+    if not plan:
+        return np.full(len(desde), MONTO_SIN_TARIFA)
+    horas = np.maximum(hasta - desde, 0.0)
+
+    # Tarifa media: horas en cada franja a su tarifa y el resto a la base
+    hora_dia = np.mod(desde, 24)
+    tarifa_inicio = np.full(len(desde), plan["hora"])
+    en_franjas = np.zeros(len(desde))
+    importe = np.zeros(len(desde))
+    for inicio, fin, tarifa in plan["tramos"]:
+        ancho = fin - inicio
+        dia_desde = np.floor(desde / 24)
+        dia_hasta = np.floor(hasta / 24)
+        acumulado_desde = dia_desde * ancho + np.clip(desde - dia_desde * 24 - inicio, 0, ancho)
+        acumulado_hasta = dia_hasta * ancho + np.clip(hasta - dia_hasta * 24 - inicio, 0, ancho)
+        dentro = acumulado_hasta - acumulado_desde
+        en_franjas += dentro
+        importe += dentro * tarifa
+        tarifa_inicio[(hora_dia >= inicio) & (hora_dia < fin)] = tarifa
+    con_duracion = horas > 0
+    tarifa_media = tarifa_inicio.copy()
+    tarifa_media[con_duracion] = (
+        importe[con_duracion] + (horas[con_duracion] - en_franjas[con_duracion]) * plan["hora"]
+    ) / horas[con_duracion]
+
+    facturables = horas
+    if plan["fraccion_minutos"]:
+        fraccion = plan["fraccion_minutos"] / 60
+        unidades = horas / fraccion
+        if plan["redondeo"] == "ARRIBA":
+            unidades = np.ceil(unidades - 1e-9)
+        elif plan["redondeo"] == "CERCANO":
+            unidades = np.floor(unidades + 0.5)
+        else:
+            unidades = np.floor(unidades + 1e-9)
+        facturables = unidades * fraccion
+    facturables = np.maximum(facturables, HORAS_MINIMAS_COBRO)
+    return np.round(np.maximum(facturables * tarifa_media, plan["minima"]), 2)
+
+motor_tarifas = MotorTarifas()
+
+# 🆕 ASIGNADOR ATÓMICO DE ESPACIOS (LISTAS LIBRES POR TIPO DE VEHÍCULO)
+class AsignadorEspacios:
+    """Listas libres en memoria por TIPO_VEHICULO respaldadas por un UPDATE condicional.
+
+    La lista es solo una pista: el espacio se reclama con
+    UPDATE ... WHERE ESTADO = 'DISPONIBLE' dentro de la transacción del llamador,
+    así que dos toques simultáneos nunca obtienen el mismo espacio. Si la
+    transacción no se confirma, el espacio vuelve a su lista.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.libres = {}       # tipo -> deque de IDs de espacio
+        self.en_lista = set()  # IDs presentes en alguna lista (evita duplicados)
+        self.espacios = {}     # ID -> (tipo, número)
+
+    def cargar(self):
+        """Construye las listas libres desde la base de datos (se llama al iniciar)"""
+        filas = db.session.query(
+            Espacio.ID, Espacio.NUMERO, Espacio.TIPO_VEHICULO, Espacio.ESTADO
+        ).order_by(Espacio.ID).all()
+        with self.lock:
+            self.libres = {}
+            self.en_lista = set()
+            self.espacios = {}
+            for espacio_id, numero, tipo, estado in filas:
+                self.espacios[espacio_id] = (tipo, numero)
+                if estado == "DISPONIBLE":
+                    self.libres.setdefault(tipo, deque()).append(espacio_id)
+                    self.en_lista.add(espacio_id)
+
+    def recargar_tipo(self, tipo_vehiculo):
+        """Vuelve a leer los espacios disponibles de un tipo (lista vacía o desactualizada)"""
+        filas = db.session.query(Espacio.ID, Espacio.NUMERO).filter_by(
+            TIPO_VEHICULO=tipo_vehiculo, ESTADO="DISPONIBLE"
+        ).order_by(Espacio.ID).all()
+        with self.lock:
+            lista = self.libres.setdefault(tipo_vehiculo, deque())
+            for espacio_id, numero in filas:
+                self.espacios[espacio_id] = (tipo_vehiculo, numero)
+                if espacio_id not in self.en_lista:
+                    lista.append(espacio_id)
+                    self.en_lista.add(espacio_id)
+
+    def tomar_candidato(self, tipo_vehiculo):
+        with self.lock:
+            lista = self.libres.get(tipo_vehiculo)
+            if not lista:
+                return None
+            espacio_id = lista.popleft()
+            self.en_lista.discard(espacio_id)
+            return espacio_id
+
+    def reclamar(self, tipo_vehiculo):
+        """Ocupa un espacio DISPONIBLE del tipo en la transacción actual.
+
+        Retorna {"id", "numero"} o None si no hay espacios.
+        """
+        recargado = False
+        while True:
+            espacio_id = self.tomar_candidato(tipo_vehiculo)
+            if espacio_id is None:
+                if recargado:
+                    return None
+                self.recargar_tipo(tipo_vehiculo)
+                recargado = True
+                continue
+            
+            resultado = db.session.execute(
+                text("UPDATE ESPACIO SET ESTADO = 'OCUPADO' WHERE ID = :id AND ESTADO = 'DISPONIBLE'"),
+                {"id": espacio_id}
+            )
+            if resultado.rowcount == 1:
+                db.session.info.setdefault("espacios_reclamados", []).append(espacio_id)
+                return {"id": espacio_id, "numero": self.espacios[espacio_id][1]}
+            # Lo ocupó un sensor u otro proceso: se descarta y se prueba el siguiente
+
+    def hay_disponible(self, tipo_vehiculo):
+        """Indica si hay algún espacio libre del tipo, sin reclamarlo"""
+        with self.lock:
+            if self.libres.get(tipo_vehiculo):
+                return True
+        self.recargar_tipo(tipo_vehiculo)
+        with self.lock:
+            return bool(self.libres.get(tipo_vehiculo))
+
+    def liberar(self, espacio_id):
+        """Devuelve un espacio a su lista (salida o sensor que lo desocupa)"""
+        with self.lock:
+            datos = self.espacios.get(espacio_id)
+            if datos is None or espacio_id in self.en_lista:
+                return
+            self.libres.setdefault(datos[0], deque()).append(espacio_id)
+            self.en_lista.add(espacio_id)
+
+    def devolver(self, espacio_ids):
+        """Devuelve al frente de su lista los espacios de una transacción revertida"""
+        with self.lock:
+            for espacio_id in espacio_ids:
+                datos = self.espacios.get(espacio_id)
+                if datos is None or espacio_id in self.en_lista:
+                    continue
+                self.libres.setdefault(datos[0], deque()).appendleft(espacio_id)
+                self.en_lista.add(espacio_id)
+
+    def estadisticas(self):
+        """Espacios libres por tipo según las listas en memoria"""
+        with self.lock:
+            return {tipo: len(lista) for tipo, lista in self.libres.items()}
+
+asignador_espacios = AsignadorEspacios()
+
+@event.listens_for(Session, "after_commit")
+def confirmar_espacios_reclamados(session):
+    session.info.pop("espacios_reclamados", None)
+
+@event.listens_for(Session, "after_transaction_end")
+def devolver_espacios_reclamados(session, transaccion):
+    # Si la transacción raíz terminó sin commit (rollback o close), el UPDATE se revirtió
+    if transaccion.parent is None and session.info.get("espacios_reclamados"):
+        asignador_espacios.devolver(session.info.pop("espacios_reclamados"))
+
+# 🆕 BUS DE EVENTOS DE OCUPACIÓN (ALIMENTA /api/espacios/stream)
+class BusEventos:
+    """Reparte cada evento ya serializado a las colas de todos los dashboards suscritos"""
+
+    def __init__(self, tamano_cola=1000, maximo_suscriptores=None):
+        self.lock = threading.Lock()
+        self.suscriptores = set()
+        self.tamano_cola = tamano_cola
+        self.maximo_suscriptores = maximo_suscriptores
+        self.secuencia = 0
+
+    def suscribir(self):
+        """Retorna la cola del dashboard, o None si ya hay maximo_suscriptores conectados"""
+        suscripcion = queue.Queue(maxsize=self.tamano_cola)
+        with self.lock:
+            if self.maximo_suscriptores is not None and len(self.suscriptores) >= self.maximo_suscriptores:
+                return None
+            self.suscriptores.add(suscripcion)
+        return suscripcion
+
+    def cancelar(self, suscripcion):
+        with self.lock:
+            self.suscriptores.discard(suscripcion)
+
+    def publicar(self, tipo, datos):
+        with self.lock:
+            self.secuencia += 1
+            mensaje = f"id: {self.secuencia}\nevent: {tipo}\ndata: {json.dumps(datos, default=str)}\n\n"
+            suscriptores = list(self.suscriptores)
+        for suscripcion in suscriptores:
+            try:
+                suscripcion.put_nowait(mensaje)
+            except queue.Full:
+                # Cliente demasiado lento: se desconecta y al reconectar recibe un snapshot nuevo
+                self.cancelar(suscripcion)
+                suscripcion.queue.clear()
+                suscripcion.put_nowait(None)
+
+bus_eventos = BusEventos(maximo_suscriptores=MAXIMO_DASHBOARDS)
+
+def emitir_evento(tipo, **datos):
+    """Agrega un evento a la transacción actual; se publica solo si hay commit"""
+    db.session.info.setdefault("eventos_pendientes", []).append((tipo, datos))
+
+@event.listens_for(Session, "after_commit")
+def publicar_eventos_pendientes(session):
+    for tipo, datos in session.info.pop("eventos_pendientes", []):
+        bus_eventos.publicar(tipo, datos)
+
+@event.listens_for(Session, "after_transaction_end")
+def descartar_eventos_pendientes(session, transaccion):
+    if transaccion.parent is None:
+        session.info.pop("eventos_pendientes", None)
+
+# 🆕 SERVICIO DE TOKENS: ALEATORIOS, CON VIGENCIA E ÍNDICE EN MEMORIA DE LOS PENDIENTES
+# Los tokens salen de secrets (80 bits), no de la hora, así dos peticiones en el
+# mismo microsegundo no chocan con el UNIQUE de TOKEN. Las páginas y el QR validan
+# contra el índice; el consumo es un UPDATE condicional, así solo una petición gana.
+VIGENCIA_TOKENS = {"REGISTRO": 1800, "RECARGA": 1800}  # Segundos
+
+SQL_CONSUMIR_TOKEN = text("""
+    UPDATE TRANSACCION
+    SET ESTADO = 'CONFIRMADA',
+        MONTO = COALESCE(:monto, MONTO),
+        ID_USUARIO = COALESCE(:usuario_id, ID_USUARIO)
+    WHERE TOKEN = :token AND TIPO = :tipo AND ESTADO = 'PENDIENTE' AND FECHA >= :limite
+""").bindparams(bindparam("limite", type_=db.DateTime))
+
+class ServicioTokens:
+    """Emite, valida y consume los tokens de registro y recarga.
+
+    El índice guarda solo tokens PENDIENTES confirmados en la base de datos (se
+    agregan después del commit) y los olvida al vencer o al consumirse. Un fallo
+    del índice (por ejemplo después de reiniciar) se resuelve con una consulta.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pendientes = {}
+        self.vencimientos = []
+        self.por_tarjeta = {}
+        self.emitidos = 0
+        self.consumidos = 0
+        self.rechazados = 0
+        self.aciertos = 0
+        self.fallos = 0
+
+    def nuevo_token(self):
+        """Token aleatorio de 20 caracteres hexadecimales que no está pendiente"""
+        while True:
+            token = secrets.token_hex(10)
+            if token not in self.pendientes:
+                return token
+
+    def emitir(self, tipo, usuario_id=None, tarjeta_rfid=None, monto=0):
+        """Agrega la transacción PENDIENTE a la sesión y retorna el token; se indexa tras el commit"""
+        token = self.nuevo_token()
+        datos = {"tipo": tipo, "usuario_id": usuario_id, "tarjeta_rfid": tarjeta_rfid, "fecha": datetime.utcnow()}
+        db.session.add(Transaccion(
+            ID_USUARIO=usuario_id,
+            TIPO=tipo,
+            MONTO=monto,
+            ESTADO="PENDIENTE",
+            TOKEN=token,
+            TARJETA_RFID=tarjeta_rfid,
+            FECHA=datos["fecha"]
+        ))
+        db.session.info.setdefault("tokens_emitidos", []).append((token, datos))
+        return token
+
+    def registrar(self, token, datos, emitido=False):
+        vence = datos["fecha"] + timedelta(seconds=VIGENCIA_TOKENS[datos["tipo"]])
+        with self.lock:
+            self.emitidos += emitido
+            self.pendientes[token] = dict(datos, vence=vence)
+            heapq.heappush(self.vencimientos, (vence, token))
+            if datos["tipo"] == "REGISTRO" and datos["tarjeta_rfid"]:
+                # Un toque nuevo de la misma tarjeta reemplaza el registro anterior
+                anterior = self.por_tarjeta.get(datos["tarjeta_rfid"])
+                if anterior and anterior != token:
+                    self.pendientes.pop(anterior, None)
+                self.por_tarjeta[datos["tarjeta_rfid"]] = token
+
+    def olvidar(self, token, consumido=False):
+        with self.lock:
+            self.consumidos += consumido
+            datos = self.pendientes.pop(token, None)
+            if datos and self.por_tarjeta.get(datos["tarjeta_rfid"]) == token:
+                del self.por_tarjeta[datos["tarjeta_rfid"]]
+
+    def purgar(self, ahora=None):
+        """Saca del índice los tokens vencidos; retorna cuántos"""
+        ahora = ahora or datetime.utcnow()
+        purgados = 0
+        with self.lock:
+            while self.vencimientos and self.vencimientos[0][0] <= ahora:
+                vence, token = heapq.heappop(self.vencimientos)
+                datos = self.pendientes.get(token)
+                if datos and datos["vence"] == vence:
+                    del self.pendientes[token]
+                    if self.por_tarjeta.get(datos["tarjeta_rfid"]) == token:
+                        del self.por_tarjeta[datos["tarjeta_rfid"]]
+                    purgados += 1
+        return purgados
+
+    def leer_pendiente(self, token, tipo):
+        """Busca el token en la base de datos (fallo del índice)"""
+        limite = datetime.utcnow() - timedelta(seconds=VIGENCIA_TOKENS[tipo])
+        fila = db.session.query(
+            Transaccion.ID_USUARIO, Transaccion.TARJETA_RFID, Transaccion.FECHA
+        ).filter(
+            Transaccion.TOKEN == token, Transaccion.TIPO == tipo,
+            Transaccion.ESTADO == "PENDIENTE", Transaccion.FECHA >= limite
+        ).first()
+        if fila is None:
+            return None
+        return {"tipo": tipo, "usuario_id": fila[0], "tarjeta_rfid": fila[1], "fecha": fila[2]}
+
+    def validar(self, token, tipo):
+        """Retorna los datos del token si está PENDIENTE y vigente; None si no"""
+        if not token:
+            return None
+        self.purgar()
+        with self.lock:
+            datos = self.pendientes.get(token)
+            if datos is not None:
+                self.aciertos += 1
+                return datos if datos["tipo"] == tipo else None
+            self.fallos += 1
+
+        datos = self.leer_pendiente(token, tipo)
+        if datos is not None:
+            self.registrar(token, datos)
+        return datos
+
+    def consumir(self, token, tipo, monto=None, usuario_id=None):
+        """Marca el token CONFIRMADO en la transacción actual; False si otra petición ya lo usó o venció"""
+        limite = datetime.utcnow() - timedelta(seconds=VIGENCIA_TOKENS[tipo])
+        resultado = db.session.execute(SQL_CONSUMIR_TOKEN, {
+            "token": token, "tipo": tipo, "monto": monto, "usuario_id": usuario_id, "limite": limite
+        })
+        if resultado.rowcount != 1:
+            with self.lock:
+                self.rechazados += 1
+            self.olvidar(token)
+            return False
+        db.session.info.setdefault("tokens_consumidos", []).append(token)
+        return True
+
+    def cargar(self):
+        """Indexa los tokens pendientes y vigentes (se llama al iniciar)"""
+        limite = datetime.utcnow() - timedelta(seconds=max(VIGENCIA_TOKENS.values()))
+        filas = db.session.query(
+            Transaccion.TOKEN, Transaccion.TIPO, Transaccion.ID_USUARIO,
+            Transaccion.TARJETA_RFID, Transaccion.FECHA
+        ).filter(
+            Transaccion.ESTADO == "PENDIENTE", Transaccion.TOKEN.isnot(None),
+            Transaccion.TIPO.in_(list(VIGENCIA_TOKENS)), Transaccion.FECHA >= limite
+        ).order_by(Transaccion.FECHA).all()
+        for token, tipo, usuario_id, tarjeta_rfid, fecha in filas:
+            self.registrar(token, {"tipo": tipo, "usuario_id": usuario_id,
+                                   "tarjeta_rfid": tarjeta_rfid, "fecha": fecha})
+        self.purgar()
+        print(f"🎟️ Tokens pendientes indexados: {len(self.pendientes)}")
+
+    def estadisticas(self):
+        """Tokens pendientes en memoria y contadores de uso"""
+        with self.lock:
+            total = self.aciertos + self.fallos
+            return {
+                "pendientes": len(self.pendientes),
+                "emitidos": self.emitidos,
+                "consumidos": self.consumidos,
+                "rechazados": self.rechazados,
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+                "tasa_aciertos": round(self.aciertos / total * 100, 2) if total else 0
+            }
+
+servicio_tokens = ServicioTokens()
+
+@event.listens_for(Session, "after_commit")
+def indexar_tokens(session):
+    for token, datos in session.info.pop("tokens_emitidos", []):
+        servicio_tokens.registrar(token, datos, emitido=True)
+    for token in session.info.pop("tokens_consumidos", []):
+        servicio_tokens.olvidar(token, consumido=True)
+
+@event.listens_for(Session, "after_transaction_end")
+def descartar_tokens(session, transaccion):
+    if transaccion.parent is None:
+        session.info.pop("tokens_emitidos", None)
+        session.info.pop("tokens_consumidos", None)
+
+# 🆕 BARREDOR DE TRANSACCIONES PENDIENTES VENCIDAS
+# Cada toque de una tarjeta nueva y cada QR de recarga deja una fila PENDIENTE
+# que nadie cierra si el usuario no termina. Un hilo marca como EXPIRADA la que
+# pasó su VIGENCIA_TOKENS y borra las EXPIRADAS después de RETENCION_EXPIRADAS.
+# Trabaja en lotes pequeños encolados en el escritor único, cada uno una escritura
+# corta que se turna con las de las barreras en vez de pelearles el bloqueo de SQLite.
+INTERVALO_BARREDOR = 300          # Segundos entre pasadas
+LOTE_BARREDOR = 500               # Filas por transacción
+PAUSA_ENTRE_LOTES = 0.05          # Segundos: deja escribir a los endpoints entre lote y lote
+RETENCION_EXPIRADAS = 7           # Días que se conservan las EXPIRADAS antes de borrarlas
+INTERVALO_CORTES_SALDO = 3600     # Segundos entre cortes del libro de saldos
+
+SQL_EXPIRAR_PENDIENTES = text("""
+    UPDATE TRANSACCION SET ESTADO = 'EXPIRADA'
+    WHERE ID IN (
+        SELECT ID FROM TRANSACCION
+        WHERE TIPO = :tipo AND ESTADO = 'PENDIENTE' AND FECHA < :limite
+        ORDER BY FECHA LIMIT :lote
+    )
+""").bindparams(bindparam("limite", type_=db.DateTime))
+
+SQL_BORRAR_EXPIRADAS = text("""
+    DELETE FROM TRANSACCION
+    WHERE ID IN (
+        SELECT ID FROM TRANSACCION
+        WHERE TIPO = :tipo AND ESTADO = 'EXPIRADA' AND FECHA < :limite
+        ORDER BY FECHA LIMIT :lote
+    )
+""").bindparams(bindparam("limite", type_=db.DateTime))
+
+class BarredorTransacciones:
+    """Hilo en segundo plano que expira y borra transacciones pendientes abandonadas"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.detener = threading.Event()
+        self.hilo = None
+        self.pasadas = 0
+        self.expiradas = 0
+        self.borradas = 0
+        self.lotes = 0
+        self.errores = 0
+        self.ultima_pasada = None
+        self.duracion_ultima = 0.0
+        self.cortes_saldo = 0
+        self.ultimo_corte = None
+
+    def procesar_en_lotes(self, sentencia, tipo, limite):
+        """Ejecuta la sentencia lote por lote hasta que no afecte filas; retorna el total.
+        Cada lote es una escritura del escritor único, como los toques de las barreras."""
+        parametros = {"tipo": tipo, "limite": limite, "lote": LOTE_BARREDOR}
+        total = 0
+        while not self.detener.is_set():
+            afectadas = escritor_unico.ejecutar(lambda: db.session.execute(sentencia, parametros).rowcount, plazo=30)
+            with self.lock:
+                self.lotes += 1
+            total += afectadas
+            if afectadas < LOTE_BARREDOR:
+                break
+            time.sleep(PAUSA_ENTRE_LOTES)
+        return total
+
+    def barrer(self, ahora=None):
+        """Una pasada completa; retorna {"expiradas", "borradas"}"""
+        ahora = ahora or datetime.utcnow()
+        inicio = time.perf_counter()
+        expiradas = borradas = 0
+        for tipo, vigencia in VIGENCIA_TOKENS.items():
+            expiradas += self.procesar_en_lotes(
+                SQL_EXPIRAR_PENDIENTES, tipo, ahora - timedelta(seconds=vigencia))
+            borradas += self.procesar_en_lotes(
+                SQL_BORRAR_EXPIRADAS, tipo, ahora - timedelta(days=RETENCION_EXPIRADAS))
+        servicio_tokens.purgar(ahora)
+        dias_cerrados = cerrar_dias_recientes(ahora.date())
+        cortes = 0
+        if self.ultimo_corte is None or ahora - self.ultimo_corte >= timedelta(seconds=INTERVALO_CORTES_SALDO):
+            cortes = escritor_unico.ejecutar(tomar_cortes_saldo, plazo=30)
+            self.ultimo_corte = ahora
+        with self.lock:
+            self.cortes_saldo += cortes
+            self.pasadas += 1
+            self.expiradas += expiradas
+            self.borradas += borradas
+            self.ultima_pasada = ahora
+            self.duracion_ultima = time.perf_counter() - inicio
+        if expiradas or borradas:
+            bitacora_fondo.info("barredor_pasada", expiradas=expiradas, borradas=borradas)
+        return {"expiradas": expiradas, "borradas": borradas, "dias_cerrados": dias_cerrados}
+
+    def ejecutar(self):
+        while not self.detener.wait(INTERVALO_BARREDOR):
+            try:
+                with app.app_context():
+                    self.barrer()
+            except Exception as e:
+                with self.lock:
+                    self.errores += 1
+                bitacora_fondo.error("barredor_error", error=str(e))
+
+    def iniciar(self):
+        """Arranca el hilo (una sola vez por proceso)"""
+        if self.hilo is None:
+            self.hilo = threading.Thread(target=self.ejecutar, name="barredor-transacciones", daemon=True)
+            self.hilo.start()
+
+    def estadisticas(self):
+        """Filas recuperadas y tiempos de las pasadas"""
+        with self.lock:
+            return {
+                "activo": self.hilo is not None and self.hilo.is_alive(),
+                "intervalo_segundos": INTERVALO_BARREDOR,
+                "pasadas": self.pasadas,
+                "lotes": self.lotes,
+                "expiradas": self.expiradas,
+                "borradas": self.borradas,
+                "errores": self.errores,
+                "cortes_saldo": self.cortes_saldo,
+                "ultima_pasada": self.ultima_pasada.strftime('%Y-%m-%d %H:%M:%S') if self.ultima_pasada else None,
+                "duracion_ultima_ms": round(self.duracion_ultima * 1000, 2)
+            }
+
+barredor_transacciones = BarredorTransacciones()
+
+# 🆕 ESCRITOR ÚNICO: UNA COLA DE TRANSACCIONES CORTAS CON COMMIT EN GRUPO
+# SQLite admite un solo escritor. En vez de que cada hilo pelee el bloqueo (y
+# pierda con "database is locked" en hora pico), las rutas de las barreras y los
+# sensores encolan una función con sus escrituras. Un hilo dedicado toma todas las
+# que haya en la cola, abre BEGIN IMMEDIATE, ejecuta cada una en su SAVEPOINT (si
+# una falla solo se revierte esa) y hace un solo COMMIT por grupo. Quien encola
+# espera su resultado; si su plazo vence antes de empezar, recibe EscrituraVencida.
+PLAZO_ESCRITURA = 2.0       # Segundos que una escritura puede esperar turno en la cola
+MAXIMO_GRUPO_ESCRITURA = 64  # Trabajos por COMMIT
+
+class EscrituraVencida(Exception):
+    """La escritura no alcanzó a empezar antes de su plazo"""
+
+class TrabajoEscritura:
+    def __init__(self, funcion, plazo):
+        self.funcion = funcion
+        self.vence = time.monotonic() + plazo
+        self.encolado = time.perf_counter()
+        self.estado = "EN_COLA"  # EN_COLA, EJECUTANDO, VENCIDO
+        self.resultado = None
+        self.error = None
+        self.listo = threading.Event()
+        self.medicion = getattr(metricas_hilo, "medicion", None)  # El SQL del trabajo cuenta para la petición
+
+class EscritorUnico:
+    """Hilo que ejecuta las escrituras encoladas en grupos con un solo COMMIT"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cola = queue.Queue()
+        self.hilo = None
+        self.grupos = 0
+        self.trabajos = 0
+        self.fallidos = 0
+        self.vencidos = 0
+        self.grupo_maximo = 0
+        self.espera_maxima = 0.0
+        self.duracion_ultimo_grupo = 0.0
+
+    def iniciar(self):
+        with self.lock:
+            if self.hilo is None:
+                self.hilo = threading.Thread(target=self.ejecutar_hilo, name="escritor-unico", daemon=True)
+                self.hilo.start()
+
+    def ejecutar(self, funcion, plazo=PLAZO_ESCRITURA):
+        """Encola la función y retorna su resultado (o relanza su excepción).
+
+        La función corre en el hilo escritor con su propia db.session, dentro de la
+        transacción del grupo: no debe hacer commit ni tocar objetos ORM de la sesión
+        del llamador. Los eventos, comandos y espacios que registre se publican al
+        hacer commit, igual que en una petición normal.
+        """
+        if threading.current_thread() is self.hilo:
+            return funcion()
+        self.iniciar()
+        trabajo = TrabajoEscritura(funcion, plazo)
+        self.cola.put(trabajo)
+        if not trabajo.listo.wait(plazo):
+            with self.lock:
+                if trabajo.estado == "EN_COLA":
+                    trabajo.estado = "VENCIDO"
+                    self.vencidos += 1
+                    raise EscrituraVencida(f"La escritura esperó más de {plazo} s en la cola")
+            trabajo.listo.wait()  # Ya empezó: es corta, se espera el COMMIT
+        if trabajo.error is not None:
+            raise trabajo.error
+        return trabajo.resultado
+
+    def ejecutar_hilo(self):
+        with app.app_context():
+            while True:
+                trabajos = [self.cola.get()]
+                while len(trabajos) < MAXIMO_GRUPO_ESCRITURA:
+                    try:
+                        trabajos.append(self.cola.get_nowait())
+                    except queue.Empty:
+                        break
+                try:
+                    self.procesar_grupo(trabajos)
+                except Exception as e:
+                    bitacora_fondo.error("escritor_error", error=str(e))
+
+    def tomar_vigentes(self, trabajos):
+        ahora = time.monotonic()
+        vigentes = []
+        with self.lock:
+            for trabajo in trabajos:
+                if trabajo.estado != "EN_COLA":
+                    continue  # El llamador ya se rindió
+                if trabajo.vence < ahora:
+                    trabajo.estado = "VENCIDO"
+                    trabajo.error = EscrituraVencida("La escritura venció en la cola")
+                    self.vencidos += 1
+                    trabajo.listo.set()
+                    continue
+                trabajo.estado = "EJECUTANDO"
+                self.espera_maxima = max(self.espera_maxima, time.perf_counter() - trabajo.encolado)
+                vigentes.append(trabajo)
+        return vigentes
+
+    def procesar_grupo(self, trabajos):
+        vigentes = self.tomar_vigentes(trabajos)
+        if not vigentes:
+            return
+        inicio = time.perf_counter()
+        try:
+            # Toma el bloqueo de escritura al empezar (y espera busy_timeout si lo tiene otro proceso)
+            db.session.connection().exec_driver_sql("BEGIN IMMEDIATE")
+            if len(vigentes) == 1:
+                # Sin compañeros de grupo no hace falta SAVEPOINT: si falla se revierte todo
+                with medir_sql_para(vigentes[0].medicion):
+                    vigentes[0].resultado = vigentes[0].funcion()
+            else:
+                self.ejecutar_con_savepoints(vigentes)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            for trabajo in vigentes:
+                if trabajo.error is None:
+                    trabajo.error = e
+        finally:
+            db.session.close()
+        
+        fallidos = sum(1 for trabajo in vigentes if trabajo.error is not None)
+        with self.lock:
+            self.grupos += 1
+            self.trabajos += len(vigentes)
+            self.fallidos += fallidos
+            self.grupo_maximo = max(self.grupo_maximo, len(vigentes))
+            self.duracion_ultimo_grupo = time.perf_counter() - inicio
+        for trabajo in vigentes:
+            trabajo.listo.set()
+
+    def ejecutar_con_savepoints(self, vigentes):
+        """Cada trabajo en su SAVEPOINT: el que falla se revierte sin tumbar al resto del grupo"""
+        for trabajo in vigentes:
+            marcas = marcar_info_sesion(db.session.info)
+            punto = db.session.begin_nested()
+            try:
+                with medir_sql_para(trabajo.medicion):
+                    trabajo.resultado = trabajo.funcion()
+                punto.commit()
+            except Exception as e:
+                punto.rollback()
+                revertir_info_sesion(db.session.info, marcas)
+                trabajo.error = e
+
+    def estadisticas(self):
+        """Cola, grupos y trabajos vencidos del escritor"""
+        with self.lock:
+            return {
+                "activo": self.hilo is not None and self.hilo.is_alive(),
+                "en_cola": self.cola.qsize(),
+                "grupos": self.grupos,
+                "trabajos": self.trabajos,
+                "trabajos_por_grupo": round(self.trabajos / self.grupos, 2) if self.grupos else 0,
+                "grupo_maximo": self.grupo_maximo,
+                "fallidos": self.fallidos,
+                "vencidos": self.vencidos,
+                "espera_maxima_ms": round(self.espera_maxima * 1000, 2),
+                "duracion_ultimo_grupo_ms": round(self.duracion_ultimo_grupo * 1000, 2)
+            }
+
+def marcar_info_sesion(info):
+    """Largo de cada lista de session.info antes de un trabajo"""
+    return {clave: len(valor) for clave, valor in info.items() if isinstance(valor, list)}
+
+def revertir_info_sesion(info, marcas):
+    """Quita lo que agregó un trabajo revertido (eventos, tokens, espacios reclamados)"""
+    for clave in list(info):
+        valor = info[clave]
+        if not isinstance(valor, list):
+            continue
+        marca = marcas.get(clave, 0)
+        if clave == "espacios_reclamados" and len(valor) > marca:
+            asignador_espacios.devolver(valor[marca:])
+        del valor[marca:]
+
+escritor_unico = EscritorUnico()
+
+# 🆕 MOVIMIENTOS DE SALDO: UPDATE ATÓMICO + FILA EN EL LIBRO, EN LA MISMA TRANSACCIÓN
+# USUARIO.SALDO sigue siendo el saldo vigente (lectura O(1)); el débito lleva la
+# condición SALDO >= monto, así dos cobros simultáneos no dejan el saldo negativo
+# ni se pisan. CORTE_SALDO guarda cada tanto el saldo reproducido por usuario
+# para que la auditoría sume solo los movimientos posteriores al último corte.
+class SaldoInsuficiente(Exception):
+    """El débito no se aplicó porque el saldo no alcanza"""
+
+SQL_ABONAR_SALDO = text("UPDATE USUARIO SET SALDO = COALESCE(SALDO, 0) + :monto WHERE ID = :usuario_id")
+SQL_DEBITAR_SALDO = text("UPDATE USUARIO SET SALDO = SALDO - :monto WHERE ID = :usuario_id AND SALDO >= :monto")
+
+def registrar_movimiento(usuario_id, tipo, monto, referencia):
+    # Un NaN o un infinito en el libro rompería la suma de los cortes para siempre
+    if not math.isfinite(monto):
+        raise ValueError(f"Monto inválido para el libro de saldo: {monto}")
+    saldo = float(db.session.query(Usuario.SALDO).filter_by(ID=usuario_id).scalar())
+    db.session.add(MovimientoSaldo(
+        ID_USUARIO=usuario_id,
+        FECHA=datetime.utcnow(),
+        TIPO=tipo,
+        MONTO=monto,
+        SALDO_RESULTANTE=saldo,
+        REFERENCIA=referencia
+    ))
+    return saldo
+
+def abonar_saldo(usuario_id, monto, tipo="RECARGA", referencia=None):
+    """Suma al saldo y lo anota en el libro (sin commit); retorna el saldo nuevo.
+    Lanza ValueError si el monto no es un número finito mayor que cero."""
+    if not math.isfinite(monto) or monto <= 0:
+        raise ValueError(f"El abono debe ser mayor que cero: {monto}")
+    db.session.execute(SQL_ABONAR_SALDO, {"usuario_id": usuario_id, "monto": monto})
+    return registrar_movimiento(usuario_id, tipo, monto, referencia)
+
+def debitar_saldo(usuario_id, monto, tipo="COBRO", referencia=None):
+    """Resta del saldo solo si alcanza (sin commit); retorna el saldo nuevo o lanza SaldoInsuficiente"""
+    # Un débito negativo sería un abono que no pasa por abonar_saldo
+    if not math.isfinite(monto) or monto < 0:
+        raise ValueError(f"El débito no puede ser negativo: {monto}")
+    if db.session.execute(SQL_DEBITAR_SALDO, {"usuario_id": usuario_id, "monto": monto}).rowcount != 1:
+        raise SaldoInsuficiente(f"Saldo insuficiente para debitar {monto}")
+    return registrar_movimiento(usuario_id, tipo, -monto, referencia)
+
+# Último corte de cada usuario (o ninguno) y lo que suman los movimientos posteriores
+SQL_ULTIMO_CORTE = """
+    LEFT JOIN CORTE_SALDO C ON C.ID_USUARIO = U.ID
+         AND C.ID_MOVIMIENTO = (SELECT MAX(ID_MOVIMIENTO) FROM CORTE_SALDO WHERE ID_USUARIO = U.ID)
+"""
+
+SQL_TOMAR_CORTES = text("""
+    INSERT INTO CORTE_SALDO (ID_USUARIO, ID_MOVIMIENTO, SALDO, FECHA)
+    SELECT U.ID, MAX(M.ID), COALESCE(C.SALDO, 0) + SUM(M.MONTO), :fecha
+    FROM USUARIO U
+    """ + SQL_ULTIMO_CORTE + """
+    JOIN MOVIMIENTO_SALDO M ON M.ID_USUARIO = U.ID AND M.ID > COALESCE(C.ID_MOVIMIENTO, 0)
+    GROUP BY U.ID
+""").bindparams(bindparam("fecha", type_=db.DateTime))
+
+SQL_AUDITAR_SALDOS = """
+    SELECT U.ID, U.NOMBRE, U.SALDO, C.ID_MOVIMIENTO, C.SALDO, C.FECHA,
+           COUNT(M.ID), COALESCE(C.SALDO, 0) + COALESCE(SUM(M.MONTO), 0)
+    FROM USUARIO U
+    """ + SQL_ULTIMO_CORTE + """
+    LEFT JOIN MOVIMIENTO_SALDO M ON M.ID_USUARIO = U.ID AND M.ID > COALESCE(C.ID_MOVIMIENTO, 0)
+    {filtro}
+    GROUP BY U.ID
+    ORDER BY U.ID
+"""
+
+def tomar_cortes_saldo():
+    """Corta el saldo de cada usuario con movimientos nuevos (sin commit); retorna cuántos"""
+    return db.session.execute(SQL_TOMAR_CORTES, {"fecha": datetime.utcnow()}).rowcount
+
+def auditar_saldos(usuario_id=None):
+    """Compara USUARIO.SALDO con el último corte más los movimientos posteriores"""
+    filtro = "WHERE U.ID = :usuario_id" if usuario_id is not None else ""
+    filas = db.session.execute(text(SQL_AUDITAR_SALDOS.format(filtro=filtro)), {"usuario_id": usuario_id})
+    resultado = []
+    for uid, nombre, saldo, corte_movimiento, corte_saldo, corte_fecha, reproducidos, calculado in filas:
+        saldo = float(saldo or 0)
+        calculado = float(calculado or 0)
+        resultado.append({
+            "usuario_id": uid,
+            "nombre": nombre,
+            "saldo": saldo,
+            "saldo_libro": round(calculado, 2),
+            "diferencia": round(saldo - calculado, 2),
+            "ok": abs(saldo - calculado) < 0.005,
+            "ultimo_corte": {
+                "id_movimiento": corte_movimiento,
+                "saldo": float(corte_saldo),
+                "fecha": str(corte_fecha)[:19]
+            } if corte_movimiento else None,
+            "movimientos_reproducidos": reproducidos
+        })
+    return resultado
+
+# 🆕 CONTADORES DIARIOS: UN UPSERT POR EVENTO EN VEZ DE 8 COUNT/SUM POR REFRESCO DEL DASHBOARD
+# Las entradas, salidas y el recaudo se cuentan por tipo de vehículo; las
+# recargas y los usuarios nuevos no dependen del vehículo y van en la fila GENERAL.
+# La fecha es la del timestamp guardado, igual que en los filtros de rango_dia.
+TIPO_GENERAL = "GENERAL"
+
+SQL_SUMAR_CONTADORES = text("""
+    INSERT INTO CONTADOR_DIARIO (FECHA, TIPO_VEHICULO, ENTRADAS, SALIDAS, RECAUDO,
+                                 RECARGAS, MONTO_RECARGAS, USUARIOS_NUEVOS)
+    VALUES (:fecha, :tipo, :entradas, :salidas, :recaudo, :recargas, :monto_recargas, :usuarios_nuevos)
+    ON CONFLICT (FECHA, TIPO_VEHICULO) DO UPDATE SET
+        ENTRADAS = ENTRADAS + excluded.ENTRADAS,
+        SALIDAS = SALIDAS + excluded.SALIDAS,
+        RECAUDO = RECAUDO + excluded.RECAUDO,
+        RECARGAS = RECARGAS + excluded.RECARGAS,
+        MONTO_RECARGAS = MONTO_RECARGAS + excluded.MONTO_RECARGAS,
+        USUARIOS_NUEVOS = USUARIOS_NUEVOS + excluded.USUARIOS_NUEVOS
+""")
+
+def parametros_contadores(fecha, tipo, entradas=0, salidas=0, recaudo=0.0, recargas=0,
+                          monto_recargas=0.0, usuarios_nuevos=0):
+    return {
+        "fecha": fecha.isoformat(),
+        "tipo": tipo,
+        "entradas": entradas,
+        "salidas": salidas,
+        "recaudo": float(recaudo),
+        "recargas": recargas,
+        "monto_recargas": float(monto_recargas),
+        "usuarios_nuevos": usuarios_nuevos
+    }
+
+def sumar_contadores(momento, tipo_vehiculo=TIPO_GENERAL, **incrementos):
+    """Suma a los contadores del día de `momento` dentro de la transacción actual (sin commit)"""
+    db.session.execute(SQL_SUMAR_CONTADORES,
+                       parametros_contadores(momento.date(), tipo_vehiculo or TIPO_GENERAL, **incrementos))
+
+SQL_LEER_CONTADORES = text("""
+    SELECT COALESCE(SUM(ENTRADAS), 0), COALESCE(SUM(SALIDAS), 0), COALESCE(SUM(RECAUDO), 0),
+           COALESCE(SUM(RECARGAS), 0), COALESCE(SUM(MONTO_RECARGAS), 0), COALESCE(SUM(USUARIOS_NUEVOS), 0),
+           (SELECT COUNT(*) FROM ESPACIO WHERE ESTADO = 'OCUPADO'),
+           (SELECT COUNT(*) FROM ESPACIO WHERE ESTADO = 'DISPONIBLE')
+    FROM CONTADOR_DIARIO WHERE FECHA = :fecha
+""")
+
+def leer_contadores(fecha):
+    """Totales del día y ocupación actual en una sola sentencia"""
+    (entradas, salidas, recaudo, recargas, monto_recargas, usuarios_nuevos,
+     ocupados, disponibles) = db.session.execute(SQL_LEER_CONTADORES, {"fecha": fecha.isoformat()}).one()
+    return {
+        "fecha": fecha,
+        "entradas": entradas,
+        "salidas": salidas,
+        "recaudo": float(recaudo),
+        "recargas": recargas,
+        "monto_recargas": float(monto_recargas),
+        "usuarios_nuevos": usuarios_nuevos,
+        "espacios_ocupados": ocupados,
+        "espacios_disponibles": disponibles
+    }
+
+# Reconstrucción desde las tablas crudas, agrupada por día (y tipo cuando aplica)
+SQL_RECONSTRUIR_CONTADORES = [
+    ("entradas", text("""
+        SELECT date(E.FECHA_ENTRADA), V.TIPO, COUNT(*)
+        FROM ENTRADA E JOIN VEHICULO V ON V.ID = E.ID_VEHICULO
+        WHERE E.FECHA_ENTRADA >= :inicio AND E.FECHA_ENTRADA < :fin
+        GROUP BY date(E.FECHA_ENTRADA), V.TIPO""")),
+    ("salidas", text("""
+        SELECT date(E.FECHA_SALIDA), V.TIPO, COUNT(*), COALESCE(SUM(E.MONTO_COBRADO), 0)
+        FROM ENTRADA E JOIN VEHICULO V ON V.ID = E.ID_VEHICULO
+        WHERE E.FECHA_SALIDA >= :inicio AND E.FECHA_SALIDA < :fin AND E.ESTADO = 'FINALIZADA'
+        GROUP BY date(E.FECHA_SALIDA), V.TIPO""")),
+    ("recargas", text("""
+        SELECT date(FECHA), 'GENERAL', COUNT(*), COALESCE(SUM(MONTO), 0)
+        FROM TRANSACCION
+        WHERE TIPO = 'RECARGA' AND ESTADO = 'CONFIRMADA' AND FECHA >= :inicio AND FECHA < :fin
+        GROUP BY date(FECHA)""")),
+    ("usuarios_nuevos", text("""
+        SELECT date(FECHA_REGISTRO), 'GENERAL', COUNT(*)
+        FROM USUARIO
+        WHERE FECHA_REGISTRO >= :inicio AND FECHA_REGISTRO < :fin
+        GROUP BY date(FECHA_REGISTRO)""")),
+]
+
+def reconstruir_contadores(conexion, desde=None, hasta=None):
+    """Borra y recalcula CONTADOR_DIARIO entre dos fechas (por defecto todo el historial)"""
+    desde = desde or date(1970, 1, 1)
+    hasta = hasta or hoy_utc() + timedelta(days=1)
+    conexion.execute(text("DELETE FROM CONTADOR_DIARIO WHERE FECHA >= :desde AND FECHA <= :hasta"),
+                     {"desde": desde.isoformat(), "hasta": hasta.isoformat()})
+    
+    rango = {"inicio": rango_dia(desde)[0], "fin": rango_dia(hasta)[1]}
+    filas = []
+    for metrica, sql in SQL_RECONSTRUIR_CONTADORES:
+        for dia, tipo, *valores in conexion.execute(sql, rango):
+            dia = date.fromisoformat(dia)
+            if metrica == "entradas":
+                filas.append(parametros_contadores(dia, tipo, entradas=valores[0]))
+            elif metrica == "salidas":
+                filas.append(parametros_contadores(dia, tipo, salidas=valores[0], recaudo=valores[1]))
+            elif metrica == "recargas":
+                filas.append(parametros_contadores(dia, tipo, recargas=valores[0], monto_recargas=valores[1]))
+            else:
+                filas.append(parametros_contadores(dia, tipo, usuarios_nuevos=valores[0]))
+    if filas:
+        conexion.execute(SQL_SUMAR_CONTADORES, filas)
+    return len(filas)
 
 # ENDPOINTS PRINCIPALES
 @app.route("/")
@@ -128,85 +1942,115 @@ def index():
 @app.route("/api/salida/detectar", methods=["POST"])
 def detectar_salida():
     """Procesa la salida de un vehículo y genera factura"""
+    data = request.get_json(silent=True) or {}
+    respuesta, codigo = procesar_salida(str(data.get("tarjeta_rfid", "")).strip().upper())
+    return jsonify(respuesta), codigo
+
+def procesar_salida(tarjeta_rfid):
+    """Salida con cobro y factura; la usan /api/salida/detectar y el protocolo v2. Retorna (respuesta, código)"""
     try:
-        data = request.get_json() or {}
-        tarjeta_rfid = data.get("tarjeta_rfid", "").strip().upper()
-        
         if not tarjeta_rfid:
-            return jsonify({"error": "Tarjeta RFID requerida"}), 400
+            return {"error": "Tarjeta RFID requerida"}, 400
         
-        print(f"🚗 SALIDA detectada - Tarjeta RFID: {tarjeta_rfid}")
+        bitacora_barrera.debug("salida_detectada", tarjeta=tarjeta_rfid)
         
-        # Buscar usuario
-        usuario = Usuario.query.filter_by(TARJETA_RFID=tarjeta_rfid).first()
-        if not usuario:
-            return jsonify({"error": "Usuario no encontrado"}), 404
-        
-        # Buscar entrada activa
-        entrada_activa = Entrada.query.filter_by(
-            ID_USUARIO=usuario.ID, 
-            ESTADO="ACTIVA"
-        ).first()
+        # Buscar usuario y entrada activa en el índice RFID
+        registro = indice_rfid.obtener(tarjeta_rfid)
+        if not registro:
+            return {"error": "Usuario no encontrado"}, 404
         
+        entrada_activa = registro["entrada"]
         if not entrada_activa:
-            return jsonify({"error": "No tiene entrada activa"}), 400
+            return {"error": "No tiene entrada activa"}, 400
         
         # Calcular tiempo y monto
-        tiempo_estacionado = datetime.utcnow() - entrada_activa.FECHA_ENTRADA
-        horas = max(1, tiempo_estacionado.total_seconds() / 3600)
-        
-        vehiculo = Vehiculo.query.get(entrada_activa.ID_VEHICULO)
-        tarifa = Tarifa.query.filter_by(TIPO_VEHICULO=vehiculo.TIPO, ACTIVA=True).first()
-        
-        if tarifa:
-            monto_cobrar = float(tarifa.TARIFA_HORA) * horas
-            monto_cobrar = max(monto_cobrar, float(tarifa.TARIFA_MINIMA))
-        else:
-            monto_cobrar = 2000.0
+        fecha_salida = datetime.utcnow()
+        tiempo_estacionado = fecha_salida - entrada_activa["fecha_entrada"]
+        cobro = motor_tarifas.cotizar(entrada_activa["tipo"], entrada_activa["fecha_entrada"], fecha_salida)
+        monto_cobrar = cobro["monto"]
         
         # Verificar saldo suficiente
-        if float(usuario.SALDO) < monto_cobrar:
-            return jsonify({
+        saldo_actual = registro["saldo"]
+        if saldo_actual < monto_cobrar:
+            return {
                 "accion": "SALDO_INSUFICIENTE_SALIDA",
                 "mensaje": "Saldo insuficiente para pagar estacionamiento",
                 "monto_requerido": monto_cobrar,
-                "saldo_actual": float(usuario.SALDO),
+                "saldo_actual": saldo_actual,
                 "comando": "MOSTRAR_ALERTA"
-            }), 200
-        
-        # Cobrar y finalizar entrada
-        usuario.SALDO = float(usuario.SALDO) - monto_cobrar
-        entrada_activa.FECHA_SALIDA = datetime.utcnow()
-        entrada_activa.ESTADO = "FINALIZADA"
-        entrada_activa.MONTO_COBRADO = monto_cobrar
-        entrada_activa.TIEMPO_ESTACIONADO = str(tiempo_estacionado).split('.')[0]
+            }, 200
+        
+        # Finalizar entrada, cobrar y liberar espacio en una sola transacción (escritor único)
+        def finalizar_salida():
+            finalizadas = Entrada.query.filter_by(ID=entrada_activa["id"], ESTADO="ACTIVA").update({
+                Entrada.FECHA_SALIDA: fecha_salida,
+                Entrada.ESTADO: "FINALIZADA",
+                Entrada.MONTO_COBRADO: monto_cobrar,
+                Entrada.TIEMPO_ESTACIONADO: str(tiempo_estacionado).split('.')[0]
+            }, synchronize_session=False)
+            if not finalizadas:
+                return None
+            
+            # Si el saldo ya no alcanza lanza SaldoInsuficiente y se revierte la salida completa
+            nuevo_saldo = debitar_saldo(registro["usuario_id"], monto_cobrar,
+                                        referencia=f"ENTRADA:{entrada_activa['id']}")
+            if entrada_activa["espacio_id"]:
+                Espacio.query.filter_by(ID=entrada_activa["espacio_id"]).update({
+                    Espacio.ESTADO: "DISPONIBLE",
+                    Espacio.ID_ENTRADA_ACTUAL: None
+                }, synchronize_session=False)
+            
+            sumar_contadores(fecha_salida, entrada_activa["tipo"], salidas=1, recaudo=monto_cobrar)
+            guardar_factura(entrada_activa["id"], cobro["tarifa_hora"])
+            emitir_evento("entrada", accion="FINALIZADA", id=entrada_activa["id"],
+                          espacio=entrada_activa["espacio"], usuario=registro["nombre"],
+                          placa=entrada_activa["placa"], monto_cobrado=monto_cobrar)
+            return nuevo_saldo
         
-        # Liberar espacio
-        if entrada_activa.espacio:
-            entrada_activa.espacio.ESTADO = "DISPONIBLE"
-            entrada_activa.espacio.ID_ENTRADA_ACTUAL = None
+        try:
+            nuevo_saldo = escritor_unico.ejecutar(finalizar_salida)
+        except SaldoInsuficiente:
+            # Otro cobro se adelantó: el saldo del índice estaba desactualizado
+            indice_rfid.invalidar(tarjeta_rfid)
+            return {
+                "accion": "SALDO_INSUFICIENTE_SALIDA",
+                "mensaje": "Saldo insuficiente para pagar estacionamiento",
+                "monto_requerido": monto_cobrar,
+                "comando": "MOSTRAR_ALERTA"
+            }, 200
+        if nuevo_saldo is None:
+            # El índice tenía una entrada que ya no está activa
+            indice_rfid.invalidar(tarjeta_rfid)
+            return {"error": "No tiene entrada activa"}, 400
         
-        db.session.commit()
+        indice_rfid.actualizar(tarjeta_rfid, saldo=nuevo_saldo, entrada=None)
+        if entrada_activa["espacio_id"]:
+            asignador_espacios.liberar(entrada_activa["espacio_id"])
+        usuario_nombre = registro["nombre"]
         
-        print(f"✅ SALIDA EXITOSA - Usuario: {usuario.NOMBRE}, Monto: {monto_cobrar}")
+        bitacora_barrera.info("salida_registrada", usuario_id=registro["usuario_id"],
+                              entrada_id=entrada_activa["id"], monto=monto_cobrar)
         
-        factura_url = f"http://{obtener_ip_servidor()}:5000/api/factura/generar/{entrada_activa.ID}"
+        factura_url = f"http://{obtener_ip_servidor()}:5000/api/factura/generar/{entrada_activa['id']}"
         
-        return jsonify({
+        return {
             "accion": "SALIDA_PERMITIDA",
             "mensaje": "Salida exitosa",
-            "usuario": usuario.NOMBRE,
+            "usuario": usuario_nombre,
             "tiempo_estacionado": str(tiempo_estacionado),
             "monto_cobrado": monto_cobrar,
-            "nuevo_saldo": float(usuario.SALDO),
+            "nuevo_saldo": nuevo_saldo,
             "factura_url": factura_url,  # 🆕 URL de la factura
             "comando": "ABRIR_BARRERA"
-        }), 200
+        }, 200
         
+    except EscrituraVencida as e:
+        bitacora_barrera.advertencia("salida_sin_turno", error=str(e))
+        return {"error": "Servidor ocupado, intente de nuevo", "comando": "MOSTRAR_ALERTA"}, 503
     except Exception as e:
         db.session.rollback()
-        print(f"❌ Error en salida: {str(e)}")
-        return jsonify({"error": f"Error en el servidor: {str(e)}"}), 500
+        bitacora_barrera.error("salida_error", error=str(e))
+        return {"error": f"Error en el servidor: {str(e)}"}, 500
 # ✅ ENDPOINT DE ENTRADA MEJORADO CON ESPACIOS
 # ✅ ENDPOINT SIMPLIFICADO DE ENTRADA - SIEMPRE RESPONDE Y REGISTRA
 # 🆕 MODIFICAR EL ENDPOINT DE ENTRADA PARA USAR PLACA
@@ -214,150 +2058,279 @@ def detectar_salida():
 @app.route("/api/entrada/detectar", methods=["POST"])
 def detectar_entrada():
     """Paso 1: Verifica estado y luego decide si abre barrera"""
+    data = request.get_json(silent=True) or {}
+    respuesta, codigo = procesar_entrada(str(data.get("tarjeta_rfid", "")).strip().upper())
+    return jsonify(respuesta), codigo
+
+def procesar_entrada(tarjeta_rfid):
+    """Entrada con espacio asignado o registro de usuario nuevo; la usan /api/entrada/detectar y el protocolo v2"""
     try:
-        data = request.get_json() or {}
-        tarjeta_rfid = data.get("tarjeta_rfid", "").strip().upper()
-        
         if not tarjeta_rfid:
-            return jsonify({"error": "Tarjeta RFID requerida"}), 400
+            return {"error": "Tarjeta RFID requerida"}, 400
         
-        print(f"🚗 Vehículo detectado - Tarjeta RFID: {tarjeta_rfid}")
+        bitacora_barrera.debug("entrada_detectada", tarjeta=tarjeta_rfid)
         
-        # ✅ 1. BUSCAR USUARIO EN BASE DE DATOS
-        usuario = Usuario.query.filter_by(TARJETA_RFID=tarjeta_rfid).first()
+        # ✅ 1. BUSCAR USUARIO EN EL ÍNDICE RFID
+        registro = indice_rfid.obtener(tarjeta_rfid)
         
-        if usuario:
+        if registro:
             # Usuario existe - verificar saldo
-            saldo_actual = float(usuario.SALDO) if usuario.SALDO else 0.0
+            saldo_actual = registro["saldo"]
             tarifa_minima = obtener_tarifa_minima()
             
-            print(f"👤 Usuario: {usuario.NOMBRE}")
-            print(f"💰 Saldo actual: {saldo_actual}")
-            print(f"🎯 Mínimo requerido: {tarifa_minima}")
-            
             # ✅ VERIFICAR SI YA TIENE ENTRADA ACTIVA
-            entrada_activa = Entrada.query.filter_by(
-                ID_USUARIO=usuario.ID, 
-                ESTADO="ACTIVA"
-            ).first()
+            entrada_activa = registro["entrada"]
             
             if entrada_activa:
-                return jsonify({
+                return {
                     "accion": "ENTRADA_DUPLICADA",
                     "mensaje": "Ya tiene una entrada activa",
-                    "usuario": usuario.NOMBRE,
-                    "placa": entrada_activa.vehiculo.PLACA,
+                    "usuario": registro["nombre"],
+                    "placa": entrada_activa["placa"],
                     "comando": "MOSTRAR_ALERTA"
-                }), 200
+                }, 200
+            
+            vehiculo = registro["vehiculo"]
             
             # ✅ VERIFICAR SALDO SUFICIENTE
             if saldo_actual < tarifa_minima:
-                return jsonify({
+                return {
                     "accion": "SALDO_INSUFICIENTE",
                     "mensaje": "Saldo insuficiente. Recargue para ingresar",
-                    "usuario": usuario.NOMBRE,
-                    "placa": usuario.vehiculos[0].PLACA if usuario.vehiculos else "SIN PLACA",
+                    "usuario": registro["nombre"],
+                    "placa": vehiculo["placa"] if vehiculo else "SIN PLACA",
                     "saldo_actual": saldo_actual,
                     "saldo_minimo": tarifa_minima,
                     "comando": "MOSTRAR_ALERTA"
-                }), 200
+                }, 200
             
             # ✅ BUSCAR ESPACIO DISPONIBLE ANTES DE PERMITIR ENTRADA
-            vehiculo = Vehiculo.query.filter_by(ID_USUARIO=usuario.ID).first()
             if not vehiculo:
-                return jsonify({"error": "No tiene vehículo registrado"}), 400
+                return {"error": "No tiene vehículo registrado"}, 400
             
-            espacio_disponible = Espacio.query.filter_by(
-                TIPO_VEHICULO=vehiculo.TIPO,
-                ESTADO="DISPONIBLE"
-            ).first()
+            # ✅ RECLAMAR ESPACIO Y CREAR LA ENTRADA EN UNA SOLA ESCRITURA
+            fecha_entrada = datetime.utcnow()
             
-            if not espacio_disponible:
-                return jsonify({
+            def registrar_entrada():
+                # El índice recibe la entrada después de esta escritura: otro toque de la misma
+                # tarjeta pudo pasar el chequeo de arriba, así que se repite en la base, en turno
+                entrada_existente = db.session.query(Entrada.ID).filter_by(
+                    ID_USUARIO=registro["usuario_id"], ESTADO="ACTIVA").first()
+                if entrada_existente:
+                    return None, entrada_existente[0]
+                espacio_disponible = asignador_espacios.reclamar(vehiculo["tipo"])
+                if not espacio_disponible:
+                    return None
+                entrada = Entrada(
+                    ID_USUARIO=registro["usuario_id"],
+                    ID_VEHICULO=vehiculo["id"],
+                    ID_ESPACIO=espacio_disponible["id"],
+                    FECHA_ENTRADA=fecha_entrada,
+                    ESTADO="ACTIVA"
+                )
+                db.session.add(entrada)
+                db.session.flush()  # Para obtener el ID de la entrada
+                
+                Espacio.query.filter_by(ID=espacio_disponible["id"]).update(
+                    {Espacio.ID_ENTRADA_ACTUAL: entrada.ID}, synchronize_session=False)
+                
+                sumar_contadores(fecha_entrada, vehiculo["tipo"], entradas=1)
+                emitir_evento("entrada", accion="INICIADA", id=entrada.ID, espacio=espacio_disponible["numero"],
+                              usuario=registro["nombre"], placa=vehiculo["placa"],
+                              hora_entrada=fecha_entrada.strftime('%H:%M:%S'))
+                return espacio_disponible, entrada.ID
+            
+            resultado = escritor_unico.ejecutar(registrar_entrada)
+            if not resultado:
+                return {
                     "accion": "NO_HAY_ESPACIOS",
                     "mensaje": "No hay espacios disponibles",
-                    "usuario": usuario.NOMBRE,
-                    "placa": vehiculo.PLACA,
+                    "usuario": registro["nombre"],
+                    "placa": vehiculo["placa"],
                     "comando": "MOSTRAR_ALERTA"
-                }), 200
-            
-            # ✅ CREAR ENTRADA Y ASIGNAR ESPACIO (PARA PRIMERA VEZ Y SIGUIENTES)
-            entrada = Entrada(
-                ID_USUARIO=usuario.ID,
-                ID_VEHICULO=vehiculo.ID,
-                ID_ESPACIO=espacio_disponible.ID,
-                ESTADO="ACTIVA"
-            )
-            db.session.add(entrada)
-            db.session.flush()  # Para obtener el ID de la entrada
+                }, 200
             
-            # ✅ OCUPAR ESPACIO
-            espacio_disponible.ESTADO = "OCUPADO"
-            espacio_disponible.ID_ENTRADA_ACTUAL = entrada.ID
+            espacio_disponible, entrada_id = resultado
+            if espacio_disponible is None:
+                bitacora_barrera.info("entrada_duplicada", usuario_id=registro["usuario_id"], entrada_id=entrada_id)
+                return {
+                    "accion": "ENTRADA_DUPLICADA",
+                    "mensaje": "Ya tiene una entrada activa",
+                    "usuario": registro["nombre"],
+                    "placa": vehiculo["placa"],
+                    "comando": "MOSTRAR_ALERTA"
+                }, 200
+            espacio_id = espacio_disponible["id"]
+            numero_espacio = espacio_disponible["numero"]
             
-            db.session.commit()
+            indice_rfid.actualizar(tarjeta_rfid, entrada={
+                "id": entrada_id,
+                "fecha_entrada": fecha_entrada,
+                "espacio_id": espacio_id,
+                "espacio": numero_espacio,
+                "placa": vehiculo["placa"],
+                "tipo": vehiculo["tipo"]
+            })
             
-            print(f"🎉 ENTRADA REGISTRADA - {usuario.NOMBRE} - {vehiculo.PLACA}")
-            print(f"📍 Espacio asignado: {espacio_disponible.NUMERO}")
+            bitacora_barrera.info("entrada_registrada", usuario_id=registro["usuario_id"],
+                                  entrada_id=entrada_id, espacio=numero_espacio)
             
-            return jsonify({
+            return {
                 "accion": "ENTRADA_PERMITIDA",
-                "mensaje": f"Bienvenido, espacio {espacio_disponible.NUMERO} asignado",
-                "usuario": usuario.NOMBRE,
-                "placa": vehiculo.PLACA,
-                "espacio": espacio_disponible.NUMERO,
+                "mensaje": f"Bienvenido, espacio {numero_espacio} asignado",
+                "usuario": registro["nombre"],
+                "placa": vehiculo["placa"],
+                "espacio": numero_espacio,
                 "saldo_actual": saldo_actual,
                 "comando": "ABRIR_BARRERA"
-            }), 200
+            }, 200
         else:
             # ✅ USUARIO NUEVO - VERIFICAR SI HAY ESPACIOS ANTES DE GENERAR QR
-            espacio_disponible = Espacio.query.filter_by(
-                TIPO_VEHICULO="CARRO",  # Asumimos carro para usuario nuevo
-                ESTADO="DISPONIBLE"
-            ).first()
-            
-            if not espacio_disponible:
-                return jsonify({
+            # Asumimos carro para usuario nuevo
+            if not asignador_espacios.hay_disponible("CARRO"):
+                return {
                     "accion": "NO_HAY_ESPACIOS_NUEVO",
                     "mensaje": "No hay espacios disponibles para registro",
                     "comando": "MOSTRAR_ALERTA"
-                }), 200
+                }, 200
             
             # ✅ HAY ESPACIO - GENERAR QR REGISTRO
-            Transaccion.query.filter_by(TARJETA_RFID=tarjeta_rfid, TIPO="REGISTRO", ESTADO="PENDIENTE").delete()
+            def emitir_registro():
+                Transaccion.query.filter_by(TARJETA_RFID=tarjeta_rfid, TIPO="REGISTRO", ESTADO="PENDIENTE").delete()
+                return servicio_tokens.emitir("REGISTRO", tarjeta_rfid=tarjeta_rfid)
             
-            token_registro = generar_token()
-            transaccion = Transaccion(
-                TIPO="REGISTRO",
-                ESTADO="PENDIENTE",
-                TOKEN=token_registro,
-                TARJETA_RFID=tarjeta_rfid
-            )
-            db.session.add(transaccion)
-            db.session.commit()
+            token_registro = escritor_unico.ejecutar(emitir_registro)
             
             ip_servidor = obtener_ip_servidor()
             url_registro = f"http://{ip_servidor}:5000/registro/{token_registro}"
+            cache_qr.prerenderizar(url_registro, **QR_REGISTRO)
             
-            print(f"👤 USUARIO NUEVO - Generando registro")
-            print(f"📱 URL Registro: {url_registro}")
+            bitacora_barrera.info("registro_emitido", tarjeta=tarjeta_rfid)  # Sin la URL: el token da acceso
             
-            return jsonify({
+            return {
                 "accion": "USUARIO_NUEVO", 
                 "mensaje": "Usuario no registrado. Complete el registro",
                 "tarjeta_rfid": tarjeta_rfid,
                 "token_registro": token_registro,
                 "url_registro": url_registro,
                 "comando": "ABRIR_BARRERA"  # 🆕 PERMITE ENTRADA PARA REGISTRO
-            }), 200
+            }, 200
             
+    except EscrituraVencida as e:
+        bitacora_barrera.advertencia("entrada_sin_turno", error=str(e))
+        return {"error": "Servidor ocupado, intente de nuevo", "comando": "MOSTRAR_ALERTA"}, 503
     except Exception as e:
-        print(f"❌ Error en detección: {str(e)}")
-        return jsonify({"error": f"Error en el servidor: {str(e)}"}), 500
-import pandas as pd
-from io import BytesIO
+        bitacora_barrera.error("entrada_error", error=str(e))
+        return {"error": f"Error en el servidor: {str(e)}"}, 500
+
+# 🆕 PROTOCOLO COMPACTO v2 PARA LOS ESP32: UNA RUTA, CAMPOS CORTOS, RESPUESTAS FIJAS
+# Mismo negocio que /api/entrada/detectar, /api/salida/detectar y
+# /api/sensores/actualizar, pero el ESP32 envía ~25 bytes y recibe 1-8 bytes de
+# texto sin mensajes para pantalla, sobre una conexión keep-alive que reutiliza.
+#   {"t":"E","c":"<uid>"}  entrada     {"t":"S","c":"<uid>"}  salida
+#   {"t":"P","m":<bits>,"n":<sensores>}  sensores del controlador principal (bit 0 = sensor_1)
+# Respuesta: una letra y a lo sumo un dato separado por espacio
+#   A <espacio|monto>  abrir barrera          R  usuario nuevo: abrir para el registro
+#   L  sin espacios    F <monto>  saldo insuficiente (mínimo de entrada o cobro de salida)
+#   D  ya tiene entrada activa    X  tarjeta sin usuario, sin entrada o sin vehículo
+#   K  lecturas aplicadas         O  servidor ocupado, reintentar    E  error
+CODIGOS_V2 = {
+    "ENTRADA_PERMITIDA": ("A", "espacio"),
+    "SALIDA_PERMITIDA": ("A", "monto_cobrado"),
+    "USUARIO_NUEVO": ("R", None),
+    "NO_HAY_ESPACIOS": ("L", None),
+    "NO_HAY_ESPACIOS_NUEVO": ("L", None),
+    "SALDO_INSUFICIENTE": ("F", "saldo_minimo"),
+    "SALDO_INSUFICIENTE_SALIDA": ("F", "monto_requerido"),
+    "ENTRADA_DUPLICADA": ("D", None),
+}
+PROCESOS_V2 = {"E": procesar_entrada, "S": procesar_salida}
+
+def respuesta_v2(codigo, dato=None, estado=200):
+    if isinstance(dato, float):
+        dato = f"{dato:.0f}"
+    return Response(codigo if dato is None else f"{codigo} {dato}", status=estado, content_type="text/plain")
+
+@app.route("/api/v2/barrera", methods=["POST"])
+def barrera_v2():
+    """Protocolo compacto de las barreras y sensores del ESP32"""
+    data = request.get_json(silent=True) or {}
+    tipo = data.get("t")
+    medicion = getattr(metricas_hilo, "medicion", None)
+    if tipo == "P":
+        if medicion is not None:
+            medicion.grupo = "sensores"
+        try:
+            bits, sensores = int(data.get("m", 0)), int(data.get("n", 0))
+            lecturas = [(CONTROLADOR_PRINCIPAL, pin, bool(bits >> (pin - 1) & 1), None)
+                        for pin in range(1, sensores + 1)]
+            aplicar_lecturas_sensores(lecturas)
+            return respuesta_v2("K")
+        except (TypeError, ValueError):
+            return respuesta_v2("E", estado=400)
+        except EscrituraVencida as e:
+            bitacora_sensores.advertencia("lectura_sin_turno", error=str(e))
+            return respuesta_v2("O", estado=503)
+        except Exception as e:
+            db.session.rollback()
+            bitacora_sensores.error("lectura_error", error=str(e))
+            return respuesta_v2("E", estado=500)
+    
+    procesar = PROCESOS_V2.get(tipo)
+    if procesar is None:
+        return respuesta_v2("E", estado=400)
+    respuesta, estado = procesar(str(data.get("c", "")).strip().upper())
+    if estado == 503:
+        return respuesta_v2("O", estado=503)
+    if estado >= 500:
+        return respuesta_v2("E", estado=estado)
+    codigo, campo = CODIGOS_V2.get(respuesta.get("accion"), ("X", None))
+    return respuesta_v2(codigo, respuesta.get(campo) if campo else None, estado)
+
+import csv
+import click
+import tempfile
+import xlsxwriter
+from io import BytesIO, StringIO
 from datetime import datetime, date
-from flask import send_file
+from flask import send_file, stream_with_context
+
+# 🆕 EXPORTACIÓN EN STREAMING: LAS FILAS SE LEEN POR LOTES Y NUNCA SE CARGAN TODAS
+FILAS_POR_LOTE = 1000
+
+def iterar_filas(consulta, formato):
+    """Recorre la consulta por lotes de FILAS_POR_LOTE y formatea cada tupla al vuelo"""
+    return map(formato, consulta.yield_per(FILAS_POR_LOTE))
+
+def iterar_facturas_dia(fecha):
+    url_base = f"http://{obtener_ip_servidor()}:5000"
+    return (fila_factura_dia(fila, url_base) for fila in consulta_facturas_dia(fecha).yield_per(FILAS_POR_LOTE))
+
+# clave: (nombre de la hoja, función fecha -> iterador de filas, mensaje si queda vacía)
+HOJAS_REPORTE = {
+    "resumen": ("Resumen General", lambda fecha: iter([generar_resumen_diario(fecha)]), None),
+    "entradas": ("Entradas y Salidas",
+                 lambda fecha: iterar_filas(consulta_entradas_dia(fecha), fila_entrada_dia), "No hay actividad hoy"),
+    "recargas": ("Recargas",
+                 lambda fecha: iterar_filas(consulta_recargas_dia(fecha), fila_recarga_dia), "No hay recargas hoy"),
+    "espacios": ("Espacios Actuales", lambda fecha: iterar_filas(consulta_espacios(), fila_espacio), None),
+    "facturas": ("Facturación", iterar_facturas_dia, "No hay facturas hoy"),
+    "usuarios": ("Usuarios Nuevos",
+                 lambda fecha: iterar_filas(consulta_usuarios_nuevos(fecha), fila_usuario_nuevo),
+                 "No hay usuarios nuevos hoy"),
+}
+
+def escribir_hoja(libro, nombre, filas, mensaje_vacio, formato_encabezado):
+    """Escribe una hoja fila por fila (constant_memory exige ir siempre hacia adelante)"""
+    hoja = libro.add_worksheet(nombre)
+    numero_fila = 0
+    for numero_fila, fila in enumerate(filas, start=1):
+        if numero_fila == 1:
+            hoja.write_row(0, 0, list(fila.keys()), formato_encabezado)
+        hoja.write_row(numero_fila, 0, list(fila.values()))
+    if numero_fila == 0 and mensaje_vacio:
+        hoja.write_row(0, 0, ["Mensaje"], formato_encabezado)
+        hoja.write_row(1, 0, [mensaje_vacio])
 
 # 🆕 ENDPOINT PARA GENERAR REPORTE DIARIO EN EXCEL
 @app.route("/api/reportes/diario/excel")
@@ -365,267 +2338,486 @@ def generar_reporte_diario_excel():
     """Genera un reporte Excel con la actividad del día"""
     try:
         # Obtener fecha actual
-        hoy = date.today()
+        hoy = hoy_utc()
         fecha_str = hoy.strftime("%Y-%m-%d")
         nombre_archivo = f"reporte_parqueadero_{fecha_str}.xlsx"
         
-        # Crear un escritor de Excel en memoria
-        output = BytesIO()
-        
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-            # 🟢 HOJA 1: RESUMEN GENERAL
-            resumen_data = generar_resumen_diario(hoy)
-            df_resumen = pd.DataFrame([resumen_data])
-            df_resumen.to_excel(writer, sheet_name='Resumen General', index=False)
-            
-            # 🟢 HOJA 2: ENTRADAS Y SALIDAS DEL DÍA
-            entradas_data = generar_entradas_dia(hoy)
-            if entradas_data:
-                df_entradas = pd.DataFrame(entradas_data)
-                df_entradas.to_excel(writer, sheet_name='Entradas y Salidas', index=False)
-            else:
-                pd.DataFrame([{"Mensaje": "No hay actividad hoy"}]).to_excel(
-                    writer, sheet_name='Entradas y Salidas', index=False)
-            
-            # 🟢 HOJA 3: RECARGAS DEL DÍA
-            recargas_data = generar_recargas_dia(hoy)
-            if recargas_data:
-                df_recargas = pd.DataFrame(recargas_data)
-                df_recargas.to_excel(writer, sheet_name='Recargas', index=False)
-            else:
-                pd.DataFrame([{"Mensaje": "No hay recargas hoy"}]).to_excel(
-                    writer, sheet_name='Recargas', index=False)
-            
-            # 🟢 HOJA 4: ESTADO ACTUAL DE ESPACIOS
-            espacios_data = generar_estado_espacios()
-            df_espacios = pd.DataFrame(espacios_data)
-            df_espacios.to_excel(writer, sheet_name='Espacios Actuales', index=False)
-            
-            # 🟢 HOJA 5: FACTURACIÓN DEL DÍA
-            facturas_data = generar_facturas_dia(hoy)
-            if facturas_data:
-                df_facturas = pd.DataFrame(facturas_data)
-                df_facturas.to_excel(writer, sheet_name='Facturación', index=False)
-            else:
-                pd.DataFrame([{"Mensaje": "No hay facturas hoy"}]).to_excel(
-                    writer, sheet_name='Facturación', index=False)
-            
-            # 🟢 HOJA 6: USUARIOS NUEVOS
-            usuarios_nuevos_data = generar_usuarios_nuevos(hoy)
-            if usuarios_nuevos_data:
-                df_usuarios = pd.DataFrame(usuarios_nuevos_data)
-                df_usuarios.to_excel(writer, sheet_name='Usuarios Nuevos', index=False)
-            else:
-                pd.DataFrame([{"Mensaje": "No hay usuarios nuevos hoy"}]).to_excel(
-                    writer, sheet_name='Usuarios Nuevos', index=False)
-        
-        output.seek(0)
+        # El libro va a un archivo temporal en modo constant_memory: la memoria no crece con las filas
+        archivo = tempfile.TemporaryFile()
+        # strings_to_urls desactivado: cada hipervínculo se guarda en memoria hasta el cierre
+        libro = xlsxwriter.Workbook(archivo, {"constant_memory": True, "strings_to_urls": False})
+        formato_encabezado = libro.add_format({"bold": True, "border": 1})
+        for hoja, iterar, mensaje_vacio in HOJAS_REPORTE.values():
+            escribir_hoja(libro, hoja, iterar(hoy), mensaje_vacio, formato_encabezado)
+        libro.close()
+        archivo.seek(0)
         
-        print(f"📊 Reporte diario generado: {nombre_archivo}")
+        bitacora_reportes.info("reporte_diario_excel", archivo=nombre_archivo)
         
+        # send_file lo envía por bloques y cierra (borra) el temporal al terminar
         return send_file(
-            output,
+            archivo,
             mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
             as_attachment=True,
             download_name=nombre_archivo
         )
         
     except Exception as e:
-        print(f"❌ Error generando reporte Excel: {str(e)}")
+        bitacora_reportes.error("reporte_diario_excel_error", error=str(e))
         return jsonify({"error": f"Error generando reporte: {str(e)}"}), 500
 
-# 🆕 FUNCIONES AUXILIARES PARA GENERAR DATOS
-def generar_resumen_diario(fecha):
-    """Genera datos de resumen del día"""
-    # Entradas de hoy
-    entradas_hoy = Entrada.query.filter(
-        db.func.date(Entrada.FECHA_ENTRADA) == fecha
-    ).count()
-    
-    # Salidas de hoy
-    salidas_hoy = Entrada.query.filter(
-        db.func.date(Entrada.FECHA_SALIDA) == fecha,
-        Entrada.ESTADO == "FINALIZADA"
-    ).count()
-    
-    # Recaudo de hoy
-    recaudo_hoy = db.session.query(db.func.sum(Entrada.MONTO_COBRADO)).filter(
-        db.func.date(Entrada.FECHA_SALIDA) == fecha,
-        Entrada.ESTADO == "FINALIZADA"
-    ).scalar() or 0
-    
-    # Recargas de hoy
-    recargas_hoy = Transaccion.query.filter(
-        db.func.date(Transaccion.FECHA) == fecha,
-        Transaccion.TIPO == "RECARGA",
-        Transaccion.ESTADO == "CONFIRMADA"
-    ).count()
+# 🆕 REPORTE DIARIO EN CSV, ENVIADO MIENTRAS SE LEE DE LA BASE
+@app.route("/api/reportes/diario/csv/<hoja>")
+def generar_reporte_diario_csv(hoja):
+    """Una hoja del reporte diario como CSV en streaming (primer byte inmediato)"""
+    try:
+        fecha_str = request.args.get('fecha', hoy_utc().strftime("%Y-%m-%d"))
+        fecha = datetime.strptime(fecha_str, "%Y-%m-%d").date()
+    except ValueError:
+        return jsonify({"error": "Fecha inválida, use AAAA-MM-DD"}), 400
     
-    # Monto recargas hoy
-    monto_recargas_hoy = db.session.query(db.func.sum(Transaccion.MONTO)).filter(
-        db.func.date(Transaccion.FECHA) == fecha,
-        Transaccion.TIPO == "RECARGA",
-        Transaccion.ESTADO == "CONFIRMADA"
-    ).scalar() or 0
+    if hoja not in HOJAS_REPORTE:
+        return jsonify({"error": f"Hoja inválida, use una de: {', '.join(HOJAS_REPORTE)}"}), 400
+    _, iterar, mensaje_vacio = HOJAS_REPORTE[hoja]
     
-    # Usuarios nuevos hoy
-    usuarios_nuevos_hoy = Usuario.query.filter(
-        db.func.date(Usuario.FECHA_REGISTRO) == fecha
-    ).count()
+    def generar():
+        filas = iterar(fecha)
+        buffer = StringIO()
+        escritor = csv.writer(buffer)
+        buffer.write("\ufeff")  # BOM para que Excel reconozca UTF-8
+        vacio = True
+        for numero_fila, fila in enumerate(filas):
+            if vacio:
+                escritor.writerow(fila.keys())
+                vacio = False
+            escritor.writerow(fila.values())
+            if numero_fila % FILAS_POR_LOTE == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        if vacio and mensaje_vacio:
+            escritor.writerow(["Mensaje"])
+            escritor.writerow([mensaje_vacio])
+        yield buffer.getvalue()
     
-    # Espacios actuales
-    espacios_ocupados = Espacio.query.filter_by(ESTADO="OCUPADO").count()
-    espacios_disponibles = Espacio.query.filter_by(ESTADO="DISPONIBLE").count()
+    return Response(stream_with_context(generar()), mimetype="text/csv", headers={
+        "Content-Disposition": f"attachment; filename=reporte_{hoja}_{fecha_str}.csv"
+    })
+
+# 🆕 FUNCIONES AUXILIARES PARA GENERAR DATOS
+def generar_resumen_diario(fecha):
+    """Genera datos de resumen del día (una lectura de CONTADOR_DIARIO)"""
+    contadores = leer_contadores(fecha)
+    espacios_ocupados = contadores["espacios_ocupados"]
+    espacios_disponibles = contadores["espacios_disponibles"]
     
     return {
         "Fecha": fecha.strftime("%Y-%m-%d"),
-        "Entradas Hoy": entradas_hoy,
-        "Salidas Hoy": salidas_hoy,
-        "Recaudo Hoy ($)": float(recaudo_hoy),
-        "Recargas Hoy": recargas_hoy,
-        "Monto Recargas Hoy ($)": float(monto_recargas_hoy),
-        "Usuarios Nuevos Hoy": usuarios_nuevos_hoy,
+        "Entradas Hoy": contadores["entradas"],
+        "Salidas Hoy": contadores["salidas"],
+        "Recaudo Hoy ($)": contadores["recaudo"],
+        "Recargas Hoy": contadores["recargas"],
+        "Monto Recargas Hoy ($)": contadores["monto_recargas"],
+        "Usuarios Nuevos Hoy": contadores["usuarios_nuevos"],
         "Espacios Ocupados": espacios_ocupados,
         "Espacios Disponibles": espacios_disponibles,
         "Total Espacios": espacios_ocupados + espacios_disponibles,
         "Tasa Ocupación (%)": round((espacios_ocupados / (espacios_ocupados + espacios_disponibles)) * 100, 2) if (espacios_ocupados + espacios_disponibles) > 0 else 0
     }
 
+# 🆕 CADA HOJA SE ARMA CON UNA SOLA CONSULTA (JOINS) QUE DEVUELVE TUPLAS, SIN N+1
+def consulta_entradas_dia(fecha):
+    """Entradas del día con usuario, vehículo y espacio"""
+    inicio, fin = rango_dia(fecha)
+    return db.session.query(
+        Entrada.ID, Usuario.NOMBRE, Usuario.CEDULA, Vehiculo.PLACA, Vehiculo.TIPO, Espacio.NUMERO,
+        Entrada.FECHA_ENTRADA, Entrada.FECHA_SALIDA, Entrada.ESTADO, Entrada.TIEMPO_ESTACIONADO,
+        Entrada.MONTO_COBRADO
+    ).join(Usuario, Usuario.ID == Entrada.ID_USUARIO).join(
+        Vehiculo, Vehiculo.ID == Entrada.ID_VEHICULO
+    ).outerjoin(
+        Espacio, Espacio.ID == Entrada.ID_ESPACIO
+    ).filter(
+        Entrada.FECHA_ENTRADA >= inicio,
+        Entrada.FECHA_ENTRADA < fin
+    ).order_by(Entrada.FECHA_ENTRADA.desc())
+
+def fila_entrada_dia(fila):
+    (entrada_id, nombre, cedula, placa, tipo, espacio, fecha_entrada, fecha_salida,
+     estado, tiempo, monto) = fila
+    return {
+        "ID Entrada": entrada_id,
+        "Usuario": nombre,
+        "Cédula": cedula,
+        "Vehículo": placa,
+        "Tipo Vehículo": tipo,
+        "Espacio": espacio or "N/A",
+        "Hora Entrada": fecha_entrada.strftime("%H:%M:%S"),
+        "Hora Salida": fecha_salida.strftime("%H:%M:%S") if fecha_salida else "ACTIVA",
+        "Estado": estado,
+        "Tiempo Estacionado": tiempo or "N/A",
+        "Monto Cobrado ($)": float(monto) if monto else 0
+    }
+
 def generar_entradas_dia(fecha):
     """Genera datos de entradas y salidas del día"""
-    entradas = Entrada.query.filter(
-        db.func.date(Entrada.FECHA_ENTRADA) == fecha
-    ).order_by(Entrada.FECHA_ENTRADA.desc()).all()
-    
-    datos = []
-    for entrada in entradas:
-        datos.append({
-            "ID Entrada": entrada.ID,
-            "Usuario": entrada.usuario.NOMBRE,
-            "Cédula": entrada.usuario.CEDULA,
-            "Vehículo": entrada.vehiculo.PLACA,
-            "Tipo Vehículo": entrada.vehiculo.TIPO,
-            "Espacio": entrada.espacio.NUMERO if entrada.espacio else "N/A",
-            "Hora Entrada": entrada.FECHA_ENTRADA.strftime("%H:%M:%S"),
-            "Hora Salida": entrada.FECHA_SALIDA.strftime("%H:%M:%S") if entrada.FECHA_SALIDA else "ACTIVA",
-            "Estado": entrada.ESTADO,
-            "Tiempo Estacionado": entrada.TIEMPO_ESTACIONADO or "N/A",
-            "Monto Cobrado ($)": float(entrada.MONTO_COBRADO) if entrada.MONTO_COBRADO else 0
-        })
-    
-    return datos
+    return [fila_entrada_dia(fila) for fila in consulta_entradas_dia(fecha)]
 
-def generar_recargas_dia(fecha):
-    """Genera datos de recargas del día"""
-    recargas = Transaccion.query.filter(
-        db.func.date(Transaccion.FECHA) == fecha,
+def consulta_recargas_dia(fecha):
+    """Recargas confirmadas del día con el usuario que las hizo"""
+    inicio, fin = rango_dia(fecha)
+    return db.session.query(
+        Transaccion.ID, Usuario.NOMBRE, Usuario.CEDULA, Transaccion.MONTO, Transaccion.FECHA
+    ).outerjoin(Usuario, Usuario.ID == Transaccion.ID_USUARIO).filter(
+        Transaccion.FECHA >= inicio,
+        Transaccion.FECHA < fin,
         Transaccion.TIPO == "RECARGA",
         Transaccion.ESTADO == "CONFIRMADA"
-    ).order_by(Transaccion.FECHA.desc()).all()
-    
-    datos = []
-    for recarga in recargas:
-        usuario = Usuario.query.get(recarga.ID_USUARIO)
-        datos.append({
-            "ID Transacción": recarga.ID,
-            "Usuario": usuario.NOMBRE if usuario else "N/A",
-            "Cédula": usuario.CEDULA if usuario else "N/A",
-            "Monto ($)": float(recarga.MONTO),
-            "Hora Recarga": recarga.FECHA.strftime("%H:%M:%S"),
-            "Método": "QR"
-        })
-    
-    return datos
+    ).order_by(Transaccion.FECHA.desc())
+
+def fila_recarga_dia(fila):
+    transaccion_id, nombre, cedula, monto, fecha = fila
+    return {
+        "ID Transacción": transaccion_id,
+        "Usuario": nombre or "N/A",
+        "Cédula": cedula or "N/A",
+        "Monto ($)": float(monto),
+        "Hora Recarga": fecha.strftime("%H:%M:%S"),
+        "Método": "QR"
+    }
+
+def generar_recargas_dia(fecha):
+    """Genera datos de recargas del día"""
+    return [fila_recarga_dia(fila) for fila in consulta_recargas_dia(fecha)]
+
+def consulta_espacios():
+    """Espacios con la entrada actual, su usuario y su vehículo"""
+    return db.session.query(
+        Espacio.NUMERO, Espacio.TIPO_VEHICULO, Espacio.ESTADO, Espacio.SENSOR_PIN,
+        Espacio.ULTIMA_DETECCION, Usuario.NOMBRE, Vehiculo.PLACA, Entrada.FECHA_ENTRADA
+    ).outerjoin(Entrada, Entrada.ID == Espacio.ID_ENTRADA_ACTUAL).outerjoin(
+        Usuario, Usuario.ID == Entrada.ID_USUARIO
+    ).outerjoin(
+        Vehiculo, Vehiculo.ID == Entrada.ID_VEHICULO
+    ).order_by(Espacio.ID)
+
+def fila_espacio(fila):
+    numero, tipo, estado, sensor_pin, ultima_deteccion, nombre, placa, fecha_entrada = fila
+    return {
+        "Número": numero,
+        "Tipo": tipo,
+        "Estado": estado,
+        "Vehículo": placa or "N/A",
+        "Usuario": nombre or "N/A",
+        "Hora Entrada": fecha_entrada.strftime("%H:%M:%S") if fecha_entrada else "N/A",
+        "Sensor Pin": sensor_pin,
+        "Última Detección": ultima_deteccion.strftime("%H:%M:%S") if ultima_deteccion else "N/A"
+    }
 
 def generar_estado_espacios():
     """Genera estado actual de espacios"""
-    espacios = Espacio.query.all()
-    
-    datos = []
-    for espacio in espacios:
-        entrada_actual = None
-        if espacio.ID_ENTRADA_ACTUAL:
-            entrada_actual = Entrada.query.get(espacio.ID_ENTRADA_ACTUAL)
-        
-        datos.append({
-            "Número": espacio.NUMERO,
-            "Tipo": espacio.TIPO_VEHICULO,
-            "Estado": espacio.ESTADO,
-            "Vehículo": entrada_actual.vehiculo.PLACA if entrada_actual and entrada_actual.vehiculo else "N/A",
-            "Usuario": entrada_actual.usuario.NOMBRE if entrada_actual and entrada_actual.usuario else "N/A",
-            "Hora Entrada": entrada_actual.FECHA_ENTRADA.strftime("%H:%M:%S") if entrada_actual else "N/A",
-            "Sensor Pin": espacio.SENSOR_PIN,
-            "Última Detección": espacio.ULTIMA_DETECCION.strftime("%H:%M:%S") if espacio.ULTIMA_DETECCION else "N/A"
-        })
-    
-    return datos
+    return [fila_espacio(fila) for fila in consulta_espacios()]
 
-def generar_facturas_dia(fecha):
-    """Genera datos de facturación del día"""
-    facturas = Entrada.query.filter(
-        db.func.date(Entrada.FECHA_SALIDA) == fecha,
+def consulta_facturas_dia(fecha):
+    """Salidas cobradas del día con usuario, vehículo y espacio"""
+    inicio, fin = rango_dia(fecha)
+    return db.session.query(
+        Entrada.ID, Usuario.NOMBRE, Usuario.CEDULA, Vehiculo.PLACA, Espacio.NUMERO,
+        Entrada.FECHA_ENTRADA, Entrada.FECHA_SALIDA, Entrada.TIEMPO_ESTACIONADO, Entrada.MONTO_COBRADO
+    ).join(Usuario, Usuario.ID == Entrada.ID_USUARIO).join(
+        Vehiculo, Vehiculo.ID == Entrada.ID_VEHICULO
+    ).outerjoin(
+        Espacio, Espacio.ID == Entrada.ID_ESPACIO
+    ).filter(
+        Entrada.FECHA_SALIDA >= inicio,
+        Entrada.FECHA_SALIDA < fin,
         Entrada.ESTADO == "FINALIZADA",
         Entrada.MONTO_COBRADO.isnot(None)
-    ).order_by(Entrada.FECHA_SALIDA.desc()).all()
-    
-    datos = []
-    for factura in facturas:
-        datos.append({
-            "ID Factura": factura.ID,
-            "Usuario": factura.usuario.NOMBRE,
-            "Cédula": factura.usuario.CEDULA,
-            "Vehículo": factura.vehiculo.PLACA,
-            "Espacio": factura.espacio.NUMERO if factura.espacio else "N/A",
-            "Entrada": factura.FECHA_ENTRADA.strftime("%H:%M"),
-            "Salida": factura.FECHA_SALIDA.strftime("%H:%M"),
-            "Tiempo": factura.TIEMPO_ESTACIONADO or "N/A",
-            "Monto ($)": float(factura.MONTO_COBRADO),
-            "URL Factura": f"http://{obtener_ip_servidor()}:5000/api/factura/generar/{factura.ID}"
-        })
-    
-    return datos
+    ).order_by(Entrada.FECHA_SALIDA.desc())
+
+def fila_factura_dia(fila, url_base):
+    entrada_id, nombre, cedula, placa, espacio, fecha_entrada, fecha_salida, tiempo, monto = fila
+    return {
+        "ID Factura": entrada_id,
+        "Usuario": nombre,
+        "Cédula": cedula,
+        "Vehículo": placa,
+        "Espacio": espacio or "N/A",
+        "Entrada": fecha_entrada.strftime("%H:%M"),
+        "Salida": fecha_salida.strftime("%H:%M"),
+        "Tiempo": tiempo or "N/A",
+        "Monto ($)": float(monto),
+        "URL Factura": f"{url_base}/api/factura/generar/{entrada_id}"
+    }
+
+def generar_facturas_dia(fecha):
+    """Genera datos de facturación del día"""
+    url_base = f"http://{obtener_ip_servidor()}:5000"  # Una sola vez, no por fila
+    return [fila_factura_dia(fila, url_base) for fila in consulta_facturas_dia(fecha)]
+
+def consulta_usuarios_nuevos(fecha):
+    """Usuarios registrados en el día con la placa de su primer vehículo"""
+    inicio, fin = rango_dia(fecha)
+    placa = db.select(Vehiculo.PLACA).where(
+        Vehiculo.ID_USUARIO == Usuario.ID
+    ).order_by(Vehiculo.ID).limit(1).correlate(Usuario).scalar_subquery()
+    return db.session.query(
+        Usuario.ID, Usuario.NOMBRE, Usuario.CEDULA, Usuario.TELEFONO, Usuario.EMAIL,
+        Usuario.TARJETA_RFID, placa, Usuario.FECHA_REGISTRO, Usuario.SALDO
+    ).filter(
+        Usuario.FECHA_REGISTRO >= inicio,
+        Usuario.FECHA_REGISTRO < fin
+    ).order_by(Usuario.FECHA_REGISTRO.desc())
+
+def fila_usuario_nuevo(fila):
+    usuario_id, nombre, cedula, telefono, email, tarjeta, placa, fecha_registro, saldo = fila
+    return {
+        "ID Usuario": usuario_id,
+        "Nombre": nombre,
+        "Cédula": cedula,
+        "Teléfono": telefono or "N/A",
+        "Email": email or "N/A",
+        "Tarjeta RFID": tarjeta or "N/A",
+        "Vehículo": placa or "N/A",
+        "Hora Registro": fecha_registro.strftime("%H:%M:%S"),
+        "Saldo Inicial ($)": float(saldo)
+    }
 
 def generar_usuarios_nuevos(fecha):
     """Genera datos de usuarios nuevos del día"""
-    usuarios = Usuario.query.filter(
-        db.func.date(Usuario.FECHA_REGISTRO) == fecha
-    ).order_by(Usuario.FECHA_REGISTRO.desc()).all()
+    return [fila_usuario_nuevo(fila) for fila in consulta_usuarios_nuevos(fecha)]
+
+# 🆕 RESUMEN POR DÍA: LOS DÍAS CERRADOS SE LEEN DE RESUMEN_DIARIO, SOLO HOY VA A LAS TABLAS CRUDAS
+# Los días son UTC, como las fechas guardadas y CONTADOR_DIARIO. El barredor guarda
+# el rollup de los días recientes; el reporte por rango solo lee y tiene un máximo de días.
+MAXIMO_DIAS_RANGO = 366
+DIAS_CIERRE_AUTOMATICO = 7
+def calcular_pico_ocupacion(fecha):
+    """Máximo de entradas simultáneas durante el día (barrido sobre entradas y salidas)"""
+    inicio, fin = rango_dia(fecha)
+    estancias = db.session.query(Entrada.FECHA_ENTRADA, Entrada.FECHA_SALIDA).filter(
+        Entrada.FECHA_ENTRADA < fin,
+        db.or_(Entrada.FECHA_SALIDA >= inicio, Entrada.FECHA_SALIDA.is_(None))
+    )
     
-    datos = []
-    for usuario in usuarios:
-        vehiculo = Vehiculo.query.filter_by(ID_USUARIO=usuario.ID).first()
-        datos.append({
-            "ID Usuario": usuario.ID,
-            "Nombre": usuario.NOMBRE,
-            "Cédula": usuario.CEDULA,
-            "Teléfono": usuario.TELEFONO or "N/A",
-            "Email": usuario.EMAIL or "N/A",
-            "Tarjeta RFID": usuario.TARJETA_RFID or "N/A",
-            "Vehículo": vehiculo.PLACA if vehiculo else "N/A",
-            "Hora Registro": usuario.FECHA_REGISTRO.strftime("%H:%M:%S"),
-            "Saldo Inicial ($)": float(usuario.SALDO)
-        })
+    cambios = []
+    for fecha_entrada, fecha_salida in estancias:
+        cambios.append((max(fecha_entrada, inicio), 1))
+        if fecha_salida is not None and fecha_salida < fin:
+            cambios.append((fecha_salida, -1))
+    
+    # A igual hora, las salidas se cuentan antes que las entradas
+    pico = ocupados = 0
+    for _, cambio in sorted(cambios):
+        ocupados += cambio
+        pico = max(pico, ocupados)
+    return pico
+
+def calcular_resumen_dia(fecha):
+    """Totales de un día leídos directamente de ENTRADA, TRANSACCION y USUARIO"""
+    inicio, fin = rango_dia(fecha)
+    
+    entradas = Entrada.query.filter(
+        Entrada.FECHA_ENTRADA >= inicio,
+        Entrada.FECHA_ENTRADA < fin
+    ).count()
+    
+    salidas, recaudo = db.session.query(
+        db.func.count(Entrada.ID), db.func.sum(Entrada.MONTO_COBRADO)
+    ).filter(
+        Entrada.FECHA_SALIDA >= inicio,
+        Entrada.FECHA_SALIDA < fin,
+        Entrada.ESTADO == "FINALIZADA"
+    ).one()
+    
+    recargas, monto_recargas = db.session.query(
+        db.func.count(Transaccion.ID), db.func.sum(Transaccion.MONTO)
+    ).filter(
+        Transaccion.FECHA >= inicio,
+        Transaccion.FECHA < fin,
+        Transaccion.TIPO == "RECARGA",
+        Transaccion.ESTADO == "CONFIRMADA"
+    ).one()
+    
+    usuarios_nuevos = Usuario.query.filter(
+        Usuario.FECHA_REGISTRO >= inicio,
+        Usuario.FECHA_REGISTRO < fin
+    ).count()
+    
+    return {
+        "fecha": fecha,
+        "entradas": entradas,
+        "salidas": salidas,
+        "recaudo": float(recaudo or 0),
+        "recargas": recargas,
+        "monto_recargas": float(monto_recargas or 0),
+        "usuarios_nuevos": usuarios_nuevos,
+        "pico_ocupacion": calcular_pico_ocupacion(fecha)
+    }
+
+def guardar_resumen_dia(resumen):
+    """Guarda (o reemplaza) la fila de RESUMEN_DIARIO de un día ya terminado; no hace commit"""
+    db.session.merge(ResumenDiario(
+        FECHA=resumen["fecha"],
+        ENTRADAS=resumen["entradas"],
+        SALIDAS=resumen["salidas"],
+        RECAUDO=resumen["recaudo"],
+        RECARGAS=resumen["recargas"],
+        MONTO_RECARGAS=resumen["monto_recargas"],
+        USUARIOS_NUEVOS=resumen["usuarios_nuevos"],
+        PICO_OCUPACION=resumen["pico_ocupacion"],
+        FECHA_CIERRE=datetime.utcnow()
+    ))
+    return resumen
+
+def cerrar_dia(fecha):
+    """Calcula (o recalcula) la fila de RESUMEN_DIARIO de un día ya terminado; no hace commit"""
+    return guardar_resumen_dia(calcular_resumen_dia(fecha))
+
+def dias_sin_resumen(inicio, fin):
+    """Días entre inicio y fin (inclusive) que aún no tienen fila en RESUMEN_DIARIO"""
+    cerrados = {fecha for (fecha,) in db.session.query(ResumenDiario.FECHA).filter(
+        ResumenDiario.FECHA >= inicio,
+        ResumenDiario.FECHA <= fin
+    )}
+    return [inicio + timedelta(days=i) for i in range((fin - inicio).days + 1)
+            if inicio + timedelta(days=i) not in cerrados]
+
+def cerrar_dias_recientes(hoy=None, dias=DIAS_CIERRE_AUTOMATICO):
+    """Guarda el rollup de los últimos `dias` días cerrados que no lo tengan (lo llama el barredor).
+    Las lecturas van en el hilo que llama; en el escritor único solo se escriben las filas."""
+    hoy = hoy or hoy_utc()
+    faltantes = dias_sin_resumen(hoy - timedelta(days=dias), hoy - timedelta(days=1))
+    resumenes = [calcular_resumen_dia(dia) for dia in faltantes]
+    db.session.rollback()  # Suelta la lectura antes de pedir turno al escritor
+    if resumenes:
+        escritor_unico.ejecutar(lambda: [guardar_resumen_dia(resumen) for resumen in resumenes], plazo=30)
+        bitacora_reportes.info("rollup_diario", dias_cerrados=len(resumenes))
+    return len(resumenes)
+
+def resumen_rango(inicio, fin):
+    """Un resumen por día del rango: ~1 fila leída por día cerrado y consultas crudas solo para hoy.
+    No escribe: un día cerrado sin rollup (el barredor aún no pasa, o historial viejo) se calcula
+    en memoria; `flask cerrar-dias --desde` lo deja guardado."""
+    hoy = hoy_utc()
+    ultimo_cerrado = min(fin, hoy - timedelta(days=1))
+    
+    por_fecha = {}
+    if inicio <= ultimo_cerrado:
+        filas = ResumenDiario.query.filter(
+            ResumenDiario.FECHA >= inicio,
+            ResumenDiario.FECHA <= ultimo_cerrado
+        )
+        for fila in filas:
+            por_fecha[fila.FECHA] = {
+                "fecha": fila.FECHA,
+                "entradas": fila.ENTRADAS,
+                "salidas": fila.SALIDAS,
+                "recaudo": float(fila.RECAUDO),
+                "recargas": fila.RECARGAS,
+                "monto_recargas": float(fila.MONTO_RECARGAS),
+                "usuarios_nuevos": fila.USUARIOS_NUEVOS,
+                "pico_ocupacion": fila.PICO_OCUPACION
+            }
+        
+        faltantes = [inicio + timedelta(days=i) for i in range((ultimo_cerrado - inicio).days + 1)]
+        faltantes = [dia for dia in faltantes if dia not in por_fecha]
+        for dia in faltantes:
+            por_fecha[dia] = calcular_resumen_dia(dia)
+        if faltantes:
+            bitacora_reportes.info("rollup_en_memoria", dias=len(faltantes))
+    
+    if inicio <= hoy <= fin:
+        contadores = leer_contadores(hoy)
+        por_fecha[hoy] = {
+            "fecha": hoy,
+            "entradas": contadores["entradas"],
+            "salidas": contadores["salidas"],
+            "recaudo": contadores["recaudo"],
+            "recargas": contadores["recargas"],
+            "monto_recargas": contadores["monto_recargas"],
+            "usuarios_nuevos": contadores["usuarios_nuevos"],
+            "pico_ocupacion": calcular_pico_ocupacion(hoy)
+        }
     
-    return datos
+    return [por_fecha[dia] for dia in sorted(por_fecha)]
+
+@app.cli.command("cerrar-dias")
+@click.option("--desde", help="Primer día a recalcular (AAAA-MM-DD), por defecto ayer")
+@click.option("--hasta", help="Último día a recalcular (AAAA-MM-DD), por defecto ayer")
+def comando_cerrar_dias(desde, hasta):
+    """Recalcula RESUMEN_DIARIO (por ejemplo, desde un cron después de medianoche)"""
+    ayer = hoy_utc() - timedelta(days=1)
+    inicio = datetime.strptime(desde, "%Y-%m-%d").date() if desde else ayer
+    fin = min(datetime.strptime(hasta, "%Y-%m-%d").date() if hasta else ayer, ayer)
+    dia = inicio
+    while dia <= fin:
+        resumen = cerrar_dia(dia)
+        print(f"📦 {dia}: {resumen['entradas']} entradas, ${resumen['recaudo']:,.0f}, pico {resumen['pico_ocupacion']}")
+        dia += timedelta(days=1)
+    db.session.commit()
 
 # 🆕 ENDPOINT PARA REPORTE POR RANGO DE FECHAS
 @app.route("/api/reportes/rango-fechas/excel")
 def generar_reporte_rango_fechas():
     """Genera reporte Excel por rango de fechas"""
     try:
-        fecha_inicio = request.args.get('inicio', date.today().strftime("%Y-%m-%d"))
-        fecha_fin = request.args.get('fin', date.today().strftime("%Y-%m-%d"))
+        fecha_inicio = request.args.get('inicio', hoy_utc().strftime("%Y-%m-%d"))
+        fecha_fin = request.args.get('fin', hoy_utc().strftime("%Y-%m-%d"))
         
         # Convertir strings a fechas
-        inicio = datetime.strptime(fecha_inicio, "%Y-%m-%d").date()
-        fin = datetime.strptime(fecha_fin, "%Y-%m-%d").date()
+        try:
+            inicio = datetime.strptime(fecha_inicio, "%Y-%m-%d").date()
+            fin = datetime.strptime(fecha_fin, "%Y-%m-%d").date()
+        except ValueError:
+            return jsonify({"error": "Fechas inválidas, use AAAA-MM-DD"}), 400
+        if inicio > fin:
+            return jsonify({"error": "La fecha de inicio es posterior a la fecha fin"}), 400
+        if (fin - inicio).days + 1 > MAXIMO_DIAS_RANGO:
+            return jsonify({"error": f"El rango no puede pasar de {MAXIMO_DIAS_RANGO} días"}), 400
         
         nombre_archivo = f"reporte_{fecha_inicio}_a_{fecha_fin}.xlsx"
         
-        # Similar al reporte diario pero con filtro por rango
-        # (Implementación similar a la función anterior pero con filtro de fechas)
+        dias = resumen_rango(inicio, fin)
+        totales = {
+            "Desde": fecha_inicio,
+            "Hasta": fecha_fin,
+            "Días": len(dias),
+            "Entradas": sum(dia["entradas"] for dia in dias),
+            "Salidas": sum(dia["salidas"] for dia in dias),
+            "Recaudo ($)": sum(dia["recaudo"] for dia in dias),
+            "Recargas": sum(dia["recargas"] for dia in dias),
+            "Monto Recargas ($)": sum(dia["monto_recargas"] for dia in dias),
+            "Usuarios Nuevos": sum(dia["usuarios_nuevos"] for dia in dias),
+            "Pico Ocupación": max((dia["pico_ocupacion"] for dia in dias), default=0)
+        }
+        filas_dias = ({
+            "Fecha": dia["fecha"].strftime("%Y-%m-%d"),
+            "Entradas": dia["entradas"],
+            "Salidas": dia["salidas"],
+            "Recaudo ($)": dia["recaudo"],
+            "Recargas": dia["recargas"],
+            "Monto Recargas ($)": dia["monto_recargas"],
+            "Usuarios Nuevos": dia["usuarios_nuevos"],
+            "Pico Ocupación": dia["pico_ocupacion"]
+        } for dia in dias)
+        
+        archivo = tempfile.TemporaryFile()
+        libro = xlsxwriter.Workbook(archivo, {"constant_memory": True})
+        formato_encabezado = libro.add_format({"bold": True, "border": 1})
+        escribir_hoja(libro, "Totales", iter([totales]), None, formato_encabezado)
+        escribir_hoja(libro, "Resumen por Día", filas_dias, "No hay días en el rango", formato_encabezado)
+        libro.close()
+        archivo.seek(0)
+        
+        bitacora_reportes.info("reporte_rango_excel", archivo=nombre_archivo, dias=len(dias))
         
-        return jsonify({"mensaje": "Reporte por rango en desarrollo", "fechas": f"{fecha_inicio} a {fecha_fin}"})
+        return send_file(
+            archivo,
+            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            as_attachment=True,
+            download_name=nombre_archivo
+        )
         
     except Exception as e:
         return jsonify({"error": f"Error en rango de fechas: {str(e)}"}), 500
@@ -635,7 +2827,7 @@ def generar_reporte_rango_fechas():
 def resumen_diario():
     """Retorna resumen del día en formato JSON para dashboards"""
     try:
-        hoy = date.today()
+        hoy = hoy_utc()
         resumen = generar_resumen_diario(hoy)
         
         return jsonify({
@@ -781,18 +2973,20 @@ def validar_color_vehiculo(color):
 
 # 🆕 ENDPOINT DE REGISTRO CON VALIDACIONES MEJORADO
 # 🆕 ENDPOINT DE REGISTRO CON MENSAJES MEJORADOS
+class RegistroRechazado(Exception):
+    """El registro no se guarda (token ya usado o sin espacio); el escritor revierte lo hecho"""
+
 # 🆕 ENDPOINT DE REGISTRO CON MEJOR DEBUGGING
 @app.route("/api/registro/completar", methods=["POST"])
 def completar_registro():
     """Completa el registro del usuario con validaciones mejoradas"""
     try:
         data = request.get_json()
-        print(f"📨 Datos recibidos: {data}")  # 🆕 DEBUG
         
         token = data.get('token')
         
         # Validar token
-        transaccion = Transaccion.query.filter_by(TOKEN=token, TIPO="REGISTRO", ESTADO="PENDIENTE").first()
+        transaccion = servicio_tokens.validar(token, "REGISTRO")
         if not transaccion:
             return jsonify({"error": "Token inválido o expirado"}), 400
         
@@ -807,8 +3001,6 @@ def completar_registro():
             'color': data.get('color', '').strip()
         }
         
-        print(f"🔍 Campos después de limpiar: {campos}")  # 🆕 DEBUG
-        
         # Verificar campos vacíos
         campos_vacios = []
         for campo, valor in campos.items():
@@ -825,7 +3017,7 @@ def completar_registro():
                 campos_vacios.append(f"❌ {nombre_campo} es obligatorio")
         
         if campos_vacios:
-            print(f"🚫 Campos vacíos: {campos_vacios}")  # 🆕 DEBUG
+            bitacora_registro.info("registro_rechazado", vacios=[campo for campo, valor in campos.items() if not valor])
             return jsonify({
                 "error": "Faltan campos obligatorios",
                 "detalles": campos_vacios
@@ -836,13 +3028,11 @@ def completar_registro():
         
         # Nombre
         valido, mensaje = validar_nombre(campos['nombre'])
-        print(f"🔍 Validación nombre: {valido} - {mensaje}")  # 🆕 DEBUG
         if not valido:
             errores.append(f"❌ Nombre: {mensaje}")
         
         # Cédula
         valido, mensaje = validar_cedula(campos['cedula'])
-        print(f"🔍 Validación cédula: {valido} - {mensaje}")  # 🆕 DEBUG
         if not valido:
             errores.append(f"❌ Cédula: {mensaje}")
         else:
@@ -852,13 +3042,11 @@ def completar_registro():
         
         # Teléfono
         valido, mensaje = validar_telefono(campos['telefono'])
-        print(f"🔍 Validación teléfono: {valido} - {mensaje}")  # 🆕 DEBUG
         if not valido:
             errores.append(f"❌ Teléfono: {mensaje}")
         
         # Email
         valido, mensaje = validar_email(campos['email'])
-        print(f"🔍 Validación email: {valido} - {mensaje}")  # 🆕 DEBUG
         if not valido:
             errores.append(f"❌ Email: {mensaje}")
         else:
@@ -868,7 +3056,6 @@ def completar_registro():
         
         # Placa
         valido, mensaje = validar_placa(campos['placa'])
-        print(f"🔍 Validación placa: {valido} - {mensaje}")  # 🆕 DEBUG
         if not valido:
             errores.append(f"❌ Placa: {mensaje}")
         else:
@@ -878,47 +3065,48 @@ def completar_registro():
         
         # Marca
         valido, mensaje = validar_marca_vehiculo(campos['marca'])
-        print(f"🔍 Validación marca: {valido} - {mensaje}")  # 🆕 DEBUG
         if not valido:
             errores.append(f"❌ Marca: {mensaje}")
         
         # Color
         valido, mensaje = validar_color_vehiculo(campos['color'])
-        print(f"🔍 Validación color: {valido} - {mensaje}")  # 🆕 DEBUG
         if not valido:
             errores.append(f"❌ Color: {mensaje}")
         
-        print(f"🔍 Errores encontrados: {errores}")  # 🆕 DEBUG
-        
         if errores:
+            # Los mensajes de validación no incluyen los valores ingresados
+            bitacora_registro.info("registro_rechazado", errores=errores)
             return jsonify({
                 "error": "Se encontraron errores en los datos",
                 "detalles": errores
             }), 400
         
-        # VERIFICAR ESPACIOS DISPONIBLES
         tipo_vehiculo = data.get('tipo_vehiculo', 'CARRO')
-        espacio_disponible = Espacio.query.filter_by(
-            TIPO_VEHICULO=tipo_vehiculo,
-            ESTADO="DISPONIBLE"
-        ).first()
-        
-        if not espacio_disponible:
-            return jsonify({"error": "Ya no hay espacios disponibles. Intente más tarde"}), 400
-        
-        # 🆕 CREAR USUARIO Y VEHÍCULO
-        try:
+        tarjeta_rfid = transaccion["tarjeta_rfid"]
+        db.session.close()  # Las validaciones ya leyeron: no retener la conexión mientras espera turno
+        
+        # Token, usuario, vehículo, espacio y entrada en una sola escritura del escritor único
+        def guardar_registro():
+            # CONSUMIR EL TOKEN: si otra petición ya lo usó, este UPDATE no afecta filas
+            if not servicio_tokens.consumir(token, "REGISTRO"):
+                raise RegistroRechazado("Token inválido o expirado")
+            
+            # VERIFICAR ESPACIOS DISPONIBLES (si no hay, se revierte también el token)
+            espacio_disponible = asignador_espacios.reclamar(tipo_vehiculo)
+            if not espacio_disponible:
+                raise RegistroRechazado("Ya no hay espacios disponibles. Intente más tarde")
+            
+            # 🆕 CREAR USUARIO Y VEHÍCULO
             usuario = Usuario(
                 NOMBRE=campos['nombre'].title(),
                 CEDULA=campos['cedula'],
                 TELEFONO=campos['telefono'],
                 EMAIL=campos['email'].lower(),
                 SALDO=0.0,
-                TARJETA_RFID=transaccion.TARJETA_RFID
+                TARJETA_RFID=tarjeta_rfid
             )
             db.session.add(usuario)
             db.session.flush()
-            print(f"✅ Usuario creado: {usuario.NOMBRE} (ID: {usuario.ID})")
             
             vehiculo = Vehiculo(
                 PLACA=campos['placa'].upper(),
@@ -929,63 +3117,92 @@ def completar_registro():
             )
             db.session.add(vehiculo)
             db.session.flush()
-            print(f"✅ Vehículo creado: {vehiculo.PLACA} (ID: {vehiculo.ID})")
             
             entrada = Entrada(
                 ID_USUARIO=usuario.ID,
                 ID_VEHICULO=vehiculo.ID,
-                ID_ESPACIO=espacio_disponible.ID,
+                ID_ESPACIO=espacio_disponible["id"],
                 ESTADO="ACTIVA"
             )
             db.session.add(entrada)
             db.session.flush()
-            print(f"✅ Entrada creada: ID {entrada.ID}")
             
-            # OCUPAR ESPACIO
-            espacio_disponible.ESTADO = "OCUPADO"
-            espacio_disponible.ID_ENTRADA_ACTUAL = entrada.ID
+            # VINCULAR LA ENTRADA AL ESPACIO RECLAMADO
+            Espacio.query.filter_by(ID=espacio_disponible["id"]).update(
+                {Espacio.ID_ENTRADA_ACTUAL: entrada.ID}, synchronize_session=False)
             
             # GENERAR RECARGA
-            tarifa_minima = 5000
-            token_recarga = generar_token()
-            transaccion_recarga = Transaccion(
-                ID_USUARIO=usuario.ID,
-                TIPO="RECARGA",
-                MONTO=tarifa_minima * 2,
-                ESTADO="PENDIENTE",
-                TOKEN=token_recarga
-            )
-            db.session.add(transaccion_recarga)
+            tarifa_minima = motor_tarifas.tarifa_minima(vehiculo.TIPO)
+            token_recarga = servicio_tokens.emitir("RECARGA", usuario_id=usuario.ID, monto=tarifa_minima * 2)
             
-            # Actualizar transacción de registro
-            transaccion.ID_USUARIO = usuario.ID
-            transaccion.ESTADO = "CONFIRMADA"
+            # Vincular la transacción de registro al usuario creado
+            Transaccion.query.filter_by(TOKEN=token).update(
+                {Transaccion.ID_USUARIO: usuario.ID}, synchronize_session=False)
             
-            db.session.commit()
+            # 🆕 COMANDO DE APERTURA PARA LA BARRERA DE ENTRADA
+            publicar_comando("entrada", "ABRIR_BARRERA",
+                             espacio=espacio_disponible["numero"], placa=vehiculo.PLACA)
+            sumar_contadores(usuario.FECHA_REGISTRO, usuarios_nuevos=1)
+            sumar_contadores(entrada.FECHA_ENTRADA, vehiculo.TIPO, entradas=1)
+            emitir_evento("entrada", accion="INICIADA", id=entrada.ID,
+                          espacio=espacio_disponible["numero"], usuario=usuario.NOMBRE,
+                          placa=vehiculo.PLACA, hora_entrada=entrada.FECHA_ENTRADA.strftime('%H:%M:%S'))
+            
+            # Solo valores simples de vuelta: los objetos son de la sesión del escritor
+            return token_recarga, entrada.ID, {
+                "usuario_id": usuario.ID,
+                "nombre": usuario.NOMBRE,
+                "saldo": 0.0,
+                "vehiculo": {"id": vehiculo.ID, "placa": vehiculo.PLACA, "tipo": vehiculo.TIPO},
+                "entrada": {
+                    "id": entrada.ID,
+                    "fecha_entrada": entrada.FECHA_ENTRADA,
+                    "espacio_id": espacio_disponible["id"],
+                    "espacio": espacio_disponible["numero"],
+                    "placa": vehiculo.PLACA,
+                    "tipo": vehiculo.TIPO
+                }
+            }
+        
+        try:
+            token_recarga, entrada_id, registro_rfid = escritor_unico.ejecutar(guardar_registro)
+            numero_espacio = registro_rfid["entrada"]["espacio"]
+            
+            if tarjeta_rfid:
+                indice_rfid.guardar(tarjeta_rfid, registro_rfid)
             
             ip_servidor = obtener_ip_servidor()
             url_recarga = f"http://{ip_servidor}:5000/recarga/{token_recarga}"
+            cache_qr.prerenderizar(url_recarga, **QR_RECARGA)
             
-            print(f"🎉 REGISTRO EXITOSO - Usuario: {usuario.NOMBRE}")
+            bitacora_registro.info("registro_completado", usuario_id=registro_rfid["usuario_id"],
+                                   vehiculo_id=registro_rfid["vehiculo"]["id"],
+                                   entrada_id=entrada_id, espacio=numero_espacio)
             
             return jsonify({
                 "success": True,
-                "mensaje": f"✅ Registro exitoso! Espacio {espacio_disponible.NUMERO} asignado",
-                "usuario_id": usuario.ID,
-                "vehiculo_id": vehiculo.ID,
-                "espacio_asignado": espacio_disponible.NUMERO,
+                "mensaje": f"✅ Registro exitoso! Espacio {numero_espacio} asignado",
+                "usuario_id": registro_rfid["usuario_id"],
+                "vehiculo_id": registro_rfid["vehiculo"]["id"],
+                "espacio_asignado": numero_espacio,
                 "token_recarga": token_recarga,
                 "url_recarga": url_recarga
             }), 200
             
+        except RegistroRechazado as e:
+            return jsonify({"error": str(e)}), 400
+        except EscrituraVencida as e:
+            bitacora_registro.advertencia("registro_sin_turno", error=str(e))
+            return jsonify({"error": "Servidor ocupado, intente de nuevo"}), 503
         except Exception as e:
             db.session.rollback()
-            print(f"❌ Error en base de datos: {str(e)}")
+            # El texto de los errores de SQLAlchemy trae los parámetros (nombre, cédula...): solo el tipo
+            bitacora_registro.error("registro_error_base", traza=False, error=type(e).__name__)
             return jsonify({"error": f"Error al guardar en base de datos: {str(e)}"}), 500
         
     except Exception as e:
         db.session.rollback()
-        print(f"❌ Error general en registro: {str(e)}")
+        bitacora_registro.error("registro_error", traza=False, error=type(e).__name__)
         return jsonify({"error": f"Error en registro: {str(e)}"}), 500
 @app.route("/debug/usuario/<tarjeta_rfid>")
 def debug_usuario(tarjeta_rfid):
@@ -1006,177 +3223,231 @@ def debug_usuario(tarjeta_rfid):
 
 # 🆕 ENDPOINT PARA ESTADO DE ESPACIOS
 
+# 🆕 ACTIVOS ESTÁTICOS VERSIONADOS Y PRECOMPRIMIDOS PARA LAS PÁGINAS MÓVILES
+# El CSS y el JS de registro/recarga viven en static/. Al iniciar se leen, se
+# comprimen una vez (gzip y, si está instalado, brotli) y se publican bajo una
+# URL con el hash del contenido, así el teléfono los guarda un año y solo el
+# HTML pequeño de cada token viaja en cada visita.
+CARPETA_ESTATICOS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+ACTIVOS_PAGINAS = ["css/registro.css", "js/registro.js", "css/recarga.css", "js/recarga.js"]
+TIPOS_ACTIVOS = {".css": "text/css; charset=utf-8", ".js": "application/javascript; charset=utf-8"}
+CACHE_CONTROL_ACTIVOS = 31536000  # Un año: la URL cambia cuando cambia el contenido
+
+def cargar_activos():
+    activos = {}
+    for nombre in ACTIVOS_PAGINAS:
+        with open(os.path.join(CARPETA_ESTATICOS, nombre), "rb") as archivo:
+            contenido = archivo.read()
+        activos[nombre] = {
+            "version": hashlib.sha1(contenido).hexdigest()[:12],
+            "tipo": TIPOS_ACTIVOS[os.path.splitext(nombre)[1]],
+            "identity": contenido,
+            "gzip": gzip.compress(contenido, compresslevel=9, mtime=0),
+            "br": brotli.compress(contenido) if brotli else None
+        }
+    return activos
+
+activos_paginas = cargar_activos()
+
+def codificacion_aceptada(disponibles):
+    """Mejor Content-Encoding que acepta el cliente entre las disponibles"""
+    aceptadas = request.accept_encodings
+    for codificacion in ("br", "gzip"):
+        if disponibles.get(codificacion) and aceptadas[codificacion]:
+            return codificacion
+    return "identity"
+
+@app.template_global()
+def url_activo(nombre):
+    return f"/activos/{activos_paginas[nombre]['version']}/{nombre}"
+
+@app.route("/activos/<version>/<path:nombre>")
+def servir_activo(version, nombre):
+    """CSS/JS precomprimido con cache inmutable"""
+    activo = activos_paginas.get(nombre)
+    if activo is None:
+        return "Archivo no encontrado", 404
+    if version != activo["version"]:
+        return redirect(url_activo(nombre))
+    
+    codificacion = codificacion_aceptada(activo)
+    respuesta = Response(activo[codificacion], content_type=activo["tipo"])
+    if codificacion != "identity":
+        respuesta.headers["Content-Encoding"] = codificacion
+    respuesta.headers["Vary"] = "Accept-Encoding"
+    respuesta.set_etag(f"{activo['version']}-{codificacion}")
+    respuesta.cache_control.public = True
+    respuesta.cache_control.max_age = CACHE_CONTROL_ACTIVOS
+    respuesta.cache_control.immutable = True
+    return respuesta.make_conditional(request)
+
+def respuesta_pagina_token(html):
+    """HTML de un token: pequeño, comprimido si el cliente lo acepta y nunca guardado en caché"""
+    cuerpo = html.encode("utf-8")
+    respuesta = Response(cuerpo, mimetype="text/html")
+    if request.accept_encodings["gzip"]:
+        respuesta.set_data(gzip.compress(cuerpo, compresslevel=6))
+        respuesta.headers["Content-Encoding"] = "gzip"
+    respuesta.headers["Vary"] = "Accept-Encoding"
+    respuesta.cache_control.no_store = True
+    return respuesta
+
+PLANTILLA_REGISTRO = app.jinja_env.from_string('''<!DOCTYPE html>
+<html>
+<head>
+    <title>Registro - Parqueadero Inteligente</title>
+    <meta name="viewport" content="width=device-width, initial-scale=1">
+    <link rel="stylesheet" href="{{ url_activo('css/registro.css') }}">
+    <script src="{{ url_activo('js/registro.js') }}" defer></script>
+</head>
+<body data-token="{{ token }}">
+    <div class="container">
+        <h1>🚗 Registro de Usuario</h1>
+        <p>Complete sus datos para registrar su tarjeta RFID</p>
+        
+        <!-- 🆕 SECCIÓN QR -->
+        <div class="qr-section">
+            <h3>📱 Escanee este código QR</h3>
+            <img src="/qr/registro/{{ token }}" alt="QR Code" style="max-width: 200px;">
+            <p>O copie este enlace:</p>
+            <div class="url-link">
+                <strong>{{ url_registro }}</strong>
+            </div>
+        </div>
+        
+        <form id="formRegistro">
+            <h3>👤 Datos Personales</h3>
+            <input type="text" id="nombre" placeholder="Nombre completo" required>
+            <input type="text" id="cedula" placeholder="Cédula" required>
+            <input type="tel" id="telefono" placeholder="Teléfono" required>
+            <input type="email" id="email" placeholder="Email" required>
+            
+            <h3>🚗 Datos del Vehículo</h3>
+            <input type="text" id="placa" placeholder="Placa del vehículo" required>
+            <select id="tipoVehiculo">
+                <option value="CARRO">Carro</option>
+                <option value="MOTO">Moto</option>
+            </select>
+            <input type="text" id="marca" placeholder="Marca del vehículo">
+            <input type="text" id="color" placeholder="Color del vehículo">
+            
+            <button type="submit" id="btnRegistro">📝 Registrar Usuario</button>
+        </form>
+        
+        <div id="resultado"></div>
+    </div>
+</body>
+</html>
+''')
+
 @app.route("/registro/<token>")
 def pagina_registro(token):
     """Página web para registro de nuevo usuario"""
-    transaccion = Transaccion.query.filter_by(TOKEN=token, TIPO="REGISTRO", ESTADO="PENDIENTE").first()
-    if not transaccion:
+    if not servicio_tokens.validar(token, "REGISTRO"):
         return "Enlace inválido o expirado"
     
     ip_servidor = obtener_ip_servidor()
     url_registro = f"http://{ip_servidor}:5000/registro/{token}"
     
-    return render_template_string('''
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Registro - Parqueadero Inteligente</title>
-        <meta name="viewport" content="width=device-width, initial-scale=1">
-        <style>
-            body { font-family: Arial, sans-serif; max-width: 500px; margin: 0 auto; padding: 20px; }
-            .container { background: #f5f5f5; padding: 20px; border-radius: 10px; }
-            h1 { color: #333; text-align: center; }
-            input, select, button { width: 100%; padding: 10px; margin: 8px 0; border: 1px solid #ddd; border-radius: 5px; }
-            button { background: #007bff; color: white; border: none; cursor: pointer; }
-            button:hover { background: #0056b3; }
-            button:disabled { 
-                background: #6c757d; 
-                cursor: not-allowed; 
-            }
-            .success { color: green; font-weight: bold; }
-            .error { color: red; font-weight: bold; }
-            .qr-section { text-align: center; margin: 20px 0; }
-            .url-link { background: #e7f3ff; padding: 10px; border-radius: 5px; word-break: break-all; }
-            .loading { 
-                text-align: center; 
-                color: #007bff; 
-                font-weight: bold; 
-            }
-            .info-box { 
-                background: #d4edda; 
-                border: 1px solid #c3e6cb; 
-                padding: 15px; 
-                border-radius: 5px; 
-                margin: 10px 0;
-            }
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <h1>🚗 Registro de Usuario</h1>
-            <p>Complete sus datos para registrar su tarjeta RFID</p>
-            
-            <!-- 🆕 SECCIÓN QR -->
-            <div class="qr-section">
-                <h3>📱 Escanee este código QR</h3>
-                <img src="/qr/registro/{{ token }}" alt="QR Code" style="max-width: 200px;">
-                <p>O copie este enlace:</p>
-                <div class="url-link">
-                    <strong>{{ url_registro }}</strong>
-                </div>
-            </div>
-            
-            <form id="formRegistro">
-                <h3>👤 Datos Personales</h3>
-                <input type="text" id="nombre" placeholder="Nombre completo" required>
-                <input type="text" id="cedula" placeholder="Cédula" required>
-                <input type="tel" id="telefono" placeholder="Teléfono" required>
-                <input type="email" id="email" placeholder="Email" required>
-                
-                <h3>🚗 Datos del Vehículo</h3>
-                <input type="text" id="placa" placeholder="Placa del vehículo" required>
-                <select id="tipoVehiculo">
-                    <option value="CARRO">Carro</option>
-                    <option value="MOTO">Moto</option>
-                </select>
-                <input type="text" id="marca" placeholder="Marca del vehículo">
-                <input type="text" id="color" placeholder="Color del vehículo">
-                
-                <button type="submit" id="btnRegistro">📝 Registrar Usuario</button>
-            </form>
-            
-            <div id="resultado"></div>
-        </div>
+    return respuesta_pagina_token(PLANTILLA_REGISTRO.render(token=token, url_registro=url_registro))
 
-        <script>
-        document.getElementById('formRegistro').addEventListener('submit', async function(e) {
-            e.preventDefault();
-            
-            const btnRegistro = document.getElementById('btnRegistro');
-            
-            // Deshabilitar botón durante el registro
-            btnRegistro.disabled = true;
-            btnRegistro.innerHTML = '⏳ Registrando...';
-            
-            document.getElementById('resultado').innerHTML = 
-                '<div class="loading">' +
-                '   <p>📝 Procesando registro...</p>' +
-                '   <p>⏳ Por favor espere</p>' +
-                '</div>';
+# ✅ 5. COMPLETAR REGISTRO - MEJORADO
+
+# 🆕 CACHÉ LRU DE IMÁGENES QR + PRE-RENDERIZADO EN SEGUNDO PLANO
+# La imagen de una URL nunca cambia, así que se guarda el PNG ya codificado y se
+# sirve con ETag y cache inmutable. Al emitir un token se encola su QR en un pool
+# de hilos para que ya esté listo cuando el teléfono lo pida.
+QR_REGISTRO = {"color": "blue", "borde": 4}
+QR_RECARGA = {"color": "green", "borde": 5}
+CACHE_CONTROL_QR = 86400
+
+class CacheQR:
+    """PNG por (url, color) con tamaño máximo y desalojo del menos usado"""
+
+    def __init__(self, capacidad=256, hilos=2):
+        self.lock = threading.Lock()
+        self.capacidad = capacidad
+        self.imagenes = OrderedDict()  # (url, color) -> (png, etag)
+        self.en_proceso = {}           # (url, color) -> Future del pre-renderizado
+        self.pool = ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="qr")
+        self.aciertos = 0
+        self.fallos = 0
+
+    def buscar(self, url, color):
+        with self.lock:
+            imagen = self.imagenes.get((url, color))
+            if imagen is not None:
+                self.imagenes.move_to_end((url, color))
+                self.aciertos += 1
+            return imagen
+
+    def renderizar(self, url, color, borde):
+        clave = (url, color)
+        try:
+            qr = qrcode.QRCode(
+                version=1,
+                error_correction=qrcode.constants.ERROR_CORRECT_L,
+                box_size=10,
+                border=borde,
+            )
+            qr.add_data(url)
+            qr.make(fit=True)
             
-            const datos = {
-                token: '{{ token }}',
-                nombre: document.getElementById('nombre').value,
-                cedula: document.getElementById('cedula').value,
-                telefono: document.getElementById('telefono').value,
-                email: document.getElementById('email').value,
-                placa: document.getElementById('placa').value,
-                tipo_vehiculo: document.getElementById('tipoVehiculo').value,
-                marca: document.getElementById('marca').value,
-                color: document.getElementById('color').value
-            };
+            buf = BytesIO()
+            qr.make_image(fill_color=color, back_color="white").save(buf, format='PNG')
+            png = buf.getvalue()
+            imagen = (png, hashlib.sha1(png).hexdigest())
             
-            try {
-                const response = await fetch('/api/registro/completar', {
-                    method: 'POST',
-                    headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify(datos)
-                });
-                
-                const data = await response.json();
-                
-                if (response.ok) {
-                    let mensajeHTML = 
-                        '<div class="info-box">' +
-                        '   <p class="success">✅ ' + data.mensaje + '</p>' +
-                        '</div>' +
-                        '<div style="background: #e7f3ff; padding: 15px; border-radius: 10px; margin: 15px 0;">' +
-                        '   <p><strong>👤 Usuario:</strong> ' + datos.nombre + '</p>' +
-                        '   <p><strong>🚗 Vehículo:</strong> ' + datos.placa + '</p>' +
-                        '   <p><strong>📧 Email:</strong> ' + datos.email + '</p>' +
-                        '</div>' +
-                        '<div style="background: #fff3cd; padding: 15px; border-radius: 10px; margin: 15px 0;">' +
-                        '   <p><strong>💰 Siguiente paso:</strong></p>' +
-                        '   <p>Será redirigido automáticamente a la página de recarga</p>' +
-                        '</div>';
-                    
-                    document.getElementById('resultado').innerHTML = mensajeHTML;
-                    
-                    // 🆕 REDIRIGIR AUTOMÁTICAMENTE A RECARGA DESPUÉS DE 3 SEGUNDOS
-                    setTimeout(() => {
-                        if (data.url_recarga) {
-                            window.location.href = data.url_recarga;
-                        }
-                    }, 3000);
-                    
-                } else {
-                    document.getElementById('resultado').innerHTML = 
-                        '<div class="error">' +
-                        '   <p>❌ ' + data.error + '</p>' +
-                        '</div>';
-                    
-                    // Re-habilitar botón en caso de error
-                    btnRegistro.disabled = false;
-                    btnRegistro.innerHTML = '📝 Registrar Usuario';
-                }
-            } catch (error) {
-                document.getElementById('resultado').innerHTML = 
-                    '<div class="error">' +
-                    '   <p>❌ Error de conexión</p>' +
-                    '   <p>Verifique su conexión a internet e intente nuevamente</p>' +
-                    '</div>';
-                
-                // Re-habilitar botón en caso de error
-                btnRegistro.disabled = false;
-                btnRegistro.innerHTML = '📝 Registrar Usuario';
+            with self.lock:
+                self.imagenes[clave] = imagen
+                self.imagenes.move_to_end(clave)
+                while len(self.imagenes) > self.capacidad:
+                    self.imagenes.popitem(last=False)
+            return imagen
+        finally:
+            with self.lock:
+                self.en_proceso.pop(clave, None)
+
+    def obtener(self, url, color, borde):
+        """PNG y ETag de la URL; si se está pre-renderizando, espera ese resultado"""
+        imagen = self.buscar(url, color)
+        if imagen is not None:
+            return imagen
+        with self.lock:
+            self.fallos += 1
+            futuro = self.en_proceso.get((url, color))
+        if futuro is not None:
+            return futuro.result()
+        return self.renderizar(url, color, borde)
+
+    def prerenderizar(self, url, color, borde):
+        """Encola el QR en el pool sin bloquear la petición que emitió el token"""
+        clave = (url, color)
+        with self.lock:
+            if clave in self.imagenes or clave in self.en_proceso:
+                return
+            self.en_proceso[clave] = self.pool.submit(self.renderizar, url, color, borde)
+
+    def estadisticas(self):
+        with self.lock:
+            return {
+                "imagenes": len(self.imagenes),
+                "capacidad": self.capacidad,
+                "en_proceso": len(self.en_proceso),
+                "aciertos": self.aciertos,
+                "fallos": self.fallos
             }
-        });
-        </script>
-    </body>
-    </html>
-    ''', token=token, url_registro=url_registro)
 
-# ✅ 5. COMPLETAR REGISTRO - MEJORADO
+cache_qr = CacheQR()
+
+def respuesta_qr(png, etag):
+    """PNG con ETag fuerte y cache larga; responde 304 si el cliente ya lo tiene"""
+    respuesta = Response(png, mimetype='image/png')
+    respuesta.set_etag(etag)
+    respuesta.cache_control.public = True
+    respuesta.cache_control.max_age = CACHE_CONTROL_QR
+    respuesta.cache_control.immutable = True
+    return respuesta.make_conditional(request)
 
 @app.route("/qr/recarga/<token>")
 def generar_qr_recarga(token):
@@ -1185,16 +3456,8 @@ def generar_qr_recarga(token):
         ip_servidor = obtener_ip_servidor()
         url_recarga = f"http://{ip_servidor}:5000/recarga/{token}"
         
-        qr = qrcode.QRCode(version=1, box_size=10, border=5)
-        qr.add_data(url_recarga)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color="green", back_color="white")
-        buf = BytesIO()
-        img.save(buf, format='PNG')
-        buf.seek(0)
-        
-        return send_file(buf, mimetype='image/png')
+        png, etag = cache_qr.obtener(url_recarga, **QR_RECARGA)
+        return respuesta_qr(png, etag)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -1203,235 +3466,188 @@ def generar_qr_recarga(token):
 def generar_qr_registro(token):
     """Genera QR para registro de nuevo usuario"""
     try:
-        # Verificar que el token existe
-        transaccion = Transaccion.query.filter_by(TOKEN=token, TIPO="REGISTRO", ESTADO="PENDIENTE").first()
-        if not transaccion:
-            return "Token inválido o expirado", 404
-        
         ip_servidor = obtener_ip_servidor()
         url_registro = f"http://{ip_servidor}:5000/registro/{token}"
         
-        print(f"📱 Generando QR para registro: {url_registro}")
-        
-        # Generar QR
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(url_registro)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color="blue", back_color="white")
-        buf = BytesIO()
-        img.save(buf, format='PNG')
-        buf.seek(0)
+        # Verificar el token aunque el QR esté en caché: la caché no se entera cuando
+        # el token se consume o vence (con el índice en memoria no va a la base de datos)
+        if not servicio_tokens.validar(token, "REGISTRO"):
+            return "Token inválido o expirado", 404
         
-        print(f"✅ QR generado exitosamente")
-        return send_file(buf, mimetype='image/png')
+        return respuesta_qr(*cache_qr.obtener(url_registro, **QR_REGISTRO))
         
     except Exception as e:
-        print(f"❌ Error generando QR: {str(e)}")
+        bitacora_registro.error("qr_error", error=str(e))
         return jsonify({"error": f"Error generando QR: {str(e)}"}), 500
+
+@app.route("/api/cache/qr")
+def estado_cache_qr():
+    """Ocupación y aciertos de la caché de imágenes QR"""
+    return jsonify({"cache_qr": cache_qr.estadisticas()})
+
+PLANTILLA_RECARGA = app.jinja_env.from_string('''<!DOCTYPE html>
+<html>
+<head>
+    <title>Recarga - Parqueadero Inteligente</title>
+    <meta name="viewport" content="width=device-width, initial-scale=1">
+    <link rel="stylesheet" href="{{ url_activo('css/recarga.css') }}">
+    <script src="{{ url_activo('js/recarga.js') }}" defer></script>
+</head>
+<body data-token="{{ token }}">
+    <div class="container">
+        <h1>💰 Recarga de Saldo</h1>
+        
+        <div class="qr-section">
+            <h3>📱 Escanee este código QR</h3>
+            <img src="/qr/recarga/{{ token }}" alt="QR Code" style="max-width: 200px;">
+            <p>O copie este enlace:</p>
+            <div class="url-link">
+                <strong>{{ url_recarga }}</strong>
+            </div>
+        </div>
+        
+        <div class="user-info">
+            <p><strong>Usuario:</strong> {{ usuario.NOMBRE }}</p>
+            <p><strong>Saldo actual:</strong> ${{ "%.0f"|format(usuario.SALDO|float) }}</p>
+            <p><strong>Mínimo para entrada:</strong> ${{ monto_minimo }}</p>
+            <p><strong>💡 Nota:</strong> El monto mínimo para ingresar es ahora de $5,000</p>
+        </div>
+        
+        <h3>Seleccione el monto a recargar:</h3>
+        <div style="display: grid; grid-template-columns: 1fr 1fr; gap: 10px;">
+            <!-- 🆕 MONTOS ACTUALIZADOS -->
+            <div class="monto-btn" data-monto="10000">$10.000</div>
+            <div class="monto-btn" data-monto="15000">$15.000</div>
+            <div class="monto-btn" data-monto="20000">$20.000</div>
+            <div class="monto-btn" data-monto="50000">$50.000</div>
+            <div class="monto-btn" data-monto="100000">$100.000</div>
+            <div class="monto-btn" data-monto="200000">$200.000</div>
+        </div>
+        
+        <input type="hidden" id="montoSeleccionado" value="10000">
+        
+        <button onclick="procesarPago()">💳 Proceder al Pago</button>
+        
+        <div id="resultado" style="margin-top: 20px;"></div>
+    </div>
+</body>
+</html>
+''')
+
 @app.route("/recarga/<token>")
 def pagina_recarga(token):
     """Página web para recarga de saldo con montos actualizados"""
-    transaccion = Transaccion.query.filter_by(TOKEN=token, TIPO="RECARGA", ESTADO="PENDIENTE").first()
+    transaccion = servicio_tokens.validar(token, "RECARGA")
     if not transaccion:
         return "Enlace inválido o expirado"
     
-    usuario = Usuario.query.get(transaccion.ID_USUARIO)
+    usuario = db.session.get(Usuario, transaccion["usuario_id"])
     monto_minimo = 5000  # 🆕 CAMBIADO A 5000
     ip_servidor = obtener_ip_servidor()
     url_recarga = f"http://{ip_servidor}:5000/recarga/{token}"
     
-    return render_template_string('''
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Recarga - Parqueadero Inteligente</title>
-        <meta name="viewport" content="width=device-width, initial-scale=1">
-        <style>
-            body { font-family: Arial, sans-serif; max-width: 500px; margin: 0 auto; padding: 20px; }
-            .container { background: #f5f5f5; padding: 20px; border-radius: 10px; }
-            h1 { color: #333; text-align: center; }
-            .user-info { background: #e7f3ff; padding: 15px; border-radius: 5px; margin: 10px 0; }
-            .monto-btn { 
-                background: white; 
-                border: 2px solid #007bff; 
-                padding: 15px; 
-                margin: 5px; 
-                border-radius: 5px; 
-                cursor: pointer;
-                text-align: center;
-            }
-            .monto-btn.selected { background: #007bff; color: white; }
-            button { width: 100%; padding: 15px; background: #28a745; color: white; border: none; border-radius: 5px; cursor: pointer; }
-            button:hover { background: #218838; }
-            .success { color: green; }
-            .error { color: red; }
-            .qr-section { text-align: center; margin: 20px 0; }
-            .url-link { background: #e7f3ff; padding: 10px; border-radius: 5px; word-break: break-all; }
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <h1>💰 Recarga de Saldo</h1>
-            
-            <div class="qr-section">
-                <h3>📱 Escanee este código QR</h3>
-                <img src="/qr/recarga/{{ token }}" alt="QR Code" style="max-width: 200px;">
-                <p>O copie este enlace:</p>
-                <div class="url-link">
-                    <strong>{{ url_recarga }}</strong>
-                </div>
-            </div>
-            
-            <div class="user-info">
-                <p><strong>Usuario:</strong> {{ usuario.NOMBRE }}</p>
-                <p><strong>Saldo actual:</strong> ${{ "%.0f"|format(usuario.SALDO|float) }}</p>
-                <p><strong>Mínimo para entrada:</strong> ${{ monto_minimo }}</p>
-                <p><strong>💡 Nota:</strong> El monto mínimo para ingresar es ahora de $5,000</p>
-            </div>
-            
-            <h3>Seleccione el monto a recargar:</h3>
-            <div style="display: grid; grid-template-columns: 1fr 1fr; gap: 10px;">
-                <!-- 🆕 MONTOS ACTUALIZADOS -->
-                <div class="monto-btn" data-monto="10000">$10.000</div>
-                <div class="monto-btn" data-monto="15000">$15.000</div>
-                <div class="monto-btn" data-monto="20000">$20.000</div>
-                <div class="monto-btn" data-monto="50000">$50.000</div>
-                <div class="monto-btn" data-monto="100000">$100.000</div>
-                <div class="monto-btn" data-monto="200000">$200.000</div>
-            </div>
-            
-            <input type="hidden" id="montoSeleccionado" value="10000">
-            
-            <button onclick="procesarPago()">💳 Proceder al Pago</button>
-            
-            <div id="resultado" style="margin-top: 20px;"></div>
-        </div>
+    return respuesta_pagina_token(PLANTILLA_RECARGA.render(
+        usuario=usuario, monto_minimo=monto_minimo, token=token, url_recarga=url_recarga))
 
-        <script>
-        // Seleccionar monto
-        document.querySelectorAll('.monto-btn').forEach(btn => {
-            btn.addEventListener('click', function() {
-                document.querySelectorAll('.monto-btn').forEach(b => b.classList.remove('selected'));
-                this.classList.add('selected');
-                document.getElementById('montoSeleccionado').value = this.dataset.monto;
-            });
-        });
-        
-        // Seleccionar primer monto por defecto
-        document.querySelector('.monto-btn').classList.add('selected');
-        
-        async function procesarPago() {
-            const monto = document.getElementById('montoSeleccionado').value;
-            const token = '{{ token }}';
-            
-            document.getElementById('resultado').innerHTML = '<p>⏳ Procesando pago...</p>';
-            
-            try {
-                const response = await fetch('/api/recarga/procesar', {
-                    method: 'POST',
-                    headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({token: token, monto: parseFloat(monto)})
-                });
-                
-                const data = await response.json();
-                
-                if (response.ok) {
-                    document.getElementById('resultado').innerHTML = 
-                        '<p class="success">✅ ' + data.mensaje + '</p>' +
-                        '<p><strong>Nuevo saldo:</strong> $' + data.nuevo_saldo + '</p>' +
-                        '<p><strong>Ya puede ingresar al parqueadero!</strong></p>' +
-                        '<p>Pase su tarjeta RFID nuevamente en la entrada</p>';
-                } else {
-                    document.getElementById('resultado').innerHTML = 
-                        '<p class="error">❌ ' + data.error + '</p>';
-                }
-            } catch (error) {
-                document.getElementById('resultado').innerHTML = 
-                    '<p class="error">❌ Error de conexión</p>';
-            }
-        }
-        </script>
-    </body>
-    </html>
-    ''', usuario=usuario, monto_minimo=monto_minimo, token=token, url_recarga=url_recarga)
 @app.route("/api/recarga/procesar", methods=["POST"])
 def procesar_recarga():
     """Procesa la recarga de saldo y abre barrera automáticamente si hay espacio"""
     try:
         data = request.get_json()
         token = data.get('token')
-        monto = float(data.get('monto', 0))
+        try:
+            monto = float(data.get('monto', 0))
+        except (TypeError, ValueError):
+            monto = math.nan
+        if not math.isfinite(monto) or monto <= 0:
+            return jsonify({"error": "El monto debe ser un número mayor que cero"}), 400
         
-        transaccion = Transaccion.query.filter_by(TOKEN=token, TIPO="RECARGA", ESTADO="PENDIENTE").first()
+        transaccion = servicio_tokens.validar(token, "RECARGA")
         if not transaccion:
             return jsonify({"error": "Token inválido o expirado"}), 400
         
-        usuario = Usuario.query.get(transaccion.ID_USUARIO)
-        if not usuario:
-            return jsonify({"error": "Usuario no encontrado"}), 404
-        
-        # ACTUALIZAR SALDO
-        saldo_anterior = float(usuario.SALDO) if usuario.SALDO else 0.0
-        nuevo_saldo = saldo_anterior + monto
-        usuario.SALDO = nuevo_saldo
-        
-        # Confirmar transacción
-        transaccion.MONTO = monto
-        transaccion.ESTADO = "CONFIRMADA"
-        
-        db.session.commit()
+        usuario = db.session.get(Usuario, transaccion["usuario_id"])
+        if not usuario:
+            return jsonify({"error": "Usuario no encontrado"}), 404
+        
+        # Valores simples para el escritor: los objetos de esta sesión no cruzan de hilo
+        usuario_id, nombre, tarjeta_rfid = usuario.ID, usuario.NOMBRE, usuario.TARJETA_RFID
+        vehiculo = Vehiculo.query.filter_by(ID_USUARIO=usuario_id).first()
+        datos_vehiculo = {"id": vehiculo.ID, "placa": vehiculo.PLACA, "tipo": vehiculo.TIPO} if vehiculo else None
+        
+        # La recarga y la entrada automática se confirman juntas en el escritor único
+        def confirmar_recarga():
+            # Confirmar transacción: un segundo envío del mismo token no vuelve a sumar saldo
+            if not servicio_tokens.consumir(token, "RECARGA", monto=monto):
+                return None
+            
+            # ACTUALIZAR SALDO (abono atómico + movimiento en el libro)
+            nuevo_saldo = abonar_saldo(usuario_id, monto, referencia=f"RECARGA:{token}")
+            sumar_contadores(transaccion["fecha"], recargas=1, monto_recargas=monto)
+            
+            # 🆕 VERIFICAR SI HAY ESPACIO DISPONIBLE Y CREAR ENTRADA AUTOMÁTICAMENTE
+            if not datos_vehiculo:
+                return nuevo_saldo, None, False
+            # La entrada activa se busca en turno: un toque en la barrera pudo crearla recién
+            if db.session.query(Entrada.ID).filter_by(ID_USUARIO=usuario_id, ESTADO="ACTIVA").first():
+                return nuevo_saldo, None, True
+            
+            # 🆕 BUSCAR ESPACIO DISPONIBLE SEGÚN SENSORES
+            espacio_disponible = asignador_espacios.reclamar(datos_vehiculo["tipo"])
+            if not espacio_disponible:
+                return nuevo_saldo, None, False
+            
+            # 🆕 CREAR ENTRADA AUTOMÁTICAMENTE
+            entrada = Entrada(
+                ID_USUARIO=usuario_id,
+                ID_VEHICULO=datos_vehiculo["id"],
+                ID_ESPACIO=espacio_disponible["id"],
+                FECHA_ENTRADA=datetime.utcnow(),
+                ESTADO="ACTIVA"
+            )
+            db.session.add(entrada)
+            db.session.flush()
+            
+            # VINCULAR LA ENTRADA AL ESPACIO RECLAMADO
+            Espacio.query.filter_by(ID=espacio_disponible["id"]).update(
+                {Espacio.ID_ENTRADA_ACTUAL: entrada.ID}, synchronize_session=False)
+            
+            # 🆕 COMANDO DE APERTURA: se entrega al ESP32 en cuanto se confirma
+            publicar_comando("entrada", "ABRIR_BARRERA",
+                             espacio=espacio_disponible["numero"], placa=datos_vehiculo["placa"])
+            sumar_contadores(entrada.FECHA_ENTRADA, datos_vehiculo["tipo"], entradas=1)
+            emitir_evento("entrada", accion="INICIADA", id=entrada.ID,
+                          espacio=espacio_disponible["numero"], usuario=nombre,
+                          placa=datos_vehiculo["placa"],
+                          hora_entrada=entrada.FECHA_ENTRADA.strftime('%H:%M:%S'))
+            return nuevo_saldo, {
+                "id": entrada.ID,
+                "fecha_entrada": entrada.FECHA_ENTRADA,
+                "espacio_id": espacio_disponible["id"],
+                "espacio": espacio_disponible["numero"],
+                "placa": datos_vehiculo["placa"],
+                "tipo": datos_vehiculo["tipo"]
+            }, False
+        
+        resultado = escritor_unico.ejecutar(confirmar_recarga)
+        if resultado is None:
+            return jsonify({"error": "Token inválido o expirado"}), 400
+        
+        nuevo_saldo, entrada_rfid, entrada_activa = resultado
+        saldo_anterior = nuevo_saldo - monto
         
-        print(f"💰 RECARGA EXITOSA - Usuario: {usuario.NOMBRE}, Saldo: {nuevo_saldo}")
+        if tarjeta_rfid:
+            indice_rfid.actualizar(tarjeta_rfid, saldo=nuevo_saldo)
         
-        # 🆕 VERIFICAR SI HAY ESPACIO DISPONIBLE Y CREAR ENTRADA AUTOMÁTICAMENTE
-        vehiculo = Vehiculo.query.filter_by(ID_USUARIO=usuario.ID).first()
         espacio_asignado = None
-        entrada_creada = False
-        
-        if vehiculo:
-            # Verificar si ya tiene entrada activa
-            entrada_activa = Entrada.query.filter_by(ID_USUARIO=usuario.ID, ESTADO="ACTIVA").first()
-            
-            if not entrada_activa:
-                # 🆕 BUSCAR ESPACIO DISPONIBLE SEGÚN SENSORES
-                espacio_disponible = Espacio.query.filter_by(
-                    TIPO_VEHICULO=vehiculo.TIPO,
-                    ESTADO="DISPONIBLE"
-                ).first()
-                
-                if espacio_disponible:
-                    # 🆕 CREAR ENTRADA AUTOMÁTICAMENTE
-                    entrada = Entrada(
-                        ID_USUARIO=usuario.ID,
-                        ID_VEHICULO=vehiculo.ID,
-                        ID_ESPACIO=espacio_disponible.ID,
-                        ESTADO="ACTIVA"
-                    )
-                    db.session.add(entrada)
-                    db.session.flush()
-                    
-                    # OCUPAR ESPACIO
-                    espacio_disponible.ESTADO = "OCUPADO"
-                    espacio_disponible.ID_ENTRADA_ACTUAL = entrada.ID
-                    
-                    db.session.commit()
-                    entrada_creada = True
-                    espacio_asignado = espacio_disponible.NUMERO
-                    
-                    print(f"🎉 ENTRADA AUTOMÁTICA CREADA - Usuario: {usuario.NOMBRE}, Espacio: {espacio_asignado}")
-                    
-                    # 🆕 IMPORTANTE: Enviar comando de apertura automática
-                    # En un sistema real, aquí enviarías una señal a Arduino via WebSocket o HTTP
-                else:
-                    print(f"⚠️ Recarga exitosa pero no hay espacios disponibles para {usuario.NOMBRE}")
-            else:
-                print(f"⚠️ Usuario {usuario.NOMBRE} ya tiene entrada activa")
+        entrada_creada = entrada_rfid is not None
+        if entrada_creada:
+            espacio_asignado = entrada_rfid["espacio"]
+            if tarjeta_rfid:
+                indice_rfid.actualizar(tarjeta_rfid, entrada=entrada_rfid)
+        bitacora_recargas.info("recarga_confirmada", usuario_id=usuario_id, monto=monto,
+                               entrada_automatica=entrada_creada, espacio=espacio_asignado,
+                               sin_espacio=bool(vehiculo and not entrada_creada and not entrada_activa))
         
         # 🆕 PREPARAR RESPUESTA CON INFORMACIÓN DE ENTRADA
         respuesta = {
@@ -1448,14 +3664,10 @@ def procesar_recarga():
                 "entrada_automatica": True,
                 "mensaje_entrada": f"¡Entrada registrada exitosamente!",
                 "espacio_asignado": espacio_asignado,
-                "vehiculo": vehiculo.PLACA,
+                "vehiculo": datos_vehiculo["placa"],
                 "comando": "ABRIR_BARRERA"  # 🆕 COMANDO PARA ARDUINO
             })
             
-            # 🆕 ENVIAR SEÑAL DE APERTURA A ARDUINO
-            # En un sistema real, implementarías WebSockets o un endpoint especial
-            print(f"🚦 ENVIANDO COMANDO DE APERTURA AUTOMÁTICA PARA {usuario.NOMBRE}")
-            
         else:
             respuesta.update({
                 "entrada_automatica": False,
@@ -1464,55 +3676,194 @@ def procesar_recarga():
         
         return jsonify(respuesta), 200
         
+    except EscrituraVencida as e:
+        bitacora_recargas.advertencia("recarga_sin_turno", error=str(e))
+        return jsonify({"error": "Servidor ocupado, intente de nuevo"}), 503
     except Exception as e:
         db.session.rollback()
-        print(f"❌ Error en recarga: {str(e)}")
+        bitacora_recargas.error("recarga_error", error=str(e))
         return jsonify({"error": f"Error en recarga: {str(e)}"}), 500
 # 🆕 ENDPOINT PARA CONTROL MANUAL DE BARRERA
 # 🆕 ENDPOINT PARA ACTUALIZAR ESTADO DE SENSORES
+# 🆕 INGESTA DE SENSORES (VARIOS CONTROLADORES, LOTES EN UNA TRANSACCIÓN)
+CONTROLADOR_PRINCIPAL = "PRINCIPAL"
+TAMANO_BLOQUE_SQL = 500  # IDs por sentencia IN (...) para no pasar el límite de parámetros
+
+class MapaSensores:
+    """Cache de (controlador, pin) -> (ID, número) del espacio"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pines = {}
+        self.ultima_carga = 0.0
+
+    def cargar(self):
+        filas = db.session.query(Espacio.CONTROLADOR, Espacio.SENSOR_PIN, Espacio.ID, Espacio.NUMERO).all()
+        with self.lock:
+            self.pines = {(controlador, pin): (espacio_id, numero) for controlador, pin, espacio_id, numero in filas}
+            self.ultima_carga = time.monotonic()
+
+    def resolver(self, controlador, pin):
+        """Retorna (ID, número) del espacio o None; recarga como mucho cada 5 s ante pines nuevos"""
+        espacio = self.pines.get((controlador, pin))
+        if espacio is None and time.monotonic() - self.ultima_carga > 5:
+            self.cargar()
+            espacio = self.pines.get((controlador, pin))
+        return espacio
+
+mapa_sensores = MapaSensores()
+
+SQL_OCUPAR_POR_SENSOR = text("""
+    UPDATE ESPACIO SET ESTADO = 'OCUPADO', ULTIMA_DETECCION = :ts
+    WHERE ID = :id AND ESTADO = 'DISPONIBLE'
+      AND (ULTIMA_DETECCION IS NULL OR ULTIMA_DETECCION <= :ts)
+""")
+SQL_LIBERAR_POR_SENSOR = text("""
+    UPDATE ESPACIO SET ESTADO = 'DISPONIBLE', ULTIMA_DETECCION = :ts
+    WHERE ID = :id AND ESTADO = 'OCUPADO'
+      AND (ULTIMA_DETECCION IS NULL OR ULTIMA_DETECCION <= :ts)
+      AND NOT EXISTS (SELECT 1 FROM ENTRADA WHERE ID_ESPACIO = :id AND ESTADO = 'ACTIVA')
+""")
+SQL_MARCAR_DETECCION = text("""
+    UPDATE ESPACIO SET ULTIMA_DETECCION = :ts
+    WHERE ID = :id AND (ULTIMA_DETECCION IS NULL OR ULTIMA_DETECCION <= :ts)
+""")
+SQL_ESTADO_ESPACIOS = text("""
+    SELECT ID, ESTADO,
+           EXISTS (SELECT 1 FROM ENTRADA WHERE ID_ESPACIO = ESPACIO.ID AND ESTADO = 'ACTIVA')
+    FROM ESPACIO WHERE ID IN :ids
+""").bindparams(bindparam("ids", expanding=True))
+
+SQL_ESTADO_FINAL_ESPACIOS = text(
+    "SELECT NUMERO, ESTADO, ULTIMA_DETECCION FROM ESPACIO WHERE ID IN :ids"
+).bindparams(bindparam("ids", expanding=True)).columns(
+    NUMERO=db.String, ESTADO=db.String, ULTIMA_DETECCION=db.DateTime)
+
+def escribir_lecturas_sensores(lecturas):
+    """Aplica lecturas (controlador, pin, detectado, ts) en una sola transacción (sin commit).
+
+    Las lecturas de un mismo espacio se reducen a la más reciente; los UPDATE se
+    envían en lote (executemany) y llevan su propia condición, así que una
+    lectura vieja o una entrada activa nunca pisan el estado real del espacio.
+    """
+    ahora = datetime.utcnow()
+    ultimas = {}
+    desconocidas = 0
+    for controlador, pin, detectado, ts in lecturas:
+        espacio = mapa_sensores.resolver(controlador, pin)
+        if espacio is None:
+            desconocidas += 1
+            continue
+        fecha = min(datetime.utcfromtimestamp(ts), ahora) if ts else ahora
+        anterior = ultimas.get(espacio[0])
+        if anterior is None or fecha >= anterior[1]:
+            ultimas[espacio[0]] = (bool(detectado), fecha, espacio[1])
+
+    ocupar, liberar, marcar = [], [], []
+    ids = list(ultimas)
+    for inicio in range(0, len(ids), TAMANO_BLOQUE_SQL):
+        filas = db.session.execute(SQL_ESTADO_ESPACIOS, {"ids": ids[inicio:inicio + TAMANO_BLOQUE_SQL]})
+        for espacio_id, estado, con_entrada in filas:
+            detectado, fecha, numero = ultimas[espacio_id]
+            parametros = {"id": espacio_id, "ts": fecha}
+            if detectado and estado == "DISPONIBLE":
+                ocupar.append(parametros)
+            elif not detectado and estado == "OCUPADO" and not con_entrada:
+                liberar.append(parametros)
+            else:
+                marcar.append(parametros)
+
+    if ocupar:
+        db.session.execute(SQL_OCUPAR_POR_SENSOR, ocupar)
+    if liberar:
+        db.session.execute(SQL_LIBERAR_POR_SENSOR, liberar)
+    if marcar:
+        db.session.execute(SQL_MARCAR_DETECCION, marcar)
+    
+    # Los UPDATE llevan condición: se relee el estado final para avisar solo cambios reales
+    cambiados = [parametros["id"] for parametros in ocupar + liberar]
+    for inicio in range(0, len(cambiados), TAMANO_BLOQUE_SQL):
+        filas = db.session.execute(SQL_ESTADO_FINAL_ESPACIOS, {"ids": cambiados[inicio:inicio + TAMANO_BLOQUE_SQL]})
+        for numero, estado, ultima_deteccion in filas:
+            emitir_evento("espacio", numero=numero, estado=estado,
+                          ultima_deteccion=ultima_deteccion.strftime('%H:%M:%S') if ultima_deteccion else None)
+
+    return {
+        "lecturas": len(lecturas),
+        "espacios": len(ultimas),
+        "ocupados": len(ocupar),
+        "liberados": [parametros["id"] for parametros in liberar],
+        "desconocidas": desconocidas
+    }
+
+def aplicar_lecturas_sensores(lecturas):
+    """Aplica las lecturas en el escritor único y devuelve los espacios liberados a las listas libres"""
+    resultado = escritor_unico.ejecutar(lambda: escribir_lecturas_sensores(lecturas))
+    for espacio_id in resultado["liberados"]:
+        asignador_espacios.liberar(espacio_id)
+    return dict(resultado, liberados=len(resultado["liberados"]))
+
 @app.route("/api/sensores/actualizar", methods=["POST"])
 def actualizar_sensores():
-    """Actualiza el estado de los espacios basado en los sensores"""
+    """Actualiza el estado de los espacios basado en los sensores del controlador principal"""
     try:
         data = request.get_json() or {}
-        print(f"📡 Datos de sensores recibidos: {data}")
+        bitacora_sensores.debug("lectura_recibida", datos=data)
         
         # Ejemplo de data esperada: {"sensor_1": true, "sensor_2": false, "sensor_3": true}
+        lecturas = [
+            (CONTROLADOR_PRINCIPAL, int(sensor_key.split("_")[1]), detectado, None)
+            for sensor_key, detectado in data.items()
+            if sensor_key.startswith("sensor_")
+        ]
+        resultado = aplicar_lecturas_sensores(lecturas)
         
-        for sensor_key, detectado in data.items():
-            if sensor_key.startswith("sensor_"):
-                numero_sensor = int(sensor_key.split("_")[1])
-                
-                # Buscar espacio con este sensor
-                espacio = Espacio.query.filter_by(SENSOR_PIN=numero_sensor).first()
-                if espacio:
-                    if detectado:
-                        # Sensor detecta vehículo
-                        if espacio.ESTADO == "DISPONIBLE":
-                            espacio.ESTADO = "OCUPADO"
-                            print(f"🅿️ Sensor {numero_sensor}: Espacio {espacio.NUMERO} ahora OCUPADO")
-                    else:
-                        # Sensor no detecta vehículo
-                        if espacio.ESTADO == "OCUPADO":
-                            # Verificar si hay entrada activa
-                            entrada_activa = Entrada.query.filter_by(
-                                ID_ESPACIO=espacio.ID, 
-                                ESTADO="ACTIVA"
-                            ).first()
-                            
-                            if not entrada_activa:
-                                espacio.ESTADO = "DISPONIBLE"
-                                print(f"🅿️ Sensor {numero_sensor}: Espacio {espacio.NUMERO} ahora DISPONIBLE")
-                    
-                    espacio.ULTIMA_DETECCION = datetime.utcnow()
-        
-        db.session.commit()
+        if resultado["ocupados"] or resultado["liberados"]:
+            bitacora_sensores.info("espacios_cambiados", **resultado)
         
         return jsonify({"success": True, "mensaje": "Sensores actualizados"}), 200
         
+    except EscrituraVencida as e:
+        bitacora_sensores.advertencia("lectura_sin_turno", error=str(e))
+        return jsonify({"error": "Servidor ocupado, reenvíe la lectura"}), 503
+    except Exception as e:
+        db.session.rollback()
+        bitacora_sensores.error("lectura_error", error=str(e))
+        return jsonify({"error": f"Error en sensores: {str(e)}"}), 500
+
+@app.route("/api/sensores/lote", methods=["POST"])
+def ingerir_lote_sensores():
+    """Recibe lotes de lecturas de muchos ESP32.
+
+    Formato: {"lecturas": [["ESP32-2", 1, true, 1718000000], ...]} o bien
+    {"lecturas": [{"controlador": "ESP32-2", "pin": 1, "ocupado": true, "ts": 1718000000}]}.
+    "ts" (segundos Unix) es opcional; sin él se usa la hora del servidor.
+    """
+    try:
+        data = request.get_json() or {}
+        lecturas = []
+        for lectura in data.get("lecturas", []):
+            if isinstance(lectura, dict):
+                lecturas.append((str(lectura["controlador"]), int(lectura["pin"]),
+                                 lectura["ocupado"], lectura.get("ts")))
+            else:
+                controlador, pin, detectado = lectura[:3]
+                ts = lectura[3] if len(lectura) > 3 else None
+                lecturas.append((str(controlador), int(pin), detectado, ts))
+        
+        resultado = aplicar_lecturas_sensores(lecturas)
+        bitacora_sensores.info("lote_aplicado", **resultado)
+        return jsonify({"success": True, **resultado}), 200
+        
+    except (KeyError, TypeError, ValueError) as e:
+        db.session.rollback()
+        return jsonify({"error": f"Lectura inválida: {str(e)}"}), 400
+    except EscrituraVencida as e:
+        bitacora_sensores.advertencia("lote_sin_turno", error=str(e))
+        return jsonify({"error": "Servidor ocupado, reenvíe el lote"}), 503
     except Exception as e:
         db.session.rollback()
-        print(f"❌ Error actualizando sensores: {str(e)}")
+        bitacora_sensores.error("lote_error", error=str(e))
         return jsonify({"error": f"Error en sensores: {str(e)}"}), 500
 
 # 🆕 ENDPOINT PARA OBTENER ESPACIOS DISPONIBLES (CONSIDERA SENSORES)
@@ -1537,201 +3888,528 @@ def espacios_disponibles():
 from flask import Flask, jsonify, request, send_file, render_template_string, redirect  # 🆕 AGREGAR redirect
 
 
+# 🆕 FACTURAS: INSTANTÁNEA AL SALIR, PLANTILLA PRECOMPILADA Y CACHÉ DE BYTES CON ETAG
+# Los montos, la tarifa y el saldo restante se copian a FACTURA en la misma
+# transacción de la salida, así que la factura no cambia si luego cambian la
+# tarifa o el saldo. Al ser inmutable, el HTML renderizado se guarda por ID.
+DATOS_FACTURA = """
+    SELECT E.ID AS ID_ENTRADA, U.NOMBRE, U.CEDULA, U.TELEFONO, U.EMAIL, V.PLACA, V.TIPO AS TIPO_VEHICULO,
+           V.MARCA, V.COLOR, S.NUMERO AS ESPACIO, E.FECHA_ENTRADA, E.FECHA_SALIDA, E.TIEMPO_ESTACIONADO,
+           :tarifa_hora AS TARIFA_HORA, E.MONTO_COBRADO, U.SALDO AS SALDO_RESTANTE, :fecha_emision AS FECHA_EMISION
+    FROM ENTRADA E
+    JOIN USUARIO U ON U.ID = E.ID_USUARIO
+    JOIN VEHICULO V ON V.ID = E.ID_VEHICULO
+    LEFT JOIN ESPACIO S ON S.ID = E.ID_ESPACIO
+    WHERE E.ID = :entrada_id AND E.ESTADO = 'FINALIZADA'
+"""
+
+SQL_GUARDAR_FACTURA = text("""
+    INSERT OR IGNORE INTO FACTURA (ID_ENTRADA, NOMBRE, CEDULA, TELEFONO, EMAIL, PLACA, TIPO_VEHICULO,
+                                   MARCA, COLOR, ESPACIO, FECHA_ENTRADA, FECHA_SALIDA, TIEMPO_ESTACIONADO,
+                                   TARIFA_HORA, MONTO_COBRADO, SALDO_RESTANTE, FECHA_EMISION)
+""" + DATOS_FACTURA).bindparams(bindparam("fecha_emision", type_=db.DateTime))
+
+# Las mismas columnas sin guardarlas, para mostrar salidas anteriores a las instantáneas
+SQL_FACTURA_SIN_CONGELAR = text(DATOS_FACTURA).bindparams(
+    bindparam("fecha_emision", type_=db.DateTime)
+).columns(FECHA_ENTRADA=db.DateTime, FECHA_SALIDA=db.DateTime, FECHA_EMISION=db.DateTime)
+
+SQL_SALIDAS_SIN_FACTURA = text("""
+    SELECT E.ID, V.TIPO, E.FECHA_ENTRADA, E.FECHA_SALIDA
+    FROM ENTRADA E
+    JOIN VEHICULO V ON V.ID = E.ID_VEHICULO
+    LEFT JOIN FACTURA F ON F.ID_ENTRADA = E.ID
+    WHERE E.ID > :desde AND E.ESTADO = 'FINALIZADA' AND F.ID_ENTRADA IS NULL
+    ORDER BY E.ID LIMIT :lote
+""").columns(FECHA_ENTRADA=db.DateTime, FECHA_SALIDA=db.DateTime)
+
+def guardar_factura(entrada_id, tarifa_hora):
+    """Congela la factura de una entrada ya finalizada (sin commit; no hace nada si ya existe)"""
+    db.session.execute(SQL_GUARDAR_FACTURA, {
+        "entrada_id": entrada_id,
+        "tarifa_hora": tarifa_hora,
+        "fecha_emision": datetime.utcnow()
+    })
+
+def factura_sin_congelar(entrada):
+    """Factura en memoria (no se agrega a la sesión) de una salida que no tiene instantánea:
+    tarifa y saldo actuales. La congela `flask congelar-facturas`, no la ruta GET."""
+    fila = db.session.execute(SQL_FACTURA_SIN_CONGELAR, {
+        "entrada_id": entrada.ID,
+        "tarifa_hora": motor_tarifas.cotizar(
+            entrada.vehiculo.TIPO, entrada.FECHA_ENTRADA, entrada.FECHA_SALIDA)["tarifa_hora"],
+        "fecha_emision": datetime.utcnow()
+    }).mappings().first()
+    return Factura(**fila) if fila else None
+
+def congelar_facturas_pendientes(lote=500):
+    """Congela en el escritor único, lote por lote, las salidas que aún no tienen FACTURA; retorna cuántas"""
+    desde = total = 0
+    while True:
+        filas = db.session.execute(SQL_SALIDAS_SIN_FACTURA, {"desde": desde, "lote": lote}).all()
+        db.session.rollback()  # Suelta la lectura antes de pedir turno al escritor
+        if not filas:
+            return total
+        tarifas = [(fila.ID, motor_tarifas.cotizar(fila.TIPO, fila.FECHA_ENTRADA, fila.FECHA_SALIDA)["tarifa_hora"])
+                   for fila in filas]
+        escritor_unico.ejecutar(lambda: [guardar_factura(entrada_id, tarifa) for entrada_id, tarifa in tarifas],
+                                plazo=30)
+        total += len(filas)
+        desde = filas[-1].ID
+
+PLANTILLA_FACTURA = app.jinja_env.from_string("""
+<!DOCTYPE html>
+<html>
+<head>
+    <title>Factura - Parqueadero Inteligente</title>
+    <meta charset="UTF-8">
+    <style>
+        body { 
+            font-family: 'Arial', sans-serif; 
+            max-width: 800px; 
+            margin: 0 auto; 
+            padding: 20px;
+            background-color: #f8f9fa;
+        }
+        .container { 
+            background: white; 
+            padding: 30px; 
+            border-radius: 15px;
+            box-shadow: 0 0 20px rgba(0,0,0,0.1);
+            border: 2px solid #007bff;
+        }
+        .header { 
+            text-align: center; 
+            border-bottom: 3px solid #007bff; 
+            padding-bottom: 20px;
+            margin-bottom: 30px;
+        }
+        .logo { 
+            font-size: 32px; 
+            font-weight: bold;
+            color: #007bff;
+            margin-bottom: 10px;
+        }
+        .factura-id { 
+            background: #007bff; 
+            color: white; 
+            padding: 8px 15px; 
+            border-radius: 20px;
+            display: inline-block;
+            font-weight: bold;
+        }
+        .info-section { 
+            margin: 25px 0; 
+            padding: 20px;
+            background: #f8f9fa;
+            border-radius: 10px;
+            border-left: 4px solid #007bff;
+        }
+        .info-section h3 {
+            color: #007bff;
+            margin-top: 0;
+            border-bottom: 1px solid #dee2e6;
+            padding-bottom: 10px;
+        }
+        .total-section { 
+            background: linear-gradient(135deg, #007bff, #0056b3); 
+            color: white; 
+            padding: 25px; 
+            border-radius: 10px; 
+            font-weight: bold;
+            text-align: center;
+            margin: 30px 0;
+        }
+        .footer { 
+            text-align: center; 
+            margin-top: 40px; 
+            color: #6c757d;
+            font-size: 14px;
+            border-top: 1px solid #dee2e6;
+            padding-top: 20px;
+        }
+        .row {
+            display: flex;
+            justify-content: space-between;
+            margin-bottom: 10px;
+        }
+        .label { font-weight: bold; color: #495057; }
+        .value { color: #212529; }
+        .total-amount {
+            font-size: 36px;
+            font-weight: bold;
+            margin: 15px 0;
+        }
+        .badge {
+            background: #28a745;
+            color: white;
+            padding: 5px 10px;
+            border-radius: 15px;
+            font-size: 12px;
+            font-weight: bold;
+        }
+    </style>
+</head>
+<body>
+    <div class="container">
+        <div class="header">
+            <div class="logo">🚗 PARQUEADERO INTELIGENTE</div>
+            <h1>FACTURA DE ESTACIONAMIENTO</h1>
+            <div class="factura-id">FACTURA #{{ '%06d' % f.ID_ENTRADA }}</div>
+            <p>Sistema Automatizado de Gestión Vehicular</p>
+        </div>
+
+        <div class="row">
+            <div style="flex: 1;">
+                <div class="info-section">
+                    <h3>👤 INFORMACIÓN DEL CLIENTE</h3>
+                    <div class="row"><span class="label">Nombre:</span><span class="value">{{ f.NOMBRE }}</span></div>
+                    <div class="row"><span class="label">Cédula:</span><span class="value">{{ f.CEDULA }}</span></div>
+                    <div class="row"><span class="label">Teléfono:</span><span class="value">{{ f.TELEFONO or 'N/A' }}</span></div>
+                    <div class="row"><span class="label">Email:</span><span class="value">{{ f.EMAIL or 'N/A' }}</span></div>
+                </div>
+            </div>
+        </div>
+
+        <div class="row">
+            <div style="flex: 1; margin-right: 15px;">
+                <div class="info-section">
+                    <h3>🚗 INFORMACIÓN DEL VEHÍCULO</h3>
+                    <div class="row"><span class="label">Placa:</span><span class="value">{{ f.PLACA }}</span></div>
+                    <div class="row"><span class="label">Tipo:</span><span class="value">{{ f.TIPO_VEHICULO }}</span></div>
+                    <div class="row"><span class="label">Marca:</span><span class="value">{{ f.MARCA or 'N/A' }}</span></div>
+                    <div class="row"><span class="label">Color:</span><span class="value">{{ f.COLOR or 'N/A' }}</span></div>
+                </div>
+            </div>
+
+            <div style="flex: 1; margin-left: 15px;">
+                <div class="info-section">
+                    <h3>📅 DETALLES DEL SERVICIO</h3>
+                    <div class="row"><span class="label">Espacio:</span><span class="value">{{ f.ESPACIO or 'N/A' }}</span></div>
+                    <div class="row"><span class="label">Fecha entrada:</span><span class="value">{{ f.FECHA_ENTRADA.strftime('%Y-%m-%d %H:%M:%S') }}</span></div>
+                    <div class="row"><span class="label">Fecha salida:</span><span class="value">{{ f.FECHA_SALIDA.strftime('%Y-%m-%d %H:%M:%S') }}</span></div>
+                    <div class="row"><span class="label">Tiempo total:</span><span class="value">{{ f.TIEMPO_ESTACIONADO or 'N/A' }}</span></div>
+                    <div class="row"><span class="label">Tarifa/hora:</span><span class="value">${{ '{:,.0f}'.format(f.TARIFA_HORA|float) }}</span></div>
+                </div>
+            </div>
+        </div>
+
+        <div class="total-section">
+            <h3>💰 TOTAL PAGADO</h3>
+            <div class="total-amount">${{ '{:,.0f}'.format(f.MONTO_COBRADO|float) }}</div>
+            <div class="row" style="justify-content: center;">
+                <span class="label" style="color: white;">Saldo restante:</span>
+                <span class="value" style="color: white; margin-left: 15px;">${{ '{:,.0f}'.format(f.SALDO_RESTANTE|float) }}</span>
+            </div>
+            <div style="margin-top: 15px;">
+                <span class="badge">PAGADO ✓</span>
+            </div>
+        </div>
+
+        <div class="footer">
+            <p><strong>¡Gracias por preferir nuestro parqueadero!</strong></p>
+            <p>Factura generada el: {{ f.FECHA_EMISION.strftime('%Y-%m-%d %H:%M:%S') }}</p>
+            <p>Para consultas: contacto@parqueaderointeligente.com</p>
+        </div>
+    </div>
+</body>
+</html>
+""")
+
+class CacheLRU:
+    """Diccionario con tamaño máximo que desaloja la entrada usada hace más tiempo"""
+
+    def __init__(self, capacidad):
+        self.lock = threading.Lock()
+        self.capacidad = capacidad
+        self.valores = OrderedDict()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def obtener(self, clave):
+        with self.lock:
+            valor = self.valores.get(clave)
+            if valor is None:
+                self.fallos += 1
+            else:
+                self.valores.move_to_end(clave)
+                self.aciertos += 1
+            return valor
+
+    def guardar(self, clave, valor):
+        with self.lock:
+            self.valores[clave] = valor
+            self.valores.move_to_end(clave)
+            while len(self.valores) > self.capacidad:
+                self.valores.popitem(last=False)
+
+    def estadisticas(self):
+        with self.lock:
+            return {"entradas": len(self.valores), "capacidad": self.capacidad,
+                    "aciertos": self.aciertos, "fallos": self.fallos}
+
+cache_facturas = CacheLRU(capacidad=512)
+
 # 🆕 ENDPOINT CORREGIDO PARA GENERAR FACTURA POR ID DE ENTRADA
 @app.route("/api/factura/generar/<int:entrada_id>")
 def generar_factura_id(entrada_id):
     """Genera factura en formato HTML usando el ID de entrada"""
     try:
-        # Buscar entrada por ID
-        entrada = Entrada.query.get(entrada_id)
-        if not entrada:
-            return jsonify({"error": "Entrada no encontrada"}), 404
-        
-        if not entrada.FECHA_SALIDA:
-            return jsonify({"error": "El vehículo aún no ha salido"}), 400
-        
-        # Calcular tiempo estacionado
-        tiempo_estacionado = entrada.FECHA_SALIDA - entrada.FECHA_ENTRADA
-        horas = tiempo_estacionado.total_seconds() / 3600
-        horas_redondeadas = max(1, round(horas * 2) / 2)
-        
-        usuario = entrada.usuario
-        vehiculo = entrada.vehiculo
-        espacio = entrada.espacio
-        
-        # Obtener tarifa
-        tarifa = Tarifa.query.filter_by(TIPO_VEHICULO=vehiculo.TIPO, ACTIVA=True).first()
-        tarifa_hora = float(tarifa.TARIFA_HORA) if tarifa else 5000.0
-        
-        factura_html = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <title>Factura - Parqueadero Inteligente</title>
-            <meta charset="UTF-8">
-            <style>
-                body {{ 
-                    font-family: 'Arial', sans-serif; 
-                    max-width: 800px; 
-                    margin: 0 auto; 
-                    padding: 20px;
-                    background-color: #f8f9fa;
-                }}
-                .container {{ 
-                    background: white; 
-                    padding: 30px; 
-                    border-radius: 15px;
-                    box-shadow: 0 0 20px rgba(0,0,0,0.1);
-                    border: 2px solid #007bff;
-                }}
-                .header {{ 
-                    text-align: center; 
-                    border-bottom: 3px solid #007bff; 
-                    padding-bottom: 20px;
-                    margin-bottom: 30px;
-                }}
-                .logo {{ 
-                    font-size: 32px; 
-                    font-weight: bold;
-                    color: #007bff;
-                    margin-bottom: 10px;
-                }}
-                .factura-id {{ 
-                    background: #007bff; 
-                    color: white; 
-                    padding: 8px 15px; 
-                    border-radius: 20px;
-                    display: inline-block;
-                    font-weight: bold;
-                }}
-                .info-section {{ 
-                    margin: 25px 0; 
-                    padding: 20px;
-                    background: #f8f9fa;
-                    border-radius: 10px;
-                    border-left: 4px solid #007bff;
-                }}
-                .info-section h3 {{
-                    color: #007bff;
-                    margin-top: 0;
-                    border-bottom: 1px solid #dee2e6;
-                    padding-bottom: 10px;
-                }}
-                .total-section {{ 
-                    background: linear-gradient(135deg, #007bff, #0056b3); 
-                    color: white; 
-                    padding: 25px; 
-                    border-radius: 10px; 
-                    font-weight: bold;
-                    text-align: center;
-                    margin: 30px 0;
-                }}
-                .footer {{ 
-                    text-align: center; 
-                    margin-top: 40px; 
-                    color: #6c757d;
-                    font-size: 14px;
-                    border-top: 1px solid #dee2e6;
-                    padding-top: 20px;
-                }}
-                .row {{
-                    display: flex;
-                    justify-content: space-between;
-                    margin-bottom: 10px;
-                }}
-                .label {{ font-weight: bold; color: #495057; }}
-                .value {{ color: #212529; }}
-                .total-amount {{
-                    font-size: 36px;
-                    font-weight: bold;
-                    margin: 15px 0;
-                }}
-                .badge {{
-                    background: #28a745;
-                    color: white;
-                    padding: 5px 10px;
-                    border-radius: 15px;
-                    font-size: 12px;
-                    font-weight: bold;
-                }}
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <div class="header">
-                    <div class="logo">🚗 PARQUEADERO INTELIGENTE</div>
-                    <h1>FACTURA DE ESTACIONAMIENTO</h1>
-                    <div class="factura-id">FACTURA #{entrada.ID:06d}</div>
-                    <p>Sistema Automatizado de Gestión Vehicular</p>
-                </div>
-                
-                <div class="row">
-                    <div style="flex: 1;">
-                        <div class="info-section">
-                            <h3>👤 INFORMACIÓN DEL CLIENTE</h3>
-                            <div class="row"><span class="label">Nombre:</span><span class="value">{usuario.NOMBRE}</span></div>
-                            <div class="row"><span class="label">Cédula:</span><span class="value">{usuario.CEDULA}</span></div>
-                            <div class="row"><span class="label">Teléfono:</span><span class="value">{usuario.TELEFONO or 'N/A'}</span></div>
-                            <div class="row"><span class="label">Email:</span><span class="value">{usuario.EMAIL or 'N/A'}</span></div>
-                        </div>
-                    </div>
-                </div>
-                
-                <div class="row">
-                    <div style="flex: 1; margin-right: 15px;">
-                        <div class="info-section">
-                            <h3>🚗 INFORMACIÓN DEL VEHÍCULO</h3>
-                            <div class="row"><span class="label">Placa:</span><span class="value">{vehiculo.PLACA}</span></div>
-                            <div class="row"><span class="label">Tipo:</span><span class="value">{vehiculo.TIPO}</span></div>
-                            <div class="row"><span class="label">Marca:</span><span class="value">{vehiculo.MARCA or 'N/A'}</span></div>
-                            <div class="row"><span class="label">Color:</span><span class="value">{vehiculo.COLOR or 'N/A'}</span></div>
-                        </div>
-                    </div>
-                    
-                    <div style="flex: 1; margin-left: 15px;">
-                        <div class="info-section">
-                            <h3>📅 DETALLES DEL SERVICIO</h3>
-                            <div class="row"><span class="label">Espacio:</span><span class="value">{espacio.NUMERO if espacio else 'N/A'}</span></div>
-                            <div class="row"><span class="label">Fecha entrada:</span><span class="value">{entrada.FECHA_ENTRADA.strftime('%Y-%m-%d %H:%M:%S')}</span></div>
-                            <div class="row"><span class="label">Fecha salida:</span><span class="value">{entrada.FECHA_SALIDA.strftime('%Y-%m-%d %H:%M:%S')}</span></div>
-                            <div class="row"><span class="label">Tiempo total:</span><span class="value">{entrada.TIEMPO_ESTACIONADO or str(tiempo_estacionado).split('.')[0]}</span></div>
-                            <div class="row"><span class="label">Tarifa/hora:</span><span class="value">${tarifa_hora:,.0f}</span></div>
-                        </div>
-                    </div>
-                </div>
-                
-                <div class="total-section">
-                    <h3>💰 TOTAL PAGADO</h3>
-                    <div class="total-amount">${float(entrada.MONTO_COBRADO):,.0f}</div>
-                    <div class="row" style="justify-content: center;">
-                        <span class="label" style="color: white;">Saldo restante:</span>
-                        <span class="value" style="color: white; margin-left: 15px;">${float(usuario.SALDO):,.0f}</span>
-                    </div>
-                    <div style="margin-top: 15px;">
-                        <span class="badge">PAGADO ✓</span>
-                    </div>
-                </div>
+        html = cache_facturas.obtener(entrada_id)
+        if html is None:
+            factura = db.session.get(Factura, entrada_id)
+            congelada = factura is not None
+            if not congelada:
+                # Salida anterior a las instantáneas: se muestra con los datos actuales, sin
+                # escribir desde el GET ni guardarla en la caché (aún puede cambiar)
+                entrada = db.session.get(Entrada, entrada_id)
+                if not entrada:
+                    return jsonify({"error": "Entrada no encontrada"}), 404
+                if not entrada.FECHA_SALIDA:
+                    return jsonify({"error": "El vehículo aún no ha salido"}), 400
                 
-                <div class="footer">
-                    <p><strong>¡Gracias por preferir nuestro parqueadero!</strong></p>
-                    <p>Factura generada el: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>
-                    <p>Para consultas: contacto@parqueaderointeligente.com</p>
-                </div>
-            </div>
-        </body>
-        </html>
-        """
-        
-        return render_template_string(factura_html)
+                factura = factura_sin_congelar(entrada)
+                if not factura:
+                    return jsonify({"error": "El vehículo aún no ha salido"}), 400
+            
+            html = PLANTILLA_FACTURA.render(f=factura).encode("utf-8")
+            html = (html, hashlib.sha1(html).hexdigest())
+            if congelada:
+                cache_facturas.guardar(entrada_id, html)
+        
+        cuerpo, etag = html
+        respuesta = Response(cuerpo, mimetype="text/html")
+        respuesta.set_etag(etag)
+        respuesta.cache_control.private = True  # Lleva datos personales: solo en el navegador
+        respuesta.cache_control.max_age = 86400
+        return respuesta.make_conditional(request)
         
     except Exception as e:
         return jsonify({"error": f"Error generando factura: {str(e)}"}), 500
 
+@app.route("/api/cache/facturas")
+def estado_cache_facturas():
+    """Ocupación y aciertos de la caché de facturas renderizadas"""
+    return jsonify({"cache_facturas": cache_facturas.estadisticas()})
+
+@app.route("/api/cache/tokens")
+def estado_tokens():
+    """Tokens pendientes en memoria y contadores del servicio de tokens"""
+    return jsonify({"tokens": servicio_tokens.estadisticas()})
+
+@app.cli.command("medir-tokens")
+@click.option("--cantidad", default=5000, help="Tokens a emitir en cada medición")
+def comando_medir_tokens(cantidad):
+    """Mide tokens por segundo: en memoria y emitiendo/consumiendo en la base de datos"""
+    aplicar_migraciones()
+    servicio = ServicioTokens()
+    inicio = time.perf_counter()
+    tokens = []
+    for _ in range(cantidad):
+        token = servicio.nuevo_token()
+        servicio.registrar(token, {"tipo": "RECARGA", "usuario_id": None,
+                                   "tarjeta_rfid": None, "fecha": datetime.utcnow()})
+        tokens.append(token)
+    validos = sum(1 for token in tokens if servicio.validar(token, "RECARGA"))
+    segundos = time.perf_counter() - inicio
+    print(f"🎟️ Índice en memoria: {cantidad} emitidos y {validos} validados en {segundos:.3f} s "
+          f"({cantidad / segundos:,.0f} tokens/s)")
+
+    # Ida y vuelta por SQLite dentro de una transacción que se revierte: no deja filas
+    inicio = time.perf_counter()
+    tokens = [servicio.emitir("RECARGA") for _ in range(cantidad)]
+    db.session.flush()
+    consumidos = sum(1 for token in tokens if servicio.consumir(token, "RECARGA", monto=0))
+    repetidos = sum(1 for token in tokens[:100] if servicio.consumir(token, "RECARGA", monto=0))
+    segundos = time.perf_counter() - inicio
+    db.session.rollback()
+    print(f"🗄️ Base de datos: {cantidad} emitidos y {consumidos} consumidos en {segundos:.3f} s "
+          f"({cantidad / segundos:,.0f} tokens/s); segundo consumo aceptado: {repetidos}")
+
+@app.route("/api/mantenimiento/barredor")
+def estado_barredor():
+    """Transacciones pendientes expiradas y borradas por el barredor"""
+    pendientes = db.session.query(Transaccion.TIPO, db.func.count(Transaccion.ID)).filter(
+        Transaccion.ESTADO == "PENDIENTE").group_by(Transaccion.TIPO).all()
+    return jsonify({
+        "barredor": barredor_transacciones.estadisticas(),
+        "pendientes": {tipo: total for tipo, total in pendientes}
+    })
+
+@app.route("/api/mantenimiento/escritor")
+def estado_escritor():
+    """Cola y commits en grupo del escritor único"""
+    return jsonify({"escritor": escritor_unico.estadisticas()})
+
+@app.route("/api/auditoria/saldos")
+@app.route("/api/auditoria/saldos/<int:usuario_id>")
+def auditoria_saldos(usuario_id=None):
+    """Saldo vigente contra último corte + movimientos posteriores, por usuario"""
+    try:
+        resultados = auditar_saldos(usuario_id)
+        if usuario_id is not None and not resultados:
+            return jsonify({"error": "Usuario no encontrado"}), 404
+        return jsonify({
+            "ok": all(resultado["ok"] for resultado in resultados),
+            "descuadrados": [resultado["usuario_id"] for resultado in resultados if not resultado["ok"]],
+            "usuarios": resultados
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/usuario/<int:usuario_id>/movimientos")
+def movimientos_usuario(usuario_id):
+    """Últimos movimientos del libro de saldos de un usuario"""
+    movimientos = MovimientoSaldo.query.filter_by(ID_USUARIO=usuario_id).order_by(
+        MovimientoSaldo.ID.desc()).limit(50).all()
+    return jsonify({
+        "movimientos": [{
+            "id": m.ID,
+            "fecha": m.FECHA.strftime('%Y-%m-%d %H:%M:%S'),
+            "tipo": m.TIPO,
+            "monto": float(m.MONTO),
+            "saldo_resultante": float(m.SALDO_RESULTANTE),
+            "referencia": m.REFERENCIA
+        } for m in movimientos]
+    })
+
+@app.cli.command("cortar-saldos")
+def comando_cortar_saldos():
+    """Toma un corte del libro de saldos y falla (código 1) si algún saldo no cuadra"""
+    aplicar_migraciones()
+    cortes = tomar_cortes_saldo()
+    db.session.commit()
+    descuadrados = [resultado for resultado in auditar_saldos() if not resultado["ok"]]
+    print(f"✂️ {cortes} cortes de saldo tomados")
+    for resultado in descuadrados:
+        print(f"❌ Usuario {resultado['usuario_id']}: saldo {resultado['saldo']} "
+              f"vs libro {resultado['saldo_libro']}")
+    if descuadrados:
+        raise SystemExit(1)
+
+@app.cli.command("congelar-facturas")
+def comando_congelar_facturas():
+    """Guarda la instantánea de FACTURA de las salidas anteriores a las instantáneas (una sola vez)"""
+    aplicar_migraciones()
+    print(f"🧾 {congelar_facturas_pendientes()} facturas congeladas")
+
+@app.cli.command("barrer-transacciones")
+def comando_barrer_transacciones():
+    """Una pasada del barredor (para cron si el servidor corre sin el hilo)"""
+    aplicar_migraciones()
+    resultado = barredor_transacciones.barrer()
+    print(f"🧹 {resultado['expiradas']} expiradas, {resultado['borradas']} borradas")
+
+# 🆕 TARIFAS: CONSULTA, CAMBIO (NUEVA VERSIÓN DEL MOTOR) Y SIMULACIÓN "QUÉ PASARÍA SI"
+def plan_publico(plan):
+    return {
+        "hora": plan["hora"],
+        "minima": plan["minima"],
+        "fraccion_minutos": plan["fraccion_minutos"],
+        "redondeo": plan["redondeo"],
+        "franjas": [{"inicio": inicio, "fin": fin, "hora": tarifa} for inicio, fin, tarifa in plan["franjas"]]
+    }
+
+def periodo_simulacion(desde, hasta, dias=365):
+    """(desde, hasta) de la simulación; por defecto los últimos `dias` días hasta hoy"""
+    hasta = datetime.strptime(hasta, '%Y-%m-%d') + timedelta(days=1) if hasta else rango_dia(datetime.utcnow())[1]
+    desde = datetime.strptime(desde, '%Y-%m-%d') if desde else hasta - timedelta(days=dias)
+    return desde, hasta
+
+@app.route("/api/tarifas")
+def listar_tarifas():
+    """Planes de tarifa vigentes y versión del motor"""
+    if not motor_tarifas.version:
+        motor_tarifas.cargar()
+    return jsonify({
+        "motor": motor_tarifas.estadisticas(),
+        "desfase_utc": DESFASE_UTC_TARIFAS,
+        "tarifas": {tipo: plan_publico(plan) for tipo, plan in motor_tarifas.planes.items()}
+    })
+
+@app.route("/api/tarifas/<tipo>", methods=["PUT"])
+def actualizar_tarifa(tipo):
+    """Cambia la tarifa activa de un tipo de vehículo y publica una nueva versión del motor"""
+    try:
+        tipo = tipo.upper()
+        try:
+            plan = normalizar_plan(tipo, request.get_json() or {}, motor_tarifas.plan(tipo))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        tarifa = Tarifa.query.filter_by(TIPO_VEHICULO=tipo, ACTIVA=True).order_by(Tarifa.ID).first()
+        if not tarifa:
+            tarifa = Tarifa(TIPO_VEHICULO=tipo, ACTIVA=True)
+            db.session.add(tarifa)
+        tarifa.TARIFA_HORA = plan["hora"]
+        tarifa.TARIFA_MINIMA = plan["minima"]
+        tarifa.FRACCION_MINUTOS = plan["fraccion_minutos"]
+        tarifa.REDONDEO = plan["redondeo"]
+        db.session.flush()
+
+        FranjaTarifa.query.filter_by(ID_TARIFA=tarifa.ID).delete(synchronize_session=False)
+        for inicio, fin, tarifa_hora in plan["franjas"]:
+            db.session.add(FranjaTarifa(ID_TARIFA=tarifa.ID, HORA_INICIO=inicio, HORA_FIN=fin,
+                                        TARIFA_HORA=tarifa_hora))
+        db.session.commit()
+
+        version = motor_tarifas.cargar()
+        bitacora_tarifas.info("tarifa_actualizada", tipo=tipo, version=version)
+        return jsonify({"tipo": tipo, "version": version, "tarifa": plan_publico(plan)})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/tarifas/simulacion", methods=["POST"])
+def simular_tarifas():
+    """Re-liquida las salidas del periodo (por defecto el último año) con una tarifa propuesta.
+
+    Cuerpo: {"desde", "hasta", "tarifas": {"CARRO": {"hora", "minima", "fraccion_minutos", "redondeo", "franjas"}}}
+    """
+    try:
+        data = request.get_json() or {}
+        try:
+            desde, hasta = periodo_simulacion(data.get("desde"), data.get("hasta"))
+            propuestas = {tipo.upper(): cambios or {} for tipo, cambios in (data.get("tarifas") or {}).items()}
+            for tipo, cambios in propuestas.items():
+                normalizar_plan(tipo, cambios, motor_tarifas.plan(tipo))
+        except (ValueError, AttributeError) as e:
+            return jsonify({"error": str(e)}), 400
+        if np is None:
+            return jsonify({"error": "La simulación de tarifas requiere numpy"}), 503
+        return jsonify(motor_tarifas.simular(propuestas, desde, hasta))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.cli.command("simular-tarifas")
+@click.option("--tarifas", "propuesta", default="{}", help='JSON, p. ej. {"CARRO": {"hora": 6000, "fraccion_minutos": 15}}')
+@click.option("--desde", default=None, help="Fecha inicial YYYY-MM-DD (por defecto hace un año)")
+@click.option("--hasta", default=None, help="Fecha final YYYY-MM-DD (por defecto hoy)")
+def comando_simular_tarifas(propuesta, desde, hasta):
+    """Re-liquida las salidas del periodo con la tarifa propuesta e imprime el impacto y el tiempo"""
+    aplicar_migraciones()
+    desde, hasta = periodo_simulacion(desde, hasta)
+    propuestas = {tipo.upper(): cambios for tipo, cambios in json.loads(propuesta).items()}
+    resultado = motor_tarifas.simular(propuestas, desde, hasta)
+    print(f"🧮 {resultado['estadias']} salidas entre {resultado['desde']} y {resultado['hasta']}: "
+          f"lectura {resultado['segundos_lectura']:.3f} s, cálculo {resultado['segundos_calculo']:.3f} s")
+    for tipo, datos in resultado["por_tipo"].items():
+        print(f"   {tipo}: vigente ${datos['vigente']:,.0f} -> propuesto ${datos['propuesto']:,.0f} "
+              f"({datos['suben']} suben, {datos['bajan']} bajan)")
+    print(f"💲 Diferencia total: ${resultado['diferencia']:,.0f}")
+
 # 🆕 ENDPOINT CORREGIDO PARA FACTURA POR PLACA
 @app.route("/api/factura/placa/<placa>")
 def factura_por_placa(placa):
     """Genera factura de la última salida por placa"""
     try:
+        # Última factura de la placa: recorrido inverso de IX_FACTURA_PLACA_SALIDA, sin ordenar
+        entrada_id = db.session.query(Factura.ID_ENTRADA).filter(
+            Factura.PLACA == placa.upper()
+        ).order_by(Factura.FECHA_SALIDA.desc()).limit(1).scalar()
+        if entrada_id:
+            return redirect(f"/api/factura/generar/{entrada_id}")
+        
         # Buscar vehículo por placa
         vehiculo = Vehiculo.query.filter_by(PLACA=placa.upper()).first()
         if not vehiculo:
@@ -1751,6 +4429,128 @@ def factura_por_placa(placa):
         
     except Exception as e:
         return jsonify({"error": f"Error buscando factura: {str(e)}"}), 500
+# 🆕 CANAL DE COMANDOS POR BARRERA (LONG-POLL CON SECUENCIA Y CONFIRMACIÓN)
+# El ESP32 mantiene abierta una petición a /api/barrera/<puerta>/comandos; el
+# servidor la responde en cuanto se confirma una recarga o registro que ordena
+# abrir. Los comandos se guardan en COMANDO_BARRERA (el ID es la secuencia), así
+# que sobreviven a reinicios y los ve cualquier proceso; dentro del mismo proceso
+# la espera se despierta al instante con una Condition.
+ESPERA_MAXIMA_COMANDOS = 30    # segundos que puede quedar abierta una petición
+VIGENCIA_COMANDOS = 60         # un comando sin confirmar caduca a los 60 s
+INTERVALO_REVISION_COMANDOS = 1.0  # revisión de la BD por comandos de otros procesos
+
+class CanalComandos:
+    """Despierta las peticiones long-poll cuando se confirma un comando nuevo"""
+
+    def __init__(self):
+        self.condicion = threading.Condition()
+        self.generacion = 0
+
+    def notificar(self):
+        with self.condicion:
+            self.generacion += 1
+            self.condicion.notify_all()
+
+    def esperar(self, generacion, segundos):
+        """Espera un comando nuevo (o el tiempo indicado); retorna la generación actual"""
+        with self.condicion:
+            if self.generacion == generacion:
+                self.condicion.wait(segundos)
+            return self.generacion
+
+canal_comandos = CanalComandos()
+cupos_esperas_comandos = threading.BoundedSemaphore(MAXIMO_ESPERAS_COMANDOS)
+
+def publicar_comando(puerta, comando, **datos):
+    """Agrega un comando a la transacción actual; se entrega cuando el llamador hace commit"""
+    db.session.add(ComandoBarrera(
+        PUERTA=puerta,
+        COMANDO=comando,
+        DATOS=json.dumps(datos) if datos else None,
+        ESTADO="PENDIENTE"
+    ))
+    db.session.info["comandos_publicados"] = True
+
+@event.listens_for(Session, "after_commit")
+def notificar_comandos_publicados(session):
+    if session.info.pop("comandos_publicados", None):
+        canal_comandos.notificar()
+
+def comandos_pendientes(puerta, desde):
+    limite = datetime.utcnow() - timedelta(seconds=VIGENCIA_COMANDOS)
+    comandos = ComandoBarrera.query.filter(
+        ComandoBarrera.PUERTA == puerta,
+        ComandoBarrera.ESTADO == "PENDIENTE",
+        ComandoBarrera.ID > desde,
+        ComandoBarrera.FECHA >= limite
+    ).order_by(ComandoBarrera.ID).limit(20).all()
+    return [{
+        "seq": comando.ID,
+        "comando": comando.COMANDO,
+        "datos": json.loads(comando.DATOS) if comando.DATOS else {},
+        "fecha": comando.FECHA.strftime('%Y-%m-%d %H:%M:%S')
+    } for comando in comandos]
+
+@app.route("/api/barrera/<puerta>/comandos")
+def esperar_comandos_barrera(puerta):
+    """Long-poll: responde apenas haya comandos con secuencia mayor a ?desde="""
+    try:
+        desde = request.args.get('desde', 0, type=int)
+        espera = min(max(request.args.get('espera', 25, type=float), 0), ESPERA_MAXIMA_COMANDOS)
+        limite = time.monotonic() + espera
+        
+        # Solo las esperas ocupan cupo; una consulta con espera=0 responde enseguida
+        if espera > 0 and not cupos_esperas_comandos.acquire(blocking=False):
+            bitacora_barrera.advertencia("esperas_sin_cupo", puerta=puerta, maximo=MAXIMO_ESPERAS_COMANDOS)
+            return jsonify({"error": "Servidor ocupado, reintente la espera de comandos"}), 503, {"Retry-After": "2"}
+        try:
+            while True:
+                generacion = canal_comandos.generacion
+                comandos = comandos_pendientes(puerta, desde)
+                # Liberar la conexión mientras se espera
+                db.session.close()
+                restante = limite - time.monotonic()
+                if comandos or restante <= 0:
+                    break
+                canal_comandos.esperar(generacion, min(restante, INTERVALO_REVISION_COMANDOS))
+        finally:
+            if espera > 0:
+                cupos_esperas_comandos.release()
+        
+        return jsonify({
+            "puerta": puerta,
+            "comandos": comandos,
+            "ultimo": comandos[-1]["seq"] if comandos else desde
+        }), 200
+        
+    except Exception as e:
+        bitacora_barrera.error("comandos_error", puerta=puerta, error=str(e))
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/barrera/<puerta>/ack", methods=["POST"])
+def confirmar_comandos_barrera(puerta):
+    """El ESP32 confirma que ejecutó todos los comandos hasta la secuencia indicada"""
+    try:
+        data = request.get_json() or {}
+        seq = int(data.get("seq", 0))
+        
+        confirmados = ComandoBarrera.query.filter(
+            ComandoBarrera.PUERTA == puerta,
+            ComandoBarrera.ESTADO == "PENDIENTE",
+            ComandoBarrera.ID <= seq
+        ).update({
+            ComandoBarrera.ESTADO: "CONFIRMADO",
+            ComandoBarrera.FECHA_CONFIRMACION: datetime.utcnow()
+        }, synchronize_session=False)
+        db.session.commit()
+        
+        return jsonify({"success": True, "confirmados": confirmados, "seq": seq}), 200
+        
+    except Exception as e:
+        db.session.rollback()
+        bitacora_barrera.error("ack_error", puerta=puerta, error=str(e))
+        return jsonify({"error": str(e)}), 500
+
 @app.route("/api/barrera/abrir-automatica", methods=["POST"])
 def abrir_barrera_automatica():
     """Endpoint para que Arduino consulte si debe abrir la barrera automáticamente"""
@@ -1761,27 +4561,28 @@ def abrir_barrera_automatica():
         if not tarjeta_rfid:
             return jsonify({"error": "Tarjeta RFID requerida"}), 400
         
-        print(f"🔍 Consulta apertura automática - Tarjeta: {tarjeta_rfid}")
+        bitacora_barrera.debug("apertura_automatica_consultada", tarjeta=tarjeta_rfid)
         
-        # Buscar usuario
-        usuario = Usuario.query.filter_by(TARJETA_RFID=tarjeta_rfid).first()
-        if not usuario:
+        # Buscar usuario en el índice RFID
+        registro = indice_rfid.obtener(tarjeta_rfid)
+        if not registro:
             return jsonify({"abrir_barrera": False, "razon": "Usuario no encontrado"}), 200
         
         # Verificar si tiene entrada activa recién creada
-        entrada_activa = Entrada.query.filter_by(ID_USUARIO=usuario.ID, ESTADO="ACTIVA").first()
+        entrada_activa = registro["entrada"]
         
         if entrada_activa:
             # Verificar si la entrada fue creada hace menos de 30 segundos (recién registrado)
-            tiempo_desde_entrada = datetime.utcnow() - entrada_activa.FECHA_ENTRADA
+            tiempo_desde_entrada = datetime.utcnow() - entrada_activa["fecha_entrada"]
             if tiempo_desde_entrada.total_seconds() < 30:  # 30 segundos de margen
-                print(f"🚦 APERTURA AUTOMÁTICA AUTORIZADA para {usuario.NOMBRE}")
+                bitacora_barrera.info("apertura_automatica", usuario_id=registro["usuario_id"],
+                                      entrada_id=entrada_activa["id"])
                 return jsonify({
                     "abrir_barrera": True,
                     "mensaje": "Bienvenido, entrada automática permitida",
-                    "usuario": usuario.NOMBRE,
-                    "vehiculo": entrada_activa.vehiculo.PLACA if entrada_activa.vehiculo else "N/A",
-                    "espacio": entrada_activa.espacio.NUMERO if entrada_activa.espacio else "N/A"
+                    "usuario": registro["nombre"],
+                    "vehiculo": entrada_activa["placa"] or "N/A",
+                    "espacio": entrada_activa["espacio"] or "N/A"
                 }), 200
         
         return jsonify({
@@ -1790,16 +4591,18 @@ def abrir_barrera_automatica():
         }), 200
         
     except Exception as e:
-        print(f"❌ Error en apertura automática: {str(e)}")
+        bitacora_barrera.error("apertura_automatica_error", error=str(e))
         return jsonify({"error": str(e)}), 500
 @app.route("/api/barrera/abrir", methods=["POST"])
 def abrir_barrera():
     """Endpoint para abrir la barrera manualmente"""
     try:
-        print("🚦 COMANDO RECIBIDO: Abrir barrera desde recarga")
+        data = request.get_json(silent=True) or {}
+        puerta = data.get("puerta", "entrada")
+        bitacora_barrera.info("apertura_manual", puerta=puerta)
         
-        # 🆕 Aquí podrías enviar un comando a Arduino via WebSocket, HTTP, etc.
-        # Por ahora solo logueamos, pero puedes expandir esta funcionalidad
+        publicar_comando(puerta, "ABRIR_BARRERA", origen="manual")
+        db.session.commit()
         
         return jsonify({
             "success": True,
@@ -1808,8 +4611,13 @@ def abrir_barrera():
         }), 200
         
     except Exception as e:
-        print(f"❌ Error en apertura manual: {str(e)}")
+        db.session.rollback()
+        bitacora_barrera.error("apertura_manual_error", error=str(e))
         return jsonify({"error": str(e)}), 500
+@app.route("/api/cache/rfid")
+def estado_cache_rfid():
+    """Aciertos y fallos del índice RFID en memoria"""
+    return jsonify({"indice_rfid": indice_rfid.estadisticas()})
 @app.route("/api/estado-sistema")
 def estado_sistema():
     """Estado general del sistema"""
@@ -1835,35 +4643,76 @@ def estado_sistema():
         })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+
+def consultar_estado_espacios():
+    """Estado de todos los espacios con su entrada actual en una sola consulta"""
+    return [{
+        "numero": numero,
+        "tipo": tipo,
+        "estado": estado,
+        "sensor_pin": sensor_pin,
+        "ultima_deteccion": ultima_deteccion.strftime('%H:%M:%S') if ultima_deteccion else None,
+        "entrada_actual": {
+            "usuario": nombre,
+            "placa": placa,
+            "hora_entrada": fecha_entrada.strftime('%H:%M:%S')
+        } if fecha_entrada else None
+    } for numero, tipo, estado, sensor_pin, ultima_deteccion, nombre, placa, fecha_entrada in consulta_espacios()]
+
+# 🆕 STREAM SSE DE OCUPACIÓN: UN SNAPSHOT Y LUEGO SOLO CAMBIOS
+# Cada conexión ocupa un hilo: se admiten MAXIMO_DASHBOARDS y cada una se cierra a
+# los EDAD_MAXIMA_STREAM segundos; EventSource reconecta solo y recibe un snapshot
+# nuevo, así un dashboard olvidado no retiene el hilo para siempre.
+EDAD_MAXIMA_STREAM = 600
+REINTENTO_STREAM_MS = 3000
+
+@app.route("/api/espacios/stream")
+def stream_espacios():
+    """Server-Sent Events: envía el estado completo una vez y después los deltas.
+    Con todos los cupos ocupados responde 503; el dashboard puede usar /api/espacios/estado."""
+    # Suscribirse antes del snapshot para no perder cambios que ocurran entre ambos
+    suscripcion = bus_eventos.suscribir()
+    if suscripcion is None:
+        return jsonify({"error": "Servidor ocupado, demasiados dashboards conectados"}), 503, {"Retry-After": "30"}
+    try:
+        snapshot = consultar_estado_espacios()
+    except Exception as e:
+        bus_eventos.cancelar(suscripcion)
+        return jsonify({"error": str(e)}), 500
+    finally:
+        db.session.close()
+    
+    # Sin stream_with_context: el generador solo lee la cola y el snapshot ya tomado,
+    # y mantener el contexto retendría la db.session de la petición toda la conexión
+    def generar():
+        vence = time.monotonic() + EDAD_MAXIMA_STREAM
+        try:
+            yield f"retry: {REINTENTO_STREAM_MS}\nevent: snapshot\ndata: {json.dumps({'espacios': snapshot})}\n\n"
+            while True:
+                restante = vence - time.monotonic()
+                if restante <= 0:
+                    break
+                try:
+                    mensaje = suscripcion.get(timeout=min(15, restante))
+                except queue.Empty:
+                    yield ": ping\n\n"  # Mantiene viva la conexión a través de proxies
+                    continue
+                if mensaje is None:
+                    break
+                yield mensaje
+        finally:
+            bus_eventos.cancelar(suscripcion)
+    
+    return Response(generar(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
 @app.route("/api/espacios/estado")
 def estado_espacios():
     """Retorna el estado actual de todos los espacios"""
     try:
-        espacios = Espacio.query.all()
-        resultado = []
-        
-        for espacio in espacios:
-            # Información de la entrada activa si existe
-            entrada_info = None
-            if espacio.ID_ENTRADA_ACTUAL:
-                entrada = Entrada.query.get(espacio.ID_ENTRADA_ACTUAL)
-                if entrada:
-                    entrada_info = {
-                        "usuario": entrada.usuario.NOMBRE,
-                        "placa": entrada.vehiculo.PLACA,
-                        "hora_entrada": entrada.FECHA_ENTRADA.strftime('%H:%M:%S')
-                    }
-            
-            resultado.append({
-                "numero": espacio.NUMERO,
-                "tipo": espacio.TIPO_VEHICULO,
-                "estado": espacio.ESTADO,
-                "sensor_pin": espacio.SENSOR_PIN,
-                "ultima_deteccion": espacio.ULTIMA_DETECCION.strftime('%H:%M:%S') if espacio.ULTIMA_DETECCION else None,
-                "entrada_actual": entrada_info
-            })
-        
-        return jsonify({"espacios": resultado})
+        return jsonify({"espacios": consultar_estado_espacios()})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 @app.route("/api/historial/entradas")
@@ -1874,27 +4723,32 @@ def historial_entradas():
         limite = request.args.get('limite', 50, type=int)
         placa = request.args.get('placa', '').upper()
         
-        query = Entrada.query
+        query = db.session.query(
+            Entrada.ID, Usuario.NOMBRE, Vehiculo.PLACA, Espacio.NUMERO, Entrada.FECHA_ENTRADA,
+            Entrada.FECHA_SALIDA, Entrada.ESTADO, Entrada.MONTO_COBRADO, Entrada.TIEMPO_ESTACIONADO
+        ).join(Usuario, Usuario.ID == Entrada.ID_USUARIO).join(
+            Vehiculo, Vehiculo.ID == Entrada.ID_VEHICULO
+        ).outerjoin(Espacio, Espacio.ID == Entrada.ID_ESPACIO)
         
         if placa:
             vehiculo = Vehiculo.query.filter_by(PLACA=placa).first()
             if vehiculo:
-                query = query.filter_by(ID_VEHICULO=vehiculo.ID)
+                query = query.filter(Entrada.ID_VEHICULO == vehiculo.ID)
         
-        entradas = query.order_by(Entrada.FECHA_ENTRADA.desc()).limit(limite).all()
+        filas = query.order_by(Entrada.FECHA_ENTRADA.desc()).limit(limite)
         
         resultado = []
-        for entrada in entradas:
+        for entrada_id, nombre, placa_vehiculo, espacio, fecha_entrada, fecha_salida, estado, monto, tiempo in filas:
             resultado.append({
-                "id": entrada.ID,
-                "usuario": entrada.usuario.NOMBRE,
-                "placa": entrada.vehiculo.PLACA,
-                "espacio": entrada.espacio.NUMERO if entrada.espacio else "N/A",
-                "fecha_entrada": entrada.FECHA_ENTRADA.strftime('%Y-%m-%d %H:%M:%S'),
-                "fecha_salida": entrada.FECHA_SALIDA.strftime('%Y-%m-%d %H:%M:%S') if entrada.FECHA_SALIDA else None,
-                "estado": entrada.ESTADO,
-                "monto_cobrado": float(entrada.MONTO_COBRADO) if entrada.MONTO_COBRADO else None,
-                "tiempo_estacionado": entrada.TIEMPO_ESTACIONADO
+                "id": entrada_id,
+                "usuario": nombre,
+                "placa": placa_vehiculo,
+                "espacio": espacio or "N/A",
+                "fecha_entrada": fecha_entrada.strftime('%Y-%m-%d %H:%M:%S'),
+                "fecha_salida": fecha_salida.strftime('%Y-%m-%d %H:%M:%S') if fecha_salida else None,
+                "estado": estado,
+                "monto_cobrado": float(monto) if monto else None,
+                "tiempo_estacionado": tiempo
             })
         
         return jsonify({
@@ -1910,22 +4764,24 @@ def historial_recargas():
         limite = request.args.get('limite', 50, type=int)
         usuario_id = request.args.get('usuario_id', type=int)
         
-        query = Transaccion.query.filter_by(TIPO="RECARGA", ESTADO="CONFIRMADA")
+        query = db.session.query(
+            Transaccion.ID, Usuario.NOMBRE, Usuario.CEDULA, Transaccion.MONTO, Transaccion.FECHA
+        ).outerjoin(Usuario, Usuario.ID == Transaccion.ID_USUARIO).filter(
+            Transaccion.TIPO == "RECARGA", Transaccion.ESTADO == "CONFIRMADA")
         
         if usuario_id:
-            query = query.filter_by(ID_USUARIO=usuario_id)
+            query = query.filter(Transaccion.ID_USUARIO == usuario_id)
         
-        recargas = query.order_by(Transaccion.FECHA.desc()).limit(limite).all()
+        filas = query.order_by(Transaccion.FECHA.desc()).limit(limite)
         
         resultado = []
-        for recarga in recargas:
-            usuario = Usuario.query.get(recarga.ID_USUARIO)
+        for recarga_id, nombre, cedula, monto, fecha in filas:
             resultado.append({
-                "id": recarga.ID,
-                "usuario": usuario.NOMBRE if usuario else "N/A",
-                "cedula": usuario.CEDULA if usuario else "N/A",
-                "monto": float(recarga.MONTO),
-                "fecha": recarga.FECHA.strftime('%Y-%m-%d %H:%M:%S'),
+                "id": recarga_id,
+                "usuario": nombre or "N/A",
+                "cedula": cedula or "N/A",
+                "monto": float(monto),
+                "fecha": fecha.strftime('%Y-%m-%d %H:%M:%S'),
                 "metodo": "QR"  # Por ahora solo QR
             })
         
@@ -1974,40 +4830,17 @@ def usuario_por_placa(placa):
 def estadisticas_diarias():
     """Estadísticas de uso del día actual"""
     try:
-        hoy = datetime.now().date()
-        
-        # Entradas de hoy
-        entradas_hoy = Entrada.query.filter(
-            db.func.date(Entrada.FECHA_ENTRADA) == hoy
-        ).count()
-        
-        # Salidas de hoy
-        salidas_hoy = Entrada.query.filter(
-            db.func.date(Entrada.FECHA_SALIDA) == hoy,
-            Entrada.ESTADO == "FINALIZADA"
-        ).count()
-        
-        # Recaudo de hoy
-        recaudo_hoy = db.session.query(db.func.sum(Entrada.MONTO_COBRADO)).filter(
-            db.func.date(Entrada.FECHA_SALIDA) == hoy,
-            Entrada.ESTADO == "FINALIZADA"
-        ).scalar() or 0
-        
-        # Recargas de hoy
-        recargas_hoy = Transaccion.query.filter(
-            db.func.date(Transaccion.FECHA) == hoy,
-            Transaccion.TIPO == "RECARGA",
-            Transaccion.ESTADO == "CONFIRMADA"
-        ).count()
+        hoy = hoy_utc()  # Los contadores van por día UTC, como sumar_contadores
+        contadores = leer_contadores(hoy)
         
         return jsonify({
             "fecha": hoy.strftime('%Y-%m-%d'),
             "estadisticas": {
-                "entradas_hoy": entradas_hoy,
-                "salidas_hoy": salidas_hoy,
-                "recaudo_hoy": float(recaudo_hoy),
-                "recargas_hoy": recargas_hoy,
-                "ocupacion_actual": Espacio.query.filter_by(ESTADO="OCUPADO").count()
+                "entradas_hoy": contadores["entradas"],
+                "salidas_hoy": contadores["salidas"],
+                "recaudo_hoy": contadores["recaudo"],
+                "recargas_hoy": contadores["recargas"],
+                "ocupacion_actual": contadores["espacios_ocupados"]
             }
         })
     except Exception as e:
@@ -2018,46 +4851,469 @@ def estadisticas_diarias():
 def generar_recarga_existente(placa):
     """Genera nueva recarga para usuario ya registrado usando placa"""
     try:
-        usuario = Usuario.query.filter_by(PLACA=placa).first()
+        # La placa es del vehículo; el usuario sale de su ID_USUARIO
+        vehiculo = Vehiculo.query.filter_by(PLACA=placa.upper()).first()
+        usuario = db.session.get(Usuario, vehiculo.ID_USUARIO) if vehiculo else None
         if not usuario:
             return jsonify({"error": "Usuario no encontrado"}), 404
         
         # Generar token de recarga
-        token_recarga = generar_token()
-        transaccion_recarga = Transaccion(
-            ID_USUARIO=usuario.ID,
-            TIPO="RECARGA",
-            MONTO=0,  # El usuario elegirá el monto
-            ESTADO="PENDIENTE",
-            TOKEN=token_recarga
-        )
-        db.session.add(transaccion_recarga)
+        token_recarga = servicio_tokens.emitir("RECARGA", usuario_id=usuario.ID)  # El usuario elegirá el monto
         db.session.commit()
         
-        # Usando la IP del servidor que muestras
-        url_recarga = f"http://10.161.108.244:5000/recarga/{token_recarga}"
+        ip_servidor = obtener_ip_servidor()
+        url_recarga = f"http://{ip_servidor}:5000/recarga/{token_recarga}"
+        cache_qr.prerenderizar(url_recarga, **QR_RECARGA)
         
         return jsonify({
             "success": True,
             "mensaje": "QR de recarga generado",
             "url_recarga": url_recarga,
-            "qr_url": f"http://10.161.108.244:5000/qr/recarga/{token_recarga}",
+            "qr_url": f"http://{ip_servidor}:5000/qr/recarga/{token_recarga}",
             "usuario": usuario.NOMBRE,
-            "placa": usuario.PLACA,
+            "placa": vehiculo.PLACA,
             "saldo_actual": float(usuario.SALDO)
         })
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     
+# 🆕 MIGRACIONES DE ESQUEMA VERSIONADAS
+# La versión aplicada se guarda en PRAGMA user_version de parqueadero.db.
+# Cada migración es idempotente (IF NOT EXISTS / checkfirst), así que si se
+# interrumpe a mitad de camino se puede volver a ejecutar sin romper nada.
+TABLAS_BASE = [Usuario.__table__, Vehiculo.__table__, Transaccion.__table__,
+               Tarifa.__table__, Espacio.__table__, Entrada.__table__]
+
+INDICES_RUTAS_CALIENTES = [
+    # Gate: entrada activa por usuario y por espacio (detectar_entrada/salida, sensores)
+    "CREATE INDEX IF NOT EXISTS IX_ENTRADA_USUARIO_ESTADO ON ENTRADA (ID_USUARIO, ESTADO)",
+    "CREATE INDEX IF NOT EXISTS IX_ENTRADA_ESPACIO_ESTADO ON ENTRADA (ID_ESPACIO, ESTADO)",
+    # Factura por placa: última salida del vehículo sin ordenar en memoria
+    "CREATE INDEX IF NOT EXISTS IX_ENTRADA_VEHICULO_ESTADO_SALIDA ON ENTRADA (ID_VEHICULO, ESTADO, FECHA_SALIDA)",
+    # Reportes y estadísticas por día
+    "CREATE INDEX IF NOT EXISTS IX_ENTRADA_FECHA_ENTRADA ON ENTRADA (FECHA_ENTRADA)",
+    "CREATE INDEX IF NOT EXISTS IX_ENTRADA_FECHA_SALIDA ON ENTRADA (FECHA_SALIDA)",
+    "CREATE INDEX IF NOT EXISTS IX_ENTRADA_ESTADO_SALIDA ON ENTRADA (ESTADO, FECHA_SALIDA)",
+    "CREATE INDEX IF NOT EXISTS IX_TRANSACCION_TIPO_ESTADO_FECHA ON TRANSACCION (TIPO, ESTADO, FECHA)",
+    "CREATE INDEX IF NOT EXISTS IX_TRANSACCION_USUARIO_TIPO_ESTADO ON TRANSACCION (ID_USUARIO, TIPO, ESTADO, FECHA)",
+    "CREATE INDEX IF NOT EXISTS IX_TRANSACCION_TARJETA_TIPO_ESTADO ON TRANSACCION (TARJETA_RFID, TIPO, ESTADO)",
+    "CREATE INDEX IF NOT EXISTS IX_USUARIO_FECHA_REGISTRO ON USUARIO (FECHA_REGISTRO)",
+    "CREATE INDEX IF NOT EXISTS IX_USUARIO_EMAIL ON USUARIO (EMAIL)",
+    # Asignación de espacios y sensores
+    "CREATE INDEX IF NOT EXISTS IX_ESPACIO_TIPO_ESTADO ON ESPACIO (TIPO_VEHICULO, ESTADO)",
+    "CREATE INDEX IF NOT EXISTS IX_ESPACIO_ESTADO ON ESPACIO (ESTADO)",
+    "CREATE INDEX IF NOT EXISTS IX_ESPACIO_SENSOR ON ESPACIO (SENSOR_PIN)",
+    "CREATE INDEX IF NOT EXISTS IX_VEHICULO_USUARIO ON VEHICULO (ID_USUARIO)",
+    "CREATE INDEX IF NOT EXISTS IX_TARIFA_TIPO_ACTIVA ON TARIFA (TIPO_VEHICULO, ACTIVA)",
+]
+
+def migracion_esquema_base(conexion):
+    db.metadata.create_all(bind=conexion, tables=TABLAS_BASE)
+
+def migracion_indices_rutas_calientes(conexion):
+    for sentencia in INDICES_RUTAS_CALIENTES:
+        conexion.execute(text(sentencia))
+
+def columnas_tabla(conexion, tabla):
+    return {fila[1] for fila in conexion.execute(text(f"PRAGMA table_info({tabla})"))}
+
+def migracion_controladores_sensores(conexion):
+    if "CONTROLADOR" not in columnas_tabla(conexion, "ESPACIO"):
+        conexion.execute(text(
+            "ALTER TABLE ESPACIO ADD COLUMN CONTROLADOR VARCHAR(30) NOT NULL DEFAULT 'PRINCIPAL'"))
+    conexion.execute(text("DROP INDEX IF EXISTS IX_ESPACIO_SENSOR"))
+    conexion.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS UX_ESPACIO_CONTROLADOR_PIN ON ESPACIO (CONTROLADOR, SENSOR_PIN)"))
+
+def migracion_comandos_barrera(conexion):
+    ComandoBarrera.__table__.create(bind=conexion, checkfirst=True)
+    conexion.execute(text(
+        "CREATE INDEX IF NOT EXISTS IX_COMANDO_PUERTA_ESTADO ON COMANDO_BARRERA (PUERTA, ESTADO, ID)"))
+
+def migracion_resumen_diario(conexion):
+    ResumenDiario.__table__.create(bind=conexion, checkfirst=True)
+
+def migracion_contadores_diarios(conexion):
+    ContadorDiario.__table__.create(bind=conexion, checkfirst=True)
+    reconstruir_contadores(conexion)
+
+def migracion_facturas(conexion):
+    Factura.__table__.create(bind=conexion, checkfirst=True)
+    conexion.execute(text(
+        "CREATE INDEX IF NOT EXISTS IX_FACTURA_PLACA_SALIDA ON FACTURA (PLACA, FECHA_SALIDA)"))
+
+def migracion_libro_saldos(conexion):
+    MovimientoSaldo.__table__.create(bind=conexion, checkfirst=True)
+    CorteSaldo.__table__.create(bind=conexion, checkfirst=True)
+    conexion.execute(text(
+        "CREATE INDEX IF NOT EXISTS IX_MOVIMIENTO_USUARIO ON MOVIMIENTO_SALDO (ID_USUARIO, ID)"))
+    # El saldo que ya tenía cada usuario entra al libro como apertura
+    conexion.execute(text("""
+        INSERT INTO MOVIMIENTO_SALDO (ID_USUARIO, FECHA, TIPO, MONTO, SALDO_RESULTANTE, REFERENCIA)
+        SELECT ID, :fecha, 'APERTURA', SALDO, SALDO, NULL FROM USUARIO
+        WHERE SALDO IS NOT NULL AND SALDO <> 0
+          AND NOT EXISTS (SELECT 1 FROM MOVIMIENTO_SALDO M WHERE M.ID_USUARIO = USUARIO.ID)
+    """).bindparams(bindparam("fecha", type_=db.DateTime)), {"fecha": datetime.utcnow()})
+
+def migracion_motor_tarifas(conexion):
+    columnas = columnas_tabla(conexion, "TARIFA")
+    if "FRACCION_MINUTOS" not in columnas:
+        conexion.execute(text("ALTER TABLE TARIFA ADD COLUMN FRACCION_MINUTOS INTEGER NOT NULL DEFAULT 0"))
+    if "REDONDEO" not in columnas:
+        conexion.execute(text("ALTER TABLE TARIFA ADD COLUMN REDONDEO VARCHAR(10) NOT NULL DEFAULT 'ARRIBA'"))
+    FranjaTarifa.__table__.create(bind=conexion, checkfirst=True)
+    conexion.execute(text("CREATE INDEX IF NOT EXISTS IX_FRANJA_TARIFA ON FRANJA_TARIFA (ID_TARIFA)"))
+
+MIGRACIONES = [
+    (1, "Esquema base", migracion_esquema_base),
+    (2, "Índices de las rutas calientes", migracion_indices_rutas_calientes),
+    (3, "Sensores de varios controladores", migracion_controladores_sensores),
+    (4, "Canal de comandos de barrera", migracion_comandos_barrera),
+    (5, "Rollup diario para reportes por rango", migracion_resumen_diario),
+    (6, "Contadores diarios por tipo de vehículo", migracion_contadores_diarios),
+    (7, "Facturas congeladas al salir", migracion_facturas),
+    (8, "Libro de saldos con cortes", migracion_libro_saldos),
+    (9, "Motor de tarifas: fracciones y franjas horarias", migracion_motor_tarifas),
+]
+
+def version_esquema(conexion):
+    return conexion.execute(text("PRAGMA user_version")).scalar()
+
+def aplicar_migraciones():
+    """Actualiza la base de datos en sitio hasta la última versión del esquema"""
+    with db.engine.begin() as conexion:
+        version_actual = version_esquema(conexion)
+    
+    for version, descripcion, migracion in MIGRACIONES:
+        if version <= version_actual:
+            continue
+        with db.engine.begin() as conexion:
+            migracion(conexion)
+            conexion.execute(text(f"PRAGMA user_version = {version}"))
+        print(f"🛠️ Migración {version} aplicada: {descripcion}")
+    
+    return MIGRACIONES[-1][0]
+
+@app.cli.command("reconstruir-contadores")
+@click.option("--desde", help="Primer día a reconstruir (AAAA-MM-DD), por defecto todo el historial")
+@click.option("--hasta", help="Último día a reconstruir (AAAA-MM-DD), por defecto hoy")
+def comando_reconstruir_contadores(desde, hasta):
+    """Recalcula CONTADOR_DIARIO desde ENTRADA, TRANSACCION y USUARIO (backfill o corrección)"""
+    aplicar_migraciones()
+    desde = datetime.strptime(desde, "%Y-%m-%d").date() if desde else None
+    hasta = datetime.strptime(hasta, "%Y-%m-%d").date() if hasta else None
+    with db.engine.begin() as conexion:
+        filas = reconstruir_contadores(conexion, desde, hasta)
+    print(f"🔢 Contadores reconstruidos: {filas} incrementos aplicados")
+
+# 🆕 CONSULTAS DE LAS RUTAS CALIENTES (DEBEN USAR ÍNDICE, NUNCA SCAN)
+CONSULTAS_CALIENTES = [
+    ("usuario_por_tarjeta", "SELECT * FROM USUARIO WHERE TARJETA_RFID = 'X'"),
+    ("usuario_por_cedula", "SELECT * FROM USUARIO WHERE CEDULA = 'X'"),
+    ("usuario_por_email", "SELECT * FROM USUARIO WHERE EMAIL = 'X'"),
+    ("vehiculo_por_placa", "SELECT * FROM VEHICULO WHERE PLACA = 'X'"),
+    ("vehiculo_por_usuario", "SELECT * FROM VEHICULO WHERE ID_USUARIO = 1"),
+    ("tarifa_activa", "SELECT * FROM TARIFA WHERE TIPO_VEHICULO = 'CARRO' AND ACTIVA = 1"),
+    ("entrada_activa_usuario", "SELECT * FROM ENTRADA WHERE ID_USUARIO = 1 AND ESTADO = 'ACTIVA'"),
+    ("entrada_activa_espacio", "SELECT * FROM ENTRADA WHERE ID_ESPACIO = 1 AND ESTADO = 'ACTIVA'"),
+    ("entradas_activas", "SELECT COUNT(*) FROM ENTRADA WHERE ESTADO = 'ACTIVA'"),
+    ("ultima_salida_vehiculo",
+     "SELECT * FROM ENTRADA WHERE ID_VEHICULO = 1 AND ESTADO = 'FINALIZADA' "
+     "ORDER BY FECHA_SALIDA DESC LIMIT 1"),
+    ("entradas_del_dia",
+     "SELECT COUNT(*) FROM ENTRADA WHERE FECHA_ENTRADA >= '2024-01-01' AND FECHA_ENTRADA < '2024-01-02'"),
+    ("salidas_del_dia",
+     "SELECT COUNT(*), SUM(MONTO_COBRADO) FROM ENTRADA WHERE FECHA_SALIDA >= '2024-01-01' "
+     "AND FECHA_SALIDA < '2024-01-02' AND ESTADO = 'FINALIZADA'"),
+    ("recargas_del_dia",
+     "SELECT COUNT(*), SUM(MONTO) FROM TRANSACCION WHERE FECHA >= '2024-01-01' AND FECHA < '2024-01-02' "
+     "AND TIPO = 'RECARGA' AND ESTADO = 'CONFIRMADA'"),
+    ("historial_recargas",
+     "SELECT * FROM TRANSACCION WHERE TIPO = 'RECARGA' AND ESTADO = 'CONFIRMADA' ORDER BY FECHA DESC LIMIT 50"),
+    ("historial_recargas_usuario",
+     "SELECT * FROM TRANSACCION WHERE ID_USUARIO = 1 AND TIPO = 'RECARGA' AND ESTADO = 'CONFIRMADA' "
+     "ORDER BY FECHA DESC LIMIT 50"),
+    ("usuarios_nuevos_del_dia",
+     "SELECT COUNT(*) FROM USUARIO WHERE FECHA_REGISTRO >= '2024-01-01' AND FECHA_REGISTRO < '2024-01-02'"),
+    ("token_pendiente", "SELECT * FROM TRANSACCION WHERE TOKEN = 'X' AND TIPO = 'RECARGA' AND ESTADO = 'PENDIENTE'"),
+    ("registro_pendiente_tarjeta",
+     "SELECT * FROM TRANSACCION WHERE TARJETA_RFID = 'X' AND TIPO = 'REGISTRO' AND ESTADO = 'PENDIENTE'"),
+    ("espacio_disponible",
+     "SELECT * FROM ESPACIO WHERE TIPO_VEHICULO = 'CARRO' AND ESTADO = 'DISPONIBLE' LIMIT 1"),
+    ("espacios_por_estado", "SELECT COUNT(*) FROM ESPACIO WHERE ESTADO = 'OCUPADO'"),
+    ("comandos_pendientes",
+     "SELECT * FROM COMANDO_BARRERA WHERE PUERTA = 'entrada' AND ESTADO = 'PENDIENTE' AND ID > 0 "
+     "ORDER BY ID LIMIT 20"),
+    ("espacio_por_sensor", "SELECT * FROM ESPACIO WHERE CONTROLADOR = 'PRINCIPAL' AND SENSOR_PIN = 1"),
+    ("contadores_del_dia", "SELECT SUM(ENTRADAS), SUM(SALIDAS) FROM CONTADOR_DIARIO WHERE FECHA = '2024-01-01'"),
+    ("ultima_factura_placa",
+     "SELECT ID_ENTRADA FROM FACTURA WHERE PLACA = 'X' ORDER BY FECHA_SALIDA DESC LIMIT 1"),
+    ("resumen_rango",
+     "SELECT * FROM RESUMEN_DIARIO WHERE FECHA >= '2024-01-01' AND FECHA <= '2024-12-31' ORDER BY FECHA"),
+    ("estancias_del_dia",
+     "SELECT FECHA_ENTRADA, FECHA_SALIDA FROM ENTRADA WHERE FECHA_ENTRADA < '2024-01-02' "
+     "AND (FECHA_SALIDA >= '2024-01-01' OR FECHA_SALIDA IS NULL)"),
+    ("movimientos_desde_corte",
+     "SELECT COUNT(ID), SUM(MONTO) FROM MOVIMIENTO_SALDO WHERE ID_USUARIO = 1 AND ID > 10"),
+    ("ultimo_corte_saldo", "SELECT MAX(ID_MOVIMIENTO) FROM CORTE_SALDO WHERE ID_USUARIO = 1"),
+    ("barredor_pendientes",
+     "SELECT ID FROM TRANSACCION WHERE TIPO = 'REGISTRO' AND ESTADO = 'PENDIENTE' "
+     "AND FECHA < '2024-01-01' ORDER BY FECHA LIMIT 500"),
+]
+
+def verificar_planes_consulta():
+    """Ejecuta EXPLAIN QUERY PLAN sobre cada consulta caliente y marca los SCAN de tabla"""
+    resultados = []
+    with db.engine.connect() as conexion:
+        for nombre, sql in CONSULTAS_CALIENTES:
+            plan = [fila[-1] for fila in conexion.execute(text(f"EXPLAIN QUERY PLAN {sql}"))]
+            problemas = [paso for paso in plan if paso.startswith("SCAN") or "TEMP B-TREE" in paso]
+            resultados.append({"consulta": nombre, "plan": plan, "ok": not problemas, "problemas": problemas})
+    return resultados
+
+@app.cli.command("verificar-indices")
+def comando_verificar_indices():
+    """Falla (código 1) si alguna consulta caliente recorre una tabla completa"""
+    aplicar_migraciones()
+    resultados = verificar_planes_consulta()
+    for resultado in resultados:
+        estado = "✅" if resultado["ok"] else "❌"
+        print(f"{estado} {resultado['consulta']}: {' | '.join(resultado['plan'])}")
+    if not all(resultado["ok"] for resultado in resultados):
+        raise SystemExit(1)
+
+@app.route("/debug/planes-consulta")
+def debug_planes_consulta():
+    """Planes de ejecución de las consultas calientes"""
+    resultados = verificar_planes_consulta()
+    return jsonify({
+        "version_esquema": MIGRACIONES[-1][0],
+        "ok": all(resultado["ok"] for resultado in resultados),
+        "consultas": resultados
+    })
+
+# 🆕 PERFILADOR DE SQL Y DETECTOR DE N+1
+# Cada sentencia se anota con su forma (el texto con literales y listas IN
+# normalizados), su tiempo y el sitio de llamada (la primera función de este
+# archivo en la pila). Una petición que repite la misma forma más de
+# UMBRAL_N_MAS_1 veces es un N+1: queda en /debug/perfilador y en la bitácora.
+# En las peticiones se activa con PARQUEADERO_PERFILADOR=1 o POST /debug/perfilador
+# (recorrer la pila cuesta); perfilar_sql() y presupuesto_consultas() funcionan siempre.
+UMBRAL_N_MAS_1 = int(os.environ.get("PARQUEADERO_UMBRAL_N1", 5))
+PERFILES_RECIENTES = 50
+FUNCIONES_PERFILADOR = {"terminar_medicion_sql", "sitio_llamada"}
+PATRON_LITERAL_SQL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+PATRON_LISTA_SQL = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+PATRON_ESPACIOS_SQL = re.compile(r"\s+")
+
+@lru_cache(maxsize=2048)
+def forma_sentencia(sql):
+    """SELECT ... WHERE ID IN (?, ?, ?) y ... IN (?, ?) tienen la misma forma"""
+    forma = PATRON_LITERAL_SQL.sub("?", sql)
+    forma = PATRON_LISTA_SQL.sub("(?...)", forma)
+    return PATRON_ESPACIOS_SQL.sub(" ", forma).strip()
+
+def sitio_llamada():
+    """función:línea de la primera llamada de este archivo que llevó a la sentencia
+    (o archivo:función:línea del primer llamador fuera de SQLAlchemy, p. ej. un test)"""
+    externo = None
+    marco = sys._getframe(1)
+    while marco is not None:
+        codigo = marco.f_code
+        if codigo.co_filename == __file__:
+            if codigo.co_name not in FUNCIONES_PERFILADOR:
+                return f"{codigo.co_name}:{marco.f_lineno}"
+        elif externo is None and "sqlalchemy" not in codigo.co_filename:
+            externo = f"{os.path.basename(codigo.co_filename)}:{codigo.co_name}:{marco.f_lineno}"
+        marco = marco.f_back
+    return externo or "?"
+
+class PerfilSQL:
+    """Sentencias de una petición o de un bloque: texto, forma, tiempo y sitio de llamada"""
+
+    def __init__(self):
+        self.sentencias = []  # (sql, forma, segundos, sitio)
+
+    def __len__(self):
+        return len(self.sentencias)
+
+    def anotar(self, sql, segundos, sitio):
+        self.sentencias.append((sql, forma_sentencia(sql), segundos, sitio))
+
+    def repetidas(self, umbral=UMBRAL_N_MAS_1):
+        """Formas ejecutadas más de `umbral` veces, de la más repetida a la menos"""
+        por_forma = {}
+        for _, forma, segundos, sitio in self.sentencias:
+            datos = por_forma.setdefault(forma, {"forma": forma, "veces": 0, "ms": 0.0, "sitios": []})
+            datos["veces"] += 1
+            datos["ms"] += segundos * 1000
+            if sitio not in datos["sitios"]:
+                datos["sitios"].append(sitio)
+        repetidas = [datos for datos in por_forma.values() if datos["veces"] > umbral]
+        for datos in repetidas:
+            datos["ms"] = round(datos["ms"], 3)
+        return sorted(repetidas, key=lambda datos: datos["veces"], reverse=True)
+
+    def resumen(self, umbral=UMBRAL_N_MAS_1):
+        return {
+            "sentencias": len(self.sentencias),
+            "ms": round(sum(sentencia[2] for sentencia in self.sentencias) * 1000, 3),
+            "repetidas": self.repetidas(umbral),
+            "detalle": [{"sql": sql, "ms": round(segundos * 1000, 3), "sitio": sitio}
+                        for sql, _, segundos, sitio in self.sentencias]
+        }
+
+class PerfiladorSQL:
+    """Perfiles recientes de peticiones y N+1 acumulados por (endpoint, forma)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.activo = os.environ.get("PARQUEADERO_PERFILADOR") == "1"
+        self.peticiones = 0
+        self.recientes = deque(maxlen=PERFILES_RECIENTES)
+        self.n_mas_1 = {}
+
+    def configurar(self, activo):
+        """Activa o desactiva el perfilado de peticiones y descarta lo acumulado"""
+        with self.lock:
+            self.activo = activo
+            self.peticiones = 0
+            self.recientes.clear()
+            self.n_mas_1 = {}
+
+    def registrar(self, regla, metodo, perfil):
+        resumen = perfil.resumen()
+        with self.lock:
+            self.peticiones += 1
+            self.recientes.append(dict(resumen, endpoint=regla, metodo=metodo,
+                                       fecha=datetime.utcnow().isoformat(timespec="seconds")))
+            for repetida in resumen["repetidas"]:
+                clave = (regla, repetida["forma"])
+                acumulado = self.n_mas_1.setdefault(clave, {
+                    "endpoint": regla, "forma": repetida["forma"], "peticiones": 0,
+                    "veces_maximo": 0, "sitios": []
+                })
+                acumulado["peticiones"] += 1
+                acumulado["veces_maximo"] = max(acumulado["veces_maximo"], repetida["veces"])
+                acumulado["sitios"] += [sitio for sitio in repetida["sitios"] if sitio not in acumulado["sitios"]]
+        for repetida in resumen["repetidas"]:
+            bitacora_sql.advertencia("n_mas_1", endpoint=regla, veces=repetida["veces"],
+                                     sitios=repetida["sitios"], forma=repetida["forma"][:200])
+
+    def reporte(self):
+        with self.lock:
+            return {
+                "activo": self.activo,
+                "umbral": UMBRAL_N_MAS_1,
+                "peticiones": self.peticiones,
+                "n_mas_1": sorted(self.n_mas_1.values(), key=lambda datos: datos["peticiones"], reverse=True),
+                "recientes": list(self.recientes)
+            }
+
+perfilador_sql = PerfiladorSQL()
+bitacora_sql = Bitacora("sql")
+
+@contextmanager
+def perfilar_sql():
+    """Perfila las sentencias que ejecuta este hilo dentro del bloque (se pueden anidar)"""
+    perfil = PerfilSQL()
+    perfiles = getattr(metricas_hilo, "perfiles", None)
+    if perfiles is None:
+        perfiles = metricas_hilo.perfiles = []
+    perfiles.append(perfil)
+    try:
+        yield perfil
+    finally:
+        perfiles.remove(perfil)
+
+class PresupuestoConsultasExcedido(AssertionError):
+    """El bloque ejecutó más sentencias de las permitidas o repitió una forma (N+1)"""
+
+@contextmanager
+def presupuesto_consultas(maximo=None, repeticiones=UMBRAL_N_MAS_1):
+    """Lanza PresupuestoConsultasExcedido si el bloque supera `maximo` sentencias o repite
+    una forma más de `repeticiones` veces. Es un AssertionError: en pytest falla el test.
+
+        with presupuesto_consultas(maximo=1):
+            generar_recargas_dia(fecha)
+    """
+    with perfilar_sql() as perfil:
+        yield perfil
+    problemas = []
+    if maximo is not None and len(perfil) > maximo:
+        problemas.append(f"{len(perfil)} sentencias (máximo {maximo})")
+    for repetida in perfil.repetidas(repeticiones):
+        problemas.append(f"{repetida['veces']} veces desde {', '.join(repetida['sitios'])}: {repetida['forma'][:160]}")
+    if problemas:
+        raise PresupuestoConsultasExcedido("; ".join(problemas))
+
+@app.route("/debug/perfilador", methods=["GET", "POST"])
+def debug_perfilador():
+    """N+1 detectados y sentencias de las últimas peticiones; POST {"activo": true} lo enciende"""
+    if request.method == "POST":
+        data = request.get_json(silent=True) or {}
+        perfilador_sql.configurar(bool(data.get("activo", True)))
+    return jsonify(perfilador_sql.reporte())
+
+# Máximo de sentencias por generador: constante, sin importar cuántas filas haya
+PRESUPUESTO_CONSULTAS = [
+    ("generar_resumen_diario", generar_resumen_diario, 1),
+    ("generar_entradas_dia", generar_entradas_dia, 1),
+    ("generar_recargas_dia", generar_recargas_dia, 1),
+    ("generar_estado_espacios", lambda fecha: generar_estado_espacios(), 1),
+    ("generar_facturas_dia", generar_facturas_dia, 1),
+    ("generar_usuarios_nuevos", generar_usuarios_nuevos, 1),
+    ("estado_espacios", lambda fecha: consultar_estado_espacios(), 1),
+]
+
+def verificar_consultas_constantes(fecha=None):
+    """Ejecuta cada generador y compara las sentencias emitidas con su presupuesto"""
+    fecha = fecha or hoy_utc()
+    resultados = []
+    for nombre, generador, presupuesto in PRESUPUESTO_CONSULTAS:
+        with perfilar_sql() as perfil:
+            datos = generador(fecha)
+        filas = len(datos) if isinstance(datos, list) else 1
+        repetidas = perfil.repetidas()
+        resultados.append({
+            "generador": nombre,
+            "filas": filas,
+            "consultas": len(perfil),
+            "presupuesto": presupuesto,
+            "repetidas": repetidas,
+            "sitios": sorted({sentencia[3] for sentencia in perfil.sentencias}),
+            "ok": len(perfil) <= presupuesto and not repetidas
+        })
+    return resultados
+
+@app.cli.command("verificar-consultas")
+def comando_verificar_consultas():
+    """Falla (código 1) si algún generador supera su presupuesto de consultas"""
+    resultados = verificar_consultas_constantes()
+    for resultado in resultados:
+        estado = "✅" if resultado["ok"] else "❌"
+        print(f"{estado} {resultado['generador']}: {resultado['consultas']}/{resultado['presupuesto']} "
+              f"consultas para {resultado['filas']} filas")
+        for repetida in resultado["repetidas"]:
+            print(f"   🔁 {repetida['veces']} veces desde {', '.join(repetida['sitios'])}: {repetida['forma'][:120]}")
+    if not all(resultado["ok"] for resultado in resultados):
+        raise SystemExit(1)
+
+@app.route("/debug/consultas")
+def debug_consultas():
+    """Sentencias SQL que emite cada generador de reportes"""
+    resultados = verificar_consultas_constantes()
+    return jsonify({
+        "ok": all(resultado["ok"] for resultado in resultados),
+        "generadores": resultados
+    })
+
 # 🆕 ACTUALIZAR LA FUNCIÓN DE INICIALIZACIÓN DE TARIFAS
 def inicializar_datos():
-    """Inicializa datos básicos del sistema con nuevas tarifas"""
+    """Migra el esquema en sitio y crea los datos básicos si la base está vacía"""
     try:
-        db.create_all()
-         # 🆕 LIMPIAR DATOS EXISTENTES
-        db.drop_all()  # Esto borra todas las tablas
-        db.create_all()  # Esto las crea vacías
+        aplicar_migraciones()
         
         # Verificar si ya hay datos para no duplicar
         if Tarifa.query.count() == 0:
@@ -2086,15 +5342,25 @@ def inicializar_datos():
     except Exception as e:
         print(f"⚠️ Error inicializando datos: {e}")
         db.session.rollback()
+# 🆕 FÁBRICA DE LA APLICACIÓN (LA USAN wsgi.py Y EL BLOQUE __main__)
+def crear_app(configuracion=None):
+    """Aplica la configuración, migra la base de datos, carga los índices en memoria y arranca el barredor"""
+    if configuracion:
+        app.config.update(configuracion)
+    if not app.extensions.get("parqueadero_iniciado"):
+        with app.app_context():
+            inicializar_datos()
+            indice_rfid.cargar()
+            motor_tarifas.cargar()
+            servicio_tokens.cargar()
+            asignador_espacios.cargar()
+            mapa_sensores.cargar()
+        barredor_transacciones.iniciar()
+        app.extensions["parqueadero_iniciado"] = True
+    return app
 
-# 🆕 ACTUALIZAR LA FUNCIÓN QUE OBTIENE LA TARIFA MÍNIMA
-def obtener_tarifa_minima():
-    """Retorna la tarifa mínima actualizada"""
-    tarifa = Tarifa.query.filter_by(TIPO_VEHICULO="CARRO", ACTIVA=True).first()
-    return float(tarifa.TARIFA_MINIMA) if tarifa else 5000.0  # 🆕 DEFAULT 5000
 if __name__ == "__main__":
-    with app.app_context():
-        inicializar_datos()
+    crear_app()
     
     print("🚀 Sistema de Parqueadero Inteligente Iniciado")
     print("📍 Versión 4.1 - Con relaciones SQLAlchemy corregidas")
@@ -2105,4 +5371,12 @@ if __name__ == "__main__":
     print("   GET  /registro/<token>     - Página de registro con QR")
     print("   GET  /recarga/<token>      - Página de recarga con QR")
     
-    app.run(debug=True, host='0.0.0.0', port=5000, threaded=True)
\ No newline at end of file
+    # 🆕 Waitress si está instalado (también corre en Windows); si no, el servidor de Flask con hilos.
+    # Sin el recargador de debug: duplicaría el proceso y con él los índices y el barredor.
+    try:
+        from waitress import serve
+        print(f"🧵 Waitress en 0.0.0.0:5000 con {HILOS_SERVIDOR} hilos")
+        serve(app, host='0.0.0.0', port=5000, threads=HILOS_SERVIDOR)
+    except ImportError:
+        app.run(debug=os.environ.get("PARQUEADERO_DEBUG") == "1", host='0.0.0.0', port=5000,
+                threaded=True, use_reloader=False)
\ No newline at end of file
@@ -0,0 +1,125 @@
+# 🆕 GENERADOR DE DATOS SINTÉTICOS PARA LOS BENCHMARKS
+# Una base SQLite por escala (1k, 100k o 1m filas de ENTRADA repartidas en los
+# últimos 30 días) en la carpeta temporal del sistema. Los reportes diarios usan
+# la fecha de hoy, así que la base se regenera si se creó otro día o si cambió
+# la versión del esquema.
+import json
+import os
+import random
+import sqlite3
+import tempfile
+from datetime import datetime, timedelta
+
+ESCALAS = {"1k": 1_000, "100k": 100_000, "1m": 1_000_000}
+DIAS_HISTORIAL = 30
+CARPETA_DATOS = os.path.join(tempfile.gettempdir(), "parqueadero_benchmarks")
+FORMATO_FECHA = "%Y-%m-%d %H:%M:%S.%f"  # Como guarda SQLAlchemy los DateTime en SQLite
+
+MARCAS = ["Mazda", "Chevrolet", "Renault", "Kia", "Toyota", "Nissan", "Yamaha", "Honda"]
+COLORES = ["Rojo", "Blanco", "Negro", "Gris", "Azul", "Plata"]
+NOMBRES = ["Juan", "María", "Carlos", "Ana", "Luis", "Sofía", "Andrés", "Laura"]
+APELLIDOS = ["Pérez", "Gómez", "Rodríguez", "López", "Martínez", "García", "Torres", "Ramírez"]
+
+def ruta_base(escala):
+    return os.path.join(CARPETA_DATOS, f"escala_{escala}.db")
+
+def ruta_metadatos(escala):
+    return os.path.join(CARPETA_DATOS, f"escala_{escala}.json")
+
+def base_vigente(escala, version_esquema):
+    """True si la base de la escala existe, es de hoy y tiene el esquema actual"""
+    try:
+        with open(ruta_metadatos(escala), encoding="utf-8") as archivo:
+            metadatos = json.load(archivo)
+    except (OSError, ValueError):
+        return False
+    return (os.path.exists(ruta_base(escala)) and metadatos.get("fecha") == datetime.utcnow().date().isoformat()
+            and metadatos.get("version_esquema") == version_esquema)
+
+def placa_sintetica(indice):
+    """ABC123 únicas: tres letras a partir del índice y tres dígitos"""
+    letras, numero = divmod(indice, 1000)
+    primera, resto = divmod(letras, 26 * 26)
+    segunda, tercera = divmod(resto, 26)
+    return f"{chr(65 + primera % 26)}{chr(65 + segunda)}{chr(65 + tercera)}{numero:03d}"
+
+def llenar_base(ruta, entradas, tarifas, semilla=7):
+    """Inserta usuarios, vehículos, espacios, entradas y recargas en una base ya migrada y vacía"""
+    aleatorio = random.Random(semilla)
+    ahora = datetime.utcnow()
+    inicio_historial = ahora - timedelta(days=DIAS_HISTORIAL)
+    segundos_historial = int((ahora - inicio_historial).total_seconds()) - 60
+    fecha = lambda momento: momento.strftime(FORMATO_FECHA)
+
+    usuarios = max(200, entradas // 10)
+    espacios = max(60, entradas // 2000)
+    conexion = sqlite3.connect(ruta)
+    try:
+        conexion.execute("PRAGMA journal_mode=WAL")
+        conexion.execute("PRAGMA synchronous=OFF")
+
+        existentes = {numero for (numero,) in conexion.execute("SELECT NUMERO FROM ESPACIO")}
+        conexion.executemany(
+            "INSERT INTO ESPACIO (NUMERO, TIPO_VEHICULO, ESTADO, SENSOR_PIN, CONTROLADOR) "
+            "VALUES (?, 'CARRO', 'DISPONIBLE', ?, 'PRINCIPAL')",
+            [(f"A{pin}", pin) for pin in range(1, espacios + 1) if f"A{pin}" not in existentes])
+        ids_espacios = [espacio_id for (espacio_id,) in conexion.execute("SELECT ID FROM ESPACIO ORDER BY ID")]
+
+        conexion.executemany(
+            "INSERT INTO USUARIO (ID, NOMBRE, CEDULA, SALDO, TELEFONO, EMAIL, FECHA_REGISTRO, TARJETA_RFID) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            ((indice + 1,
+              f"{aleatorio.choice(NOMBRES)} {aleatorio.choice(APELLIDOS)}",
+              str(10_000_000 + indice),
+              aleatorio.randrange(0, 200_000, 1000),
+              f"3{aleatorio.randrange(10**8, 10**9)}",
+              f"usuario{indice}@correo.com",
+              fecha(inicio_historial + timedelta(seconds=aleatorio.randrange(segundos_historial))),
+              f"{0xB0000000 + indice:08X}")
+             for indice in range(usuarios)))
+        tipos = ["MOTO" if aleatorio.random() < 0.1 else "CARRO" for _ in range(usuarios)]
+        conexion.executemany(
+            "INSERT INTO VEHICULO (ID, PLACA, TIPO, ID_USUARIO, COLOR, MARCA) VALUES (?, ?, ?, ?, ?, ?)",
+            ((indice + 1, placa_sintetica(indice), tipos[indice], indice + 1,
+              aleatorio.choice(COLORES), aleatorio.choice(MARCAS)) for indice in range(usuarios)))
+
+        def entrada(_):
+            usuario = aleatorio.randrange(usuarios)
+            fecha_entrada = inicio_historial + timedelta(seconds=aleatorio.randrange(segundos_historial))
+            duracion = timedelta(minutes=min(aleatorio.expovariate(1 / 150), 24 * 60))
+            fecha_salida = min(fecha_entrada + duracion, ahora)
+            tarifa_hora, tarifa_minima = tarifas.get(tipos[usuario], (5000.0, 5000.0))
+            horas = max(1, (fecha_salida - fecha_entrada).total_seconds() / 3600)
+            return (usuario + 1, usuario + 1, aleatorio.choice(ids_espacios), fecha(fecha_entrada),
+                    fecha(fecha_salida), round(max(tarifa_hora * horas, tarifa_minima), 2),
+                    str(fecha_salida - fecha_entrada).split('.')[0])
+        conexion.executemany(
+            "INSERT INTO ENTRADA (ID_USUARIO, ID_VEHICULO, ID_ESPACIO, FECHA_ENTRADA, FECHA_SALIDA, ESTADO, "
+            "MONTO_COBRADO, TIEMPO_ESTACIONADO, FACTURA_GENERADA) VALUES (?, ?, ?, ?, ?, 'FINALIZADA', ?, ?, 0)",
+            map(entrada, range(entradas)))
+
+        # La mitad de los espacios queda ocupada por una entrada activa de hoy
+        activos = aleatorio.sample(range(usuarios), min(usuarios, len(ids_espacios) // 2))
+        for espacio_id, usuario in zip(ids_espacios, activos):
+            cursor = conexion.execute(
+                "INSERT INTO ENTRADA (ID_USUARIO, ID_VEHICULO, ID_ESPACIO, FECHA_ENTRADA, ESTADO, FACTURA_GENERADA) "
+                "VALUES (?, ?, ?, ?, 'ACTIVA', 0)",
+                (usuario + 1, usuario + 1, espacio_id, fecha(ahora - timedelta(minutes=aleatorio.randrange(1, 300)))))
+            conexion.execute("UPDATE ESPACIO SET ESTADO = 'OCUPADO', ID_ENTRADA_ACTUAL = ? WHERE ID = ?",
+                             (cursor.lastrowid, espacio_id))
+
+        conexion.executemany(
+            "INSERT INTO TRANSACCION (ID_USUARIO, TIPO, MONTO, ESTADO, FECHA, TOKEN) "
+            "VALUES (?, 'RECARGA', ?, 'CONFIRMADA', ?, ?)",
+            ((aleatorio.randrange(usuarios) + 1, aleatorio.choice([10000, 20000, 50000, 100000]),
+              fecha(inicio_historial + timedelta(seconds=aleatorio.randrange(segundos_historial))),
+              f"bench{indice:x}") for indice in range(entradas // 5)))
+        conexion.commit()
+    finally:
+        conexion.close()
+    return {"usuarios": usuarios, "espacios": espacios, "entradas": entradas, "recargas": entradas // 5}
+
+def guardar_metadatos(escala, version_esquema, resumen):
+    with open(ruta_metadatos(escala), "w", encoding="utf-8") as archivo:
+        json.dump(dict(resumen, fecha=datetime.utcnow().date().isoformat(), version_esquema=version_esquema),
+                  archivo, indent=2)
@@ -0,0 +1,306 @@
+# 🆕 MICRO-BENCHMARKS: VALIDACIONES, COBRO, FACTURAS, QR, REPORTES Y TOKENS
+# Cada benchmark toma el mejor tiempo de varias rondas (como timeit: el
+# ruido de otros procesos solo suma) y se compara contra
+# linea_base.json; si alguno queda más lento que la línea base más la
+# tolerancia, el proceso termina con código 1. Antes de cada benchmark se
+# mide una carga de referencia y la comparación se hace relativa a ella, así
+# que una máquina (o un momento) más lento en general no cuenta como regresión.
+#
+#   python benchmarks/ejecutar.py                      # escala 1k, compara
+#   python benchmarks/ejecutar.py --escala 100k
+#   python benchmarks/ejecutar.py --solo reportes,cobro
+#   python benchmarks/ejecutar.py --escala 1k --guardar   # nueva línea base (misma máquina)
+import contextlib
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+import click
+
+CARPETA = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(CARPETA))
+
+from datos import CARPETA_DATOS, ESCALAS, base_vigente, guardar_metadatos, llenar_base, ruta_base  # noqa: E402
+
+ARCHIVO_LINEA_BASE = os.path.join(CARPETA, "linea_base.json")
+RONDAS = 7
+DURACION_RONDA = 0.2      # Segundos mínimos por ronda (se calibran las iteraciones)
+DURACION_REFERENCIA = 0.05
+UMBRAL_ABSOLUTO = 5e-6    # Diferencias menores (ruido de microsegundos) no cuentan como regresión
+REINTENTOS = 2            # Mediciones extra para un benchmark que sale lento
+
+BENCHMARKS = []
+
+def benchmark(nombre):
+    """Registra una función preparar(contexto) que devuelve la operación a medir"""
+    def registrar(preparar):
+        BENCHMARKS.append((nombre, preparar))
+        return preparar
+    return registrar
+
+# ---------- VALIDACIONES (100 valores por operación, válidos e inválidos) ----------
+ENTRADAS_VALIDACION = {
+    "cedula": ["1234567", "1020304050", "12AB567", "123", "", "99887766"],
+    "telefono": ["3123456789", "312 345 6789", "6012345678", "31234", ""],
+    "placa": ["ABC123", "abc12d", "AB1234", "ABCD12", " xyz987 ", ""],
+    "email": ["juan@correo.com", "sin-arroba.com", "a@b", "@correo.com", "MARIA.LOPEZ@EMPRESA.COM.CO"],
+    "nombre": ["Juan Pérez", "Ana", "María José Gómez Torres", "J Pérez", "Carl0s Ruiz"],
+    "marca_vehiculo": ["Mazda", "K", "Chevrolet", "Una marca demasiado larga"],
+    "color_vehiculo": ["Rojo", "Az", "Gris plata", "Verde limón metálico"],
+}
+
+for campo, valores in ENTRADAS_VALIDACION.items():
+    @benchmark(f"validar_{campo}")
+    def preparar_validacion(contexto, campo=campo, valores=valores):
+        validar = getattr(contexto["parqueadero"], f"validar_{campo}")
+        lote = list(itertools.islice(itertools.cycle(valores), 100))
+        return lambda: [validar(valor) for valor in lote]
+
+# ---------- COBRO (lo que calcula detectar_salida) ----------
+def estadias_muestra(contexto, cantidad=1000):
+    aleatorio = random.Random(3)
+    ahora = datetime.utcnow()
+    estadias = []
+    for _ in range(cantidad):
+        entrada = ahora - timedelta(minutes=aleatorio.randrange(5, 3000))
+        estadias.append((aleatorio.choice(["CARRO", "MOTO"]), entrada,
+                         entrada + timedelta(minutes=aleatorio.randrange(1, 900))))
+    return itertools.cycle(estadias)
+
+@benchmark("cobro_cotizar")
+def preparar_cobro(contexto):
+    motor = contexto["parqueadero"].motor_tarifas
+    estadias = estadias_muestra(contexto)
+    return lambda: motor.cotizar(*next(estadias))
+
+@benchmark("cobro_cotizar_franjas")
+def preparar_cobro_franjas(contexto):
+    parqueadero = contexto["parqueadero"]
+    motor = parqueadero.MotorTarifas()
+    motor.planes = {tipo: parqueadero.normalizar_plan(tipo, {
+        "fraccion_minutos": 15, "franjas": [{"inicio": 22, "fin": 6, "hora": 2500}, {"inicio": 7, "fin": 9, "hora": 7000}]
+    }, parqueadero.motor_tarifas.plan(tipo)) for tipo in ("CARRO", "MOTO")}
+    motor.version = 1
+    estadias = estadias_muestra(contexto)
+    return lambda: motor.cotizar(*next(estadias))
+
+@benchmark("cobro_simulacion_historial")
+def preparar_simulacion(contexto):
+    motor = contexto["parqueadero"].motor_tarifas
+    desde, hasta = contexto["parqueadero"].periodo_simulacion(None, None)
+    propuesta = {"CARRO": {"hora": 6000, "fraccion_minutos": 30}}
+    motor.simular(propuesta, desde, hasta)  # Deja el histórico en memoria
+    return lambda: motor.simular(propuesta, desde, hasta)
+
+# ---------- FACTURAS ----------
+def ids_facturables(contexto, cantidad):
+    parqueadero = contexto["parqueadero"]
+    return [entrada_id for (entrada_id,) in parqueadero.db.session.query(parqueadero.Entrada.ID).filter(
+        parqueadero.Entrada.ESTADO == "FINALIZADA").order_by(parqueadero.Entrada.ID).limit(cantidad)]
+
+@benchmark("factura_render")
+def preparar_factura_render(contexto):
+    # Más IDs que la capacidad de la caché: cada petición renderiza la plantilla
+    cliente = contexto["cliente"]
+    capacidad = contexto["parqueadero"].cache_facturas.capacidad
+    ids = ids_facturables(contexto, capacidad + 88)
+    for entrada_id in ids:
+        cliente.get(f"/api/factura/generar/{entrada_id}")  # Congela la FACTURA una vez
+    ciclo = itertools.cycle(ids)
+    return lambda: cliente.get(f"/api/factura/generar/{next(ciclo)}").data
+
+@benchmark("factura_cache")
+def preparar_factura_cache(contexto):
+    cliente = contexto["cliente"]
+    entrada_id = ids_facturables(contexto, 1)[0]
+    cliente.get(f"/api/factura/generar/{entrada_id}")
+    return lambda: cliente.get(f"/api/factura/generar/{entrada_id}").data
+
+# ---------- QR ----------
+@benchmark("qr_render")
+def preparar_qr(contexto):
+    parqueadero = contexto["parqueadero"]
+    contador = itertools.count()
+    return lambda: parqueadero.cache_qr.renderizar(
+        f"http://192.168.1.3:5000/registro/{next(contador):020x}", **parqueadero.QR_REGISTRO)
+
+# ---------- REPORTES DEL DÍA ----------
+REPORTES = {
+    "reporte_resumen": lambda p, hoy: p.generar_resumen_diario(hoy),
+    "reporte_entradas": lambda p, hoy: p.generar_entradas_dia(hoy),
+    "reporte_recargas": lambda p, hoy: p.generar_recargas_dia(hoy),
+    "reporte_espacios": lambda p, hoy: p.generar_estado_espacios(),
+    "reporte_facturas": lambda p, hoy: p.generar_facturas_dia(hoy),
+    "reporte_usuarios": lambda p, hoy: p.generar_usuarios_nuevos(hoy),
+}
+
+for nombre_reporte, generar in REPORTES.items():
+    @benchmark(nombre_reporte)
+    def preparar_reporte(contexto, generar=generar):
+        return lambda: generar(contexto["parqueadero"], contexto["hoy"])
+
+@benchmark("reporte_excel_completo")
+def preparar_excel(contexto):
+    cliente = contexto["cliente"]
+    return lambda: cliente.get("/api/reportes/diario/excel").data
+
+# ---------- TOKENS ----------
+@benchmark("tokens_emitir_validar")
+def preparar_tokens(contexto):
+    parqueadero = contexto["parqueadero"]
+    servicio = parqueadero.ServicioTokens()
+    def emitir_y_validar():
+        token = servicio.nuevo_token()
+        servicio.registrar(token, {"tipo": "RECARGA", "usuario_id": None,
+                                   "tarjeta_rfid": None, "fecha": datetime.utcnow()})
+        return servicio.validar(token, "RECARGA")
+    return emitir_y_validar
+
+def referencia_cpu():
+    """Carga fija de Python puro: mide la velocidad de la máquina en esta corrida"""
+    return sorted(str(numero * 7919 % 10007) for numero in range(2000))
+
+def medir(operacion, duracion_ronda=DURACION_RONDA):
+    """Mejor tiempo por operación de RONDAS rondas de al menos duracion_ronda"""
+    inicio = time.perf_counter()
+    operacion()
+    primera = time.perf_counter() - inicio
+    iteraciones = max(1, min(100_000, int(duracion_ronda / max(primera, 1e-7))))
+    rondas = RONDAS if primera < 2 else 3
+    tiempos = []
+    for _ in range(rondas):
+        inicio = time.perf_counter()
+        for _ in range(iteraciones):
+            operacion()
+        tiempos.append((time.perf_counter() - inicio) / iteraciones)
+    return min(tiempos)
+
+def medir_relativo(operacion):
+    """(segundos, segundos en unidades de la carga de referencia medida justo antes)"""
+    referencia = medir(referencia_cpu, DURACION_REFERENCIA)
+    segundos = medir(operacion)
+    return segundos, segundos / referencia
+
+def es_regresion(segundos, relativo, base, tolerancia):
+    return (relativo > base["relativo"] * (1 + tolerancia)
+            and segundos - base["segundos"] > UMBRAL_ABSOLUTO)
+
+def calentar(segundos=1.0):
+    """Ocupa la CPU un momento para que la primera medición no pague el arranque"""
+    fin = time.perf_counter() + segundos
+    while time.perf_counter() < fin:
+        referencia_cpu()
+
+def formato_tiempo(segundos):
+    if segundos is None:
+        return "-"
+    if segundos < 1e-3:
+        return f"{segundos * 1e6:.1f} µs"
+    if segundos < 1:
+        return f"{segundos * 1e3:.2f} ms"
+    return f"{segundos:.2f} s"
+
+def preparar_base(parqueadero, escala, regenerar):
+    """Crea (o reutiliza) la base sintética de la escala y carga los índices en memoria"""
+    version_esquema = parqueadero.MIGRACIONES[-1][0]
+    ruta = ruta_base(escala)
+    if regenerar or not base_vigente(escala, version_esquema):
+        print(f"🏗️ Generando datos sintéticos: {ESCALAS[escala]:,} entradas en {ruta}")
+        inicio = time.perf_counter()
+        parqueadero.db.engine.dispose()
+        for sufijo in ("", "-wal", "-shm"):
+            if os.path.exists(ruta + sufijo):
+                os.remove(ruta + sufijo)
+        parqueadero.inicializar_datos()
+        tarifas = {t.TIPO_VEHICULO: (float(t.TARIFA_HORA), float(t.TARIFA_MINIMA))
+                   for t in parqueadero.Tarifa.query.filter_by(ACTIVA=True)}
+        parqueadero.db.session.remove()
+        parqueadero.db.engine.dispose()
+        resumen = llenar_base(ruta, ESCALAS[escala], tarifas)
+        with parqueadero.db.engine.begin() as conexion:
+            parqueadero.reconstruir_contadores(conexion)
+        guardar_metadatos(escala, version_esquema, resumen)
+        print(f"✅ Datos listos en {time.perf_counter() - inicio:.1f} s: {resumen}")
+    parqueadero.indice_rfid.cargar()
+    parqueadero.motor_tarifas.cargar()
+    parqueadero.asignador_espacios.cargar()
+    parqueadero.mapa_sensores.cargar()
+
+@click.command()
+@click.option("--escala", type=click.Choice(list(ESCALAS)), default="1k", show_default=True)
+@click.option("--solo", default=None, help="Prefijos de benchmarks separados por coma (p. ej. reporte,cobro)")
+@click.option("--guardar", is_flag=True, help="Guarda los resultados como nueva línea base de la escala")
+@click.option("--tolerancia", default=0.50, show_default=True, help="Empeoramiento relativo permitido")
+@click.option("--regenerar", is_flag=True, help="Vuelve a generar la base sintética aunque esté vigente")
+def main(escala, solo, guardar, tolerancia, regenerar):
+    """Corre los benchmarks sobre datos sintéticos y los compara contra la línea base"""
+    os.makedirs(CARPETA_DATOS, exist_ok=True)
+    os.environ["PARQUEADERO_DB"] = ruta_base(escala)
+    os.environ.setdefault("PARQUEADERO_LOG_NIVEL", "WARNING")  # La bitácora no se mezcla con la tabla
+    import BDPARQUEADERO as parqueadero
+
+    prefijos = [prefijo.strip() for prefijo in solo.split(",")] if solo else None
+    seleccion = [(nombre, preparar) for nombre, preparar in BENCHMARKS
+                 if not prefijos or any(nombre.startswith(prefijo) for prefijo in prefijos)]
+
+    try:
+        with open(ARCHIVO_LINEA_BASE, encoding="utf-8") as archivo:
+            lineas_base = json.load(archivo)
+    except FileNotFoundError:
+        lineas_base = {}
+    linea_base = lineas_base.get(escala, {}).get("resultados", {})
+
+    resultados = {}
+    regresiones = []
+    with parqueadero.app.app_context():
+        preparar_base(parqueadero, escala, regenerar)
+        contexto = {"parqueadero": parqueadero, "hoy": date.today(), "cliente": parqueadero.app.test_client()}
+
+        calentar()
+        print(f"\n⏱️ Escala {escala} ({ESCALAS[escala]:,} entradas), tolerancia {tolerancia:.0%}")
+        print(f"{'Benchmark':<30}{'actual':>12}{'base':>12}{'relativo':>10}{'base':>8}{'cambio':>9}")
+        for nombre, preparar in seleccion:
+            # Los print() de la app (p. ej. "📊 Reporte diario generado") no se mezclan con la tabla
+            base = linea_base.get(nombre)
+            with open(os.devnull, "w") as nulo, contextlib.redirect_stdout(nulo):
+                operacion = preparar(contexto)
+                segundos, relativo = medir_relativo(operacion)
+                # Un resultado lento se vuelve a medir antes de declararlo regresión
+                for _ in range(REINTENTOS):
+                    if base is None or not es_regresion(segundos, relativo, base, tolerancia):
+                        break
+                    segundos, relativo = min((segundos, relativo), medir_relativo(operacion),
+                                             key=lambda medicion: medicion[1])
+            resultados[nombre] = {"segundos": round(segundos, 9), "relativo": round(relativo, 6)}
+            if base is None:
+                estado, cambio = "🆕", ""
+            else:
+                cambio = f"{relativo / base['relativo'] - 1:+.0%}"
+                lento = es_regresion(segundos, relativo, base, tolerancia)
+                estado = "❌" if lento else "✅"
+                if lento:
+                    regresiones.append(nombre)
+            print(f"{nombre:<30}{formato_tiempo(segundos):>12}"
+                  f"{formato_tiempo(base['segundos'] if base else None):>12}"
+                  f"{relativo:>10.3f}{base['relativo'] if base else 0:>8.3f}{cambio:>9}  {estado}")
+
+    if guardar:
+        entrada = lineas_base.setdefault(escala, {"resultados": {}})
+        entrada["entorno"] = {"python": platform.python_version(), "maquina": platform.machine(),
+                              "cpus": os.cpu_count(), "fecha": date.today().isoformat()}
+        entrada["resultados"].update(resultados)
+        with open(ARCHIVO_LINEA_BASE, "w", encoding="utf-8") as archivo:
+            json.dump(lineas_base, archivo, indent=2, sort_keys=True)
+            archivo.write("\n")
+        print(f"💾 Línea base de {escala} guardada en {ARCHIVO_LINEA_BASE}")
+    elif regresiones:
+        print(f"❌ {len(regresiones)} benchmarks más lentos que la línea base: {', '.join(regresiones)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
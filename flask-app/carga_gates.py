@@ -0,0 +1,422 @@
+# 🆕 GENERADOR DE CARGA PARA BARRERAS Y SENSORES
+# Envía exactamente los JSON que armaba httpPostJson en el firmware v1 del ESP32:
+#   POST /api/entrada/detectar     {"tarjeta_rfid":"A1B2C3D4"}
+#   POST /api/salida/detectar      {"tarjeta_rfid":"A1B2C3D4"}
+#   POST /api/sensores/actualizar  {"sensor_1":true,"sensor_2":false,...}
+# con una conexión nueva por petición, como HTTPClient en el ESP32.
+# Con --protocolo v2 envía lo mismo en el formato compacto del firmware actual
+# (POST /api/v2/barrera {"t":"E","c":"A1B2C3D4"}) sobre una conexión keep-alive
+# por hilo, que reutiliza como el HTTPClient persistente del ESP32.
+#
+# Las llegadas son de lazo abierto (Poisson): cada petición sale a su hora
+# aunque el servidor vaya atrasado, y la latencia se mide desde esa hora, así
+# que la cola del servidor sí aparece en el p99.
+#
+#   python carga_gates.py                               # servidor local con base temporal
+#   python carga_gates.py --entradas 20 --salidas 20 --controladores 10 --duracion 60
+#   python carga_gates.py --solo-sembrar --base parqueadero.db --usuarios 500
+#   python carga_gates.py --url http://192.168.1.3:5000 --usuarios 500
+#   python carga_gates.py --protocolo v2
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import click
+
+CARPETA_APP = os.path.dirname(os.path.abspath(__file__))
+RUTA_ENTRADA = "/api/entrada/detectar"
+RUTA_SALIDA = "/api/salida/detectar"
+RUTA_SENSORES = "/api/sensores/actualizar"
+RUTA_V2 = "/api/v2/barrera"
+TIPOS_V2 = {RUTA_ENTRADA: "E", RUTA_SALIDA: "S", RUTA_SENSORES: "P"}
+ACCIONES_V2 = {("E", "A"): "ENTRADA_PERMITIDA", ("E", "R"): "USUARIO_NUEVO", ("E", "L"): "NO_HAY_ESPACIOS",
+               ("E", "F"): "SALDO_INSUFICIENTE", ("E", "D"): "ENTRADA_DUPLICADA",
+               ("S", "A"): "SALIDA_PERMITIDA", ("S", "F"): "SALDO_INSUFICIENTE_SALIDA", ("P", "K"): None}
+TIMEOUT_ESP32 = 5  # http.setTimeout(5000) en el firmware
+
+# Servidor local sin gunicorn: el servidor con hilos de werkzeug
+SERVIDOR_WERKZEUG = """
+import sys
+from werkzeug.serving import make_server
+from BDPARQUEADERO import crear_app
+make_server("127.0.0.1", int(sys.argv[1]), crear_app(), threaded=True).serve_forever()
+"""
+
+def tarjeta_sintetica(indice):
+    """UID de 4 bytes en hexadecimal, igual que leerUID() en el firmware"""
+    return f"{0xC0000000 + indice:08X}"
+
+def sembrar_poblacion(base, usuarios, espacios, saldo):
+    """Crea usuarios con tarjeta, vehículo y saldo, y espacios A1..An con sensor_1..sensor_n (idempotente)"""
+    os.environ["PARQUEADERO_DB"] = os.path.abspath(base)
+    sys.path.insert(0, CARPETA_APP)
+    import BDPARQUEADERO as parqueadero
+
+    with parqueadero.app.app_context():
+        parqueadero.inicializar_datos()
+        db = parqueadero.db
+        pines = {pin for (pin,) in db.session.query(parqueadero.Espacio.SENSOR_PIN).filter_by(
+            CONTROLADOR=parqueadero.CONTROLADOR_PRINCIPAL)}
+        numeros = {numero for (numero,) in db.session.query(parqueadero.Espacio.NUMERO)}
+        for pin in range(1, espacios + 1):
+            if pin not in pines and f"A{pin}" not in numeros:
+                db.session.add(parqueadero.Espacio(NUMERO=f"A{pin}", TIPO_VEHICULO="CARRO",
+                                                   ESTADO="DISPONIBLE", SENSOR_PIN=pin))
+
+        existentes = {tarjeta for (tarjeta,) in db.session.query(parqueadero.Usuario.TARJETA_RFID)}
+        nuevos = []
+        for indice in range(usuarios):
+            tarjeta = tarjeta_sintetica(indice)
+            if tarjeta in existentes:
+                continue
+            usuario = parqueadero.Usuario(NOMBRE=f"Carga {indice}", CEDULA=f"9{indice:08d}",
+                                          SALDO=0, TARJETA_RFID=tarjeta)
+            usuario.vehiculos.append(parqueadero.Vehiculo(PLACA=f"C{indice:05d}", TIPO="CARRO"))
+            nuevos.append(usuario)
+        db.session.add_all(nuevos)
+        db.session.flush()
+        for usuario in nuevos:
+            parqueadero.abonar_saldo(usuario.ID, saldo, tipo="APERTURA", referencia="CARGA")
+        db.session.commit()
+    print(f"🌱 Población lista en {base}: {usuarios} tarjetas ({len(nuevos)} nuevas), {espacios} espacios")
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def iniciar_servidor_local(base, hilos):
+    """Levanta la app en otro proceso (gunicorn si está instalado) y espera a que responda"""
+    puerto = puerto_libre()
+    entorno = dict(os.environ, PARQUEADERO_DB=os.path.abspath(base), PARQUEADERO_HILOS=str(hilos),
+                   PARQUEADERO_BIND=f"127.0.0.1:{puerto}")
+    try:
+        import gunicorn  # noqa: F401
+        comando = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "wsgi:app"]
+        servidor = "gunicorn gthread"
+    except ImportError:
+        comando = [sys.executable, "-c", SERVIDOR_WERKZEUG, str(puerto)]
+        servidor = "werkzeug con hilos"
+    proceso = subprocess.Popen(comando, cwd=CARPETA_APP, env=entorno,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    url = f"http://127.0.0.1:{puerto}"
+    limite = time.monotonic() + 30
+    while time.monotonic() < limite:
+        try:
+            if pedir(url, "GET", "/api/espacios/estado")[0] == 200:
+                print(f"🖥️ Servidor local ({servidor}, {hilos} hilos) en {url}")
+                return proceso, url
+        except OSError:
+            time.sleep(0.2)
+    proceso.terminate()
+    raise click.ClickException("El servidor local no respondió en 30 s")
+
+def pedir(url, metodo, ruta, cuerpo=None):
+    """Una petición con conexión nueva; retorna (código, cuerpo)"""
+    destino = urlparse(url)
+    conexion = http.client.HTTPConnection(destino.hostname, destino.port or 80, timeout=TIMEOUT_ESP32)
+    try:
+        datos = json.dumps(cuerpo, separators=(",", ":")).encode() if cuerpo is not None else None
+        conexion.request(metodo, ruta, body=datos, headers={"Content-Type": "application/json"})
+        respuesta = conexion.getresponse()
+        return respuesta.status, respuesta.read()
+    finally:
+        conexion.close()
+
+def cuerpo_v2(ruta, cuerpo):
+    """Traduce el JSON de la v1 al cuerpo compacto de /api/v2/barrera"""
+    tipo = TIPOS_V2[ruta]
+    if tipo != "P":
+        return {"t": tipo, "c": cuerpo["tarjeta_rfid"]}
+    pines = [int(sensor.split("_")[1]) for sensor in cuerpo]
+    bits = sum(1 << (pin - 1) for pin in pines if cuerpo[f"sensor_{pin}"])
+    return {"t": "P", "m": bits, "n": max(pines, default=0)}
+
+def pedir_persistente(conexiones, url, ruta, cuerpo):
+    """POST por la conexión keep-alive del hilo; si el servidor la cerró, reconecta una vez"""
+    datos = json.dumps(cuerpo, separators=(",", ":")).encode()
+    for intento in range(2):
+        conexion = getattr(conexiones, "actual", None)
+        if conexion is None:
+            destino = urlparse(url)
+            conexion = conexiones.actual = http.client.HTTPConnection(
+                destino.hostname, destino.port or 80, timeout=TIMEOUT_ESP32)
+        try:
+            conexion.request("POST", ruta, body=datos, headers={"Content-Type": "application/json"})
+            respuesta = conexion.getresponse()
+            return respuesta.status, respuesta.read()
+        except (OSError, http.client.HTTPException):
+            conexion.close()
+            conexiones.actual = None
+            if intento:
+                raise
+
+class Resultados:
+    """Latencias, códigos HTTP y acciones por endpoint"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencias = {}
+        self.codigos = {}
+        self.acciones = {}
+        self.errores = {}
+        self.omitidas = {}
+
+    def registrar(self, ruta, latencia, codigo, accion=None):
+        with self.lock:
+            self.latencias.setdefault(ruta, []).append(latencia)
+            conteo = self.codigos.setdefault(ruta, {})
+            conteo[codigo] = conteo.get(codigo, 0) + 1
+            if accion:
+                conteo = self.acciones.setdefault(ruta, {})
+                conteo[accion] = conteo.get(accion, 0) + 1
+
+    def fallo(self, ruta, error):
+        with self.lock:
+            conteo = self.errores.setdefault(ruta, {})
+            nombre = type(error).__name__
+            conteo[nombre] = conteo.get(nombre, 0) + 1
+
+    def omitir(self, ruta):
+        with self.lock:
+            self.omitidas[ruta] = self.omitidas.get(ruta, 0) + 1
+
+    def resumen(self, segundos):
+        rutas = sorted(set(self.latencias) | set(self.errores) | set(self.omitidas))
+        resumen = {}
+        for ruta in rutas:
+            latencias = sorted(self.latencias.get(ruta, []))
+            percentil = lambda q: round(latencias[min(len(latencias) - 1, int(q * len(latencias)))] * 1000, 1) \
+                if latencias else None
+            exitosas = sum(total for codigo, total in self.codigos.get(ruta, {}).items() if 200 <= codigo < 300)
+            resumen[ruta] = {
+                "respuestas": len(latencias),
+                "exitosas": exitosas,
+                "por_segundo": round(exitosas / segundos, 1),
+                "p50_ms": percentil(0.50),
+                "p95_ms": percentil(0.95),
+                "p99_ms": percentil(0.99),
+                "max_ms": round(latencias[-1] * 1000, 1) if latencias else None,
+                "codigos": self.codigos.get(ruta, {}),
+                "acciones": self.acciones.get(ruta, {}),
+                "errores": self.errores.get(ruta, {}),
+                "omitidas": self.omitidas.get(ruta, 0)
+            }
+        return resumen
+
+class SimuladorParqueadero:
+    """Población de tarjetas (afuera/adentro) y sensores de cada controlador simulado"""
+
+    def __init__(self, url, usuarios, espacios, controladores, nuevas, resultados, protocolo="v1"):
+        self.url = url
+        self.protocolo = protocolo
+        self.conexiones = threading.local()
+        self.lock = threading.Lock()
+        self.afuera = [tarjeta_sintetica(indice) for indice in range(usuarios)]
+        self.adentro = {}          # tarjeta -> número de espacio
+        self.ocupados = set()      # pines con carro según el simulador
+        self.nuevas = nuevas
+        self.desconocidas = 0
+        self.resultados = resultados
+        por_controlador = -(-espacios // controladores)
+        self.pines = [list(range(inicio, min(inicio + por_controlador, espacios + 1)))
+                      for inicio in range(1, espacios + 1, por_controlador)]
+
+    def enviar(self, ruta, cuerpo, programada):
+        """Envía y registra la latencia desde la hora programada; retorna el JSON de respuesta o None"""
+        try:
+            if self.protocolo == "v2":
+                codigo, datos = pedir_persistente(self.conexiones, self.url, RUTA_V2, cuerpo_v2(ruta, cuerpo))
+            else:
+                codigo, datos = pedir(self.url, "POST", ruta, cuerpo)
+        except (OSError, http.client.HTTPException) as e:
+            self.resultados.fallo(ruta, e)
+            return None
+        latencia = time.perf_counter() - programada
+        if self.protocolo == "v2":
+            letra, _, dato = datos.decode(errors="replace").partition(" ")
+            respuesta = {"accion": ACCIONES_V2.get((TIPOS_V2[ruta], letra), letra), "espacio": dato}
+        else:
+            try:
+                respuesta = json.loads(datos)
+            except ValueError:
+                respuesta = {}
+        self.resultados.registrar(ruta, latencia, codigo, respuesta.get("accion"))
+        return respuesta
+
+    def entrada(self, programada):
+        with self.lock:
+            if random.random() < self.nuevas:
+                self.desconocidas += 1
+                tarjeta, conocida = f"{0x10000000 + self.desconocidas:08X}", False
+            elif self.afuera:
+                tarjeta, conocida = self.afuera.pop(random.randrange(len(self.afuera))), True
+            else:
+                tarjeta = None
+        if tarjeta is None:
+            self.resultados.omitir(RUTA_ENTRADA)
+            return
+        respuesta = self.enviar(RUTA_ENTRADA, {"tarjeta_rfid": tarjeta}, programada)
+        if not conocida:
+            return
+        with self.lock:
+            if respuesta and respuesta.get("accion") == "ENTRADA_PERMITIDA":
+                self.adentro[tarjeta] = respuesta.get("espacio")
+                if str(respuesta.get("espacio", "")).startswith("A"):
+                    self.ocupados.add(int(respuesta["espacio"][1:]))
+            else:
+                self.afuera.append(tarjeta)
+
+    def salida(self, programada):
+        with self.lock:
+            if not self.adentro:
+                tarjeta = None
+            else:
+                tarjeta = random.choice(list(self.adentro))
+                espacio = self.adentro.pop(tarjeta)
+        if tarjeta is None:
+            self.resultados.omitir(RUTA_SALIDA)
+            return
+        respuesta = self.enviar(RUTA_SALIDA, {"tarjeta_rfid": tarjeta}, programada)
+        with self.lock:
+            if respuesta and respuesta.get("accion") == "SALIDA_PERMITIDA":
+                self.afuera.append(tarjeta)
+                if str(espacio or "").startswith("A"):
+                    self.ocupados.discard(int(espacio[1:]))
+            else:
+                self.adentro[tarjeta] = espacio
+
+    def lectura_sensores(self, controlador, programada, ruido):
+        """Estado de los pines del controlador; cada sensor falla con probabilidad `ruido`"""
+        with self.lock:
+            estados = {f"sensor_{pin}": (pin in self.ocupados) != (random.random() < ruido)
+                       for pin in self.pines[controlador]}
+        self.enviar(RUTA_SENSORES, estados, programada)
+
+def generar_llegadas(tasa, fin, despachar, accion):
+    """Llegadas de Poisson a `tasa` por segundo hasta `fin` (perf_counter)"""
+    if tasa <= 0:
+        return
+    proxima = time.perf_counter() + random.expovariate(tasa)
+    while proxima < fin:
+        espera = proxima - time.perf_counter()
+        if espera > 0:
+            time.sleep(espera)
+        despachar(accion, proxima)
+        proxima += random.expovariate(tasa)
+
+@click.command()
+@click.option("--url", default=None, help="Servidor ya levantado; sin esto se levanta uno local con base temporal")
+@click.option("--base", default=None, help="Archivo SQLite a sembrar (por defecto uno temporal)")
+@click.option("--solo-sembrar", is_flag=True, help="Solo crea la población en --base y termina")
+@click.option("--usuarios", default=300, show_default=True, help="Tarjetas registradas con saldo")
+@click.option("--espacios", default=60, show_default=True, help="Espacios A1..An (sensor_1..sensor_n)")
+@click.option("--controladores", default=5, show_default=True, help="ESP32 simulados que reportan sensores")
+@click.option("--saldo", default=10_000_000, show_default=True, help="Saldo inicial de cada tarjeta")
+@click.option("--entradas", default=5.0, show_default=True, help="Toques de entrada por segundo (todas las barreras)")
+@click.option("--salidas", default=4.0, show_default=True, help="Toques de salida por segundo")
+@click.option("--lecturas", default=1.0, show_default=True, help="Reportes de sensores por segundo por controlador")
+@click.option("--nuevas", default=0.0, show_default=True, help="Fracción de toques de entrada con tarjeta no registrada")
+@click.option("--ruido", default=0.02, show_default=True, help="Probabilidad de que un sensor reporte mal")
+@click.option("--duracion", default=30.0, show_default=True, help="Segundos de carga")
+@click.option("--concurrencia", default=64, show_default=True, help="Peticiones en vuelo como máximo")
+@click.option("--hilos-servidor", default=16, show_default=True, help="Hilos del servidor local")
+@click.option("--protocolo", type=click.Choice(["v1", "v2"]), default="v1", show_default=True,
+              help="v1: JSON por endpoint, conexión nueva; v2: /api/v2/barrera compacto con keep-alive")
+@click.option("--semilla", default=1, show_default=True)
+@click.option("--json", "archivo_json", default=None, help="Guarda el resumen en este archivo")
+def main(url, base, solo_sembrar, usuarios, espacios, controladores, saldo, entradas, salidas, lecturas,
+         nuevas, ruido, duracion, concurrencia, hilos_servidor, protocolo, semilla, archivo_json):
+    """Carga de lazo abierto sobre entrada, salida y sensores; reporta req/s y p50/p95/p99 por endpoint"""
+    random.seed(semilla)
+    temporal = None
+    proceso = None
+    if url is None or solo_sembrar:
+        if base is None:
+            if solo_sembrar:
+                raise click.UsageError("--solo-sembrar necesita --base")
+            temporal = tempfile.TemporaryDirectory(prefix="carga_parqueadero_")
+            base = os.path.join(temporal.name, "parqueadero.db")
+        sembrar_poblacion(base, usuarios, espacios, saldo)
+        if solo_sembrar:
+            return
+
+    try:
+        if url is None:
+            proceso, url = iniciar_servidor_local(base, hilos_servidor)
+
+        resultados = Resultados()
+        simulador = SimuladorParqueadero(url.rstrip("/"), usuarios, espacios, controladores, nuevas, resultados,
+                                         protocolo)
+        print(f"🚦 {duracion:.0f} s ({protocolo}): {entradas}/s entradas, {salidas}/s salidas, "
+              f"{len(simulador.pines)} controladores x {lecturas}/s lecturas")
+
+        en_vuelo = threading.BoundedSemaphore(concurrencia)
+        saturadas = [0]
+
+        with ThreadPoolExecutor(max_workers=concurrencia) as ejecutor:
+            def despachar(accion, programada):
+                # Si ya hay `concurrencia` peticiones esperando, la llegada se cuenta y se descarta
+                if not en_vuelo.acquire(blocking=False):
+                    saturadas[0] += 1
+                    return
+                def correr():
+                    try:
+                        accion(programada)
+                    finally:
+                        en_vuelo.release()
+                ejecutor.submit(correr)
+
+            inicio = time.perf_counter()
+            fin = inicio + duracion
+            generadores = [
+                threading.Thread(target=generar_llegadas, args=(entradas, fin, despachar, simulador.entrada)),
+                threading.Thread(target=generar_llegadas, args=(salidas, fin, despachar, simulador.salida))
+            ]
+            for controlador in range(len(simulador.pines)):
+                generadores.append(threading.Thread(target=generar_llegadas, args=(
+                    lecturas, fin, despachar,
+                    lambda programada, c=controlador: simulador.lectura_sensores(c, programada, ruido))))
+            for hilo in generadores:
+                hilo.start()
+            for hilo in generadores:
+                hilo.join()
+        segundos = time.perf_counter() - inicio
+
+        resumen = resultados.resumen(segundos)
+        print(f"\n{'Endpoint':<28}{'ok':>7}{'req/s':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}  códigos")
+        for ruta, datos in resumen.items():
+            print(f"{ruta:<28}{datos['exitosas']:>7}{datos['por_segundo']:>8}"
+                  f"{datos['p50_ms'] or 0:>7.1f}ms{datos['p95_ms'] or 0:>7.1f}ms"
+                  f"{datos['p99_ms'] or 0:>7.1f}ms{datos['max_ms'] or 0:>7.1f}ms  {datos['codigos']}")
+            if datos["acciones"]:
+                print(f"{'':<28}acciones: {datos['acciones']}")
+            if datos["errores"] or datos["omitidas"]:
+                print(f"{'':<28}errores: {datos['errores']}, omitidas (sin tarjeta disponible): {datos['omitidas']}")
+        if saturadas[0]:
+            print(f"⚠️ {saturadas[0]} llegadas descartadas: más de {concurrencia} peticiones en vuelo")
+        print(f"🅿️ Al terminar: {len(simulador.adentro)} carros adentro, {len(simulador.afuera)} afuera")
+
+        if archivo_json:
+            with open(archivo_json, "w", encoding="utf-8") as archivo:
+                json.dump({"segundos": round(segundos, 2), "descartadas": saturadas[0], "endpoints": resumen},
+                          archivo, indent=2)
+    finally:
+        if proceso:
+            proceso.terminate()
+            proceso.wait(timeout=10)
+        if temporal:
+            temporal.cleanup()
+
+if __name__ == "__main__":
+    main()
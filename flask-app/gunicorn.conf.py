@@ -0,0 +1,25 @@
+# 🆕 CONFIGURACIÓN DE GUNICORN PARA EL PARQUEADERO
+# Un solo proceso con varios hilos: los índices en memoria (tarjetas RFID,
+# espacios libres, tokens, bus de eventos) viven en el proceso y SQLite admite
+# un solo escritor a la vez, así que más procesos no dan más escrituras y sí
+# dejarían índices desincronizados entre ellos.
+import os
+
+bind = os.environ.get("PARQUEADERO_BIND", "0.0.0.0:5000")
+workers = 1
+worker_class = "gthread"
+# La app lee el mismo PARQUEADERO_HILOS y reparte los hilos: un cuarto para las
+# esperas de comandos de las barreras (PARQUEADERO_MAX_ESPERAS), otro cuarto para
+# los dashboards SSE (PARQUEADERO_MAX_DASHBOARDS) y el resto queda siempre para los
+# toques de tarjeta y la API. Con 16: 4 + 4 conexiones largas y 8 hilos cortos.
+# Pasados los cupos responde 503; para más barreras o dashboards sube este número.
+threads = int(os.environ.get("PARQUEADERO_HILOS", 16))
+
+timeout = 60
+graceful_timeout = 30
+# Los ESP32 reutilizan su conexión HTTP entre lecturas (protocolo v2); con gthread
+# una conexión inactiva espera en el poller y no ocupa hilo, así que se mantiene abierta
+keepalive = int(os.environ.get("PARQUEADERO_KEEPALIVE", 75))
+
+accesslog = "-"
+errorlog = "-"
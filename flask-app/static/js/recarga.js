@@ -0,0 +1,42 @@
+// Seleccionar monto
+document.querySelectorAll('.monto-btn').forEach(btn => {
+    btn.addEventListener('click', function() {
+        document.querySelectorAll('.monto-btn').forEach(b => b.classList.remove('selected'));
+        this.classList.add('selected');
+        document.getElementById('montoSeleccionado').value = this.dataset.monto;
+    });
+});
+
+// Seleccionar primer monto por defecto
+document.querySelector('.monto-btn').classList.add('selected');
+
+async function procesarPago() {
+    const monto = document.getElementById('montoSeleccionado').value;
+    const token = document.body.dataset.token;
+
+    document.getElementById('resultado').innerHTML = '<p>⏳ Procesando pago...</p>';
+
+    try {
+        const response = await fetch('/api/recarga/procesar', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({token: token, monto: parseFloat(monto)})
+        });
+
+        const data = await response.json();
+
+        if (response.ok) {
+            document.getElementById('resultado').innerHTML = 
+                '<p class="success">✅ ' + data.mensaje + '</p>' +
+                '<p><strong>Nuevo saldo:</strong> $' + data.nuevo_saldo + '</p>' +
+                '<p><strong>Ya puede ingresar al parqueadero!</strong></p>' +
+                '<p>Pase su tarjeta RFID nuevamente en la entrada</p>';
+        } else {
+            document.getElementById('resultado').innerHTML = 
+                '<p class="error">❌ ' + data.error + '</p>';
+        }
+    } catch (error) {
+        document.getElementById('resultado').innerHTML = 
+            '<p class="error">❌ Error de conexión</p>';
+    }
+}
@@ -0,0 +1,82 @@
+document.getElementById('formRegistro').addEventListener('submit', async function(e) {
+    e.preventDefault();
+
+    const btnRegistro = document.getElementById('btnRegistro');
+
+    // Deshabilitar botón durante el registro
+    btnRegistro.disabled = true;
+    btnRegistro.innerHTML = '⏳ Registrando...';
+
+    document.getElementById('resultado').innerHTML = 
+        '<div class="loading">' +
+        '   <p>📝 Procesando registro...</p>' +
+        '   <p>⏳ Por favor espere</p>' +
+        '</div>';
+
+    const datos = {
+        token: document.body.dataset.token,
+        nombre: document.getElementById('nombre').value,
+        cedula: document.getElementById('cedula').value,
+        telefono: document.getElementById('telefono').value,
+        email: document.getElementById('email').value,
+        placa: document.getElementById('placa').value,
+        tipo_vehiculo: document.getElementById('tipoVehiculo').value,
+        marca: document.getElementById('marca').value,
+        color: document.getElementById('color').value
+    };
+
+    try {
+        const response = await fetch('/api/registro/completar', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify(datos)
+        });
+
+        const data = await response.json();
+
+        if (response.ok) {
+            let mensajeHTML = 
+                '<div class="info-box">' +
+                '   <p class="success">✅ ' + data.mensaje + '</p>' +
+                '</div>' +
+                '<div style="background: #e7f3ff; padding: 15px; border-radius: 10px; margin: 15px 0;">' +
+                '   <p><strong>👤 Usuario:</strong> ' + datos.nombre + '</p>' +
+                '   <p><strong>🚗 Vehículo:</strong> ' + datos.placa + '</p>' +
+                '   <p><strong>📧 Email:</strong> ' + datos.email + '</p>' +
+                '</div>' +
+                '<div style="background: #fff3cd; padding: 15px; border-radius: 10px; margin: 15px 0;">' +
+                '   <p><strong>💰 Siguiente paso:</strong></p>' +
+                '   <p>Será redirigido automáticamente a la página de recarga</p>' +
+                '</div>';
+
+            document.getElementById('resultado').innerHTML = mensajeHTML;
+
+            // 🆕 REDIRIGIR AUTOMÁTICAMENTE A RECARGA DESPUÉS DE 3 SEGUNDOS
+            setTimeout(() => {
+                if (data.url_recarga) {
+                    window.location.href = data.url_recarga;
+                }
+            }, 3000);
+
+        } else {
+            document.getElementById('resultado').innerHTML = 
+                '<div class="error">' +
+                '   <p>❌ ' + data.error + '</p>' +
+                '</div>';
+
+            // Re-habilitar botón en caso de error
+            btnRegistro.disabled = false;
+            btnRegistro.innerHTML = '📝 Registrar Usuario';
+        }
+    } catch (error) {
+        document.getElementById('resultado').innerHTML = 
+            '<div class="error">' +
+            '   <p>❌ Error de conexión</p>' +
+            '   <p>Verifique su conexión a internet e intente nuevamente</p>' +
+            '</div>';
+
+        // Re-habilitar botón en caso de error
+        btnRegistro.disabled = false;
+        btnRegistro.innerHTML = '📝 Registrar Usuario';
+    }
+});
@@ -0,0 +1,77 @@
+# 🆕 PRUEBAS DEL PARQUEADERO
+# BDPARQUEADERO lee PARQUEADERO_DB al importarse, así que la base temporal de la
+# sesión se fija aquí, antes de la primera importación del módulo.
+#
+#   cd flask-app && python -m pytest -q
+import os
+import shutil
+import tempfile
+from contextlib import ExitStack
+
+import pytest
+
+CARPETA_PRUEBAS = tempfile.mkdtemp(prefix="pruebas_parqueadero_")
+os.environ["PARQUEADERO_DB"] = os.path.join(CARPETA_PRUEBAS, "parqueadero.db")
+os.environ.setdefault("PARQUEADERO_LOG_NIVEL", "WARNING")
+
+import BDPARQUEADERO  # noqa: E402
+
+PILA_PRESUPUESTO = pytest.StashKey()
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "presupuesto_consultas(maximo=None, repeticiones=5): límites del fixture presupuesto_consultas")
+
+def pytest_unconfigure(config):
+    shutil.rmtree(CARPETA_PRUEBAS, ignore_errors=True)
+
+@pytest.fixture(scope="session")
+def aplicacion():
+    """La aplicación migrada sobre la base temporal, con índices en memoria y barredor"""
+    return BDPARQUEADERO.crear_app({"TESTING": True})
+
+@pytest.fixture
+def contexto(aplicacion):
+    """Contexto de aplicación con una db.session propia del test"""
+    with aplicacion.app_context():
+        yield
+        BDPARQUEADERO.db.session.remove()
+
+@pytest.fixture
+def cliente(aplicacion):
+    return aplicacion.test_client()
+
+@pytest.fixture
+def presupuesto_consultas(request, contexto):
+    """Envuelve el cuerpo del test en presupuesto_consultas(): el test falla si supera
+    `maximo` sentencias o repite una forma más de `repeticiones` veces (N+1).
+    Los límites van en la marca; retorna el PerfilSQL para contar por tramos.
+
+        @pytest.mark.presupuesto_consultas(maximo=1)
+        def test_recargas(presupuesto_consultas):
+            generar_recargas_dia(date.today())
+
+    Solo cuenta lo que corre en el hilo del test después de preparar este fixture:
+    los fixtures que siembran datos deben ir antes en la firma.
+    """
+    marca = request.node.get_closest_marker("presupuesto_consultas")
+    with ExitStack() as pila:
+        perfil = pila.enter_context(BDPARQUEADERO.presupuesto_consultas(**(marca.kwargs if marca else {})))
+        # pytest_runtest_call lo cierra al terminar el cuerpo del test, para que el exceso falle el test
+        # y no su teardown; si el test no llegó a correr, se cierra aquí
+        request.node.stash[PILA_PRESUPUESTO] = pila
+        yield perfil
+
+@pytest.hookimpl(wrapper=True)
+def pytest_runtest_call(item):
+    pila = item.stash.get(PILA_PRESUPUESTO, None)
+    if pila is None:
+        return (yield)
+    try:
+        resultado = yield
+    except BaseException as error:
+        # El test ya falló: se cierra con su excepción, sin sumar la del presupuesto
+        pila.__exit__(type(error), error, error.__traceback__)
+        raise
+    pila.close()
+    return resultado
@@ -0,0 +1,102 @@
+import threading
+
+import pytest
+from sqlalchemy import text
+
+from BDPARQUEADERO import Espacio, asignador_espacios, db, escritor_unico
+
+TIPO = "PRUEBA_ASIGNADOR"  # Tipo propio: los espacios de otros tests no entran en las listas
+ESPACIOS = 12
+TARJETAS = 48
+
+@pytest.fixture
+def espacios_prueba(contexto):
+    espacios = [Espacio(NUMERO=f"T{pin}", TIPO_VEHICULO=TIPO, ESTADO="DISPONIBLE", SENSOR_PIN=pin,
+                        CONTROLADOR=TIPO) for pin in range(1, ESPACIOS + 1)]
+    db.session.add_all(espacios)
+    db.session.commit()
+    asignador_espacios.recargar_tipo(TIPO)
+    return {espacio.ID for espacio in espacios}
+
+def en_paralelo(hilos, trabajo):
+    """Cada hilo es una tarjeta que pasa por el escritor único al mismo tiempo; retorna (resultados, errores)"""
+    salida = threading.Barrier(hilos)
+    resultados, errores = [], []
+    lock = threading.Lock()
+
+    def tarjeta():
+        salida.wait()
+        try:
+            resultado = escritor_unico.ejecutar(trabajo, plazo=30)
+        except Exception as e:
+            with lock:
+                errores.append(e)
+        else:
+            with lock:
+                resultados.append(resultado)
+
+    tarjetas = [threading.Thread(target=tarjeta) for _ in range(hilos)]
+    for hilo in tarjetas:
+        hilo.start()
+    for hilo in tarjetas:
+        hilo.join(60)
+    return resultados, errores
+
+def estados(ids):
+    filas = db.session.execute(text("SELECT ID, ESTADO FROM ESPACIO WHERE CONTROLADOR = :c"), {"c": TIPO})
+    return {espacio_id: estado for espacio_id, estado in filas if espacio_id in ids}
+
+def libres():
+    with asignador_espacios.lock:
+        return list(asignador_espacios.libres.get(TIPO, ()))
+
+class FalloDespuesDeReclamar(Exception):
+    pass
+
+def reclamar_y_fallar():
+    espacio = asignador_espacios.reclamar(TIPO)
+    raise FalloDespuesDeReclamar(espacio["id"] if espacio else None)
+
+def test_mas_tarjetas_que_espacios(espacios_prueba):
+    resultados, errores = en_paralelo(TARJETAS, lambda: asignador_espacios.reclamar(TIPO))
+
+    assert errores == []
+    asignados = [resultado["id"] for resultado in resultados if resultado is not None]
+    assert len(asignados) == ESPACIOS
+    assert len(set(asignados)) == len(asignados), "un espacio se entregó dos veces"
+    assert set(asignados) == espacios_prueba
+    assert set(estados(espacios_prueba).values()) == {"OCUPADO"}
+    assert libres() == []
+
+    # Los reclamos revertidos devuelven el espacio a la lista libre
+    liberados = set(sorted(espacios_prueba)[:4])
+    def liberar():
+        db.session.execute(text("UPDATE ESPACIO SET ESTADO = 'DISPONIBLE' WHERE ID IN (%s)"
+                                % ",".join(str(espacio_id) for espacio_id in liberados)))
+    escritor_unico.ejecutar(liberar)
+    for espacio_id in liberados:
+        asignador_espacios.liberar(espacio_id)
+
+    resultados, errores = en_paralelo(TARJETAS // 3, reclamar_y_fallar)
+    assert resultados == []
+    assert len(errores) == TARJETAS // 3
+    assert all(isinstance(error, FalloDespuesDeReclamar) for error in errores)
+    reclamados = {error.args[0] for error in errores} - {None}
+    assert reclamados and reclamados <= liberados
+    assert sorted(libres()) == sorted(liberados)
+    db.session.rollback()  # Snapshot nuevo para leer lo que confirmó el escritor
+    assert [espacio_id for espacio_id, estado in estados(espacios_prueba).items()
+            if estado == "DISPONIBLE"] == sorted(liberados)
+
+    # También al revertir la sesión del propio hilo (sin escritor)
+    espacio = asignador_espacios.reclamar(TIPO)
+    assert espacio["id"] in liberados and espacio["id"] not in libres()
+    db.session.rollback()
+    assert sorted(libres()) == sorted(liberados)
+
+    # Y se vuelven a entregar, cada uno una sola vez
+    resultados, errores = en_paralelo(TARJETAS // 3, lambda: asignador_espacios.reclamar(TIPO))
+    assert errores == []
+    asignados = [resultado["id"] for resultado in resultados if resultado is not None]
+    assert sorted(asignados) == sorted(liberados)
+    assert libres() == []
@@ -0,0 +1,34 @@
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+import BDPARQUEADERO
+from BDPARQUEADERO import Transaccion, barredor_transacciones, db
+
+def test_lotes_del_barredor_por_el_escritor(contexto, monkeypatch):
+    monkeypatch.setattr(BDPARQUEADERO, "LOTE_BARREDOR", 2)
+    monkeypatch.setattr(BDPARQUEADERO, "PAUSA_ENTRE_LOTES", 0)
+    ahora = datetime.utcnow()
+    db.session.add_all(
+        [Transaccion(TIPO="RECARGA", MONTO=0, ESTADO="PENDIENTE", TOKEN=f"barrido-pendiente-{i}",
+                     FECHA=ahora - timedelta(hours=1)) for i in range(5)] +
+        [Transaccion(TIPO="RECARGA", MONTO=0, ESTADO="EXPIRADA", TOKEN=f"barrido-expirada-{i}",
+                     FECHA=ahora - timedelta(days=30)) for i in range(3)])
+    db.session.commit()
+
+    hilos = set()
+    def anotar_hilo(conexion, cursor, sentencia, *args):
+        if sentencia.lstrip().startswith(("UPDATE TRANSACCION SET ESTADO = 'EXPIRADA'", "DELETE FROM TRANSACCION")):
+            hilos.add(threading.current_thread().name)
+    event.listen(db.engine, "before_cursor_execute", anotar_hilo)
+    try:
+        resultado = barredor_transacciones.barrer(ahora)
+    finally:
+        event.remove(db.engine, "before_cursor_execute", anotar_hilo)
+
+    assert resultado["expiradas"] >= 5 and resultado["borradas"] >= 3
+    assert hilos == {"escritor-unico"}
+    db.session.rollback()
+    estados = dict(db.session.query(Transaccion.TOKEN, Transaccion.ESTADO).filter(Transaccion.TOKEN.like("barrido-%")))
+    assert estados == {f"barrido-pendiente-{i}": "EXPIRADA" for i in range(5)}
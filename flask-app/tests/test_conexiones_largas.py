@@ -0,0 +1,61 @@
+import time
+
+import pytest
+
+import BDPARQUEADERO
+from BDPARQUEADERO import MAXIMO_DASHBOARDS, MAXIMO_ESPERAS_COMANDOS, BusEventos, bus_eventos, cupos_esperas_comandos
+
+@pytest.fixture
+def cupos_ocupados():
+    """Ocupa todos los cupos de long-poll como si cada barrera tuviera su espera abierta"""
+    for _ in range(MAXIMO_ESPERAS_COMANDOS):
+        assert cupos_esperas_comandos.acquire(blocking=False)
+    yield
+    for _ in range(MAXIMO_ESPERAS_COMANDOS):
+        cupos_esperas_comandos.release()
+
+def test_esperas_de_comandos_con_cupo(cliente, cupos_ocupados):
+    respuesta = cliente.get("/api/barrera/ENTRADA/comandos?espera=5")
+    assert respuesta.status_code == 503
+    assert respuesta.headers["Retry-After"] == "2"
+    # Sin espera no ocupa hilo y responde igual
+    assert cliente.get("/api/barrera/ENTRADA/comandos?espera=0").status_code == 200
+
+def test_espera_de_comandos_devuelve_su_cupo(cliente):
+    assert cliente.get("/api/barrera/ENTRADA/comandos?espera=0.1").status_code == 200
+    for _ in range(MAXIMO_ESPERAS_COMANDOS):
+        assert cupos_esperas_comandos.acquire(blocking=False)
+    assert not cupos_esperas_comandos.acquire(blocking=False)
+    for _ in range(MAXIMO_ESPERAS_COMANDOS):
+        cupos_esperas_comandos.release()
+
+def test_bus_con_maximo_de_suscriptores():
+    bus = BusEventos(maximo_suscriptores=2)
+    primera, segunda = bus.suscribir(), bus.suscribir()
+    assert bus.suscribir() is None
+    bus.cancelar(primera)
+    assert bus.suscribir() is not None
+    bus.publicar("prueba", {"n": 1})
+    assert segunda.get_nowait().startswith("id: 1\nevent: prueba")
+
+def test_stream_sin_cupo_responde_503(cliente):
+    ocupadas = [bus_eventos.suscribir() for _ in range(MAXIMO_DASHBOARDS)]
+    try:
+        respuesta = cliente.get("/api/espacios/stream")
+        assert respuesta.status_code == 503
+        assert "Retry-After" in respuesta.headers
+    finally:
+        for suscripcion in ocupadas:
+            bus_eventos.cancelar(suscripcion)
+
+def test_stream_se_cierra_por_edad(cliente, monkeypatch):
+    monkeypatch.setattr(BDPARQUEADERO, "EDAD_MAXIMA_STREAM", 0.3)
+    inicio = time.monotonic()
+    respuesta = cliente.get("/api/espacios/stream", buffered=False)
+    assert respuesta.status_code == 200
+    cuerpo = b"".join(respuesta.response).decode()
+    respuesta.close()
+    assert time.monotonic() - inicio < 5
+    assert cuerpo.startswith("retry: ") and "event: snapshot" in cuerpo
+    # La conexión cerrada devolvió su cupo
+    assert len(bus_eventos.suscriptores) == 0
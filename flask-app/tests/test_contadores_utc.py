@@ -0,0 +1,19 @@
+import time
+from datetime import datetime
+
+import pytest
+
+@pytest.fixture
+def zona_con_otro_dia(monkeypatch):
+    """Zona horaria local en la que la fecha local no coincide con la UTC en este momento"""
+    monkeypatch.setenv("TZ", "Etc/GMT-14" if datetime.utcnow().hour >= 12 else "Etc/GMT+12")
+    time.tzset()
+    assert datetime.now().date() != datetime.utcnow().date()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+def test_estadisticas_diarias_por_dia_utc(cliente, zona_con_otro_dia):
+    estadisticas = cliente.get("/api/estadisticas/diarias").get_json()
+    resumen = cliente.get("/api/reportes/diario/resumen").get_json()
+    assert estadisticas["fecha"] == resumen["fecha"] == datetime.utcnow().strftime("%Y-%m-%d")
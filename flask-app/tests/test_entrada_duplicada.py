@@ -0,0 +1,47 @@
+import threading
+
+import pytest
+
+from BDPARQUEADERO import Entrada, Espacio, Usuario, Vehiculo, asignador_espacios, db, indice_rfid, procesar_entrada
+
+TIPO = "PRUEBA_ENTRADA"  # Tipo propio: la tarjeta solo puede tomar estos espacios
+TARJETA = "AABB0001"
+TOQUES = 4
+
+@pytest.fixture
+def tarjeta_con_saldo(contexto):
+    usuario = Usuario(NOMBRE="Toque Doble", CEDULA="900000301", SALDO=100000, TARJETA_RFID=TARJETA)
+    db.session.add(usuario)
+    db.session.flush()
+    db.session.add(Vehiculo(ID_USUARIO=usuario.ID, PLACA="DUP001", TIPO=TIPO))
+    db.session.add_all([Espacio(NUMERO=f"D{pin}", TIPO_VEHICULO=TIPO, ESTADO="DISPONIBLE", SENSOR_PIN=pin,
+                                CONTROLADOR=TIPO) for pin in range(1, TOQUES + 1)])
+    db.session.commit()
+    asignador_espacios.recargar_tipo(TIPO)
+    indice_rfid.invalidar(TARJETA)
+    return usuario.ID
+
+def test_toques_simultaneos_de_una_tarjeta(aplicacion, tarjeta_con_saldo, monkeypatch):
+    # El índice no se entera de la entrada nueva: todos los toques pasan el chequeo en memoria,
+    # como cuando llegan antes de que el primero vuelva del escritor
+    monkeypatch.setattr(indice_rfid, "actualizar", lambda *args, **kwargs: None)
+    salida = threading.Barrier(TOQUES)
+    acciones = []
+
+    def tocar():
+        with aplicacion.app_context():
+            salida.wait()
+            respuesta, _ = procesar_entrada(TARJETA)
+            acciones.append(respuesta["accion"])
+            db.session.remove()
+
+    hilos = [threading.Thread(target=tocar) for _ in range(TOQUES)]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join(30)
+
+    assert sorted(acciones) == ["ENTRADA_DUPLICADA"] * (TOQUES - 1) + ["ENTRADA_PERMITIDA"]
+    db.session.rollback()
+    assert Entrada.query.filter_by(ID_USUARIO=tarjeta_con_saldo, ESTADO="ACTIVA").count() == 1
+    assert Espacio.query.filter_by(CONTROLADOR=TIPO, ESTADO="DISPONIBLE").count() == TOQUES - 1
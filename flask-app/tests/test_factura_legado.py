@@ -0,0 +1,40 @@
+import itertools
+from datetime import datetime, timedelta
+
+from BDPARQUEADERO import (Entrada, Factura, Usuario, Vehiculo, cache_facturas, congelar_facturas_pendientes,
+                           db)
+
+USUARIOS = itertools.count(1)
+
+def salida_sin_factura():
+    """Una salida como las anteriores a las instantáneas: FINALIZADA y sin fila en FACTURA"""
+    numero = next(USUARIOS)
+    usuario = Usuario(NOMBRE="Luis Legado", CEDULA=f"90000060{numero}", SALDO=7000)
+    db.session.add(usuario)
+    db.session.flush()
+    vehiculo = Vehiculo(ID_USUARIO=usuario.ID, PLACA=f"LEG00{numero}", TIPO="CARRO")
+    db.session.add(vehiculo)
+    db.session.flush()
+    salida = datetime.utcnow() - timedelta(days=30)
+    entrada = Entrada(ID_USUARIO=usuario.ID, ID_VEHICULO=vehiculo.ID, FECHA_ENTRADA=salida - timedelta(hours=2),
+                      FECHA_SALIDA=salida, TIEMPO_ESTACIONADO="2h 0m", MONTO_COBRADO=6000, ESTADO="FINALIZADA")
+    db.session.add(entrada)
+    db.session.commit()
+    return entrada.ID, vehiculo.PLACA
+
+def test_el_get_no_congela_la_factura(cliente, contexto):
+    entrada_id, placa = salida_sin_factura()
+    respuesta = cliente.get(f"/api/factura/generar/{entrada_id}")
+    assert respuesta.status_code == 200 and placa in respuesta.get_data(as_text=True)
+    db.session.rollback()
+    assert db.session.get(Factura, entrada_id) is None
+    assert cache_facturas.obtener(entrada_id) is None
+
+def test_congelar_facturas_pendientes(cliente, contexto):
+    entrada_id, placa = salida_sin_factura()
+    assert congelar_facturas_pendientes(lote=1) >= 1
+    factura = db.session.get(Factura, entrada_id)
+    assert factura.PLACA == placa and float(factura.SALDO_RESTANTE) == 7000
+    assert cliente.get(f"/api/factura/generar/{entrada_id}").status_code == 200
+    assert cache_facturas.obtener(entrada_id) is not None
+    assert congelar_facturas_pendientes() == 0
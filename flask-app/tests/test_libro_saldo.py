@@ -0,0 +1,50 @@
+import itertools
+import math
+
+import pytest
+
+from BDPARQUEADERO import MovimientoSaldo, Usuario, abonar_saldo, db, debitar_saldo, registrar_movimiento, servicio_tokens
+
+CEDULAS = itertools.count(900000201)
+
+@pytest.fixture
+def usuario_con_token(contexto):
+    usuario = Usuario(NOMBRE="Luis Libro", CEDULA=str(next(CEDULAS)), SALDO=0)
+    db.session.add(usuario)
+    db.session.flush()
+    token = servicio_tokens.emitir("RECARGA", usuario_id=usuario.ID)
+    db.session.commit()
+    return usuario.ID, token
+
+@pytest.mark.parametrize("monto", [-5000, 0, "nan", "inf", "-inf", "abc", None])
+def test_recarga_con_monto_invalido(cliente, usuario_con_token, monto):
+    usuario_id, token = usuario_con_token
+    respuesta = cliente.post("/api/recarga/procesar", json={"token": token, "monto": monto})
+    assert respuesta.status_code == 400
+    assert "monto" in respuesta.get_json()["error"]
+    # El token sigue pendiente y el libro no cambió
+    assert servicio_tokens.validar(token, "RECARGA")
+    assert MovimientoSaldo.query.filter_by(ID_USUARIO=usuario_id).count() == 0
+
+def test_recarga_valida(cliente, usuario_con_token):
+    usuario_id, token = usuario_con_token
+    assert cliente.post("/api/recarga/procesar", json={"token": token, "monto": "5000"}).status_code == 200
+    db.session.rollback()
+    assert float(db.session.get(Usuario, usuario_id).SALDO) == 5000
+    assert [float(m.MONTO) for m in MovimientoSaldo.query.filter_by(ID_USUARIO=usuario_id)] == [5000]
+
+@pytest.mark.parametrize("monto", [-1, 0, math.nan, math.inf])
+def test_libro_rechaza_abonos_invalidos(usuario_con_token, monto):
+    usuario_id, _ = usuario_con_token
+    with pytest.raises(ValueError):
+        abonar_saldo(usuario_id, monto)
+    db.session.rollback()
+    assert float(db.session.get(Usuario, usuario_id).SALDO) == 0
+
+def test_libro_rechaza_montos_no_finitos(usuario_con_token):
+    usuario_id, _ = usuario_con_token
+    with pytest.raises(ValueError):
+        debitar_saldo(usuario_id, -1000)
+    with pytest.raises(ValueError):
+        registrar_movimiento(usuario_id, "AJUSTE", math.nan, None)
+    db.session.rollback()
@@ -0,0 +1,40 @@
+from datetime import datetime
+
+import pytest
+
+from BDPARQUEADERO import (PresupuestoConsultasExcedido, Transaccion, Usuario, consultar_estado_espacios, db,
+                           generar_recargas_dia, presupuesto_consultas as limitar_consultas)
+
+@pytest.fixture
+def recargas_de_hoy(contexto):
+    usuario = Usuario(NOMBRE="Prueba Recargas", CEDULA="900000001", SALDO=0, TARJETA_RFID="C0FFEE01")
+    db.session.add(usuario)
+    db.session.flush()
+    db.session.add_all([
+        Transaccion(ID_USUARIO=usuario.ID, TIPO="RECARGA", MONTO=10000, ESTADO="CONFIRMADA",
+                    FECHA=datetime.utcnow(), TOKEN=f"prueba-recarga-{indice}")
+        for indice in range(30)
+    ])
+    db.session.commit()
+    return datetime.utcnow().date()
+
+@pytest.mark.presupuesto_consultas(maximo=1)
+def test_recargas_del_dia_en_una_consulta(recargas_de_hoy, presupuesto_consultas):
+    assert len(generar_recargas_dia(recargas_de_hoy)) >= 30
+    assert len(presupuesto_consultas) == 1
+
+@pytest.mark.presupuesto_consultas(maximo=1)
+def test_estado_espacios_en_una_consulta(presupuesto_consultas):
+    assert consultar_estado_espacios()
+
+def test_presupuesto_detecta_n_mas_1(contexto):
+    with pytest.raises(PresupuestoConsultasExcedido, match="4 veces desde"):
+        with limitar_consultas(repeticiones=2):
+            for usuario_id in range(1, 5):
+                Usuario.query.filter_by(ID=usuario_id).first()
+
+def test_presupuesto_detecta_exceso_de_sentencias(contexto):
+    with pytest.raises(PresupuestoConsultasExcedido, match="2 sentencias"):
+        with limitar_consultas(maximo=1):
+            Usuario.query.count()
+            Transaccion.query.count()
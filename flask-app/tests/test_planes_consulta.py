@@ -0,0 +1,108 @@
+import os
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+from flask import Flask
+from sqlalchemy import text
+
+from BDPARQUEADERO import MIGRACIONES, aplicar_migraciones, db, verificar_planes_consulta
+
+# Esquema que creaba db.create_all() antes de las migraciones versionadas (user_version 0)
+ESQUEMA_ORIGINAL = """
+CREATE TABLE USUARIO (
+    ID INTEGER NOT NULL, NOMBRE VARCHAR NOT NULL, CEDULA VARCHAR(20) NOT NULL, SALDO NUMERIC(10, 2),
+    TELEFONO VARCHAR(15), EMAIL VARCHAR(100), FECHA_REGISTRO DATETIME, TARJETA_RFID VARCHAR(20),
+    PRIMARY KEY (ID), UNIQUE (CEDULA), UNIQUE (TARJETA_RFID));
+CREATE TABLE TARIFA (
+    ID INTEGER NOT NULL, TIPO_VEHICULO VARCHAR(20) NOT NULL, TARIFA_HORA NUMERIC(10, 2) NOT NULL,
+    TARIFA_MINIMA NUMERIC(10, 2), ACTIVA BOOLEAN, PRIMARY KEY (ID));
+CREATE TABLE ESPACIO (
+    ID INTEGER NOT NULL, NUMERO VARCHAR(10) NOT NULL, TIPO_VEHICULO VARCHAR(20), ESTADO VARCHAR(20),
+    ID_ENTRADA_ACTUAL INTEGER, SENSOR_PIN INTEGER NOT NULL, ULTIMA_DETECCION DATETIME,
+    PRIMARY KEY (ID), UNIQUE (NUMERO), FOREIGN KEY(ID_ENTRADA_ACTUAL) REFERENCES ENTRADA (ID));
+CREATE TABLE ENTRADA (
+    ID INTEGER NOT NULL, ID_USUARIO INTEGER NOT NULL, ID_VEHICULO INTEGER NOT NULL, ID_ESPACIO INTEGER,
+    FECHA_ENTRADA DATETIME, FECHA_SALIDA DATETIME, ESTADO VARCHAR(20), MONTO_COBRADO NUMERIC(10, 2),
+    TIEMPO_ESTACIONADO VARCHAR(20), FACTURA_GENERADA BOOLEAN, PRIMARY KEY (ID),
+    FOREIGN KEY(ID_USUARIO) REFERENCES USUARIO (ID), FOREIGN KEY(ID_VEHICULO) REFERENCES VEHICULO (ID),
+    FOREIGN KEY(ID_ESPACIO) REFERENCES ESPACIO (ID));
+CREATE TABLE VEHICULO (
+    ID INTEGER NOT NULL, PLACA VARCHAR(10) NOT NULL, TIPO VARCHAR(20), ID_USUARIO INTEGER NOT NULL,
+    COLOR VARCHAR(20), MARCA VARCHAR(30), PRIMARY KEY (ID), UNIQUE (PLACA),
+    FOREIGN KEY(ID_USUARIO) REFERENCES USUARIO (ID));
+CREATE TABLE TRANSACCION (
+    ID INTEGER NOT NULL, ID_USUARIO INTEGER, TIPO VARCHAR(20) NOT NULL, MONTO NUMERIC(10, 2),
+    ESTADO VARCHAR(20), FECHA DATETIME, TOKEN VARCHAR(50), TARJETA_RFID VARCHAR(20),
+    PRIMARY KEY (ID), FOREIGN KEY(ID_USUARIO) REFERENCES USUARIO (ID), UNIQUE (TOKEN));
+"""
+
+def fecha(momento):
+    return momento.strftime("%Y-%m-%d %H:%M:%S.%f")
+
+@pytest.fixture
+def base_original(tmp_path):
+    """Base con el esquema original y algunos datos: un usuario con saldo, una salida y una entrada activa"""
+    ruta = str(tmp_path / "original.db")
+    ahora = datetime.utcnow()
+    conexion = sqlite3.connect(ruta)
+    conexion.executescript(ESQUEMA_ORIGINAL)
+    conexion.executescript(f"""
+        INSERT INTO USUARIO VALUES (1, 'Juan Perez', '1234567', 15000, '3123456789', 'j@x.com',
+                                    '{fecha(ahora - timedelta(days=3))}', 'ABC1');
+        INSERT INTO VEHICULO VALUES (1, 'ABC123', 'CARRO', 1, 'Rojo', 'Mazda');
+        INSERT INTO TARIFA VALUES (1, 'CARRO', 5000, 5000, 1);
+        INSERT INTO ESPACIO VALUES (1, 'A1', 'CARRO', 'OCUPADO', 2, 1, NULL);
+        INSERT INTO ESPACIO VALUES (2, 'A2', 'CARRO', 'DISPONIBLE', NULL, 2, NULL);
+        INSERT INTO ENTRADA VALUES (1, 1, 1, 2, '{fecha(ahora - timedelta(days=2, hours=3))}',
+                                    '{fecha(ahora - timedelta(days=2, hours=1))}', 'FINALIZADA', 10000, '2:00:00', 1);
+        INSERT INTO ENTRADA VALUES (2, 1, 1, 1, '{fecha(ahora - timedelta(hours=1))}', NULL, 'ACTIVA', NULL, NULL, 0);
+        INSERT INTO TRANSACCION VALUES (1, 1, 'RECARGA', 25000, 'CONFIRMADA',
+                                        '{fecha(ahora - timedelta(days=3))}', 'tok1', NULL);
+    """)
+    conexion.commit()
+    conexion.close()
+    return ruta
+
+@pytest.fixture
+def contexto_base(base_original):
+    """db ligado a la base original (otra app Flask), para migrarla en sitio"""
+    otra = Flask("migracion_original")
+    otra.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{base_original}"
+    db.init_app(otra)
+    with otra.app_context():
+        yield base_original
+        db.session.remove()
+        db.engine.dispose()
+
+def problemas_de_planes():
+    return {resultado["consulta"]: resultado["plan"] for resultado in verificar_planes_consulta()
+            if not resultado["ok"]}
+
+def test_consultas_calientes_sin_scan(contexto):
+    assert aplicar_migraciones() == MIGRACIONES[-1][0]
+    assert problemas_de_planes() == {}
+
+def test_migra_base_original_sin_perder_datos(contexto_base):
+    assert aplicar_migraciones() == MIGRACIONES[-1][0]
+
+    with db.engine.connect() as conexion:
+        assert conexion.execute(text("PRAGMA user_version")).scalar() == MIGRACIONES[-1][0]
+        assert conexion.execute(text(
+            "SELECT NOMBRE, CEDULA, SALDO, TARJETA_RFID FROM USUARIO")).all() == [("Juan Perez", "1234567", 15000, "ABC1")]
+        assert conexion.execute(text("SELECT PLACA, ID_USUARIO FROM VEHICULO")).all() == [("ABC123", 1)]
+        assert conexion.execute(text("SELECT ID, ESTADO FROM ENTRADA ORDER BY ID")).all() == [
+            (1, "FINALIZADA"), (2, "ACTIVA")]
+        assert conexion.execute(text("SELECT TOKEN, MONTO FROM TRANSACCION")).all() == [("tok1", 25000)]
+        assert conexion.execute(text(
+            "SELECT NUMERO, ESTADO, ID_ENTRADA_ACTUAL, CONTROLADOR FROM ESPACIO ORDER BY ID")).all() == [
+            ("A1", "OCUPADO", 2, "PRINCIPAL"), ("A2", "DISPONIBLE", None, "PRINCIPAL")]
+        # El saldo existente abre el libro y los contadores se reconstruyen desde el historial
+        assert conexion.execute(text(
+            "SELECT ID_USUARIO, TIPO, MONTO FROM MOVIMIENTO_SALDO")).all() == [(1, "APERTURA", 15000)]
+        assert conexion.execute(text("SELECT SUM(ENTRADAS), SUM(SALIDAS) FROM CONTADOR_DIARIO")).one() == (2, 1)
+        assert conexion.execute(text("SELECT FRACCION_MINUTOS, REDONDEO FROM TARIFA")).all() == [(0, "ARRIBA")]
+
+    assert problemas_de_planes() == {}
+    # Volver a migrar no cambia nada
+    assert aplicar_migraciones() == MIGRACIONES[-1][0]
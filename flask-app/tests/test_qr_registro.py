@@ -0,0 +1,28 @@
+from datetime import datetime, timedelta
+
+from BDPARQUEADERO import VIGENCIA_TOKENS, Transaccion, db, servicio_tokens
+
+def emitir_registro(tarjeta):
+    token = servicio_tokens.emitir("REGISTRO", tarjeta_rfid=tarjeta)
+    db.session.commit()
+    return token
+
+def test_qr_de_registro_consumido(cliente, contexto):
+    token = emitir_registro("QR0001")
+    assert cliente.get(f"/qr/registro/{token}").status_code == 200
+    assert cliente.get(f"/qr/registro/{token}").status_code == 200  # Ya desde la caché
+
+    assert servicio_tokens.consumir(token, "REGISTRO")
+    db.session.commit()
+    assert cliente.get(f"/qr/registro/{token}").status_code == 404
+
+def test_qr_de_registro_vencido(cliente, contexto):
+    token = emitir_registro("QR0002")
+    assert cliente.get(f"/qr/registro/{token}").status_code == 200
+
+    # Vence en la base y en el índice, como si hubiera pasado la vigencia
+    vencido = Transaccion.query.filter_by(TOKEN=token).one().FECHA - timedelta(seconds=VIGENCIA_TOKENS["REGISTRO"] + 1)
+    Transaccion.query.filter_by(TOKEN=token).update({"FECHA": vencido})
+    db.session.commit()
+    servicio_tokens.purgar(datetime.utcnow() + timedelta(seconds=VIGENCIA_TOKENS["REGISTRO"] + 1))
+    assert cliente.get(f"/qr/registro/{token}").status_code == 404
@@ -0,0 +1,52 @@
+import itertools
+from datetime import datetime
+
+import pytest
+
+from BDPARQUEADERO import Entrada, Espacio, Usuario, Vehiculo, asignador_espacios, db, servicio_tokens
+
+TIPO = "PRUEBA_RECARGA"
+USUARIOS = itertools.count(1)
+
+@pytest.fixture
+def usuario_con_vehiculo(contexto):
+    numero = next(USUARIOS)
+    # Los espacios que dejó libres el test anterior salen de servicio: este test cuenta los suyos
+    Espacio.query.filter_by(TIPO_VEHICULO=TIPO).update({Espacio.ESTADO: "MANTENIMIENTO"})
+    usuario = Usuario(NOMBRE="Rita Recarga", CEDULA=f"90000040{numero}", SALDO=0)
+    db.session.add(usuario)
+    db.session.flush()
+    vehiculo = Vehiculo(ID_USUARIO=usuario.ID, PLACA=f"RCE00{numero}", TIPO=TIPO)
+    db.session.add(vehiculo)
+    db.session.add_all([Espacio(NUMERO=f"R{numero}-{pin}", TIPO_VEHICULO=TIPO, ESTADO="DISPONIBLE", SENSOR_PIN=pin,
+                                CONTROLADOR=f"{TIPO}_{numero}") for pin in (1, 2)])
+    token = servicio_tokens.emitir("RECARGA", usuario_id=usuario.ID)
+    db.session.commit()
+    asignador_espacios.recargar_tipo(TIPO)
+    return usuario.ID, vehiculo.ID, token
+
+def test_recarga_crea_la_entrada(cliente, usuario_con_vehiculo):
+    usuario_id, _, token = usuario_con_vehiculo
+    datos = cliente.post("/api/recarga/procesar", json={"token": token, "monto": 10000}).get_json()
+    assert datos["entrada_automatica"] is True and datos["vehiculo"].startswith("RCE")
+    db.session.rollback()
+    assert Entrada.query.filter_by(ID_USUARIO=usuario_id, ESTADO="ACTIVA").count() == 1
+
+def test_recarga_contra_un_toque_en_la_barrera(cliente, usuario_con_vehiculo, monkeypatch):
+    usuario_id, vehiculo_id, token = usuario_con_vehiculo
+    consumir = servicio_tokens.consumir
+
+    def toque_antes_del_turno(*args, **kwargs):
+        # La barrera registra la entrada después de que la recarga leyó y antes de su escritura
+        espacio = asignador_espacios.reclamar(TIPO)
+        db.session.add(Entrada(ID_USUARIO=usuario_id, ID_VEHICULO=vehiculo_id, ID_ESPACIO=espacio["id"],
+                               FECHA_ENTRADA=datetime.utcnow(), ESTADO="ACTIVA"))
+        db.session.flush()
+        return consumir(*args, **kwargs)
+    monkeypatch.setattr(servicio_tokens, "consumir", toque_antes_del_turno)
+
+    datos = cliente.post("/api/recarga/procesar", json={"token": token, "monto": 10000}).get_json()
+    assert datos["entrada_automatica"] is False and datos["nuevo_saldo"] == 10000
+    db.session.rollback()
+    assert Entrada.query.filter_by(ID_USUARIO=usuario_id, ESTADO="ACTIVA").count() == 1
+    assert Espacio.query.filter_by(TIPO_VEHICULO=TIPO, ESTADO="DISPONIBLE").count() == 1
@@ -0,0 +1,21 @@
+from BDPARQUEADERO import Transaccion, Usuario, Vehiculo, db, obtener_ip_servidor
+
+def test_recarga_por_placa(cliente, contexto):
+    usuario = Usuario(NOMBRE="Ana Recarga", CEDULA="900000101", SALDO=7000)
+    db.session.add(usuario)
+    db.session.flush()
+    db.session.add(Vehiculo(ID_USUARIO=usuario.ID, PLACA="RCG123", TIPO="CARRO"))
+    db.session.commit()
+
+    respuesta = cliente.get("/api/recarga/generar/rcg123")
+    assert respuesta.status_code == 200
+    datos = respuesta.get_json()
+    assert (datos["usuario"], datos["placa"], datos["saldo_actual"]) == ("Ana Recarga", "RCG123", 7000.0)
+    token = datos["url_recarga"].rsplit("/", 1)[1]
+    assert datos["url_recarga"] == f"http://{obtener_ip_servidor()}:5000/recarga/{token}"
+    assert datos["qr_url"] == f"http://{obtener_ip_servidor()}:5000/qr/recarga/{token}"
+    transaccion = Transaccion.query.filter_by(TOKEN=token).one()
+    assert (transaccion.ID_USUARIO, transaccion.TIPO, transaccion.ESTADO) == (usuario.ID, "RECARGA", "PENDIENTE")
+
+def test_recarga_de_placa_desconocida(cliente):
+    assert cliente.get("/api/recarga/generar/NOEXISTE").status_code == 404
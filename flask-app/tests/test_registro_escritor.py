@@ -0,0 +1,66 @@
+import itertools
+import threading
+
+import pytest
+from sqlalchemy import event
+
+from BDPARQUEADERO import (Entrada, Espacio, EscrituraVencida, Usuario, asignador_espacios, db, escritor_unico,
+                           indice_rfid, servicio_tokens)
+
+TIPO = "PRUEBA_REGISTRO"
+REGISTROS = itertools.count(1)
+
+@pytest.fixture
+def registro(contexto):
+    """Token de registro de una tarjeta nueva y el formulario que lo completa"""
+    numero = next(REGISTROS)
+    tarjeta = f"EE{numero:06d}"
+    token = servicio_tokens.emitir("REGISTRO", tarjeta_rfid=tarjeta)
+    db.session.commit()
+    return tarjeta, {
+        "token": token, "nombre": "Nora Nueva", "cedula": f"90000050{numero}", "telefono": f"31200000{numero:02d}",
+        "email": f"nora{numero}@correo.com", "placa": f"NRA{numero:03d}", "marca": "Renault", "color": "Gris",
+        "tipo_vehiculo": TIPO
+    }
+
+@pytest.fixture
+def un_espacio(contexto):
+    db.session.add(Espacio(NUMERO="G1", TIPO_VEHICULO=TIPO, ESTADO="DISPONIBLE", SENSOR_PIN=1, CONTROLADOR=TIPO))
+    db.session.commit()
+    asignador_espacios.recargar_tipo(TIPO)
+
+def test_registro_por_el_escritor(cliente, registro, un_espacio):
+    tarjeta, formulario = registro
+    hilos = set()
+    def anotar_hilo(conexion, cursor, sentencia, *args):
+        if sentencia.lstrip().startswith(('INSERT INTO "USUARIO"', 'INSERT INTO "ENTRADA"')):
+            hilos.add(threading.current_thread().name)
+    event.listen(db.engine, "before_cursor_execute", anotar_hilo)
+    try:
+        respuesta = cliente.post("/api/registro/completar", json=formulario)
+    finally:
+        event.remove(db.engine, "before_cursor_execute", anotar_hilo)
+
+    assert respuesta.status_code == 200, respuesta.get_json()
+    assert respuesta.get_json()["espacio_asignado"] == "G1"
+    assert hilos == {"escritor-unico"}
+    usuario = Usuario.query.filter_by(TARJETA_RFID=tarjeta).one()
+    assert Entrada.query.filter_by(ID_USUARIO=usuario.ID, ESTADO="ACTIVA").count() == 1
+    assert indice_rfid.obtener(tarjeta)["entrada"]["espacio"] == "G1"
+    # El token ya se usó
+    assert cliente.post("/api/registro/completar", json=formulario).status_code == 400
+
+def test_registro_sin_espacio_no_gasta_el_token(cliente, registro):
+    tarjeta, formulario = registro
+    respuesta = cliente.post("/api/registro/completar", json=formulario)
+    assert respuesta.status_code == 400
+    assert "espacios" in respuesta.get_json()["error"]
+    assert servicio_tokens.validar(formulario["token"], "REGISTRO")
+    assert Usuario.query.filter_by(TARJETA_RFID=tarjeta).count() == 0
+
+def test_registro_sin_turno_responde_503(cliente, registro, monkeypatch):
+    def vencida(*args, **kwargs):
+        raise EscrituraVencida("La escritura esperó más de 2.0 s en la cola")
+    monkeypatch.setattr(escritor_unico, "ejecutar", vencida)
+    _, formulario = registro
+    assert cliente.post("/api/registro/completar", json=formulario).status_code == 503
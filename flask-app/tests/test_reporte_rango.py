@@ -0,0 +1,33 @@
+from datetime import timedelta
+
+from BDPARQUEADERO import (DIAS_CIERRE_AUTOMATICO, MAXIMO_DIAS_RANGO, ResumenDiario, barredor_transacciones, db,
+                           hoy_utc)
+
+def filas_resumen():
+    db.session.rollback()  # Lo que confirmó otro hilo
+    return {fila.FECHA for fila in ResumenDiario.query}
+
+def test_rango_con_maximo_de_dias(cliente):
+    respuesta = cliente.get("/api/reportes/rango-fechas/excel?inicio=2016-01-01&fin=2026-10-17")
+    assert respuesta.status_code == 400
+    assert str(MAXIMO_DIAS_RANGO) in respuesta.get_json()["error"]
+
+    fin = hoy_utc()
+    inicio = fin - timedelta(days=MAXIMO_DIAS_RANGO - 1)
+    respuesta = cliente.get(f"/api/reportes/rango-fechas/excel?inicio={inicio}&fin={fin}")
+    assert respuesta.status_code == 200
+
+def test_rango_no_guarda_dias_cerrados(cliente, contexto):
+    antes = filas_resumen()
+    fin = hoy_utc() - timedelta(days=40)
+    respuesta = cliente.get(f"/api/reportes/rango-fechas/excel?inicio={fin - timedelta(days=29)}&fin={fin}")
+    assert respuesta.status_code == 200
+    assert filas_resumen() == antes
+
+def test_barredor_cierra_los_dias_recientes(contexto):
+    hoy = hoy_utc()
+    recientes = {hoy - timedelta(days=dias) for dias in range(1, DIAS_CIERRE_AUTOMATICO + 1)}
+    barredor_transacciones.barrer()
+    assert recientes <= filas_resumen()
+    assert hoy not in filas_resumen()
+    assert barredor_transacciones.barrer()["dias_cerrados"] == 0
@@ -0,0 +1,70 @@
+import sqlite3
+from datetime import date, datetime, time, timedelta
+
+import pytest
+
+from BDPARQUEADERO import PRESUPUESTO_CONSULTAS, db, db_path
+
+ESCALAS = (10, 1000)
+
+def fecha(momento):
+    return momento.strftime("%Y-%m-%d %H:%M:%S.%f")
+
+def sembrar(dia, filas, prefijo):
+    """`filas` usuarios nuevos, entradas cobradas, recargas y espacios ocupados en el día.
+    Va por sqlite3 directo: no pasa por SQLAlchemy y no cuenta en el presupuesto."""
+    conexion = sqlite3.connect(db_path, timeout=10)
+    try:
+        siguiente = lambda tabla: conexion.execute(f"SELECT COALESCE(MAX(ID), 0) + 1 FROM {tabla}").fetchone()[0]
+        usuario, entrada, espacio = siguiente("USUARIO"), siguiente("ENTRADA"), siguiente("ESPACIO")
+        mediodia = datetime.combine(dia, time(12))
+        conexion.executemany(
+            "INSERT INTO USUARIO (ID, NOMBRE, CEDULA, SALDO, FECHA_REGISTRO, TARJETA_RFID) VALUES (?, ?, ?, 0, ?, ?)",
+            [(usuario + i, f"Usuario {prefijo}{i}", f"{prefijo}{i:06d}", fecha(mediodia), f"{prefijo}{i:06X}")
+             for i in range(filas)])
+        conexion.executemany(
+            "INSERT INTO VEHICULO (ID_USUARIO, PLACA, TIPO) VALUES (?, ?, 'CARRO')",
+            [(usuario + i, f"{prefijo}{i:04d}") for i in range(filas)])
+        conexion.executemany(
+            "INSERT INTO ESPACIO (ID, NUMERO, TIPO_VEHICULO, ESTADO, SENSOR_PIN, CONTROLADOR, ID_ENTRADA_ACTUAL) "
+            "VALUES (?, ?, 'CARRO', 'OCUPADO', ?, ?, ?)",
+            [(espacio + i, f"{prefijo}{i}", i + 1, f"REPORTES_{prefijo}", entrada + i) for i in range(filas)])
+        conexion.executemany(
+            "INSERT INTO ENTRADA (ID, ID_USUARIO, ID_VEHICULO, ID_ESPACIO, FECHA_ENTRADA, FECHA_SALIDA, ESTADO, "
+            "MONTO_COBRADO, TIEMPO_ESTACIONADO, FACTURA_GENERADA) "
+            "SELECT ?, ?, V.ID, ?, ?, ?, 'FINALIZADA', 5000, '1:00:00', 0 FROM VEHICULO V WHERE V.ID_USUARIO = ?",
+            [(entrada + i, usuario + i, espacio + i, fecha(mediodia), fecha(mediodia + timedelta(hours=1)), usuario + i)
+             for i in range(filas)])
+        conexion.executemany(
+            "INSERT INTO TRANSACCION (ID_USUARIO, TIPO, MONTO, ESTADO, FECHA, TOKEN) "
+            "VALUES (?, 'RECARGA', 10000, 'CONFIRMADA', ?, ?)",
+            [(usuario + i, fecha(mediodia), f"reporte-{prefijo}{i}") for i in range(filas)])
+        conexion.commit()
+    finally:
+        conexion.close()
+
+@pytest.mark.presupuesto_consultas(
+    maximo=len(ESCALAS) * sum(presupuesto for _, _, presupuesto in PRESUPUESTO_CONSULTAS))
+def test_generadores_con_consultas_constantes(presupuesto_consultas):
+    consultas = {}
+    filas_por_generador = {}
+    for numero, filas in enumerate(ESCALAS):
+        # Un día cerrado por escala: los de una escala no se mezclan con los de la otra
+        dia = date.today() - timedelta(days=10 + numero)
+        sembrar(dia, filas, prefijo=f"R{numero}")
+        db.session.rollback()
+        for nombre, generador, presupuesto in PRESUPUESTO_CONSULTAS:
+            antes = len(presupuesto_consultas)
+            datos = generador(dia)
+            consultas.setdefault(nombre, []).append(len(presupuesto_consultas) - antes)
+            filas_por_generador.setdefault(nombre, []).append(len(datos) if isinstance(datos, list) else 1)
+
+    for nombre, _, presupuesto in PRESUPUESTO_CONSULTAS:
+        assert len(set(consultas[nombre])) == 1, f"{nombre}: {consultas[nombre]} sentencias con {ESCALAS} filas"
+        assert consultas[nombre][0] <= presupuesto, f"{nombre}: {consultas[nombre][0]} sentencias"
+    # Las hojas por día y los espacios sí crecieron con la siembra
+    for nombre in ("generar_entradas_dia", "generar_recargas_dia", "generar_facturas_dia", "generar_usuarios_nuevos"):
+        assert filas_por_generador[nombre] == list(ESCALAS), nombre
+    for nombre in ("generar_estado_espacios", "estado_espacios"):
+        con_10, con_1000 = filas_por_generador[nombre]
+        assert con_1000 - con_10 == ESCALAS[1], nombre
@@ -0,0 +1,5 @@
+# 🆕 PUNTO DE ENTRADA WSGI
+# gunicorn -c gunicorn.conf.py wsgi:app
+from BDPARQUEADERO import crear_app
+
+app = crear_app()